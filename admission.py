@@ -0,0 +1,207 @@
+"""
+Admission control for the send endpoints.
+
+Requests are admitted against separate concurrency budgets so one kind of
+traffic cannot starve another: a burst of broadcasts can use at most the
+bulk budget, leaving the interactive budget (registrations, single sends)
+free. A request that finds its budget full waits briefly in a bounded queue
+and is otherwise rejected with AdmissionRejected (HTTP 429).
+
+Delivery is also capped by the number of device tokens in flight, which
+bounds the memory held by concurrent fan-outs. HTTP requests over the cap
+are rejected; background senders (scheduler, rollouts) wait for room.
+
+Budgets are per worker process; multiply by the gunicorn worker count for
+the instance-wide limits.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from metrics import ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_REJECTED, TOKENS_IN_FLIGHT
+
+BULK = "bulk"
+INTERACTIVE = "interactive"
+
+BULK_CONCURRENCY = int(os.getenv('BULK_SEND_CONCURRENCY', '4'))
+INTERACTIVE_CONCURRENCY = int(os.getenv('INTERACTIVE_CONCURRENCY', '16'))
+
+# Requests allowed to wait for a slot, and how long they wait
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '16'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '2'))
+
+MAX_TOKENS_IN_FLIGHT = int(os.getenv('MAX_TOKENS_IN_FLIGHT', '100000'))
+
+# Retry-After sent with a 429
+ADMISSION_RETRY_AFTER = float(os.getenv('ADMISSION_RETRY_AFTER', '2'))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is over its budget."""
+
+    def __init__(self, budget: str, retry_after: float = ADMISSION_RETRY_AFTER):
+        self.budget = budget
+        self.retry_after = retry_after
+        super().__init__(f"Too many concurrent {budget} requests, retry after {retry_after:.0f}s")
+
+
+class ConcurrencyBudget:
+    """
+    Counting semaphore with a bounded, time-limited wait queue.
+
+    Args:
+        name: Budget name used in errors and metrics
+        limit: Requests allowed to run at once
+        max_queue: Requests allowed to wait for a slot
+        queue_timeout: Seconds a request waits before it is rejected
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._rejected = 0
+
+    def acquire(self) -> None:
+        """
+        Take a slot, waiting up to queue_timeout if the budget is full.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait timed out
+        """
+        with self._cond:
+            if self._active >= self.limit:
+                if self._queued >= self.max_queue:
+                    self._reject()
+                self._queued += 1
+                ADMISSION_QUEUED.labels(budget=self.name).inc()
+                try:
+                    admitted = self._cond.wait_for(lambda: self._active < self.limit, self.queue_timeout)
+                finally:
+                    self._queued -= 1
+                    ADMISSION_QUEUED.labels(budget=self.name).dec()
+                if not admitted:
+                    self._reject()
+            self._active += 1
+            ADMISSION_ACTIVE.labels(budget=self.name).inc()
+
+    def release(self) -> None:
+        """Return a slot taken with acquire()."""
+        with self._cond:
+            self._active -= 1
+            ADMISSION_ACTIVE.labels(budget=self.name).dec()
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Context manager form of acquire()/release()."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current usage for health output."""
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "active": self._active,
+                "queued": self._queued,
+                "rejected": self._rejected
+            }
+
+    def _reject(self) -> None:
+        self._rejected += 1
+        ADMISSION_REJECTED.labels(budget=self.name).inc()
+        raise AdmissionRejected(self.name)
+
+
+class TokenBudget:
+    """
+    Cap on device tokens being delivered at once.
+
+    A single delivery larger than the cap is still admitted when nothing else
+    is in flight, so no audience is too big to ever be sent.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._rejected = 0
+
+    @contextmanager
+    def reserve(self, count: int, wait: bool = False, timeout: Optional[float] = None) -> Iterator[None]:
+        """
+        Hold count tokens of the budget for the duration of the block.
+
+        Args:
+            count: Tokens about to be delivered
+            wait: Wait for room instead of rejecting
+            timeout: Maximum wait in seconds (None waits indefinitely)
+
+        Raises:
+            AdmissionRejected: If there is no room (and wait is False or timed out)
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fits(count), timeout if wait else 0):
+                raise self.reject()
+            self._in_flight += count
+            TOKENS_IN_FLIGHT.inc(count)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= count
+                TOKENS_IN_FLIGHT.dec(count)
+                self._cond.notify_all()
+
+    def room(self) -> Optional[int]:
+        """
+        Largest delivery that would be admitted now, or None if any size would.
+
+        Audience queries stop reading once they pass this, so an audience that
+        cannot be admitted is rejected without being fetched in full.
+        """
+        with self._cond:
+            if self._in_flight == 0:
+                return None
+            return max(0, self.limit - self._in_flight)
+
+    def reject(self) -> AdmissionRejected:
+        """Count a rejection and return the error to raise."""
+        with self._cond:
+            self._rejected += 1
+        ADMISSION_REJECTED.labels(budget="tokens").inc()
+        return AdmissionRejected("tokens")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current usage for health output."""
+        with self._cond:
+            return {"limit": self.limit, "in_flight": self._in_flight, "rejected": self._rejected}
+
+    def _fits(self, count: int) -> bool:
+        return self._in_flight == 0 or self._in_flight + count <= self.limit
+
+
+BUDGETS = {
+    BULK: ConcurrencyBudget(BULK, BULK_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT),
+    INTERACTIVE: ConcurrencyBudget(INTERACTIVE, INTERACTIVE_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+}
+
+TOKENS = TokenBudget(MAX_TOKENS_IN_FLIGHT)
+
+
+def snapshot_all() -> Dict[str, Any]:
+    """Usage of every budget, for /api/health."""
+    result = {name: budget.snapshot() for name, budget in BUDGETS.items()}
+    result["tokens"] = TOKENS.snapshot()
+    return result
@@ -0,0 +1,163 @@
+"""
+Named API keys with per-key rate limits.
+
+Keys are configured as JSON, in the API_KEYS variable or the file named by
+API_KEYS_FILE:
+
+    {
+        "billing":  {"key": "k_live_...", "requests_per_second": 20, "tokens_per_minute": 200000},
+        "alerts":   {"key": "k_live_...", "requests_per_second": 5},
+        "internal": "k_live_..."
+    }
+
+Limits left out are unlimited. The single legacy API_KEY keeps working as a
+key named "default" (limits from API_KEY_REQUESTS_PER_SECOND and
+API_KEY_TOKENS_PER_MINUTE). With no keys configured authentication is off.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+import rate_limit
+from metrics import API_KEY_RATE_LIMITED, API_KEY_REQUESTS, API_KEY_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Seconds of traffic a key may send in one burst above its steady rate
+RATE_LIMIT_BURST_SECONDS = float(os.getenv('RATE_LIMIT_BURST_SECONDS', '1'))
+
+
+class RateLimited(Exception):
+    """Raised when an API key is over one of its limits."""
+
+    def __init__(self, key_name: str, limit: str, retry_after: float):
+        self.key_name = key_name
+        self.limit = limit
+        self.retry_after = retry_after
+        super().__init__(f"Rate limit exceeded for API key '{key_name}' ({limit}), retry after {retry_after:.0f}s")
+
+
+def _optional_float(value: Any) -> Optional[float]:
+    return float(value) if value not in (None, '') else None
+
+
+def parse_keys(config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Build the key registry from a {name: key or {key, limits...}} mapping.
+
+    Returns:
+        Keys indexed by the SHA-256 digest of the secret
+
+    Raises:
+        ValueError: If an entry has no key or a limit is not a positive number
+    """
+    keys = {}
+    for name, entry in config.items():
+        if isinstance(entry, str):
+            entry = {"key": entry}
+        if not isinstance(entry, dict) or not entry.get("key"):
+            raise ValueError(f"API key '{name}' has no key")
+        key = {
+            "name": name,
+            "requests_per_second": _optional_float(entry.get("requests_per_second")),
+            "tokens_per_minute": _optional_float(entry.get("tokens_per_minute"))
+        }
+        for limit in ("requests_per_second", "tokens_per_minute"):
+            if key[limit] is not None and key[limit] <= 0:
+                raise ValueError(f"API key '{name}': {limit} must be positive")
+        keys[_digest(entry["key"])] = key
+    return keys
+
+
+def _load_from_env() -> Dict[str, Dict[str, Any]]:
+    config = {}
+    legacy_key = os.getenv('API_KEY', '')
+    if legacy_key:
+        config["default"] = {
+            "key": legacy_key,
+            "requests_per_second": os.getenv('API_KEY_REQUESTS_PER_SECOND'),
+            "tokens_per_minute": os.getenv('API_KEY_TOKENS_PER_MINUTE')
+        }
+    keys_file = os.getenv('API_KEYS_FILE', '')
+    if keys_file:
+        with open(keys_file, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    if os.getenv('API_KEYS'):
+        config.update(json.loads(os.getenv('API_KEYS')))
+    keys = parse_keys(config)
+    if keys:
+        logger.info(f"Loaded {len(keys)} API key(s): {', '.join(sorted(k['name'] for k in keys.values()))}")
+    return keys
+
+
+_keys = _load_from_env()
+
+
+def enabled() -> bool:
+    """Whether any API key is configured (authentication is required)."""
+    return bool(_keys)
+
+
+def authenticate(provided: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Look up the key a caller presented.
+
+    Returns:
+        The key's settings (name and limits), or None if it is not a known key
+    """
+    if not provided:
+        return None
+    return _keys.get(_digest(provided))
+
+
+def get_key(name: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Look up a key by name, e.g. the key that started a background job."""
+    if name is None:
+        return None
+    return next((key for key in _keys.values() if key["name"] == name), None)
+
+
+def check_request(key: Dict[str, Any]) -> None:
+    """
+    Count a request against the key's requests-per-second limit.
+
+    Raises:
+        RateLimited: If the key is over its request rate
+    """
+    API_KEY_REQUESTS.labels(key=key["name"]).inc()
+    rate = key["requests_per_second"]
+    if rate is None:
+        return
+    wait = rate_limit.take(f"requests:{key['name']}", rate, max(1.0, rate * RATE_LIMIT_BURST_SECONDS))
+    if wait:
+        API_KEY_RATE_LIMITED.labels(key=key["name"], limit="requests").inc()
+        raise RateLimited(key["name"], "requests_per_second", wait)
+
+
+def charge_tokens(key: Optional[Dict[str, Any]], count: int) -> None:
+    """
+    Count a fan-out's audience against the key's tokens-per-minute limit.
+
+    Args:
+        key: The caller's key, or None when authentication is off
+        count: Device tokens about to be sent to
+
+    Raises:
+        RateLimited: If the key is over its token rate
+    """
+    if key is None:
+        return
+    rate = key["tokens_per_minute"]
+    if rate is not None:
+        wait = rate_limit.take(f"tokens:{key['name']}", rate / 60.0, rate, cost=count)
+        if wait:
+            API_KEY_RATE_LIMITED.labels(key=key["name"], limit="tokens").inc()
+            raise RateLimited(key["name"], "tokens_per_minute", wait)
+    API_KEY_TOKENS.labels(key=key["name"]).inc(count)
+
+
+def _digest(secret: str) -> str:
+    # Keys are matched by digest so the lookup does not compare secrets byte by byte
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
@@ -3,23 +3,42 @@ Main Flask application for FCM Notification Microservice.
 """
 
 import os
+import json
+import math
+import time
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
 from dotenv import load_dotenv
 from datetime import datetime
 import firebase_service
 import token_manager
 import app_configs
+import fanout
+import outbox
+import ledger
+import engagement
+import segments
+import templates
+import digest
+import scheduler
+import jobs
+import rollout
+import broadcasts
+import circuit_breaker
+import admission
+import api_keys
+import metrics
+import profiling
+import logging_config
+import shutdown
+from circuit_breaker import CircuitOpenError
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging (queued, JSON lines; see logging_config)
+logging_config.configure_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
@@ -33,42 +52,299 @@ if allowed_origins:
 else:
     CORS(app)  # Allow all origins
 
-# Optional API key authentication
-API_KEY = os.getenv('API_KEY', '')
-
-
 def check_api_key():
-    """Check if API key is required and validate it."""
-    if API_KEY:
+    """
+    Check if an API key is required, validate it and apply the key's request
+    rate limit. The caller's key is kept in g.api_key for token quotas.
+    
+    Endpoints with an admission budget are checked by admit_request before
+    they take a slot; the view's own call then returns None.
+    """
+    if g.get('api_key_checked'):
+        return None
+    if api_keys.enabled():
         provided_key = request.headers.get('X-API-Key') or request.headers.get('Authorization', '').replace('Bearer ', '')
-        if provided_key != API_KEY:
+        key = api_keys.authenticate(provided_key)
+        if key is None:
             return jsonify({
                 "success": False,
                 "error": "Invalid or missing API key"
             }), 401
+        g.api_key = key
+        try:
+            api_keys.check_request(key)
+        except api_keys.RateLimited as e:
+            return over_capacity(e)
+    g.api_key_checked = True
+    return None
+
+
+# Optional admin key for operational endpoints (request profiles); they are disabled without it
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY', '')
+
+
+def is_admin():
+    """Whether the request carries the admin key in X-Admin-Key."""
+    return bool(ADMIN_API_KEY) and request.headers.get('X-Admin-Key') == ADMIN_API_KEY
+
+
+def check_admin_key():
+    """Require the admin key for admin endpoints."""
+    if not ADMIN_API_KEY:
+        return jsonify({
+            "success": False,
+            "error": "Admin API is disabled (ADMIN_API_KEY is not set)"
+        }), 403
+    if not is_admin():
+        return jsonify({
+            "success": False,
+            "error": "Invalid or missing admin key"
+        }), 401
     return None
 
 
+def dependency_unavailable(error, kind=None, payload=None):
+    """
+    Respond to a request rejected by an open circuit breaker.
+    
+    With the outbox fallback the send is queued for replay (202); otherwise the
+    caller gets a 503 with Retry-After so it can back off.
+    """
+    if kind and circuit_breaker.outbox_fallback():
+        entry_id = outbox.enqueue(kind, payload)
+        return jsonify({
+            "success": True,
+            "message": f"{error.name} unavailable, notification queued for delivery",
+            "queued": True,
+            "outbox_id": entry_id
+        }), 202
+    
+    response = jsonify({
+        "success": False,
+        "error": str(error)
+    })
+    response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response, 503
+
+
+def over_capacity(error):
+    """Respond to a request rejected by admission control or a key's rate limit: 429 with Retry-After."""
+    response = jsonify({
+        "success": False,
+        "error": str(error)
+    })
+    response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response, 429
+
+
+def schedule_send(kind, payload, data):
+    """
+    Schedule a send for its send_at time instead of sending now.
+    
+    send_at is an ISO 8601 datetime or a time of day ("09:00"); values without
+    a UTC offset are read in the optional timezone field (IANA name).
+    """
+    try:
+        due_at = scheduler.parse_send_at(str(data['send_at']), data.get('timezone'))
+        spread_seconds = data.get('spread_seconds')
+        if spread_seconds is not None:
+            spread_seconds = float(spread_seconds)
+            if spread_seconds < 0:
+                raise ValueError("spread_seconds must not be negative")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+    
+    # The key's token quota is charged for the audience when the job fires
+    api_key = g.get('api_key')
+    job = scheduler.schedule(
+        kind, payload, due_at, spread_seconds=spread_seconds, api_key=api_key['name'] if api_key else None
+    )
+    
+    return jsonify({
+        "success": True,
+        "message": "Notification scheduled",
+        "job_id": job["id"],
+        "send_at": job["due_at"]
+    }), 202
+
+
 def initialize_services():
-    """Initialize Firebase services."""
+    """Warm up Firebase in the background so the dev server starts serving immediately."""
     try:
-        firebase_service.initialize_firebase()
-        logger.info("Services initialized successfully")
+        token_manager.start_warm_up(background=True)
+        logger.info("Service warm-up started")
     except Exception as e:
         logger.error(f"Failed to initialize services: {str(e)}")
 
 
+@app.before_request
+def start_background_workers():
+    """Start the scheduled-delivery timer and app config watch in this worker if they are not running."""
+    scheduler.ensure_started()
+    app_configs.ensure_started(background=True)
+
+
+@app.before_request
+def start_request_timer():
+    """Start the request's clock and phase timings, and the profiler if requested or sampled."""
+    g.request_started = time.perf_counter()
+    g.timings_token = profiling.start_timings()
+    if (request.args.get('profile') == '1' and is_admin()) or profiling.should_sample():
+        g.profiler = profiling.start_profile()
+
+
+# Admission budget per endpoint: fan-outs are bulk, so a burst of them
+# cannot starve registrations and single sends
+ENDPOINT_BUDGETS = {
+    'send_to_app': admission.BULK,
+    'send_to_user': admission.BULK,
+    'broadcast': admission.BULK,
+    'send_template': admission.BULK,
+    'drain_outbox': admission.BULK,
+    'register_token': admission.INTERACTIVE,
+    'send_notification': admission.INTERACTIVE
+}
+
+# Endpoints refused once the worker starts shutting down
+SEND_ENDPOINTS = (
+    'send_notification', 'send_to_app', 'send_to_user', 'broadcast', 'send_template', 'drain_outbox', 'resume_job'
+)
+
+
+@app.before_request
+def admit_request():
+    """
+    Take a slot in the endpoint's admission budget, or reject with 429 (503
+    while shutting down). The API key is checked first so unauthenticated
+    requests never hold a slot.
+    """
+    if shutdown.draining() and request.endpoint in SEND_ENDPOINTS:
+        response = jsonify({
+            "success": False,
+            "error": "Service is shutting down, retry the request"
+        })
+        response.headers['Retry-After'] = str(shutdown.SHUTDOWN_RETRY_AFTER)
+        response.headers['Connection'] = 'close'
+        return response, 503
+    budget = ENDPOINT_BUDGETS.get(request.endpoint)
+    if budget is None:
+        return None
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    try:
+        admission.BUDGETS[budget].acquire()
+    except admission.AdmissionRejected as e:
+        return over_capacity(e)
+    g.admission_budget = budget
+    return None
+
+
+@app.teardown_request
+def release_admission(error=None):
+    """Return the request's admission slot."""
+    budget = g.pop('admission_budget', None)
+    if budget is not None:
+        admission.BUDGETS[budget].release()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe the request's latency under its route pattern (not the raw path)."""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            method=request.method,
+            route=route,
+            status=response.status_code
+        ).observe(time.perf_counter() - started)
+    return response
+
+
+@app.after_request
+def add_server_timing(response):
+    """Report per-phase durations in Server-Timing and store the request's profile, if any."""
+    token = g.pop('timings_token', None)
+    if token is None:
+        return response
+    
+    timings = profiling.finish_timings(token)
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    response.headers['Server-Timing'] = profiling.server_timing_header(timings, total_ms)
+    
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile-Id'] = profiling.save_profile(
+            profiler,
+            method=request.method,
+            route=request.url_rule.rule if request.url_rule else request.path,
+            status=response.status_code,
+            duration_ms=round(total_ms, 1),
+            timings={name: round(duration, 1) for name, duration in timings.items()}
+        )
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint (text exposition format, all workers merged)."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    # Refresh values that are read rather than counted
+    circuit_breaker.snapshot_all()
+    metrics.OUTBOX_PENDING.set(outbox.pending_count())
+    metrics.SCHEDULED_PENDING.set(scheduler.pending_count())
+    metrics.DIGEST_WINDOWS_OPEN.set(digest.open_windows())
+    
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
+    breakers = circuit_breaker.snapshot_all()
+    degraded = any(b["state"] != circuit_breaker.CLOSED for b in breakers.values())
     return jsonify({
-        "status": "healthy",
+        "status": "degraded" if degraded else "healthy",
         "service": "notification-service",
         "version": "1.0.0",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": datetime.utcnow().isoformat(),
+        "dependencies": breakers,
+        "outbox": {"pending": outbox.pending_count()},
+        "delivery_ledger": ledger.status(),
+        "engagement_events": engagement.status(),
+        "token_queries": token_manager.get_coalescing_stats(),
+        "admission": admission.snapshot_all(),
+        "logging": {"dropped": logging_config.dropped_count()},
+        "app_configs": app_configs.status(),
+        "templates": templates.status(),
+        "firebase_projects": firebase_service.project_names(),
+        "shutting_down": shutdown.draining()
     }), 200
 
 
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """
+    Readiness endpoint: 200 once Firebase is initialized and the Firestore
+    channel is warm, 503 before that. Used as the deploy health check so a new
+    instance only receives traffic when the first request will not pay for init.
+    A worker that is shutting down reports 503 so traffic moves elsewhere.
+    """
+    ready = not shutdown.draining() and (token_manager.is_ready() or token_manager.warm_up())
+    return jsonify({
+        "ready": ready,
+        "service": "notification-service"
+    }), 200 if ready else 503
+
+
 @app.route('/api/register-token', methods=['POST'])
 def register_token():
     """Register a device token with app_id and optional user_id."""
@@ -124,6 +400,8 @@ def register_token():
             "user_id": user_id
         }), 200
         
+    except CircuitOpenError as e:
+        return dependency_unavailable(e)
     except Exception as e:
         logger.error(f"Error registering token: {str(e)}")
         return jsonify({
@@ -132,6 +410,40 @@ def register_token():
         }), 500
 
 
+@app.route('/api/events', methods=['POST'])
+def ingest_events():
+    """
+    Record engagement events from service workers.
+    
+    Body: {"events": [{"type": "open" | "click" | "dismiss", "app_id": "...",
+    "token": "...", "notification_id": "..." (optional)}, ...]}. Invalid events
+    are skipped and counted; the rest are buffered and written in aggregate.
+    """
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    data = request.get_json(silent=True)
+    events = data.get('events') if isinstance(data, dict) else None
+    if not isinstance(events, list) or not events:
+        return jsonify({
+            "success": False,
+            "error": "events must be a non-empty list"
+        }), 400
+    if len(events) > engagement.EVENTS_MAX_BATCH:
+        return jsonify({
+            "success": False,
+            "error": f"At most {engagement.EVENTS_MAX_BATCH} events per request"
+        }), 400
+    
+    accepted, rejected = engagement.ingest(events)
+    return jsonify({
+        "success": True,
+        "accepted": accepted,
+        "rejected": rejected
+    }), 202
+
+
 @app.route('/api/send-notification', methods=['POST'])
 def send_notification():
     """Send notification to a single device token."""
@@ -177,8 +489,14 @@ def send_notification():
         badge = data.get('badge')
         custom_data = data.get('data', {})
         
-        # Send notification
-        response = firebase_service.send_push_notification(
+        if data.get('send_at'):
+            return schedule_send("send_single", {
+                "token": token, "title": title, "body": body, "app_id": app_id,
+                "icon": icon, "badge": badge, "data": custom_data
+            }, data)
+        
+        # Send notification (through the token's app's Firebase project)
+        result = fanout.send_single(
             token=token,
             title=title,
             body=body,
@@ -193,9 +511,15 @@ def send_notification():
         return jsonify({
             "success": True,
             "message": "Notification sent successfully",
-            "message_id": response
+            "message_id": result['message_id'],
+            "send_id": result['send_id']
         }), 200
         
+    except CircuitOpenError as e:
+        return dependency_unavailable(e, "send_single", {
+            "token": token, "title": title, "body": body, "app_id": app_id,
+            "icon": icon, "badge": badge, "data": custom_data
+        })
     except ValueError as e:
         logger.warning(f"Invalid request: {str(e)}")
         return jsonify({
@@ -257,57 +581,90 @@ def send_to_app():
         custom_data = data.get('data', {})
         icon = data.get('icon')  # Override app default if provided
         badge = data.get('badge')  # Override app default if provided
+        segment = data.get('segment')  # Filter by device_type, platform, last_active
+        
+        # Validate the segment now; relative bounds are resolved again when it is sent
+        filters = None
+        if segment is not None:
+            try:
+                filters = segments.parse(segment)
+            except ValueError as e:
+                return jsonify({
+                    "success": False,
+                    "error": str(e)
+                }), 400
         
-        # Get app configuration (for icon/badge defaults)
-        app_config = app_configs.get_app_config(app_id)
+        if data.get('send_at'):
+            return schedule_send("send_to_app", {
+                "app_id": app_id, "title": title, "body": body, "user_id": user_id,
+                "icon": icon, "badge": badge, "data": custom_data, "segment": segment
+            }, data)
         
-        # Optionally add title prefix from app config
-        if app_config.get('default_title_prefix') and not title.startswith(app_config['default_title_prefix']):
-            title = f"{app_config['default_title_prefix']} {title}"
+        # Apply app title prefix and icon/badge defaults
+        send_title, send_icon, send_badge = fanout.apply_app_defaults(app_id, title, icon, badge)
         
-        # Get all tokens for this app
-        tokens = token_manager.get_tokens_for_app(app_id=app_id, user_id=user_id)
+        # Get all tokens for this app, or the segment's through the query planner,
+        # rejecting once there are more than fit under the tokens-in-flight cap
+        plan = None
+        limit = admission.TOKENS.room()
+        if filters is not None:
+            tokens, plan = segments.find_tokens(app_id, filters, user_id=user_id, limit=limit)
+        else:
+            tokens = token_manager.get_tokens_for_app(app_id=app_id, user_id=user_id, limit=limit)
         
         if not tokens:
-            logger.warning(f"No tokens found for app_id: {app_id}, user_id: {user_id}")
-            return jsonify({
+            logger.warning(f"No tokens found for app_id: {app_id}, user_id: {user_id}, segment: {segment}")
+            response = {
                 "success": True,
                 "message": "No devices registered for this app",
                 "app_id": app_id,
                 "sent_to": 0,
                 "tokens": []
-            }), 200
+            }
+            if plan is not None:
+                response["segment"] = plan
+            return jsonify(response), 200
         
-        # Use app-specific icon/badge if not overridden
-        if icon is None:
-            icon = app_config.get('icon')
-        if badge is None:
-            badge = app_config.get('badge')
+        # Count the audience against the caller's tokens-per-minute quota
+        api_keys.charge_tokens(g.get('api_key'), len(tokens))
         
         # Send multicast notification
-        batch_response = firebase_service.send_multicast_notification(
+        result = fanout.deliver(
             tokens=tokens,
-            title=title,
+            title=send_title,
             body=body,
             app_id=app_id,
-            icon=icon,
-            badge=badge,
-            data=custom_data
+            icon=send_icon,
+            badge=send_badge,
+            data=custom_data,
+            block=False,
+            user_id=user_id
         )
         
-        sent_count = batch_response.success_count if batch_response else 0
+        logger.info(f"Sent notifications to {result['sent_to']} devices for app_id: {app_id}")
         
-        logger.info(f"Sent notifications to {sent_count} devices for app_id: {app_id}")
-        
-        return jsonify({
+        response = {
             "success": True,
             "message": "Notifications sent",
             "app_id": app_id,
-            "sent_to": sent_count,
-            "failed": batch_response.failure_count if batch_response else 0,
+            "send_id": result['send_id'],
+            "sent_to": result['sent_to'],
+            "failed": result['failed'],
+            "queued": result['queued'],
+            "errors": result['errors'],
             "tokens": tokens
-        }), 200
+        }
+        if plan is not None:
+            response["segment"] = plan
+        return jsonify(response), 200
         
+    except (admission.AdmissionRejected, api_keys.RateLimited) as e:
+        return over_capacity(e)
+    except CircuitOpenError as e:
+        return dependency_unavailable(e, "send_to_app", {
+            "app_id": app_id, "title": title, "body": body, "user_id": user_id,
+            "icon": icon, "badge": badge, "data": custom_data, "segment": segment
+        })
     except Exception as e:
         logger.error(f"Error sending to app: {str(e)}")
         return jsonify({
@@ -361,6 +718,46 @@ def send_to_user():
         icon = data.get('icon')
         badge = data.get('badge')
         
+        digest_group = None
+        window = None
+        if data.get('digest'):
+            if data.get('send_at'):
+                return jsonify({
+                    "success": False,
+                    "error": "digest cannot be combined with send_at"
+                }), 400
+            if not scheduler.enabled():
+                # Held notifications are only sent by a scheduled flush job
+                return jsonify({
+                    "success": False,
+                    "error": "digest is not available while the scheduler is disabled"
+                }), 400
+            try:
+                digest_group, window_seconds = digest.parse(data['digest'])
+            except ValueError as e:
+                return jsonify({
+                    "success": False,
+                    "error": str(e)
+                }), 400
+        
+        if data.get('send_at'):
+            return schedule_send("send_to_user", {
+                "user_id": user_id, "title": title, "body": body, "app_id": app_id,
+                "icon": icon, "badge": badge, "data": custom_data
+            }, data)
+        
+        if digest_group:
+            # Within an open window the notification waits for the digest
+            window = digest.add(user_id, app_id, digest_group, window_seconds, title, body, icon, badge, custom_data)
+            if window['status'] == 'held':
+                return jsonify({
+                    "success": True,
+                    "message": "Notification added to digest",
+                    "user_id": user_id,
+                    "app_id": app_id,
+                    "digest": window
+                }), 202
+        
         # Get all tokens for this user
         tokens = token_manager.get_tokens_for_user(user_id=user_id, app_id=app_id)
         
@@ -373,30 +770,47 @@ def send_to_user():
                 "sent_to": 0
             }), 200
         
+        # Count the audience against the caller's tokens-per-minute quota
+        api_keys.charge_tokens(g.get('api_key'), len(tokens))
+        
         # Send multicast notification
-        batch_response = firebase_service.send_multicast_notification(
+        result = fanout.deliver(
             tokens=tokens,
             title=title,
             body=body,
             app_id=app_id,
             icon=icon,
             badge=badge,
-            data=custom_data
+            data=custom_data,
+            block=False,
+            user_id=user_id,
+            collapse_key=digest_group
         )
         
-        sent_count = batch_response.success_count if batch_response else 0
-        
-        logger.info(f"Sent notifications to {sent_count} devices for user_id: {user_id}")
+        logger.info(f"Sent notifications to {result['sent_to']} devices for user_id: {user_id}")
         
-        return jsonify({
+        response = {
             "success": True,
             "message": "Notifications sent",
             "user_id": user_id,
             "app_id": app_id,
-            "sent_to": sent_count,
-            "failed": batch_response.failure_count if batch_response else 0
-        }), 200
+            "send_id": result['send_id'],
+            "sent_to": result['sent_to'],
+            "failed": result['failed'],
+            "queued": result['queued'],
+            "errors": result['errors']
+        }
+        if window:
+            response["digest"] = window
+        return jsonify(response), 200
         
+    except (admission.AdmissionRejected, api_keys.RateLimited) as e:
+        return over_capacity(e)
+    except CircuitOpenError as e:
+        return dependency_unavailable(e, "send_to_user", {
+            "user_id": user_id, "title": title, "body": body, "app_id": app_id,
+            "icon": icon, "badge": badge, "data": custom_data, "collapse_key": digest_group
+        })
     except Exception as e:
         logger.error(f"Error sending to user: {str(e)}")
         return jsonify({
@@ -442,8 +856,59 @@ def broadcast():
         icon = data.get('icon')
         badge = data.get('badge')
         
-        # Get all tokens
-        tokens = token_manager.get_all_tokens()
+        if data.get('rollout') is not None:
+            if data.get('send_at'):
+                return jsonify({
+                    "success": False,
+                    "error": "rollout cannot be combined with send_at"
+                }), 400
+            if data.get('resumable'):
+                return jsonify({
+                    "success": False,
+                    "error": "rollout cannot be combined with resumable"
+                }), 400
+            try:
+                plan = rollout.validate_plan(data['rollout'])
+            except ValueError as e:
+                return jsonify({
+                    "success": False,
+                    "error": str(e)
+                }), 400
+            api_key = g.get('api_key')
+            job = rollout.start_rollout({
+                "title": title, "body": body, "icon": icon, "badge": badge, "data": custom_data
+            }, plan, api_key=api_key['name'] if api_key else None)
+            return jsonify({
+                "success": True,
+                "message": "Broadcast rollout started",
+                "job_id": job["id"],
+                "status_url": f"/api/jobs/{job['id']}"
+            }), 202
+        
+        if data.get('resumable'):
+            if data.get('send_at'):
+                return jsonify({
+                    "success": False,
+                    "error": "resumable cannot be combined with send_at"
+                }), 400
+            api_key = g.get('api_key')
+            job = broadcasts.start_broadcast({
+                "title": title, "body": body, "icon": icon, "badge": badge, "data": custom_data
+            }, api_key=api_key['name'] if api_key else None)
+            return jsonify({
+                "success": True,
+                "message": "Broadcast job started",
+                "job_id": job["id"],
+                "status_url": f"/api/jobs/{job['id']}"
+            }), 202
+        
+        if data.get('send_at'):
+            return schedule_send("broadcast", {
+                "title": title, "body": body, "icon": icon, "badge": badge, "data": custom_data
+            }, data)
+        
+        # Get all tokens, rejecting once there are more than fit under the tokens-in-flight cap
+        tokens = token_manager.get_all_tokens(limit=admission.TOKENS.room())
         
         if not tokens:
             logger.warning("No tokens found for broadcast")
@@ -453,27 +918,38 @@ def broadcast():
                 "sent_to": 0
             }), 200
         
+        # Count the audience against the caller's tokens-per-minute quota
+        api_keys.charge_tokens(g.get('api_key'), len(tokens))
+        
         # Send multicast notification
-        batch_response = firebase_service.send_multicast_notification(
+        result = fanout.deliver(
             tokens=tokens,
             title=title,
             body=body,
             icon=icon,
             badge=badge,
-            data=custom_data
+            data=custom_data,
+            block=False
         )
         
-        sent_count = batch_response.success_count if batch_response else 0
-        
-        logger.info(f"Broadcast sent to {sent_count} devices")
+        logger.info(f"Broadcast sent to {result['sent_to']} devices")
         
         return jsonify({
             "success": True,
             "message": "Broadcast sent",
-            "sent_to": sent_count,
-            "failed": batch_response.failure_count if batch_response else 0
+            "send_id": result['send_id'],
+            "sent_to": result['sent_to'],
+            "failed": result['failed'],
+            "queued": result['queued'],
+            "errors": result['errors']
         }), 200
         
+    except (admission.AdmissionRejected, api_keys.RateLimited) as e:
+        return over_capacity(e)
+    except CircuitOpenError as e:
+        return dependency_unavailable(e, "broadcast", {
+            "title": title, "body": body, "icon": icon, "badge": badge, "data": custom_data
+        })
     except Exception as e:
         logger.error(f"Error broadcasting: {str(e)}")
         return jsonify({
@@ -482,6 +958,612 @@ def broadcast():
         }), 500
 
 
+@app.route('/api/send-template', methods=['POST'])
+def send_template():
+    """
+    Send a stored template, rendered per recipient.
+    
+    The body is JSON with app_id, template_id, recipients and optional icon,
+    badge and data; or, as application/x-ndjson, those fields (without
+    recipients) on the first line and one recipient per following line. A
+    recipient is {"token" or "user_id", "variables", "locale"}.
+    """
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        try:
+            data, recipients = read_template_send()
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 400
+        
+        app_id = data.get('app_id')
+        template_id = data.get('template_id')
+        custom_data = data.get('data', {})
+        icon = data.get('icon')
+        badge = data.get('badge')
+        
+        if not app_id or not template_id:
+            return jsonify({
+                "success": False,
+                "error": "app_id and template_id are required"
+            }), 400
+        
+        if not recipients:
+            return jsonify({
+                "success": False,
+                "error": "recipients must be a non-empty list"
+            }), 400
+        
+        if len(recipients) > templates.TEMPLATE_MAX_RECIPIENTS:
+            return jsonify({
+                "success": False,
+                "error": f"At most {templates.TEMPLATE_MAX_RECIPIENTS} recipients per request"
+            }), 400
+        
+        template = templates.get_template(app_id, template_id)
+        if template is None:
+            return jsonify({
+                "success": False,
+                "error": f"Template not found: {template_id}"
+            }), 404
+        
+        messages, summary = fanout.render_template(template, recipients, app_id)
+        
+        # Count the messages against the caller's tokens-per-minute quota
+        api_keys.charge_tokens(g.get('api_key'), len(messages))
+        
+        result = fanout.deliver_rendered(
+            messages, app_id=app_id, icon=icon, badge=badge, data=custom_data, block=False
+        )
+        
+        logger.info(f"Sent template {template_id} to {result['sent_to']} devices for app_id: {app_id}")
+        
+        return jsonify({
+            "success": True,
+            "message": "Notifications sent",
+            "app_id": app_id,
+            "template_id": template_id,
+            **summary,
+            "messages": len(messages),
+            **result
+        }), 200
+        
+    except (admission.AdmissionRejected, api_keys.RateLimited) as e:
+        return over_capacity(e)
+    except CircuitOpenError as e:
+        return dependency_unavailable(e, "send_template", {
+            "app_id": app_id, "template_id": template_id, "recipients": recipients,
+            "icon": icon, "badge": badge, "data": custom_data
+        })
+    except Exception as e:
+        logger.error(f"Error sending template: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+def read_template_send():
+    """
+    Read a templated send's fields and recipients from a JSON or NDJSON body.
+    
+    Returns:
+        Tuple of (fields, recipients)
+    
+    Raises:
+        ValueError: If the body is missing or not valid JSON
+    """
+    if request.mimetype == 'application/x-ndjson':
+        parsed = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                parsed.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON on line {number}: {e.msg}")
+        if not parsed or not isinstance(parsed[0], dict):
+            raise ValueError("The first line must be an object with app_id and template_id")
+        return parsed[0], parsed[1:]
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValueError("Request body is required")
+    recipients = data.get('recipients')
+    if not isinstance(recipients, list):
+        raise ValueError("recipients must be a non-empty list")
+    return data, recipients
+
+
+@app.route('/api/deliveries', methods=['GET'])
+def list_deliveries():
+    """
+    Query the delivery ledger, newest first.
+    
+    Filters (all optional): since and until (ISO 8601, or a duration ago such
+    as 1h or 7d; since defaults to 1h), app_id, user_id, status (sent or
+    failed), error_code, send_id, token and limit (default 100).
+    """
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    args = request.args
+    try:
+        since = ledger.parse_time(args.get('since', '1h'))
+        until = ledger.parse_time(args['until']) if args.get('until') else None
+        limit = int(args.get('limit', 100))
+        if not 0 <= limit <= ledger.QUERY_MAX_LIMIT:
+            raise ValueError(f"limit must be between 0 and {ledger.QUERY_MAX_LIMIT}")
+        status = args.get('status')
+        if status not in (None, ledger.SENT, ledger.FAILED):
+            raise ValueError(f"status must be {ledger.SENT} or {ledger.FAILED}")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+    
+    result = ledger.query(
+        since=since,
+        until=until,
+        app_id=args.get('app_id'),
+        user_id=args.get('user_id'),
+        status=status,
+        error_code=args.get('error_code'),
+        send_id=args.get('send_id'),
+        token=args.get('token'),
+        limit=limit
+    )
+    return jsonify({
+        "success": True,
+        "count": len(result["deliveries"]),
+        **result
+    }), 200
+
+
+@app.route('/api/scheduled', methods=['GET'])
+def list_scheduled():
+    """List pending scheduled sends, soonest first."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    limit = request.args.get('limit', 100, type=int)
+    jobs = scheduler.list_jobs(limit=limit)
+    return jsonify({
+        "success": True,
+        "count": len(jobs),
+        "jobs": jobs
+    }), 200
+
+
+@app.route('/api/scheduled/<job_id>', methods=['GET', 'DELETE'])
+def scheduled_job(job_id):
+    """Get or cancel a scheduled send."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    if request.method == 'DELETE':
+        if not scheduler.cancel(job_id):
+            return jsonify({
+                "success": False,
+                "error": "Scheduled job not found or already sent"
+            }), 404
+        return jsonify({
+            "success": True,
+            "message": "Scheduled job cancelled",
+            "job_id": job_id
+        }), 200
+    
+    job = scheduler.get_job(job_id)
+    if not job:
+        return jsonify({
+            "success": False,
+            "error": "Scheduled job not found or already sent"
+        }), 404
+    return jsonify({
+        "success": True,
+        "job": job
+    }), 200
+
+
+@app.route('/api/apps', methods=['GET'])
+def list_apps():
+    """List configured apps with their resolved configurations."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    configs = app_configs.list_app_configs()
+    return jsonify({
+        "success": True,
+        "count": len(configs),
+        "apps": configs
+    }), 200
+
+
+@app.route('/api/apps/<app_id>', methods=['GET'])
+def get_app(app_id):
+    """Get one app's resolved configuration."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    if not app_configs.is_configured(app_id):
+        return jsonify({
+            "success": False,
+            "error": "App not configured",
+            "defaults": dict(app_configs.get_app_config(app_id))
+        }), 404
+    return jsonify({
+        "success": True,
+        "app_id": app_id,
+        "config": dict(app_configs.get_app_config(app_id))
+    }), 200
+
+
+@app.route('/api/apps/<app_id>', methods=['PUT'])
+def put_app(app_id):
+    """Create or replace an app's configuration (admin)."""
+    auth_error = check_admin_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        app_configs.validate_app_id(app_id)
+        config = app_configs.validate_config(request.get_json(silent=True))
+        project = config.get("firebase_project")
+        if project and project not in firebase_service.project_names():
+            raise ValueError(f"Unknown Firebase project: {project}")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+    
+    try:
+        created = not app_configs.is_configured(app_id)
+        resolved = app_configs.put_app_config(app_id, config)
+        return jsonify({
+            "success": True,
+            "app_id": app_id,
+            "config": resolved
+        }), 201 if created else 200
+    except Exception as e:
+        logger.error(f"Error storing app config for {app_id}: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/apps/<app_id>', methods=['DELETE'])
+def delete_app(app_id):
+    """Remove an app's configuration; its sends fall back to the defaults (admin)."""
+    auth_error = check_admin_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        if not app_configs.delete_app_config(app_id):
+            return jsonify({
+                "success": False,
+                "error": "App not configured"
+            }), 404
+        return jsonify({
+            "success": True,
+            "message": f"App config deleted: {app_id}"
+        }), 200
+    except Exception as e:
+        logger.error(f"Error deleting app config for {app_id}: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/apps/<app_id>/templates', methods=['GET'])
+def list_app_templates(app_id):
+    """List an app's notification templates."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        found = templates.list_templates(app_id)
+        return jsonify({
+            "success": True,
+            "app_id": app_id,
+            "count": len(found),
+            "templates": found
+        }), 200
+    except CircuitOpenError as e:
+        return dependency_unavailable(e)
+    except Exception as e:
+        logger.error(f"Error listing templates for {app_id}: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/apps/<app_id>/templates/<template_id>', methods=['GET'])
+def get_app_template(app_id, template_id):
+    """Get one notification template as stored, with the variables it uses."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        stored = templates.get_template_doc(app_id, template_id)
+        if stored is None:
+            return jsonify({
+                "success": False,
+                "error": "Template not found"
+            }), 404
+        return jsonify({
+            "success": True,
+            "template": stored,
+            "variables": templates.Template(app_id, template_id, stored).variables
+        }), 200
+    except CircuitOpenError as e:
+        return dependency_unavailable(e)
+    except Exception as e:
+        logger.error(f"Error reading template {template_id} for {app_id}: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/apps/<app_id>/templates/<template_id>', methods=['PUT'])
+def put_app_template(app_id, template_id):
+    """Create or replace a notification template (admin)."""
+    auth_error = check_admin_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        stored = templates.validate(template_id, request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+    
+    try:
+        created = templates.put_template(app_id, template_id, stored)
+        return jsonify({
+            "success": True,
+            "app_id": app_id,
+            "template_id": template_id,
+            "template": stored
+        }), 201 if created else 200
+    except CircuitOpenError as e:
+        return dependency_unavailable(e)
+    except Exception as e:
+        logger.error(f"Error storing template {template_id} for {app_id}: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/apps/<app_id>/templates/<template_id>', methods=['DELETE'])
+def delete_app_template(app_id, template_id):
+    """Delete a notification template (admin)."""
+    auth_error = check_admin_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        if not templates.delete_template(app_id, template_id):
+            return jsonify({
+                "success": False,
+                "error": "Template not found"
+            }), 404
+        return jsonify({
+            "success": True,
+            "message": f"Template deleted: {template_id}"
+        }), 200
+    except CircuitOpenError as e:
+        return dependency_unavailable(e)
+    except Exception as e:
+        logger.error(f"Error deleting template {template_id} for {app_id}: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """List background send jobs (e.g. broadcast rollouts), newest first."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    found = jobs.list_jobs(kind=request.args.get('kind'), limit=request.args.get('limit', 50, type=int))
+    return jsonify({
+        "success": True,
+        "count": len(found),
+        "jobs": found
+    }), 200
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Get progress of a background send job."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({
+            "success": False,
+            "error": "Job not found"
+        }), 404
+    return jsonify({
+        "success": True,
+        "job": job
+    }), 200
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Stop a background send job at its next checkpoint."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    job = jobs.request_cancel(job_id)
+    if not job:
+        return jsonify({
+            "success": False,
+            "error": "Job not found"
+        }), 404
+    return jsonify({
+        "success": True,
+        "message": "Cancel requested",
+        "job": job
+    }), 200
+
+
+@app.route('/api/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """Continue an interrupted or failed broadcast or rollout job from its last checkpoint."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({
+            "success": False,
+            "error": "Job not found"
+        }), 404
+    kind = "Rollout" if job["kind"] == "rollout" else "Broadcast"
+    resumed = rollout.resume(job_id) if kind == "Rollout" else broadcasts.resume(job_id)
+    if not resumed:
+        return jsonify({
+            "success": False,
+            "error": f"Job cannot be resumed (kind: {job['kind']}, status: {job['status']})"
+        }), 409
+    return jsonify({
+        "success": True,
+        "message": f"{kind} resumed",
+        "job": resumed,
+        "status_url": f"/api/jobs/{job_id}"
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>/chunks', methods=['GET'])
+def job_chunks(job_id):
+    """Per-chunk outcomes of a broadcast job, in send order."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    if not jobs.get_job(job_id):
+        return jsonify({
+            "success": False,
+            "error": "Job not found"
+        }), 404
+    offset = request.args.get('offset', 0, type=int)
+    chunks = jobs.read_results(job_id, offset=offset, limit=request.args.get('limit', 100, type=int))
+    return jsonify({
+        "success": True,
+        "offset": offset,
+        "count": len(chunks),
+        "chunks": chunks
+    }), 200
+
+
+@app.route('/api/outbox/drain', methods=['POST'])
+def drain_outbox():
+    """Replay sends queued while a dependency was unavailable."""
+    auth_error = check_api_key()
+    if auth_error:
+        return auth_error
+    
+    try:
+        result = fanout.drain_outbox()
+        logger.info(f"Outbox drained: {result}")
+        return jsonify({
+            "success": True,
+            **result
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error draining outbox: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def list_profiles():
+    """List captured request profiles, newest first."""
+    auth_error = check_admin_key()
+    if auth_error:
+        return auth_error
+    
+    profiles = profiling.list_profiles()
+    return jsonify({
+        "success": True,
+        "count": len(profiles),
+        "profiles": profiles
+    }), 200
+
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """
+    Download a captured profile as a pstats dump (load with pstats or snakeviz),
+    or as a text report with ?format=text&sort=cumulative.
+    """
+    auth_error = check_admin_key()
+    if auth_error:
+        return auth_error
+    
+    path = profiling.get_profile_path(profile_id)
+    if path is None:
+        return jsonify({
+            "success": False,
+            "error": "Profile not found"
+        }), 404
+    
+    if request.args.get('format') == 'text':
+        try:
+            report = profiling.profile_summary(
+                profile_id,
+                sort=request.args.get('sort', 'cumulative'),
+                limit=int(request.args.get('limit', 40))
+            )
+        except (KeyError, ValueError):
+            return jsonify({
+                "success": False,
+                "error": "Invalid sort or limit"
+            }), 400
+        return Response(report, mimetype='text/plain')
+    
+    return send_file(
+        path,
+        mimetype='application/octet-stream',
+        as_attachment=True,
+        download_name=f"{profile_id}.prof"
+    )
+
+
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors."""
@@ -503,6 +1585,7 @@ def internal_error(error):
 if __name__ == '__main__':
     # Initialize Firebase before starting server
     initialize_services()
+    scheduler.ensure_started()
     
     # Get port from environment or use default
     # Railway automatically sets PORT environment variable
@@ -1,8 +1,37 @@
 """
 App-specific configurations for different Progressive Web Apps (PWAs).
 Each app can have its own icon, badge, and notification settings.
+
+Configs are stored in a local JSON file (APP_CONFIG_SOURCE=file, the default)
+or in a Firestore collection (APP_CONFIG_SOURCE=firestore) and managed through
+/api/apps. Until an app is stored there, the built-in APP_CONFIGS below are
+served.
+
+Lookups never touch the store: every app's config is resolved (defaults
+filled in) once per load and served from an in-process snapshot. The snapshot
+is replaced when the store changes (file mtime poll, or a Firestore snapshot
+listener) and refreshed in the background once it is older than
+APP_CONFIG_TTL_SECONDS in case a change notification was missed.
 """
 
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Mapping, Optional
+from profiling import phase
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
 APP_CONFIGS = {
     "trading-app": {
         "name": "Trading Dashboard",
@@ -27,24 +56,438 @@ APP_CONFIGS = {
     }
 }
 
+# Values for fields an app does not set
+DEFAULT_CONFIG = {
+    "icon": "/icon-192x192.png",
+    "badge": "/icon-96x96.png",
+    "default_title_prefix": "",
+    "color": "#000000"
+}
+
+# firebase_project names an entry of FIREBASE_PROJECTS; unset means the default project
+CONFIG_FIELDS = ("name", "icon", "badge", "default_title_prefix", "color", "firebase_project")
+
+APP_CONFIG_SOURCE = os.getenv('APP_CONFIG_SOURCE', 'file').lower()
+APP_CONFIGS_FILE = os.getenv('APP_CONFIGS_FILE', os.path.join(os.getenv('DATA_DIR', 'data'), 'app_configs.json'))
+APP_CONFIG_COLLECTION = os.getenv('APP_CONFIG_COLLECTION', 'app_configs')
+
+# Age after which the snapshot is refreshed in the background
+APP_CONFIG_TTL_SECONDS = float(os.getenv('APP_CONFIG_TTL_SECONDS', '300'))
+
+# How often the file source checks for changes made by other workers
+APP_CONFIG_WATCH_SECONDS = float(os.getenv('APP_CONFIG_WATCH_SECONDS', '2'))
+
+
+class FileSource:
+    """App configs in one JSON file ({app_id: config}), shared by the workers on an instance."""
+
+    name = "file"
+    # Loading reads a local file, cheap enough to do on a request
+    local = True
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Stored configs, or None if nothing has been stored yet."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, app_id: str, config: Dict[str, Any]) -> None:
+        with self._locked():
+            configs = self.load()
+            configs = dict(APP_CONFIGS) if configs is None else configs
+            configs[app_id] = config
+            self._save(configs)
+
+    def delete(self, app_id: str) -> bool:
+        with self._locked():
+            configs = self.load()
+            configs = dict(APP_CONFIGS) if configs is None else configs
+            if configs.pop(app_id, None) is None:
+                return False
+            self._save(configs)
+            return True
+
+    def watch(self, on_change: Callable[[Optional[Dict[str, Dict[str, Any]]]], None]) -> None:
+        """Poll the file's mtime and reload when another process changes it, until the source is replaced."""
+        initial = self._version()
+
+        def poll():
+            version = initial
+            while True:
+                time.sleep(APP_CONFIG_WATCH_SECONDS)
+                if _source is not self:
+                    return
+                current = self._version()
+                if current != version:
+                    version = current
+                    try:
+                        on_change(self.load())
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Failed to reload app configs from {self.path}: {str(e)}")
+
+        threading.Thread(target=poll, name="app-config-watch", daemon=True).start()
+
+    def _version(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _save(self, configs: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(configs, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock held for a read-modify-write of the file."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+
+
+# Document marking an app config collection that has been written through
+# /api/apps; it is not an app and its id cannot be used as one
+SEEDED_DOCUMENT = "_seeded"
+
+
+class FirestoreSource:
+    """App configs as documents (id = app_id) in a Firestore collection."""
+
+    name = "firestore"
+    local = False
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        self._listener = None
+
+    def load(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Stored configs, or None if nothing has been stored yet."""
+        from circuit_breaker import FIRESTORE_BREAKER
+        import token_manager
+        with FIRESTORE_BREAKER.guard():
+            docs = list(self._ref().stream(timeout=token_manager.FIRESTORE_TIMEOUT))
+        return self._configs(docs)
 
-def get_app_config(app_id: str) -> dict:
+    def put(self, app_id: str, config: Dict[str, Any]) -> None:
+        self._write(app_id, config)
+
+    def delete(self, app_id: str) -> bool:
+        return self._write(app_id, None)
+
+    def watch(self, on_change: Callable[[Optional[Dict[str, Dict[str, Any]]]], None]) -> None:
+        """Listen for changes; Firestore delivers the full collection on every change."""
+        def on_snapshot(docs, changes, read_time):
+            on_change(self._configs(docs))
+
+        self._listener = self._ref().on_snapshot(on_snapshot)
+
+    def _write(self, app_id: str, config: Optional[Dict[str, Any]]) -> bool:
+        """
+        Set an app's document (or delete it, with config None) in a transaction.
+
+        Like FileSource, the first write seeds an empty collection with the
+        built-in configs, and marks the collection as written so that deleting
+        its last app leaves it empty instead of bringing the built-ins back.
+
+        Returns:
+            True if the app had a config before
+        """
+        from google.cloud.firestore_v1 import transactional
+        from circuit_breaker import FIRESTORE_BREAKER
+        import token_manager
+        ref = self._ref()
+        timeout = token_manager.FIRESTORE_TIMEOUT
+
+        @transactional
+        def write(transaction) -> bool:
+            # Every read comes before the first write
+            marked = ref.document(SEEDED_DOCUMENT).get(transaction=transaction, timeout=timeout).exists
+            # A collection written before the marker existed is kept as it is
+            seed = {} if marked or list(ref.limit(1).stream(transaction=transaction, timeout=timeout)) \
+                else dict(APP_CONFIGS)
+            existed = app_id in seed or ref.document(app_id).get(transaction=transaction, timeout=timeout).exists
+            if config is None and not existed:
+                return False
+
+            seed.pop(app_id, None)
+            for seed_id, seed_config in seed.items():
+                transaction.set(ref.document(seed_id), seed_config)
+            if not marked:
+                transaction.set(ref.document(SEEDED_DOCUMENT), {"seeded": True})
+            if config is not None:
+                transaction.set(ref.document(app_id), config)
+            else:
+                transaction.delete(ref.document(app_id))
+            return existed
+
+        with FIRESTORE_BREAKER.guard():
+            return write(token_manager.get_firestore_client().transaction())
+
+    @staticmethod
+    def _configs(docs) -> Optional[Dict[str, Dict[str, Any]]]:
+        """The apps' configs, {} once written even if now empty, None if never written."""
+        configs = {doc.id: doc.to_dict() for doc in docs}
+        if configs.pop(SEEDED_DOCUMENT, None) is not None:
+            return configs
+        return configs or None
+
+    def _ref(self):
+        # Imported here: token_manager imports firebase_service, which imports this module
+        import token_manager
+        return token_manager.get_firestore_client().collection(self.collection)
+
+
+def _create_source():
+    if APP_CONFIG_SOURCE == 'firestore':
+        return FirestoreSource(APP_CONFIG_COLLECTION)
+    if APP_CONFIG_SOURCE == 'file':
+        return FileSource(APP_CONFIGS_FILE)
+    raise ValueError(f"Unknown APP_CONFIG_SOURCE: {APP_CONFIG_SOURCE}")
+
+
+_source = _create_source()
+_snapshot: Optional[Dict[str, Mapping[str, Any]]] = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+_refreshing = False
+_watch_pid = None
+
+
+def validate_config(config: Any) -> Dict[str, Any]:
+    """
+    Validate an app config from a request body.
+
+    Returns:
+        The config with only known fields
+
+    Raises:
+        ValueError: If it is not an object, has unknown fields or non-string values
+    """
+    if not isinstance(config, dict):
+        raise ValueError("App config must be a JSON object")
+    unknown = set(config) - set(CONFIG_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown app config fields: {', '.join(sorted(unknown))}")
+    for field, value in config.items():
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"{field} must be a string")
+    return {field: config[field] for field in CONFIG_FIELDS if config.get(field) is not None}
+
+
+def validate_app_id(app_id: str) -> None:
+    """
+    Check an app_id from a request path can be stored.
+
+    Raises:
+        ValueError: If the id is reserved for the store's own bookkeeping
+    """
+    if app_id == SEEDED_DOCUMENT:
+        raise ValueError(f"{app_id} is reserved and cannot be used as an app_id")
+
+
+def resolve(app_id: str, config: Dict[str, Any]) -> Mapping[str, Any]:
+    """An app's config with defaults filled in, as a read-only mapping."""
+    return MappingProxyType({
+        "name": f"App: {app_id}",
+        **DEFAULT_CONFIG,
+        **{field: value for field, value in config.items() if value is not None}
+    })
+
+
+@lru_cache(maxsize=1024)
+def _default_for(app_id: str) -> Mapping[str, Any]:
+    return resolve(app_id, {})
+
+
+def _install(configs: Optional[Dict[str, Dict[str, Any]]]) -> None:
+    """Replace the snapshot with freshly resolved configs."""
+    global _snapshot, _loaded_at
+    configs = APP_CONFIGS if configs is None else configs
+    snapshot = {app_id: resolve(app_id, config) for app_id, config in configs.items()}
+    with _lock:
+        _snapshot = snapshot
+        _loaded_at = time.monotonic()
+
+
+def reload() -> int:
+    """
+    Load every config from the store now.
+
+    Returns:
+        Number of configured apps
+    """
+    _install(_source.load())
+    return len(_snapshot)
+
+
+def _refresh_in_background() -> None:
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+
+    def refresh():
+        global _refreshing
+        try:
+            reload()
+        except Exception as e:
+            # Keep serving the last good snapshot
+            logger.error(f"Failed to refresh app configs: {str(e)}")
+        finally:
+            _refreshing = False
+
+    threading.Thread(target=refresh, name="app-config-refresh", daemon=True).start()
+
+
+def ensure_started(background: bool = False) -> None:
+    """
+    Load the configs and start watching the store, once per process (safe to call often).
+
+    Args:
+        background: Load and start the watch on a daemon thread, so the
+            caller (a request, or a worker that must answer health checks)
+            never waits on the store
+    """
+    global _watch_pid
+    if _watch_pid == os.getpid():
+        return
+    with _lock:
+        if _watch_pid == os.getpid():
+            return
+        _watch_pid = os.getpid()
+    if background:
+        threading.Thread(target=_start, name="app-config-load", daemon=True).start()
+    else:
+        _start()
+
+
+def _start() -> None:
+    try:
+        if _snapshot is None:
+            reload()
+    except Exception as e:
+        # The TTL refresh and the watch retry; until then the built-in configs are served
+        logger.error(f"Failed to load app configs, using built-in configs: {str(e)}")
+        if _snapshot is None:
+            _install(None)
+    try:
+        _source.watch(_install)
+        logger.info(f"Watching app configs ({_source.name} source)")
+    except Exception as e:
+        logger.error(f"Failed to start app config watch: {str(e)}")
+
+
+@lru_cache(maxsize=1)
+def _builtin() -> Dict[str, Mapping[str, Any]]:
+    return {app_id: resolve(app_id, config) for app_id, config in APP_CONFIGS.items()}
+
+
+def _current() -> Dict[str, Mapping[str, Any]]:
+    snapshot = _snapshot
+    if snapshot is None and not _source.local:
+        # Requests never wait on Firestore: until the worker's load finishes
+        # (normally started in post_fork) the built-in configs are served
+        ensure_started(background=True)
+        return _builtin()
+    if snapshot is None:
+        # First lookup in a process that was not warmed up
+        try:
+            reload()
+        except Exception as e:
+            logger.error(f"Failed to load app configs, using built-in configs: {str(e)}")
+            _install(None)
+        return _snapshot
+    if time.monotonic() - _loaded_at > APP_CONFIG_TTL_SECONDS:
+        _refresh_in_background()
+    return snapshot
+
+
+def get_app_config(app_id: str) -> Mapping[str, Any]:
     """
     Get configuration for a specific app.
-    
+
     Args:
         app_id: The identifier for the PWA app
-        
+
     Returns:
-        Dictionary containing app configuration with defaults if app_id not found
+        Read-only mapping with the app's configuration, defaults filled in
+        (also for apps with no stored configuration)
     """
-    return APP_CONFIGS.get(app_id, {
-        "name": f"App: {app_id}",
-        "icon": "/icon-192x192.png",
-        "badge": "/icon-96x96.png",
-        "default_title_prefix": "",
-        "color": "#000000"
-    })
+    with phase("app_config"):
+        config = _current().get(app_id)
+        return config if config is not None else _default_for(app_id)
+
+
+def is_configured(app_id: str) -> bool:
+    """Whether the app has a stored (or built-in) configuration."""
+    return app_id in _current()
+
+
+def is_known(app_id: str) -> bool:
+    """
+    Whether the app is in the loaded snapshot (the built-in configs before the
+    first load). Unlike is_configured it never loads configs, so it is safe on
+    paths the load itself runs through, such as metric labels.
+    """
+    snapshot = _snapshot
+    return app_id in (snapshot if snapshot is not None else APP_CONFIGS)
+
+
+def list_app_configs() -> Dict[str, Dict[str, Any]]:
+    """All configured apps' resolved configurations."""
+    return {app_id: dict(config) for app_id, config in sorted(_current().items())}
+
+
+def put_app_config(app_id: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Create or replace an app's configuration.
+
+    Args:
+        app_id: App identifier
+        config: Validated config (see validate_config)
+
+    Returns:
+        The resolved configuration
+    """
+    _source.put(app_id, config)
+    reload()
+    logger.info(f"Stored app config for {app_id}")
+    return dict(get_app_config(app_id))
+
+
+def delete_app_config(app_id: str) -> bool:
+    """
+    Remove an app's configuration (it falls back to defaults).
+
+    Returns:
+        True if it existed
+    """
+    deleted = _source.delete(app_id)
+    if deleted:
+        reload()
+        logger.info(f"Deleted app config for {app_id}")
+    return deleted
+
+
+def status() -> Dict[str, Any]:
+    """Source, size and age of the config snapshot (for /api/health)."""
+    snapshot = _snapshot
+    return {
+        "source": _source.name,
+        "apps": len(snapshot) if snapshot is not None else None,
+        "age_seconds": round(time.monotonic() - _loaded_at, 1) if snapshot is not None else None
+    }
 
 
 def get_app_icon(app_id: str) -> str:
@@ -63,4 +506,3 @@ def get_app_title_prefix(app_id: str) -> str:
     """Get default title prefix for an app."""
     config = get_app_config(app_id)
     return config.get("default_title_prefix", "")
-
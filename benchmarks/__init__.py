@@ -0,0 +1,4 @@
+"""
+Offline benchmarks: the service end to end against an in-memory token store
+and a fake FCM transport. Run with `python -m benchmarks.run`.
+"""
@@ -0,0 +1,91 @@
+"""
+Compare two benchmark result files and flag regressions.
+
+Usage:
+    python -m benchmarks.compare base.json head.json [--threshold 0.10]
+
+Exits 1 if any case present in both files lost more than the threshold of
+its throughput, or grew its p99 latency or peak RSS by more than it.
+"""
+
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+# (label, getter, higher is better)
+METRICS = (
+    ("tokens/s", lambda result: result["tokens_per_second"], True),
+    ("p99 ms", lambda result: result["latency_ms"]["p99"], False),
+    ("peak RSS MiB", lambda result: result["rss_bytes"]["peak"] / 2**20, False),
+)
+
+
+def load(path: str) -> Tuple[Dict[str, Any], Dict[Tuple[str, int], Dict[str, Any]]]:
+    """Read a results file. Returns (config, {(scenario, tokens): result})."""
+    with open(path, "r", encoding="utf-8") as f:
+        results = json.load(f)
+    return results["config"], {(result["scenario"], result["tokens"]): result for result in results["results"]}
+
+
+def compare(
+    base: Dict[Tuple[str, int], Dict[str, Any]],
+    head: Dict[Tuple[str, int], Dict[str, Any]],
+    threshold: float
+) -> Tuple[List[str], List[str]]:
+    """
+    Compare the cases present in both result sets.
+
+    Returns:
+        Tuple of (report lines, regression descriptions)
+    """
+    lines = []
+    regressions = []
+    for key in sorted(set(base) & set(head)):
+        scenario, tokens = key
+        for label, get, higher_is_better in METRICS:
+            before, after = get(base[key]), get(head[key])
+            change = _change(before, after)
+            lines.append(f"{scenario:12} {tokens:>9} {label:13} {before:>14,.1f} {after:>14,.1f} {_percent(change):>9}")
+            if change is None:
+                continue
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append(f"{scenario} at {tokens} tokens: {label} {_percent(change)}")
+    return lines, regressions
+
+
+def _change(before: Optional[float], after: Optional[float]) -> Optional[float]:
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def _percent(change: Optional[float]) -> str:
+    return "n/a" if change is None else f"{change:+.1%}"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", help="Results of the baseline commit")
+    parser.add_argument("head", help="Results of the commit under test")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed relative regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    base_config, base = load(args.base)
+    head_config, head = load(args.head)
+    if base_config != head_config:
+        print(f"Warning: the runs used different settings ({base_config} vs {head_config})\n")
+    lines, regressions = compare(base, head, args.threshold)
+    print(f"{'scenario':12} {'tokens':>9} {'metric':13} {'base':>14} {'head':>14} {'change':>9}")
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""
+The Flask app wired to the in-memory token store and fake FCM, for serving
+under gunicorn during load tests:
+
+    gunicorn -c gunicorn.conf.py benchmarks.fake_app:app
+
+The store is seeded at import. With preload_app (the default) the master
+seeds it once and every worker starts from a copy; tokens registered later
+are only visible to the worker that stored them.
+
+Environment:
+    FAKE_TOKENS: Tokens to seed (default 10000)
+    FAKE_APPS: Apps the tokens are spread over, named loadtest-app-<n> (default 10)
+    FAKE_USERS: Users the tokens are spread over, named user-<n> (default 1000)
+    FAKE_FCM_LATENCY_MS: Time every FCM call takes (default 50)
+    FAKE_FCM_ERROR_RATE: Share of messages FCM rejects (default 0)
+    FAKE_STORE_LATENCY_MS: Time every Firestore call takes (default 5)
+"""
+
+import os
+
+from benchmarks import fakes
+
+FAKE_TOKENS = int(os.getenv('FAKE_TOKENS', '10000'))
+FAKE_APPS = int(os.getenv('FAKE_APPS', '10'))
+FAKE_USERS = int(os.getenv('FAKE_USERS', '1000'))
+FAKE_FCM_LATENCY_MS = float(os.getenv('FAKE_FCM_LATENCY_MS', '50'))
+FAKE_FCM_ERROR_RATE = float(os.getenv('FAKE_FCM_ERROR_RATE', '0'))
+FAKE_STORE_LATENCY_MS = float(os.getenv('FAKE_STORE_LATENCY_MS', '5'))
+
+APP_IDS = [f"loadtest-app-{i}" for i in range(FAKE_APPS)]
+
+db = fakes.FakeFirestore(latency=FAKE_STORE_LATENCY_MS / 1000)
+fcm = fakes.FakeFCM(latency=FAKE_FCM_LATENCY_MS / 1000, error_rate=FAKE_FCM_ERROR_RATE, keep_calls=10000)
+fakes.seed_tokens(db, FAKE_TOKENS, APP_IDS, users=FAKE_USERS)
+fakes.install(db, fcm)
+
+from app import app  # noqa: E402
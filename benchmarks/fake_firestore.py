@@ -0,0 +1,861 @@
+"""
+An in-memory Firestore client for tests and benchmarks.
+
+FakeFirestore follows the google-cloud-firestore client API closely enough
+to stand in for it via token_manager.set_firestore_client(), and follows
+Firestore's semantics where the service relies on them:
+
+- documents are copied on write and on read, so callers never share state
+  with the store;
+- set() replaces a document (or merges with merge=True), update() fails with
+  NotFound on a missing document and accepts dotted field paths, create()
+  fails with AlreadyExists, delete() of a missing document succeeds;
+- SERVER_TIMESTAMP, DELETE_FIELD and Increment transforms are applied;
+- queries return documents in document id order unless ordered otherwise;
+  a document missing a filtered or ordered field is not returned, range
+  filters only match values of the same type, and an inequality filter
+  orders by its field first;
+- order_by, limit, offset, select and the start_at / start_after / end_at /
+  end_before cursors (field values or a snapshot) work on any fields;
+- batches apply all of their writes or none, and hold at most 500;
+- transactions work with google.cloud.firestore_v1.transactional: reads must
+  come before writes, and the commit is aborted (and the function retried) if
+  a document the transaction read was written since;
+- count() aggregations, billed like Firestore at one read per 1000 matching
+  documents (at least one).
+
+documents_read counts billed document reads, so tests and benchmarks can
+assert what a code path costs.
+
+Firestore locks what a transaction reads; the fake checks documents read with
+get() or get_all() at commit instead, and does not track queries run in a
+transaction.
+
+Not supported: collection group queries, listeners and other aggregations.
+"""
+
+import bisect
+import itertools
+import random
+import string
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+
+# Writes per batch (and per commit) Firestore accepts
+MAX_BATCH_WRITES = 500
+
+# Index entries a count() aggregation reads per billed document read
+COUNT_ENTRIES_PER_READ = 1000
+
+ASCENDING = "ASCENDING"
+DESCENDING = "DESCENDING"
+
+_DOCUMENT_ID = "__name__"
+_RANGE_OPS = ("<", "<=", ">", ">=")
+_INEQUALITY_OPS = _RANGE_OPS + ("!=", "not-in")
+_AUTO_ID_CHARS = string.ascii_letters + string.digits
+_MISSING = object()
+
+
+def _clone(value: Any) -> Any:
+    """Copy the mutable parts (maps and arrays) of a field value; everything else is immutable."""
+    if isinstance(value, dict):
+        return {
+            key: _clone(nested) if isinstance(nested, (dict, list)) else nested
+            for key, nested in value.items()
+        }
+    if isinstance(value, list):
+        return [_clone(item) for item in value]
+    return value
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _get_field(data: Dict[str, Any], path: str) -> Any:
+    """Value at a dotted field path, or _MISSING."""
+    if "." not in path:
+        return data.get(path, _MISSING)
+    value = data
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set_field(data: Dict[str, Any], path: str, value: Any) -> None:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        child = data.get(part)
+        if not isinstance(child, dict):
+            child = data[part] = {}
+        data = child
+    data[parts[-1]] = value
+
+
+def _delete_field(data: Dict[str, Any], path: str) -> None:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        data = data.get(part)
+        if not isinstance(data, dict):
+            return
+    data.pop(parts[-1], None)
+
+
+def _type_rank(value: Any) -> int:
+    """Firestore's cross-type ordering: null < bool < number < timestamp < string < bytes < array < map."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, (list, tuple)):
+        return 7
+    return 8
+
+
+class _Key:
+    """Sort key ordering values of any type the way Firestore does."""
+
+    __slots__ = ("rank", "value")
+
+    def __init__(self, value: Any):
+        self.rank = _type_rank(value)
+        if self.rank == 7:
+            value = [_Key(item) for item in value]
+        elif self.rank == 8:
+            value = sorted((k, _Key(v)) for k, v in value.items())
+        self.value = value
+
+    def __lt__(self, other: "_Key") -> bool:
+        if self.rank != other.rank:
+            return self.rank < other.rank
+        return self.rank != 0 and self.value < other.value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Key) and self.rank == other.rank and self.value == other.value
+
+
+# Types whose Python ordering is Firestore's ordering when both sides have the type
+_PLAIN_TYPES = (str, int, float, datetime, bytes)
+
+
+def _compare(left: Any, right: Any) -> int:
+    if type(left) is type(right) and type(left) in _PLAIN_TYPES:
+        return -1 if left < right else (1 if right < left else 0)
+    a, b = _Key(left), _Key(right)
+    return -1 if a < b else (1 if b < a else 0)
+
+
+def _matches(value: Any, op: str, operand: Any) -> bool:
+    if value is _MISSING:
+        return False
+    if op == "==":
+        if type(value) is type(operand) and type(value) in _PLAIN_TYPES:
+            return value == operand
+        return _compare(value, operand) == 0
+    if op == "!=":
+        return value is not None and _compare(value, operand) != 0
+    if op in _RANGE_OPS:
+        if _type_rank(value) != _type_rank(operand):
+            return False
+        order = _compare(value, operand)
+        return {"<": order < 0, "<=": order <= 0, ">": order > 0, ">=": order >= 0}[op]
+    if op == "in":
+        return any(_compare(value, item) == 0 for item in operand)
+    if op == "not-in":
+        return value is not None and all(_compare(value, item) != 0 for item in operand)
+    if op == "array_contains":
+        return isinstance(value, list) and any(_compare(item, operand) == 0 for item in value)
+    if op == "array_contains_any":
+        return isinstance(value, list) and any(_compare(item, wanted) == 0 for item in value for wanted in operand)
+    raise exceptions.InvalidArgument(f"Unsupported filter operator: {op}")
+
+
+class DocumentSnapshot:
+    """A document as read at one point in time."""
+
+    def __init__(
+        self,
+        reference: "DocumentReference",
+        data: Optional[Dict[str, Any]],
+        create_time: Optional[datetime] = None,
+        update_time: Optional[datetime] = None,
+        read_time: Optional[datetime] = None
+    ):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = read_time or _now()
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return _clone(self._data)
+
+    def get(self, field_path: str) -> Any:
+        if self._data is None:
+            raise KeyError(field_path)
+        value = _get_field(self._data, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return _clone(value)
+
+
+class _Stored:
+    """A stored document: its data and write times."""
+
+    __slots__ = ("data", "create_time", "update_time")
+
+    def __init__(self, data: Dict[str, Any], create_time: datetime, update_time: datetime):
+        self.data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+
+class DocumentReference:
+    """A reference to a document that may or may not exist."""
+
+    def __init__(self, client: "FakeFirestore", collection_path: str, doc_id: str):
+        self._client = client
+        self._collection_path = collection_path
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection_path}/{self.id}"
+
+    @property
+    def parent(self) -> "CollectionReference":
+        return CollectionReference(self._client, self._collection_path)
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, DocumentReference) and other._client is self._client and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    def get(self, field_paths: Optional[List[str]] = None, transaction=None, timeout: Optional[float] = None):
+        self._client.wait()
+        return self._client._snapshot(self, field_paths, transaction)
+
+    def create(self, document_data: Dict[str, Any], timeout: Optional[float] = None) -> "WriteResult":
+        return self._client._commit([("create", self, document_data, None)])[0]
+
+    def set(self, document_data: Dict[str, Any], merge: bool = False, timeout: Optional[float] = None):
+        return self._client._commit([("set", self, document_data, merge)])[0]
+
+    def update(self, field_updates: Dict[str, Any], option=None, timeout: Optional[float] = None):
+        return self._client._commit([("update", self, field_updates, None)])[0]
+
+    def delete(self, option=None, timeout: Optional[float] = None) -> datetime:
+        return self._client._commit([("delete", self, None, None)])[0].update_time
+
+
+class WriteResult:
+    """The outcome of one write."""
+
+    def __init__(self, update_time: datetime):
+        self.update_time = update_time
+
+
+class Query:
+    """An immutable query over one collection."""
+
+    def __init__(
+        self,
+        client: "FakeFirestore",
+        collection_path: str,
+        filters: Tuple = (),
+        orders: Tuple = (),
+        limit: Optional[int] = None,
+        offset: int = 0,
+        projection: Optional[Tuple[str, ...]] = None,
+        start: Optional[Tuple[Any, bool]] = None,
+        end: Optional[Tuple[Any, bool]] = None
+    ):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._offset = offset
+        self._projection = projection
+        self._start = start
+        self._end = end
+
+    def _copy(self, **changes) -> "Query":
+        fields = {
+            "filters": self._filters, "orders": self._orders, "limit": self._limit, "offset": self._offset,
+            "projection": self._projection, "start": self._start, "end": self._end
+        }
+        fields.update(changes)
+        return Query(self._client, self._collection_path, **fields)
+
+    def where(self, field_path: Optional[str] = None, op_string: Optional[str] = None, value: Any = None,
+              filter=None) -> "Query":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string in ("in", "not-in", "array_contains_any") and not isinstance(value, (list, tuple)):
+            raise exceptions.InvalidArgument(f"'{op_string}' requires a list of values")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "Query":
+        if direction not in (ASCENDING, DESCENDING):
+            raise ValueError(f"Invalid direction: {direction}")
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "Query":
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip: int) -> "Query":
+        return self._copy(offset=num_to_skip)
+
+    def select(self, field_paths: List[str]) -> "Query":
+        return self._copy(projection=tuple(field_paths))
+
+    def start_at(self, document_fields_or_snapshot) -> "Query":
+        return self._copy(start=(document_fields_or_snapshot, True))
+
+    def start_after(self, document_fields_or_snapshot) -> "Query":
+        return self._copy(start=(document_fields_or_snapshot, False))
+
+    def end_at(self, document_fields_or_snapshot) -> "Query":
+        return self._copy(end=(document_fields_or_snapshot, True))
+
+    def end_before(self, document_fields_or_snapshot) -> "Query":
+        return self._copy(end=(document_fields_or_snapshot, False))
+
+    def count(self, alias: Optional[str] = None) -> "AggregationQuery":
+        return AggregationQuery(self, alias or "count")
+
+    def _effective_orders(self) -> List[Tuple[str, str]]:
+        """Explicit orders, the inequality field first if not ordered, then document id."""
+        orders = list(self._orders)
+        inequality = [field for field, op, _ in self._filters if op in _INEQUALITY_OPS and field != _DOCUMENT_ID]
+        if inequality and not any(field == inequality[0] for field, _ in orders):
+            if orders:
+                raise exceptions.InvalidArgument(
+                    f"The first order_by must be on the inequality field {inequality[0]}"
+                )
+            orders.append((inequality[0], ASCENDING))
+        if not any(field == _DOCUMENT_ID for field, _ in orders):
+            orders.append((_DOCUMENT_ID, orders[-1][1] if orders else ASCENDING))
+        return orders
+
+    def _cursor_values(self, cursor, orders: List[Tuple[str, str]]) -> List[Any]:
+        if isinstance(cursor, DocumentSnapshot):
+            data = cursor._data or {}
+            return [cursor.id if field == _DOCUMENT_ID else _get_field(data, field) for field, _ in orders]
+        if isinstance(cursor, dict):
+            values = []
+            for field, _ in orders:
+                if field not in cursor:
+                    break
+                value = cursor[field]
+                values.append(value.id if isinstance(value, DocumentReference) else value)
+            if not values:
+                raise exceptions.InvalidArgument("Cursor has no value for the first ordered field")
+            return values
+        raise TypeError("Cursor must be a dict of field values or a DocumentSnapshot")
+
+    def _position(self, values: List[Any], key: List[Any], orders: List[Tuple[str, str]]) -> int:
+        """Compare a document's order key with a (possibly shorter) cursor: -1, 0 or 1."""
+        for value, cursor_value, (_, direction) in zip(key, values, orders):
+            order = _compare(value, cursor_value)
+            if order:
+                return order if direction == ASCENDING else -order
+        return 0
+
+    def _passes(self, doc_id: str, data: Dict[str, Any]) -> bool:
+        for field, op, value in self._filters:
+            if not _matches(doc_id if field == _DOCUMENT_ID else _get_field(data, field), op, value):
+                return False
+        return True
+
+    def stream(self, transaction=None, timeout: Optional[float] = None) -> Iterator[DocumentSnapshot]:
+        self._client.wait()
+        orders = self._effective_orders()
+        if len(orders) == 1 and orders[0][1] == ASCENDING:
+            rows = self._rows_in_id_order()
+        else:
+            rows = self._rows_sorted(orders)
+        read_time = _now()
+        for doc_id, stored in rows:
+            reference = DocumentReference(self._client, self._collection_path, doc_id)
+            self._client._bill(1)
+            yield self._client._make_snapshot(reference, stored, self._projection, read_time)
+
+    def _rows_in_id_order(self) -> List[Tuple[str, "_Stored"]]:
+        """Matching documents of a query ordered only by id: seek to the start cursor, stop at the limit."""
+        orders = [(_DOCUMENT_ID, ASCENDING)]
+        start_id, start_inclusive = None, True
+        if self._start is not None:
+            start_id, start_inclusive = self._cursor_values(self._start[0], orders)[0], self._start[1]
+        end_id, end_inclusive = None, True
+        if self._end is not None:
+            end_id, end_inclusive = self._cursor_values(self._end[0], orders)[0], self._end[1]
+
+        wanted = None if self._limit is None else self._offset + self._limit
+        rows = []
+        for doc_id, stored in self._client._documents(self._collection_path, start_id, start_inclusive):
+            if end_id is not None and (doc_id > end_id or (doc_id == end_id and not end_inclusive)):
+                break
+            if self._filters and not self._passes(doc_id, stored.data):
+                continue
+            rows.append((doc_id, stored))
+            if wanted is not None and len(rows) >= wanted:
+                break
+        return rows[self._offset:]
+
+    def _rows_sorted(self, orders: List[Tuple[str, str]]) -> List[Tuple[str, "_Stored"]]:
+        rows = []
+        for doc_id, stored in self._client._documents(self._collection_path):
+            data = stored.data
+            if self._filters and not self._passes(doc_id, data):
+                continue
+            key = [doc_id if field == _DOCUMENT_ID else _get_field(data, field) for field, _ in orders]
+            if _MISSING in key:
+                continue
+            rows.append((key, doc_id, stored))
+
+        # Documents arrive in ascending id order; sort stably by each order, least significant first
+        for index in range(len(orders) - 1, -1, -1):
+            field, direction = orders[index]
+            if field == _DOCUMENT_ID and direction == ASCENDING:
+                continue
+            rows.sort(key=lambda row: _Key(row[0][index]), reverse=direction == DESCENDING)
+
+        if self._start is not None:
+            values, inclusive = self._cursor_values(self._start[0], orders), self._start[1]
+            rows = [row for row in rows if self._position(values, row[0], orders) > (-1 if inclusive else 0)]
+        if self._end is not None:
+            values, inclusive = self._cursor_values(self._end[0], orders), self._end[1]
+            rows = [row for row in rows if self._position(values, row[0], orders) < (1 if inclusive else 0)]
+
+        rows = rows[self._offset:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return [(doc_id, stored) for _, doc_id, stored in rows]
+
+    def get(self, transaction=None, timeout: Optional[float] = None) -> List[DocumentSnapshot]:
+        return list(self.stream(transaction=transaction, timeout=timeout))
+
+
+class AggregationResult:
+    """One aggregate of an aggregation query."""
+
+    def __init__(self, alias: str, value: int, read_time: datetime):
+        self.alias = alias
+        self.value = value
+        self.read_time = read_time
+
+
+class AggregationQuery:
+    """A count() over a query's matching documents."""
+
+    def __init__(self, query: Query, alias: str):
+        self._query = query
+        self._alias = alias
+
+    def get(self, transaction=None, timeout: Optional[float] = None) -> List[List[AggregationResult]]:
+        query = self._query
+        query._client.wait()
+        orders = query._effective_orders()
+        if len(orders) == 1 and orders[0][1] == ASCENDING:
+            count = len(query._rows_in_id_order())
+        else:
+            count = len(query._rows_sorted(orders))
+        query._client._bill(max(1, -(-count // COUNT_ENTRIES_PER_READ)))
+        return [[AggregationResult(self._alias, count, _now())]]
+
+
+class CollectionReference(Query):
+    """A collection: a query over all of its documents, plus document access."""
+
+    def __init__(self, client: "FakeFirestore", path: str):
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self._collection_path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        if document_id is None:
+            document_id = "".join(random.choice(_AUTO_ID_CHARS) for _ in range(20))
+        if "/" in document_id:
+            raise ValueError(f"Document id must not contain '/': {document_id}")
+        return DocumentReference(self._client, self._collection_path, document_id)
+
+    def add(self, document_data: Dict[str, Any], document_id: Optional[str] = None):
+        reference = self.document(document_id)
+        result = reference.create(document_data)
+        return result.update_time, reference
+
+    def list_documents(self, page_size: Optional[int] = None) -> Iterator[DocumentReference]:
+        for doc_id, _ in self._client._documents(self._collection_path):
+            yield DocumentReference(self._client, self._collection_path, doc_id)
+
+
+class WriteBatch:
+    """Writes applied together by commit(): all of them or, on any error, none."""
+
+    def __init__(self, client: "FakeFirestore"):
+        self._client = client
+        self._writes: List[Tuple] = []
+        self.committed = False
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def create(self, reference: DocumentReference, document_data: Dict[str, Any]) -> "WriteBatch":
+        self._writes.append(("create", reference, document_data, None))
+        return self
+
+    def set(self, reference: DocumentReference, document_data: Dict[str, Any], merge: bool = False) -> "WriteBatch":
+        self._writes.append(("set", reference, document_data, merge))
+        return self
+
+    def update(self, reference: DocumentReference, field_updates: Dict[str, Any], option=None) -> "WriteBatch":
+        self._writes.append(("update", reference, field_updates, None))
+        return self
+
+    def delete(self, reference: DocumentReference, option=None) -> "WriteBatch":
+        self._writes.append(("delete", reference, None, None))
+        return self
+
+    def commit(self, timeout: Optional[float] = None) -> List[WriteResult]:
+        if self.committed:
+            raise ValueError("Batch already committed")
+        results = self._client._commit(self._writes)
+        self.committed = True
+        return results
+
+    def __enter__(self) -> "WriteBatch":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is None:
+            self.commit()
+
+
+class Transaction(WriteBatch):
+    """
+    Writes committed together, only if no document the transaction read has changed.
+
+    Run a function in one with google.cloud.firestore_v1.transactional, which
+    begins it, calls the function and commits, retrying on Aborted.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, client: "FakeFirestore", max_attempts: int = 5, read_only: bool = False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id: Optional[bytes] = None
+        # (collection path, doc id) -> the stored version read (None: missing)
+        self._reads: Dict[Tuple[str, str], Optional[_Stored]] = {}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    @property
+    def id(self) -> Optional[bytes]:
+        return self._id
+
+    def _read(self, key: Tuple[str, str], stored: Optional[_Stored]) -> None:
+        if self._id is None:
+            raise ValueError("Transaction not in progress")
+        if self._writes:
+            raise exceptions.InvalidArgument(
+                "Firestore transactions require all reads to be executed before all writes."
+            )
+        self._reads.setdefault(key, stored)
+
+    def _add_write(self, write: Tuple) -> None:
+        if self._read_only:
+            raise ValueError("Cannot perform write operation in read-only transaction.")
+        self._writes.append(write)
+
+    def create(self, reference: DocumentReference, document_data: Dict[str, Any]) -> "Transaction":
+        self._add_write(("create", reference, document_data, None))
+        return self
+
+    def set(self, reference: DocumentReference, document_data: Dict[str, Any], merge: bool = False) -> "Transaction":
+        self._add_write(("set", reference, document_data, merge))
+        return self
+
+    def update(self, reference: DocumentReference, field_updates: Dict[str, Any], option=None) -> "Transaction":
+        self._add_write(("update", reference, field_updates, None))
+        return self
+
+    def delete(self, reference: DocumentReference, option=None) -> "Transaction":
+        self._add_write(("delete", reference, None, None))
+        return self
+
+    def commit(self, timeout: Optional[float] = None) -> List[WriteResult]:
+        raise ValueError("Transactions are committed by firestore_v1.transactional")
+
+    def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        if self._id is not None:
+            raise ValueError("Transaction already in progress")
+        self._id = str(next(self._ids)).encode()
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _rollback(self) -> None:
+        self._clean_up()
+
+    def _commit(self) -> List[WriteResult]:
+        if self._id is None:
+            raise ValueError("Transaction not in progress")
+        try:
+            return self._client._commit(self._writes, expected=self._reads)
+        finally:
+            self._clean_up()
+
+
+class FakeFirestore:
+    """
+    An in-memory Firestore client.
+
+    Args:
+        latency: Seconds every read or write call takes (simulated round trip)
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._lock = threading.RLock()
+        # collection path -> {doc id: _Stored}, plus each collection's ids in order
+        self._collections: Dict[str, Dict[str, _Stored]] = {}
+        self._sorted_ids: Dict[str, List[str]] = {}
+        self.documents_read = 0
+
+    def wait(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, collection_path: str) -> CollectionReference:
+        if collection_path.count("/") % 2:
+            raise ValueError(f"Not a collection path: {collection_path}")
+        return CollectionReference(self, collection_path)
+
+    def document(self, document_path: str) -> DocumentReference:
+        collection_path, _, doc_id = document_path.rpartition("/")
+        return self.collection(collection_path).document(doc_id)
+
+    def collections(self) -> Iterator[CollectionReference]:
+        with self._lock:
+            paths = [path for path, docs in self._collections.items() if docs and "/" not in path]
+        for path in sorted(paths):
+            yield CollectionReference(self, path)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> Transaction:
+        return Transaction(self, max_attempts, read_only)
+
+    def get_all(self, references: List[DocumentReference], field_paths: Optional[List[str]] = None,
+                transaction=None, timeout: Optional[float] = None) -> Iterator[DocumentSnapshot]:
+        self.wait()
+        for reference in references:
+            yield self._snapshot(reference, field_paths, transaction)
+
+    # Direct access for seeding large fixtures without per-document call overhead
+
+    def load(self, collection_path: str, documents: Dict[str, Dict[str, Any]]) -> None:
+        """Store documents as-is (no copy, no transforms): for bulk seeding only."""
+        now = _now()
+        with self._lock:
+            docs = self._collections.setdefault(collection_path, {})
+            for doc_id, data in documents.items():
+                docs[doc_id] = _Stored(data, now, now)
+            self._sorted_ids.pop(collection_path, None)
+
+    def _documents(
+        self,
+        collection_path: str,
+        start_id: Optional[str] = None,
+        inclusive: bool = True
+    ) -> Iterator[Tuple[str, _Stored]]:
+        """
+        (id, stored document) pairs of a collection in id order, from start_id on.
+
+        The ids are listed under the lock; a document deleted while the caller
+        iterates is skipped.
+        """
+        with self._lock:
+            docs = self._collections.get(collection_path)
+            if not docs:
+                return
+            ids = self._sorted_ids.get(collection_path)
+            if ids is None:
+                ids = self._sorted_ids[collection_path] = sorted(docs)
+        position = 0
+        if start_id is not None:
+            position = (bisect.bisect_left if inclusive else bisect.bisect_right)(ids, start_id)
+        for index in range(position, len(ids)):
+            stored = docs.get(ids[index])
+            if stored is not None:
+                yield ids[index], stored
+
+    def _make_snapshot(self, reference, stored: Optional[_Stored], field_paths, read_time=None) -> DocumentSnapshot:
+        # Stored data is never modified in place (commits swap in new copies),
+        # so a snapshot can share it; to_dict() hands out copies
+        if stored is None:
+            return DocumentSnapshot(reference, None, read_time=read_time)
+        data = stored.data
+        if field_paths is not None:
+            data = {}
+            for path in field_paths:
+                value = _get_field(stored.data, path)
+                if value is not _MISSING:
+                    _set_field(data, path, value)
+        return DocumentSnapshot(reference, data, stored.create_time, stored.update_time, read_time)
+
+    def _bill(self, reads: int) -> None:
+        with self._lock:
+            self.documents_read += reads
+
+    def _snapshot(self, reference: DocumentReference, field_paths=None, transaction=None) -> DocumentSnapshot:
+        # A lookup is billed whether or not the document exists
+        self._bill(1)
+        with self._lock:
+            stored = self._collections.get(reference._collection_path, {}).get(reference.id)
+            if transaction is not None:
+                transaction._read((reference._collection_path, reference.id), stored)
+            return self._make_snapshot(reference, stored, field_paths)
+
+    def _commit(
+        self,
+        writes: List[Tuple],
+        expected: Optional[Dict[Tuple[str, str], Optional[_Stored]]] = None
+    ) -> List[WriteResult]:
+        if len(writes) > MAX_BATCH_WRITES:
+            raise exceptions.InvalidArgument(f"A batch can contain at most {MAX_BATCH_WRITES} writes")
+        self.wait()
+        with self._lock:
+            for (collection_path, doc_id), stored in (expected or {}).items():
+                # Commits swap in new _Stored objects, so any write since the read shows up here
+                if self._collections.get(collection_path, {}).get(doc_id) is not stored:
+                    raise exceptions.Aborted("Too much contention on these documents. Please try again.")
+
+            # Work on copies of the touched documents so a failing write leaves the store unchanged
+            now = _now()
+            staged: Dict[Tuple[str, str], Optional[_Stored]] = {}
+            for kind, reference, data, merge in writes:
+                key = (reference._collection_path, reference.id)
+                if key not in staged:
+                    current = self._collections.get(key[0], {}).get(key[1])
+                    staged[key] = _Stored(_clone(current.data), current.create_time, now) if current else None
+                staged[key] = self._apply(kind, reference, staged[key], data, merge, now)
+
+            for (collection_path, doc_id), stored in staged.items():
+                docs = self._collections.setdefault(collection_path, {})
+                if stored is None:
+                    if docs.pop(doc_id, None) is not None:
+                        self._sorted_ids.pop(collection_path, None)
+                    continue
+                if doc_id not in docs:
+                    self._sorted_ids.pop(collection_path, None)
+                docs[doc_id] = stored
+        return [WriteResult(now) for _ in writes]
+
+    def _apply(self, kind, reference, stored: Optional[_Stored], data, merge, now) -> Optional[_Stored]:
+        if kind == "delete":
+            return None
+        if kind == "create" and stored is not None:
+            raise exceptions.AlreadyExists(f"Document already exists: {reference.path}")
+        if kind == "update" and stored is None:
+            raise exceptions.NotFound(f"No document to update: {reference.path}")
+        if not isinstance(data, dict):
+            raise TypeError("Document data must be a dict")
+
+        if stored is None:
+            stored = _Stored({}, now, now)
+        elif kind == "set" and not merge:
+            stored.data = {}
+        stored.update_time = now
+
+        for field, value in data.items():
+            if kind == "update":
+                # update() takes dotted field paths
+                self._write_field(stored.data, field, value, now)
+            elif merge and isinstance(value, dict):
+                # A merge only replaces the leaves it names
+                for path, leaf in _flatten(value, field):
+                    self._write_field(stored.data, path, leaf, now)
+            elif value is transforms.DELETE_FIELD:
+                if not merge:
+                    raise ValueError("DELETE_FIELD can only be used with update() or set(merge=True)")
+                stored.data.pop(field, None)
+            else:
+                stored.data[field] = self._resolve(value, stored.data.get(field, _MISSING), now)
+        return stored
+
+    def _write_field(self, data: Dict[str, Any], path: str, value: Any, now: datetime) -> None:
+        if value is transforms.DELETE_FIELD:
+            _delete_field(data, path)
+            return
+        _set_field(data, path, self._resolve(value, _get_field(data, path), now))
+
+    def _resolve(self, value: Any, current: Any, now: datetime) -> Any:
+        if value is transforms.SERVER_TIMESTAMP:
+            return now
+        if isinstance(value, transforms.Increment):
+            base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+            return base + value.value
+        if isinstance(value, transforms.ArrayUnion):
+            items = list(current) if isinstance(current, list) else []
+            return items + [item for item in value.values if item not in items]
+        if isinstance(value, transforms.ArrayRemove):
+            items = list(current) if isinstance(current, list) else []
+            return [item for item in items if item not in value.values]
+        if isinstance(value, transforms.Sentinel):
+            raise exceptions.InvalidArgument(f"Unsupported field transform: {value}")
+        if isinstance(value, dict):
+            return {key: self._resolve(nested, _MISSING, now) for key, nested in value.items()}
+        return _clone(value)
+
+
+def _flatten(value: Dict[str, Any], prefix: str) -> Iterator[Tuple[str, Any]]:
+    """Dotted paths of a nested dict's leaves (a merge set() only replaces leaves)."""
+    if not value:
+        yield prefix, {}
+        return
+    for key, nested in value.items():
+        path = f"{prefix}.{key}"
+        if isinstance(nested, dict):
+            yield from _flatten(nested, path)
+        else:
+            yield path, nested
@@ -0,0 +1,138 @@
+"""
+In-memory stand-ins for Firestore and the FCM HTTP API.
+
+FakeFirestore (benchmarks.fake_firestore) replaces the Firestore client.
+FakeFCM replaces the SDK's send calls with a local transport that takes a
+configurable time per call and fails a configurable share of messages, so
+delivery runs through all of the service's own code (message building,
+breaker, metrics, failure summaries).
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+from unittest.mock import patch
+
+import firebase_service
+import token_manager
+from benchmarks.fake_firestore import FakeFirestore
+
+
+def seed_tokens(db: FakeFirestore, count: int, app_ids: List[str], users: int = 0) -> None:
+    """Register count tokens, spread round-robin over app_ids (and users if given)."""
+    docs = {}
+    for i in range(count):
+        token = f"bench-token-{i:08d}"
+        data = {"token": token, "app_id": app_ids[i % len(app_ids)]}
+        if users:
+            data["user_id"] = f"user-{i % users}"
+        docs[token] = data
+    db.load(token_manager.COLLECTION_NAME, docs)
+
+
+class FakeFCM:
+    """
+    A local FCM transport.
+
+    Args:
+        latency: Seconds every send call takes
+        error_rate: Share of messages rejected as unregistered tokens
+        seed: Seed for choosing which messages fail
+        keep_calls: Call durations to keep (None: all of them)
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        keep_calls: Optional[int] = None
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.messages = 0
+        self.call_seconds = deque(maxlen=keep_calls)
+
+    def _response(self, messaging):
+        if self.error_rate and self._random.random() < self.error_rate:
+            return messaging.SendResponse(None, messaging.UnregisteredError("Requested entity was not found."))
+        return messaging.SendResponse({"name": "projects/bench/messages/1"}, None)
+
+    def _record(self, started: float, messages: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.messages += messages
+            self.call_seconds.append(time.perf_counter() - started)
+
+    def send(self, message, dry_run: bool = False, app=None) -> str:
+        started = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        messaging = firebase_service.messaging
+        with self._lock:
+            response = self._response(messaging)
+        self._record(started, 1)
+        if response.exception:
+            raise response.exception
+        return response.message_id
+
+    def send_each_for_multicast(self, multicast_message, dry_run: bool = False, app=None):
+        started = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        messaging = firebase_service.messaging
+        with self._lock:
+            responses = [self._response(messaging) for _ in multicast_message.tokens]
+        self._record(started, len(responses))
+        return messaging.BatchResponse(responses)
+
+    def send_each(self, messages, dry_run: bool = False, app=None):
+        started = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        messaging = firebase_service.messaging
+        with self._lock:
+            responses = [self._response(messaging) for _ in messages]
+        self._record(started, len(responses))
+        return messaging.BatchResponse(responses)
+
+
+def install(db: FakeFirestore, fcm: FakeFCM) -> Callable[[], None]:
+    """
+    Route the service's Firestore and FCM calls to the fakes.
+
+    Returns:
+        A function that restores the real clients
+    """
+    firebase_service.load_sdk()
+    token_manager.set_firestore_client(db)
+    patchers = [
+        patch.object(firebase_service, "_firebase_app", object()),
+        patch.object(firebase_service.messaging, "send", fcm.send),
+        patch.object(firebase_service.messaging, "send_each_for_multicast", fcm.send_each_for_multicast),
+        patch.object(firebase_service.messaging, "send_each", fcm.send_each)
+    ]
+    for patcher in patchers:
+        patcher.start()
+
+    def uninstall() -> None:
+        for patcher in reversed(patchers):
+            patcher.stop()
+        token_manager.set_firestore_client(None)
+    return uninstall
+
+
+@contextmanager
+def installed(db: FakeFirestore, fcm: FakeFCM) -> Iterator[None]:
+    """Route the service's Firestore and FCM calls to the fakes for the duration of the block."""
+    uninstall = install(db, fcm)
+    try:
+        yield
+    finally:
+        uninstall()
@@ -0,0 +1,435 @@
+"""
+HTTP load test of the service under gunicorn, with fake FCM and token store.
+
+Starts gunicorn (gunicorn.conf.py, benchmarks.fake_app:app) on a local port,
+then sends a weighted mix of register-token, send-notification, send-to-user
+and send-to-app requests at each target rate in turn. Requests are issued on
+a fixed schedule whether or not earlier ones have finished (open loop), and
+latency is measured from the scheduled time, so a saturated server shows up
+as growing latency instead of a lower request rate.
+
+For every step and endpoint it reports the achieved rate, latency
+percentiles and errors by status. An endpoint's saturation point is the
+first step at which its p99 exceeds --slo-ms, its error rate exceeds
+--max-error-rate, or the service falls behind the schedule.
+
+Usage:
+    python -m benchmarks.loadtest --rps 20,50,100,200 --duration 20
+    python -m benchmarks.loadtest --mix send-to-app=1 --rps 5,10 --fake-tokens 100000 --output load.json
+    python -m benchmarks.loadtest --url https://staging.example.com --rps 10   # existing server, no fakes
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from benchmarks.run import ROOT, git_revision, latency_summary
+
+ENDPOINTS = {
+    "register-token": "/api/register-token",
+    "send-notification": "/api/send-notification",
+    "send-to-user": "/api/send-to-user",
+    "send-to-app": "/api/send-to-app",
+}
+DEFAULT_MIX = "register-token=40,send-notification=30,send-to-user=20,send-to-app=10"
+
+# A step is behind schedule when it achieves less than this share of its target rate
+MIN_ACHIEVED_SHARE = 0.9
+
+READY_TIMEOUT = 60
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """
+    Parse "endpoint=weight,..." into normalized shares.
+
+    Raises:
+        ValueError: If an endpoint is unknown or no weight is positive
+    """
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in mix: {name} (expected one of {', '.join(ENDPOINTS)})")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("Mix weights must add up to more than 0")
+    return {name: weight / total for name, weight in weights.items() if weight > 0}
+
+
+def interleave(mix: Dict[str, float]) -> Callable[[], str]:
+    """
+    Pick endpoints in proportion to their shares, spread evenly (smooth
+    weighted round robin), so every step sends each endpoint its exact share.
+    """
+    credits = {endpoint: 0.0 for endpoint in mix}
+
+    def pick() -> str:
+        for endpoint, share in mix.items():
+            credits[endpoint] += share
+        endpoint = max(credits, key=credits.get)
+        credits[endpoint] -= 1
+        return endpoint
+    return pick
+
+
+class Workload:
+    """
+    Builds request bodies against the seeded fake store.
+
+    Args:
+        tokens: Seeded token count
+        apps: Seeded app count
+        users: Seeded user count
+        seed: Random seed, so runs send the same sequence of requests
+    """
+
+    def __init__(self, tokens: int, apps: int, users: int, seed: int = 0):
+        self.tokens = tokens
+        self.apps = apps
+        self.users = users
+        self._random = random.Random(seed)
+        self._registered = 0
+        self._lock = threading.Lock()
+
+    def body(self, endpoint: str) -> Dict[str, Any]:
+        with self._lock:
+            app_id = f"loadtest-app-{self._random.randrange(self.apps)}"
+            user_id = f"user-{self._random.randrange(self.users)}"
+            token = f"bench-token-{self._random.randrange(self.tokens):08d}"
+            if endpoint == "register-token":
+                self._registered += 1
+                token = f"loadtest-new-{os.getpid()}-{self._registered:08d}"
+        message = {"title": "Load test", "body": "Load test notification"}
+        if endpoint == "register-token":
+            return {"token": token, "app_id": app_id, "user_id": user_id, "device_type": "web", "platform": "chrome"}
+        if endpoint == "send-notification":
+            return {"token": token, **message}
+        if endpoint == "send-to-user":
+            return {"user_id": user_id, **message}
+        return {"app_id": app_id, **message}
+
+
+class Client:
+    """Keep-alive HTTP connections, one per sending thread."""
+
+    def __init__(self, url: str, api_key: Optional[str] = None, timeout: float = 30.0):
+        parsed = urlparse(url)
+        self._connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        self._host = parsed.netloc
+        self._prefix = parsed.path.rstrip("/")
+        self._headers = {"Content-Type": "application/json"}
+        if api_key:
+            self._headers["Authorization"] = f"Bearer {api_key}"
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def post(self, path: str, body: Dict[str, Any]) -> int:
+        """POST JSON and return the status code (retries once on a stale keep-alive connection)."""
+        payload = json.dumps(body)
+        for attempt in (1, 2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = self._connection_class(self._host, timeout=self._timeout)
+            try:
+                connection.request("POST", self._prefix + path, body=payload, headers=self._headers)
+                response = connection.getresponse()
+                response.read()
+                if response.getheader("Connection", "").lower() == "close":
+                    self._drop()
+                return response.status
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._drop()
+                if attempt == 2:
+                    raise
+        raise AssertionError("unreachable")
+
+    def get(self, path: str) -> int:
+        connection = self._connection_class(self._host, timeout=self._timeout)
+        try:
+            connection.request("GET", self._prefix + path)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def _drop(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+
+class StepStats:
+    """Outcomes of one step, per endpoint."""
+
+    def __init__(self, endpoints: List[str]):
+        self._lock = threading.Lock()
+        self.latencies = {endpoint: [] for endpoint in endpoints}
+        self.statuses = {endpoint: {} for endpoint in endpoints}
+
+    def record(self, endpoint: str, latency: float, status: str) -> None:
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] = self.statuses[endpoint].get(status, 0) + 1
+
+
+def run_step(
+    client: Client,
+    workload: Workload,
+    mix: Dict[str, float],
+    rps: float,
+    duration: float,
+    concurrency: int
+) -> Dict[str, Any]:
+    """Send requests at rps for duration seconds and summarize them."""
+    endpoints = list(mix)
+    pick = interleave(mix)
+    stats = StepStats(endpoints)
+
+    def send(endpoint: str, scheduled: float) -> None:
+        try:
+            status = str(client.post(ENDPOINTS[endpoint], workload.body(endpoint)))
+        except (OSError, http.client.HTTPException) as e:
+            status = type(e).__name__
+        stats.record(endpoint, time.perf_counter() - scheduled, status)
+
+    total = int(rps * duration)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="loadtest") as pool:
+        started = time.perf_counter()
+        for i in range(total):
+            scheduled = started + i / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, pick(), scheduled)
+    elapsed = time.perf_counter() - started
+
+    step = {"target_rps": rps, "requests": total, "seconds": round(elapsed, 3), "endpoints": {}}
+    for endpoint in endpoints:
+        latencies = stats.latencies[endpoint]
+        statuses = stats.statuses[endpoint]
+        errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+        step["endpoints"][endpoint] = {
+            "target_rps": round(rps * mix[endpoint], 3),
+            "achieved_rps": round(len(latencies) / elapsed, 3),
+            "requests": len(latencies),
+            "error_rate": round(errors / len(latencies), 4) if latencies else 0.0,
+            "statuses": statuses,
+            "latency_ms": latency_summary(latencies)
+        }
+    return step
+
+
+def saturation(steps: List[Dict[str, Any]], slo_ms: float, max_error_rate: float) -> Dict[str, Dict[str, Any]]:
+    """
+    Find each endpoint's saturation point.
+
+    Returns:
+        {endpoint: {"sustained_rps", "saturated_at_rps", "reason"}}, where
+        sustained_rps is the highest total rate the endpoint kept up with
+        before its first failing step
+    """
+    report = {}
+    for endpoint in steps[0]["endpoints"] if steps else ():
+        sustained, saturated_at, reason = None, None, None
+        for step in steps:
+            result = step["endpoints"][endpoint]
+            reason = _saturation_reason(result, slo_ms, max_error_rate)
+            if reason:
+                saturated_at = step["target_rps"]
+                break
+            sustained = step["target_rps"]
+        report[endpoint] = {"sustained_rps": sustained, "saturated_at_rps": saturated_at, "reason": reason}
+    return report
+
+
+def _saturation_reason(result: Dict[str, Any], slo_ms: float, max_error_rate: float) -> Optional[str]:
+    p99 = result["latency_ms"]["p99"]
+    if p99 is not None and p99 > slo_ms:
+        return f"p99 {p99:.0f} ms > {slo_ms:.0f} ms"
+    if result["error_rate"] > max_error_rate:
+        return f"error rate {result['error_rate']:.1%} > {max_error_rate:.1%}"
+    if result["achieved_rps"] < result["target_rps"] * MIN_ACHIEVED_SHARE:
+        return f"achieved {result['achieved_rps']:.1f}/s of {result['target_rps']:.1f}/s"
+    return None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args: argparse.Namespace) -> Tuple[subprocess.Popen, str, Callable[[], None]]:
+    """
+    Start gunicorn serving benchmarks.fake_app and wait until it is ready.
+
+    Returns:
+        Tuple of (process, base URL, stop function)
+    """
+    port = args.port or _free_port()
+    data_dir = tempfile.mkdtemp(prefix="notification-loadtest-")
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "DATA_DIR": data_dir,
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(data_dir, "metrics"),
+        "SCHEDULER_ENABLED": "false",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "GUNICORN_LOG_LEVEL": os.getenv("GUNICORN_LOG_LEVEL", "warning"),
+        "API_KEY": "",
+        "API_KEYS": "",
+        "FIREBASE_PROJECTS": "",
+        "FAKE_TOKENS": str(args.fake_tokens),
+        "FAKE_APPS": str(args.fake_apps),
+        "FAKE_USERS": str(args.fake_users),
+        "FAKE_FCM_LATENCY_MS": str(args.fcm_latency_ms),
+        "FAKE_FCM_ERROR_RATE": str(args.fcm_error_rate),
+        "FAKE_STORE_LATENCY_MS": str(args.store_latency_ms),
+    }
+    if args.workers:
+        env["WEB_CONCURRENCY"] = str(args.workers)
+    if args.threads:
+        env["GUNICORN_THREADS"] = str(args.threads)
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "benchmarks.fake_app:app"],
+        cwd=ROOT, env=env
+    )
+    url = f"http://127.0.0.1:{port}"
+
+    def stop() -> None:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    client = Client(url, timeout=5)
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            if client.get("/api/ready") == 200:
+                return process, url, stop
+        except OSError:
+            pass
+        time.sleep(0.2)
+    stop()
+    raise RuntimeError(f"Service not ready after {READY_TIMEOUT}s")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rps", default="10,25,50,100", help="Comma-separated target request rates, one step each")
+    parser.add_argument("--duration", type=float, default=15, help="Seconds per step")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Endpoint weights, e.g. send-to-app=1,register-token=3")
+    parser.add_argument("--concurrency", type=int, default=256, help="Maximum requests in flight from the client")
+    parser.add_argument("--slo-ms", type=float, default=1000, help="p99 latency above which an endpoint is saturated")
+    parser.add_argument("--max-error-rate", type=float, default=0.01,
+                        help="Error rate above which an endpoint is saturated")
+    parser.add_argument("--stop-on-saturation", action="store_true",
+                        help="Stop after the first step at which every endpoint is saturated")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the request bodies")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    server = parser.add_argument_group("server (ignored with --url)")
+    server.add_argument("--url", help="Load an already running service instead of starting one")
+    server.add_argument("--api-key", default=os.getenv("API_KEY"), help="API key for --url")
+    server.add_argument("--port", type=int, default=0, help="Port for the started service (default: a free one)")
+    server.add_argument("--workers", type=int, default=0, help="gunicorn workers (default: gunicorn.conf.py)")
+    server.add_argument("--threads", type=int, default=0, help="Threads per worker (default: gunicorn.conf.py)")
+    server.add_argument("--fake-tokens", type=int, default=10000, help="Tokens seeded in the fake store")
+    server.add_argument("--fake-apps", type=int, default=10, help="Apps the seeded tokens belong to")
+    server.add_argument("--fake-users", type=int, default=1000, help="Users the seeded tokens belong to")
+    server.add_argument("--fcm-latency-ms", type=float, default=50, help="Time every fake FCM call takes")
+    server.add_argument("--fcm-error-rate", type=float, default=0.0, help="Share of messages the fake FCM rejects")
+    server.add_argument("--store-latency-ms", type=float, default=5, help="Time every fake Firestore call takes")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+        rates = [float(rate) for rate in args.rps.split(",") if rate]
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+
+    stop = None
+    url = args.url
+    if not url:
+        _, url, stop = start_server(args)
+
+    report = {
+        **git_revision(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "target": args.url or "gunicorn benchmarks.fake_app:app",
+        "config": {
+            key: getattr(args, key) for key in (
+                "duration", "mix", "concurrency", "slo_ms", "max_error_rate", "seed", "workers", "threads",
+                "fake_tokens", "fake_apps", "fake_users", "fcm_latency_ms", "fcm_error_rate", "store_latency_ms"
+            )
+        },
+        "steps": []
+    }
+    workload = Workload(args.fake_tokens, args.fake_apps, args.fake_users, seed=args.seed)
+    client = Client(url, api_key=args.api_key if args.url else None)
+    try:
+        for rps in rates:
+            step = run_step(client, workload, mix, rps, args.duration, args.concurrency)
+            report["steps"].append(step)
+            for endpoint, result in step["endpoints"].items():
+                print(
+                    f"{rps:>7.1f}/s {endpoint:18} {result['achieved_rps']:>7.1f}/s "
+                    f"p50 {result['latency_ms']['p50']} ms p99 {result['latency_ms']['p99']} ms "
+                    f"errors {result['error_rate']:.1%} {result['statuses']}",
+                    file=sys.stderr
+                )
+            if args.stop_on_saturation and all(
+                _saturation_reason(result, args.slo_ms, args.max_error_rate)
+                for result in step["endpoints"].values()
+            ):
+                break
+    finally:
+        if stop:
+            stop()
+
+    report["saturation"] = saturation(report["steps"], args.slo_ms, args.max_error_rate)
+    for endpoint, point in report["saturation"].items():
+        print(
+            f"{endpoint:18} sustained {point['sustained_rps'] or '-'}/s, "
+            f"saturated at {point['saturated_at_rps'] or '-'}/s {point['reason'] or ''}",
+            file=sys.stderr
+        )
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+Benchmark /api/send-to-app and /api/broadcast end to end, offline.
+
+Every (scenario, audience size) case runs in its own process, so its peak RSS
+is not inflated by earlier, larger cases. A case seeds the fake token store,
+then sends requests through the Flask app and reports throughput, request and
+FCM call latency percentiles and memory.
+
+Usage:
+    python -m benchmarks.run                               # 1k, 100k and 1M tokens
+    python -m benchmarks.run --sizes 1000,10000 --fcm-latency-ms 50 --output bench.json
+    python -m benchmarks.compare base.json bench.json      # flag regressions
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("send_to_app", "broadcast")
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+BENCH_APP_ID = "bench-app"
+
+# Requests per case: enough for stable percentiles on small audiences,
+# without making the 1M case take minutes
+TOKENS_PER_CASE = 200_000
+MAX_REQUESTS = 50
+
+RESULTS_VERSION = 1
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile (None for no values)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def latency_summary(seconds: List[float]) -> Dict[str, Optional[float]]:
+    """p50, p99 and max in milliseconds."""
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+    return {
+        "p50": ms(percentile(seconds, 50)),
+        "p99": ms(percentile(seconds, 99)),
+        "max": ms(max(seconds) if seconds else None)
+    }
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes (0 where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def requests_for(size: int) -> int:
+    return max(1, min(MAX_REQUESTS, TOKENS_PER_CASE // size))
+
+
+def run_case(scenario: str, size: int, requests: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run one case in this process (called in the child)."""
+    # Imported here so the parent never loads the service
+    from benchmarks import fakes
+    from app import app
+    imported = current_rss()
+
+    db = fakes.FakeFirestore(latency=args.store_latency_ms / 1000)
+    fcm = fakes.FakeFCM(latency=args.fcm_latency_ms / 1000, error_rate=args.fcm_error_rate, seed=args.seed)
+    fakes.seed_tokens(db, size, [BENCH_APP_ID])
+    seeded = current_rss()
+
+    if scenario == "send_to_app":
+        path, body = "/api/send-to-app", {"app_id": BENCH_APP_ID, "title": "Bench", "body": "Benchmark"}
+    else:
+        path, body = "/api/broadcast", {"title": "Bench", "body": "Benchmark"}
+    payload = json.dumps(body)
+
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    with fakes.installed(db, fcm):
+        # One untimed request loads the SDK and warms caches
+        client.post(path, data=payload, content_type="application/json")
+        fcm.call_seconds.clear()
+        fcm.calls = fcm.messages = 0
+
+        started = time.perf_counter()
+        for _ in range(requests):
+            request_started = time.perf_counter()
+            response = client.post(path, data=payload, content_type="application/json")
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code != 200 or response.get_json()["sent_to"] + response.get_json()["failed"] != size:
+                errors += 1
+        elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": scenario,
+        "tokens": size,
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "tokens_per_second": round(size * requests / elapsed, 1),
+        "requests_per_second": round(requests / elapsed, 3),
+        "latency_ms": latency_summary(latencies),
+        "fcm_calls": fcm.calls,
+        "fcm_call_ms": latency_summary(fcm.call_seconds),
+        "rss_bytes": {"imported": imported, "seeded": seeded, "peak": peak_rss()}
+    }
+
+
+def spawn_case(scenario: str, size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run one case in a fresh interpreter and return its result."""
+    requests = args.requests or requests_for(size)
+    env = {
+        **os.environ,
+        "DATA_DIR": tempfile.mkdtemp(prefix="notification-bench-"),
+        "SCHEDULER_ENABLED": "false",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "API_KEY": "",
+        "API_KEYS": "",
+        "FIREBASE_PROJECTS": ""
+    }
+    command = [
+        sys.executable, "-m", "benchmarks.run", "--case", f"{scenario}:{size}:{requests}",
+        "--fcm-latency-ms", str(args.fcm_latency_ms),
+        "--fcm-error-rate", str(args.fcm_error_rate),
+        "--store-latency-ms", str(args.store_latency_ms),
+        "--seed", str(args.seed)
+    ]
+    completed = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{scenario} at {size} tokens failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_revision() -> Dict[str, Any]:
+    def git(*command):
+        return subprocess.run(["git", *command], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {
+        "commit": git("rev-parse", "HEAD") or None,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma-separated audience sizes")
+    parser.add_argument("--requests", type=int, default=0, help="Timed requests per case (default: by size)")
+    parser.add_argument("--fcm-latency-ms", type=float, default=0.0, help="Time every fake FCM call takes")
+    parser.add_argument("--fcm-error-rate", type=float, default=0.0, help="Share of messages FCM rejects")
+    parser.add_argument("--store-latency-ms", type=float, default=0.0, help="Time every fake Firestore call takes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for error injection")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    if args.case:
+        scenario, size, requests = args.case.split(":")
+        print(json.dumps(run_case(scenario, int(size), int(requests), args)))
+        return 0
+
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    results = {
+        "version": RESULTS_VERSION,
+        **git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "fcm_latency_ms": args.fcm_latency_ms,
+            "fcm_error_rate": args.fcm_error_rate,
+            "store_latency_ms": args.store_latency_ms,
+            "seed": args.seed
+        },
+        "results": []
+    }
+    for size in (int(size) for size in args.sizes.split(",") if size):
+        for scenario in scenarios:
+            result = spawn_case(scenario, size, args)
+            results["results"].append(result)
+            print(
+                f"{scenario:12} {size:>9} tokens: {result['tokens_per_second']:>12,.0f} tokens/s, "
+                f"p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms, "
+                f"peak RSS {result['rss_bytes']['peak'] / 2**20:.0f} MiB",
+                file=sys.stderr
+            )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Benchmark a user's token lookup: device_tokens query versus index document.
+
+Seeds the fake token store with users of each size, builds their index
+documents with rebuild_user_index, then looks every user up both ways and
+reports p50/p99 latency and billed reads per lookup.
+
+The fake answers a query by scanning the collection in memory, while Firestore
+serves it from an index, so in-process query times grow with the collection
+and overstate the difference. Billed reads match Firestore's. Use
+--store-latency-ms to add a round trip to every call; for real latencies run
+against the Firestore emulator or a project.
+
+Usage:
+    python -m benchmarks.user_index                                # 1, 5 and 50 tokens per user
+    python -m benchmarks.user_index --tokens-per-user 3 --users 1000 --store-latency-ms 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.run import latency_summary
+
+DEFAULT_TOKENS_PER_USER = (1, 5, 50)
+BENCH_APP_ID = "bench-app"
+
+
+def run_case(tokens_per_user: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Seed one user size and time both lookups for every user."""
+    # Imported here so the environment is set before the service loads
+    import token_manager
+    import rebuild_user_index
+    from benchmarks import fakes
+
+    db = fakes.FakeFirestore()
+    user_ids = [f"user-{i}" for i in range(args.users)]
+    db.load(token_manager.COLLECTION_NAME, {
+        f"bench-token-{i:05d}-{n:03d}": {
+            "token": f"bench-token-{i:05d}-{n:03d}", "app_id": BENCH_APP_ID, "user_id": user_id
+        }
+        for i, user_id in enumerate(user_ids) for n in range(tokens_per_user)
+    })
+
+    with fakes.installed(db, fakes.FakeFCM()):
+        if rebuild_user_index.rebuild(user_ids, workers=1):
+            raise RuntimeError("Rebuilding the index failed")
+        db.latency = args.store_latency_ms / 1000
+
+        result = {"tokens_per_user": tokens_per_user, "users": args.users}
+        for name, lookup in (
+            ("query", token_manager.query_user_tokens),
+            ("index", token_manager.lookup_user_index)
+        ):
+            latencies = []
+            reads = db.documents_read
+            for user_id in user_ids:
+                started = time.perf_counter()
+                tokens = lookup(user_id, BENCH_APP_ID)
+                latencies.append(time.perf_counter() - started)
+                if len(tokens or ()) != tokens_per_user:
+                    raise RuntimeError(f"{name} lookup of {user_id} found {len(tokens or ())} tokens")
+            result[name] = {
+                "latency_ms": latency_summary(latencies),
+                "reads_per_lookup": round((db.documents_read - reads) / len(user_ids), 2)
+            }
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens-per-user", default=",".join(str(n) for n in DEFAULT_TOKENS_PER_USER),
+                        help="Comma-separated tokens per user, one case each")
+    parser.add_argument("--users", type=int, default=200, help="Users seeded, and looked up, per case")
+    parser.add_argument("--store-latency-ms", type=float, default=0.0, help="Time every fake Firestore call takes")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="notification-bench-"))
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    results = {"config": {"users": args.users, "store_latency_ms": args.store_latency_ms}, "results": []}
+    for tokens_per_user in (int(n) for n in args.tokens_per_user.split(",") if n):
+        result = run_case(tokens_per_user, args)
+        results["results"].append(result)
+        print(
+            f"{tokens_per_user:>4} tokens/user: "
+            f"query p50 {result['query']['latency_ms']['p50']} ms, p99 {result['query']['latency_ms']['p99']} ms, "
+            f"{result['query']['reads_per_lookup']} reads; "
+            f"index p50 {result['index']['latency_ms']['p50']} ms, p99 {result['index']['latency_ms']['p99']} ms, "
+            f"{result['index']['reads_per_lookup']} reads",
+            file=sys.stderr
+        )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+Resumable broadcasts.
+
+A broadcast job walks the device_tokens collection in document id order, one
+FCM-sized page at a time, and persists its progress so it can stop at any
+point (failure, cancel, worker shutdown, process crash) and be resumed later
+without re-sending to devices it already reached.
+
+Per page the job:
+
+1. records the page as in_flight (write-ahead) in the job state,
+2. sends it,
+3. appends the page's outcome to the job's result log,
+4. advances the cursor (last processed document id) and clears in_flight.
+
+On resume, an in_flight page with a result in the log is counted as done. One
+without a result may or may not have reached FCM; it is recorded with outcome
+"unknown" and skipped, so every token is attempted at most once.
+
+Pages are sent with the outbox fallback off: an open breaker stops the job at
+its cursor ("interrupted") instead of moving the rest of the audience into the
+outbox. While a page is being sent (including waiting for room under the
+tokens-in-flight cap) the job is touched every HEARTBEAT_SECONDS, so it is
+never taken for abandoned while its worker is alive.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, Optional, Tuple
+import api_keys
+import circuit_breaker
+import fanout
+import jobs
+import shutdown
+import token_manager
+from circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# One page is one FCM multicast call, so an interrupted page is never split
+PAGE_SIZE = fanout.FCM_MULTICAST_LIMIT
+
+# A running job whose state has not changed for this long is treated as
+# abandoned (its worker died) and may be resumed
+STALE_SECONDS = 300
+
+# How often a job touches its state while a page is being sent
+HEARTBEAT_SECONDS = STALE_SECONDS / 5
+
+COUNTERS = ("processed", "sent", "failed", "queued", "unknown")
+
+
+def start_broadcast(message: Dict[str, Any], api_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Create a resumable broadcast job and start it in the background.
+
+    Args:
+        message: deliver() arguments other than tokens (title, body, icon, badge, data)
+        api_key: Name of the key that started it; its tokens-per-minute limit paces the job
+
+    Returns:
+        The created job
+    """
+    job = jobs.create_job(
+        "broadcast",
+        {"message": message, "api_key": api_key},
+        cursor=None, in_flight=None, chunks=0, errors={},
+        **{counter: 0 for counter in COUNTERS}
+    )
+    jobs.start(job, run_broadcast)
+    logger.info(f"Started resumable broadcast {job['id']}")
+    return job
+
+
+def resumable(job: Dict[str, Any]) -> bool:
+    """Whether a broadcast job can be resumed now."""
+    if job["kind"] != "broadcast":
+        return False
+    if job["status"] in (jobs.INTERRUPTED, jobs.FAILED):
+        return True
+    if job["status"] in (jobs.PENDING, jobs.RUNNING):
+        updated_at = datetime.fromisoformat(job["updated_at"])
+        return datetime.utcnow() - updated_at > timedelta(seconds=STALE_SECONDS)
+    return False
+
+
+def resume(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Continue a broadcast from its last checkpoint in the background.
+
+    Returns:
+        The job, or None if it is not resumable (finished, running, or not a broadcast)
+    """
+    job = jobs.transition(job_id, resumable, status=jobs.RUNNING, error=None, resumed_at=datetime.utcnow().isoformat())
+    if job is None:
+        return None
+    jobs.start(job, run_broadcast)
+    logger.info(f"Resumed broadcast {job_id} after {job['chunks']} chunks")
+    return job
+
+
+def run_broadcast(job_id: str) -> None:
+    """Send a broadcast job's remaining pages (blocking)."""
+    job = jobs.get_job(job_id)
+    message = job["params"]["message"]
+    key = api_keys.get_key(job["params"].get("api_key"))
+    totals = {counter: job.get(counter, 0) for counter in COUNTERS}
+    errors = dict(job.get("errors") or {})
+    cursor = job.get("cursor")
+    index = job.get("chunks", 0)
+
+    if job.get("in_flight"):
+        cursor, index = _recover(job_id, job["in_flight"], totals, errors)
+        jobs.update_job(job_id, cursor=cursor, in_flight=None, chunks=index, errors=errors, **totals)
+    jobs.update_job(job_id, status=jobs.RUNNING)
+
+    status, error = jobs.COMPLETED, None
+    while True:
+        if jobs.cancel_requested(job_id):
+            status = jobs.CANCELLED
+            break
+        if shutdown.should_stop_sending():
+            status = jobs.INTERRUPTED
+            break
+
+        try:
+            page = token_manager.get_token_page(after=cursor, limit=PAGE_SIZE)
+        except CircuitOpenError as e:
+            status, error = jobs.INTERRUPTED, str(e)
+            break
+        if not page:
+            break
+        if not charge(job_id, key, len(page)):
+            status = jobs.INTERRUPTED
+            break
+
+        in_flight = {"index": index, "after": cursor, "last_doc_id": page[-1][0], "tokens": len(page)}
+        jobs.update_job(job_id, in_flight=in_flight)
+        try:
+            with circuit_breaker.fail_fast(), heartbeat(job_id):
+                result = fanout.deliver([token for _, token in page], send_id=job_id, **message)
+        except CircuitOpenError as e:
+            # The breaker refused the call, so nothing in this page was sent
+            jobs.update_job(job_id, in_flight=None)
+            status, error = jobs.INTERRUPTED, str(e)
+            break
+
+        record = {
+            **in_flight,
+            "outcome": "sent",
+            "sent": result["sent_to"],
+            "failed": result["failed"],
+            "queued": result["queued"],
+            "errors": result["errors"],
+            "finished_at": datetime.utcnow().isoformat()
+        }
+        jobs.append_result(job_id, record)
+        _count(record, totals, errors)
+        cursor, index = in_flight["last_doc_id"], index + 1
+        jobs.update_job(job_id, cursor=cursor, in_flight=None, chunks=index, errors=errors, **totals)
+
+    jobs.update_job(job_id, status=status, error=error)
+    logger.info(
+        f"Broadcast {job_id} {status}: {totals['sent']} sent, {totals['failed']} failed, "
+        f"{totals['queued']} queued, {totals['unknown']} unknown after {index} chunks"
+    )
+
+
+def _recover(job_id: str, in_flight: Dict[str, Any], totals: Dict[str, int], errors: Dict[str, int]) -> Tuple[str, int]:
+    """Settle the page a previous run was sending when it stopped. Returns (cursor, next index)."""
+    results = jobs.read_results(job_id)
+    if results and results[-1]["index"] == in_flight["index"]:
+        # Sent and logged; only the job state update was lost
+        record = results[-1]
+    else:
+        record = {**in_flight, "outcome": "unknown", "finished_at": datetime.utcnow().isoformat()}
+        jobs.append_result(job_id, record)
+        logger.warning(
+            f"Broadcast {job_id}: chunk {in_flight['index']} ({in_flight['tokens']} tokens) may have been "
+            f"sent before the job stopped; skipping it so no device is notified twice"
+        )
+    _count(record, totals, errors)
+    return in_flight["last_doc_id"], in_flight["index"] + 1
+
+
+def _count(record: Dict[str, Any], totals: Dict[str, int], errors: Dict[str, int]) -> None:
+    totals["processed"] += record["tokens"]
+    if record["outcome"] == "unknown":
+        totals["unknown"] += record["tokens"]
+        return
+    for counter in ("sent", "failed", "queued"):
+        totals[counter] += record[counter]
+    for code, count in record["errors"].items():
+        errors[code] = errors.get(code, 0) + count
+
+
+@contextmanager
+def heartbeat(job_id: str) -> Iterator[None]:
+    """
+    Touch the job every HEARTBEAT_SECONDS for the duration of the block, so a
+    long send or wait is not taken for an abandoned job (also used by rollouts).
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                jobs.update_job(job_id, heartbeat_at=datetime.utcnow().isoformat())
+            except Exception as e:
+                logger.warning(f"Job {job_id}: heartbeat failed: {str(e)}")
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{job_id[:8]}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def charge(job_id: str, key: Optional[Dict[str, Any]], count: int) -> bool:
+    """
+    Charge a page against the starting key's token rate, waiting while it is
+    over (also used by rollouts for each batch).
+
+    Returns:
+        False if the worker started shutting down while waiting
+    """
+    waited = False
+    while True:
+        try:
+            api_keys.charge_tokens(key, count)
+        except api_keys.RateLimited as e:
+            # Keep the heartbeat fresh so the wait is not mistaken for a dead job
+            jobs.update_job(job_id, waiting_until=(datetime.utcnow() + timedelta(seconds=e.retry_after)).isoformat())
+            waited = True
+            if shutdown.wait(e.retry_after):
+                return False
+            continue
+        if waited:
+            jobs.update_job(job_id, waiting_until=None)
+        return True
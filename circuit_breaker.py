@@ -0,0 +1,276 @@
+"""
+Circuit breakers around the external dependencies (FCM and Firestore).
+
+A breaker watches the outcome and latency of recent calls. When too many of
+them fail or are too slow it opens and rejects calls immediately with
+CircuitOpenError, so a degraded dependency cannot tie up every worker. After a
+cool-down it lets a few probe calls through (half-open) and closes again once
+they succeed.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Type
+from metrics import BREAKER_REJECTED, BREAKER_STATE
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Numeric encoding of the state for the circuit_breaker_state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name} is unavailable (circuit open), retry after {retry_after:.0f}s")
+
+
+class CircuitBreaker:
+    """
+    Count-based sliding-window circuit breaker.
+
+    Args:
+        name: Dependency name used in logs, errors and health output
+        failure_rate_threshold: Fraction of failed or slow calls that opens the breaker
+        slow_call_seconds: Calls taking longer than this count as failures
+        window_size: Number of recent calls considered
+        minimum_calls: Calls required in the window before the rate is evaluated
+        open_seconds: How long the breaker stays open before probing
+        half_open_max_calls: Probe calls allowed while half-open
+        excluded_exceptions: Exceptions that are caller errors, not dependency failures
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        window_size: int = 20,
+        minimum_calls: int = 10,
+        open_seconds: float = 30.0,
+        half_open_max_calls: int = 3,
+        excluded_exceptions: Tuple[Type[BaseException], ...] = ()
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.excluded_exceptions = excluded_exceptions
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._window = deque(maxlen=window_size)
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+        self._rejected = 0
+        BREAKER_STATE.labels(dependency=name).set(STATE_VALUES[CLOSED])
+
+    @property
+    def state(self) -> str:
+        """Current state, moving from open to half-open once the cool-down has elapsed."""
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker will let a probe call through."""
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run fn through the breaker.
+
+        Raises:
+            CircuitOpenError: If the breaker is open or the half-open probe budget is used up
+        """
+        with self.guard():
+            return fn(*args, **kwargs)
+
+    @contextmanager
+    def guard(self, track_latency: bool = True) -> Iterator[None]:
+        """
+        Context manager form of call().
+
+        Args:
+            track_latency: Count slow blocks as failures. Disable for work whose
+                duration grows with the result size, such as full collection scans.
+
+        Raises:
+            CircuitOpenError: If the breaker is open or the half-open probe budget is used up
+        """
+        self._before_call()
+        start = time.monotonic() if track_latency else None
+        try:
+            yield
+        except self.excluded_exceptions:
+            self._after_call(ok=True, start=start)
+            raise
+        except Exception:
+            self._after_call(ok=False, start=start)
+            raise
+        self._after_call(ok=True, start=start)
+
+    def reset(self) -> None:
+        """Force the breaker closed and forget recorded calls."""
+        with self._lock:
+            self._transition(CLOSED)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """State and window statistics for health and metrics output."""
+        with self._lock:
+            self._maybe_half_open()
+            calls = len(self._window)
+            failures = sum(1 for ok in self._window if not ok)
+            return {
+                "state": self._state,
+                "calls": calls,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "rejected": self._rejected,
+                "retry_after": round(max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 1)
+                if self._state == OPEN else 0.0
+            }
+
+    def _before_call(self) -> None:
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == OPEN:
+                self._rejected += 1
+                BREAKER_REJECTED.labels(dependency=self.name).inc()
+                raise CircuitOpenError(self.name, self._opened_at + self.open_seconds - time.monotonic())
+            if self._state == HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_max_calls:
+                    self._rejected += 1
+                    BREAKER_REJECTED.labels(dependency=self.name).inc()
+                    raise CircuitOpenError(self.name, 1.0)
+                self._half_open_in_flight += 1
+
+    def _after_call(self, ok: bool, start: Optional[float]) -> None:
+        # A call that succeeded but took too long still counts against the dependency
+        duration = time.monotonic() - start if start is not None else 0.0
+        if ok and duration > self.slow_call_seconds:
+            logger.warning(f"Slow {self.name} call: {duration:.2f}s")
+            ok = False
+
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+                if not ok:
+                    self._transition(OPEN)
+                    return
+                self._half_open_successes += 1
+                if self._half_open_successes >= self.half_open_max_calls:
+                    self._transition(CLOSED)
+                return
+
+            self._window.append(ok)
+            if self._state == CLOSED and len(self._window) >= self.minimum_calls:
+                failures = sum(1 for result in self._window if not result)
+                if failures / len(self._window) >= self.failure_rate_threshold:
+                    self._transition(OPEN)
+
+    def _maybe_half_open(self) -> None:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state: str) -> None:
+        if state != self._state:
+            logger.warning(f"Circuit breaker {self.name}: {self._state} -> {state}")
+        self._state = state
+        BREAKER_STATE.labels(dependency=self.name).set(STATE_VALUES[state])
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state == CLOSED:
+            self._window.clear()
+
+
+def _breaker_from_env(name: str, prefix: str, **kwargs) -> CircuitBreaker:
+    """Build a breaker whose thresholds can be tuned with <PREFIX>_BREAKER_* variables."""
+    return CircuitBreaker(
+        name,
+        failure_rate_threshold=float(os.getenv(f'{prefix}_BREAKER_FAILURE_RATE', '0.5')),
+        slow_call_seconds=float(os.getenv(f'{prefix}_BREAKER_SLOW_CALL_SECONDS', '5')),
+        window_size=int(os.getenv(f'{prefix}_BREAKER_WINDOW', '20')),
+        minimum_calls=int(os.getenv(f'{prefix}_BREAKER_MIN_CALLS', '10')),
+        open_seconds=float(os.getenv(f'{prefix}_BREAKER_OPEN_SECONDS', '30')),
+        half_open_max_calls=int(os.getenv(f'{prefix}_BREAKER_HALF_OPEN_CALLS', '3')),
+        **kwargs
+    )
+
+
+# What to do with a send when a breaker is open: "fail_fast" (503) or "outbox" (queue it)
+FALLBACK = os.getenv('BREAKER_FALLBACK', 'fail_fast').lower()
+
+_fail_fast = threading.local()
+
+
+def outbox_fallback() -> bool:
+    """Whether a send refused by an open breaker is queued in the outbox (see fail_fast)."""
+    return FALLBACK == 'outbox' and not getattr(_fail_fast, "active", False)
+
+
+@contextmanager
+def fail_fast() -> Iterator[None]:
+    """
+    Let CircuitOpenError reach the caller instead of queueing sends in the outbox,
+    for sends made on this thread within the block.
+
+    Used by callers that keep their own place and retry, such as outbox replays
+    and broadcast jobs, so an open breaker stops them rather than moving their
+    work into new outbox entries.
+    """
+    previous = getattr(_fail_fast, "active", False)
+    _fail_fast.active = True
+    try:
+        yield
+    finally:
+        _fail_fast.active = previous
+
+FCM_BREAKER = _breaker_from_env("fcm", "FCM")
+FIRESTORE_BREAKER = _breaker_from_env("firestore", "FIRESTORE")
+
+BREAKERS = {
+    FCM_BREAKER.name: FCM_BREAKER,
+    FIRESTORE_BREAKER.name: FIRESTORE_BREAKER
+}
+
+
+def register_breaker(name: str, prefix: str) -> CircuitBreaker:
+    """
+    Create a breaker tuned with <PREFIX>_BREAKER_* variables and include it in health output.
+
+    Returns:
+        The registered breaker (the existing one if the name is already registered)
+    """
+    if name not in BREAKERS:
+        BREAKERS[name] = _breaker_from_env(name, prefix)
+    return BREAKERS[name]
+
+
+def get_breaker(name: str) -> Optional[CircuitBreaker]:
+    """Get a registered breaker by dependency name."""
+    return BREAKERS.get(name)
+
+
+def snapshot_all() -> Dict[str, Dict[str, Any]]:
+    """Snapshot every registered breaker, keyed by dependency name."""
+    return {name: breaker.snapshot() for name, breaker in BREAKERS.items()}
@@ -0,0 +1,280 @@
+"""
+Per-user notification digests.
+
+A send to a user can name a digest group. The first notification for a
+(user_id, app_id, group) opens a coalescing window and is sent at once. Later
+notifications for the same key that arrive before the window closes are
+held. When the window closes, they are merged into one digest and sent once.
+The digest holds the count plus the latest titles.
+
+Every notification in a group is sent with the group as its FCM collapse key.
+The key is also used as the web push and Android tag and the APNs collapse
+id. So the digest replaces the first notification on the device instead of
+showing next to it.
+
+Windows live in the shared SQLite database, so every worker on the instance
+merges into the same window. A window that holds notifications is closed by a
+scheduled "flush_digest" job, so digests need the scheduler. If that job is
+lost, the next notification for the group finds the window more than
+DIGEST_FLUSH_GRACE_SECONDS past its close and reopens it, with what it
+held, under a new job.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import shared_store
+from metrics import DIGEST_NOTIFICATIONS, DIGEST_SENDS, DIGEST_SENDS_SAVED, app_label
+
+logger = logging.getLogger(__name__)
+
+# Default and longest coalescing window
+DIGEST_WINDOW_SECONDS = float(os.getenv('DIGEST_WINDOW_SECONDS', '30'))
+DIGEST_MAX_WINDOW_SECONDS = float(os.getenv('DIGEST_MAX_WINDOW_SECONDS', '3600'))
+
+# Latest titles listed in a digest body
+DIGEST_TITLES = int(os.getenv('DIGEST_TITLES', '5'))
+
+# Digest title; {count} is the number of notifications merged
+DIGEST_TITLE = os.getenv('DIGEST_TITLE', '{count} new notifications')
+
+# How long past its close a holding window waits for its flush job before it is reopened
+DIGEST_FLUSH_GRACE_SECONDS = float(os.getenv('DIGEST_FLUSH_GRACE_SECONDS', '300'))
+
+# Send the notification that opens a window at once (false: hold it too, so a burst is sent exactly once)
+DIGEST_SEND_FIRST = os.getenv('DIGEST_SEND_FIRST', 'true').lower() == 'true'
+
+# APNs collapse ids are at most 64 bytes
+_GROUP = re.compile(r'^[A-Za-z0-9_.:-]{1,64}$')
+
+shared_store.register_schema("digest", [
+    """CREATE TABLE IF NOT EXISTS digest_windows (
+        user_id TEXT NOT NULL,
+        app_id TEXT NOT NULL,
+        collapse_group TEXT NOT NULL,
+        window_id TEXT NOT NULL,
+        closes_at REAL NOT NULL,
+        total INTEGER NOT NULL,
+        held INTEGER NOT NULL,
+        titles TEXT NOT NULL,
+        latest TEXT NOT NULL,
+        PRIMARY KEY (user_id, app_id, collapse_group)
+    )""",
+    # Windows that only sent their first notification have no job to close them
+    """CREATE INDEX IF NOT EXISTS digest_windows_unheld
+        ON digest_windows (closes_at) WHERE held = 0"""
+])
+
+
+def parse(spec: Any) -> Tuple[str, float]:
+    """
+    Validate a send's digest option.
+
+    Args:
+        spec: A group name, or {"group": name, "window_seconds": seconds}
+
+    Returns:
+        Tuple of (group, window seconds)
+
+    Raises:
+        ValueError: If the group or window is invalid
+    """
+    if isinstance(spec, str):
+        spec = {"group": spec}
+    if not isinstance(spec, dict):
+        raise ValueError("digest must be a group name or an object with group and window_seconds")
+    unknown = set(spec) - {"group", "window_seconds"}
+    if unknown:
+        raise ValueError(f"Unknown digest fields: {', '.join(sorted(unknown))}")
+
+    group = spec.get("group")
+    if not isinstance(group, str) or not _GROUP.match(group):
+        raise ValueError("digest group must be 1-64 letters, digits, '.', '_', ':' or '-'")
+    window_seconds = spec.get("window_seconds", DIGEST_WINDOW_SECONDS)
+    if isinstance(window_seconds, bool) or not isinstance(window_seconds, (int, float)):
+        raise ValueError("digest window_seconds must be a number")
+    if not 0 < window_seconds <= DIGEST_MAX_WINDOW_SECONDS:
+        raise ValueError(f"digest window_seconds must be more than 0 and at most {DIGEST_MAX_WINDOW_SECONDS:g}")
+    return group, float(window_seconds)
+
+
+def add(
+    user_id: str,
+    app_id: Optional[str],
+    group: str,
+    window_seconds: float,
+    title: str,
+    body: str,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    now: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Add a notification to its user's digest window, opening one if none is open.
+
+    Args:
+        user_id: User the notification is for
+        app_id: App the send is limited to, if any
+        group: Digest group (see parse)
+        window_seconds: Window length, if this notification opens one
+        title: Notification title
+        body: Notification body text
+        icon: Icon URL
+        badge: Badge URL
+        data: Custom data payload
+        now: Current time (for tests)
+
+    Returns:
+        Dictionary with status ("send": send it now with the group as its
+        collapse key, or "held": it goes out in the digest), group, window_id,
+        closes_at (epoch seconds) and count (notifications in the window)
+    """
+    # Imported here: scheduler imports fanout, which imports this module
+    import scheduler
+
+    now = time.time() if now is None else now
+    key = (user_id, app_id or "", group)
+    latest = json.dumps({"title": title, "body": body, "icon": icon, "badge": badge, "data": data}, default=str)
+    try:
+        with shared_store.transaction() as db:
+            db.execute("DELETE FROM digest_windows WHERE held = 0 AND closes_at <= ?", (now,))
+            row = db.execute(
+                "SELECT window_id, closes_at, total, held, titles FROM digest_windows "
+                "WHERE user_id = ? AND app_id = ? AND collapse_group = ?", key
+            ).fetchone()
+            reopened = False
+            if row is None:
+                window_id, closes_at, total = uuid.uuid4().hex, now + window_seconds, 1
+                held = 0 if DIGEST_SEND_FIRST else 1
+                db.execute(
+                    "INSERT INTO digest_windows "
+                    "(user_id, app_id, collapse_group, window_id, closes_at, total, held, titles, latest) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*key, window_id, closes_at, total, held, json.dumps([title]), latest)
+                )
+            else:
+                window_id, closes_at, total, held, titles = row
+                reopened = held > 0 and closes_at + DIGEST_FLUSH_GRACE_SECONDS <= now
+                if reopened:
+                    # Its flush job never ran: a new id keeps that job, should it
+                    # still run, from sending the window twice
+                    logger.warning(
+                        f"Digest window {window_id} for user_id: {user_id}, group: {group} was not flushed, "
+                        f"reopening it with {held} held notification(s)"
+                    )
+                    window_id, closes_at = uuid.uuid4().hex, now + window_seconds
+                total += 1
+                held += 1
+                titles = json.dumps((json.loads(titles) + [title])[-DIGEST_TITLES:])
+                db.execute(
+                    "UPDATE digest_windows SET window_id = ?, closes_at = ?, total = ?, held = ?, titles = ?, latest = ? "
+                    "WHERE user_id = ? AND app_id = ? AND collapse_group = ?",
+                    (window_id, closes_at, total, held, titles, latest, *key)
+                )
+            if held == 1 or reopened:
+                # Scheduled inside the transaction: if it fails the window is not
+                # changed, and a job whose window never committed finds nothing to send
+                scheduler.schedule(
+                    "flush_digest",
+                    {"user_id": user_id, "app_id": app_id, "group": group, "window_id": window_id},
+                    datetime.fromtimestamp(closes_at, tz=timezone.utc),
+                    spread_seconds=0
+                )
+    except (sqlite3.Error, OSError) as e:
+        # A digest problem (the store, or writing the flush job) must not hold notifications back
+        logger.warning(f"Digest window not updated, sending without coalescing: {str(e)}")
+        DIGEST_NOTIFICATIONS.labels(app_id=app_label(app_id), outcome="bypassed").inc()
+        return {"status": "send", "group": group, "window_id": None, "closes_at": None, "count": 1}
+
+    status = "held" if row is not None or not DIGEST_SEND_FIRST else "send"
+    DIGEST_NOTIFICATIONS.labels(app_id=app_label(app_id), outcome=status).inc()
+    return {"status": status, "group": group, "window_id": window_id, "closes_at": closes_at, "count": total}
+
+
+def flush(user_id: str, app_id: Optional[str], group: str, window_id: str) -> Dict[str, Any]:
+    """
+    Close a digest window and send what it held (the "flush_digest" job).
+
+    Returns:
+        The send's result, or zero counts if the window had nothing to send
+    """
+    # Imported here: fanout and scheduler import this module through each other
+    import fanout
+    import scheduler
+
+    key = (user_id, app_id or "", group, window_id)
+    with shared_store.transaction() as db:
+        row = db.execute(
+            "SELECT total, held, titles, latest FROM digest_windows "
+            "WHERE user_id = ? AND app_id = ? AND collapse_group = ? AND window_id = ?", key
+        ).fetchone()
+        if row is not None:
+            db.execute(
+                "DELETE FROM digest_windows WHERE user_id = ? AND app_id = ? AND collapse_group = ? AND window_id = ?",
+                key
+            )
+    if row is None or not row[1]:
+        return {"sent_to": 0, "failed": 0, "queued": 0}
+
+    total, held, titles, latest = row
+    payload = {
+        "user_id": user_id, "app_id": app_id, "collapse_key": group,
+        **compose(total, json.loads(titles), json.loads(latest))
+    }
+    DIGEST_SENDS.labels(app_id=app_label(app_id)).inc()
+    DIGEST_SENDS_SAVED.labels(app_id=app_label(app_id)).inc(held - 1)
+    logger.info(f"Sending digest of {total} notifications for user_id: {user_id}, app_id: {app_id}, group: {group}")
+
+    try:
+        return fanout.send_to_user(**payload)
+    except Exception as e:
+        # The window is already closed, so retrying this job would find it empty;
+        # the digest is retried as a send of its own instead
+        job = scheduler.schedule("send_to_user", payload, datetime.now(timezone.utc), spread_seconds=0)
+        logger.warning(f"Digest send for user_id: {user_id} failed, retrying as job {job['id']}: {str(e)}")
+        return {"sent_to": 0, "failed": 0, "queued": total, "retry_job_id": job["id"]}
+
+
+def compose(total: int, titles: List[str], latest: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The notification that closes a window.
+
+    Args:
+        total: Notifications in the window
+        titles: The latest titles, oldest first
+        latest: The latest notification (title, body, icon, badge, data)
+
+    Returns:
+        title, body, icon, badge and data to send: the notification itself if
+        it is alone, otherwise a digest listing the latest titles, newest first
+    """
+    if total == 1:
+        return latest
+    lines = list(reversed(titles))
+    if total > len(titles):
+        lines.append(f"+{total - len(titles)} more")
+    return {
+        "title": DIGEST_TITLE.format(count=total),
+        "body": "\n".join(lines),
+        "icon": latest.get("icon"),
+        "badge": latest.get("badge"),
+        "data": {**(latest.get("data") or {}), "digest_count": total}
+    }
+
+
+def open_windows() -> int:
+    """Windows holding notifications that have not been sent yet."""
+    return shared_store.connect().execute("SELECT COUNT(*) FROM digest_windows WHERE held > 0").fetchone()[0]
+
+
+def reset() -> None:
+    """Drop every open window without sending it."""
+    with shared_store.transaction() as db:
+        db.execute("DELETE FROM digest_windows")
@@ -0,0 +1,349 @@
+"""
+Ingestion of notification engagement events (open, click, dismiss).
+
+Service workers post events in batches to POST /api/events. A request only
+validates its events and copies them into a fixed-size ring buffer, so
+memory stays constant however fast events arrive. When the buffer is full the
+oldest unflushed events are overwritten and counted as dropped.
+
+A flusher thread per process drains the buffer every EVENTS_FLUSH_SECONDS and
+aggregates it before anything is written:
+
+- engagement counters per app (notification_engagement/{app_id}) and per
+  notification (notification_engagement/{app_id}/notifications/{notification_id}),
+  added with Firestore increments so every worker and instance can write them
+- last_active on each device token that reported an event, once per token
+  per flush
+
+Counts that fail to be written (Firestore down) are kept and added to the
+next flush.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote
+import token_manager
+from circuit_breaker import FIRESTORE_BREAKER
+from metrics import ENGAGEMENT_EVENTS, ENGAGEMENT_EVENTS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+ENGAGEMENT_COLLECTION = "notification_engagement"
+NOTIFICATIONS_SUBCOLLECTION = "notifications"
+
+EVENT_TYPES = ("open", "click", "dismiss")
+
+# Events held per process between flushes
+EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', '100000'))
+EVENTS_FLUSH_SECONDS = float(os.getenv('EVENTS_FLUSH_SECONDS', '5'))
+
+# Events accepted in one request
+EVENTS_MAX_BATCH = int(os.getenv('EVENTS_MAX_BATCH', '1000'))
+
+# Longest app_id, notification_id or token accepted
+MAX_FIELD_LENGTH = 4096
+
+
+class RingBuffer:
+    """Fixed-capacity FIFO that overwrites its oldest items when full."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._slots: List[Any] = [None] * capacity
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def extend(self, items: List[Any]) -> int:
+        """
+        Append items.
+
+        Returns:
+            Number of older items overwritten to make room
+        """
+        overwritten = 0
+        with self._lock:
+            for item in items:
+                end = (self._start + self._size) % self.capacity
+                self._slots[end] = item
+                if self._size == self.capacity:
+                    self._start = (self._start + 1) % self.capacity
+                    overwritten += 1
+                else:
+                    self._size += 1
+        return overwritten
+
+    def drain(self) -> List[Any]:
+        """Remove and return every item, oldest first."""
+        with self._lock:
+            start, size = self._start, self._size
+            end = start + size
+            if end <= self.capacity:
+                items = self._slots[start:end]
+            else:
+                items = self._slots[start:] + self._slots[:end - self.capacity]
+            self._slots = [None] * self.capacity
+            self._start = self._size = 0
+        return items
+
+
+_buffer = RingBuffer(EVENTS_BUFFER_SIZE)
+_lock = threading.Lock()
+_stats = {"accepted": 0, "rejected": 0, "dropped": 0, "flushed": 0}
+# Aggregates a failed flush could not write, added to the next one
+_carry: Tuple[Dict[Tuple[str, Optional[str]], List[int]], Dict[str, datetime]] = ({}, {})
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+# Set once the buffer overflows, so the warning is logged once per flush interval
+_overflowing = False
+
+
+def validate(event: Any) -> Optional[Tuple[int, str, Optional[str], str]]:
+    """
+    Check one posted event.
+
+    An event is an object with type (open, click or dismiss), app_id, token
+    and optionally notification_id, all strings. The token must be usable as
+    a Firestore document id, as registered tokens are, and so must app_id and
+    notification_id once quoted, as counters are stored under them.
+
+    Returns:
+        (type index, app_id, notification_id, token), or None if invalid
+    """
+    if not isinstance(event, dict):
+        return None
+    try:
+        kind = EVENT_TYPES.index(event.get("type"))
+    except ValueError:
+        return None
+    app_id = event.get("app_id")
+    token = event.get("token")
+    notification_id = event.get("notification_id")
+    if not isinstance(app_id, str) or not isinstance(token, str) or not app_id or not token:
+        return None
+    if notification_id is not None and (not isinstance(notification_id, str) or not notification_id):
+        return None
+    if max(len(app_id), len(token), len(notification_id or "")) > MAX_FIELD_LENGTH:
+        return None
+    if not token_manager.valid_document_id(token) or not token_manager.valid_document_id(_document_id(app_id)):
+        return None
+    if notification_id is not None and not token_manager.valid_document_id(_document_id(notification_id)):
+        return None
+    return kind, app_id, notification_id, token
+
+
+def ingest(events: List[Any]) -> Tuple[int, int]:
+    """
+    Buffer a batch of posted events for the next flush.
+
+    Args:
+        events: Posted event objects (see validate)
+
+    Returns:
+        Tuple of (accepted, rejected) counts
+    """
+    global _overflowing
+    now = time.time()
+    accepted = []
+    by_type = [0] * len(EVENT_TYPES)
+    for event in events:
+        parsed = validate(event)
+        if parsed is not None:
+            accepted.append(parsed + (now,))
+            by_type[parsed[0]] += 1
+    rejected = len(events) - len(accepted)
+
+    overwritten = _buffer.extend(accepted)
+    with _lock:
+        _stats["accepted"] += len(accepted)
+        _stats["rejected"] += rejected
+        _stats["dropped"] += overwritten
+    for kind, count in enumerate(by_type):
+        if count:
+            ENGAGEMENT_EVENTS.labels(type=EVENT_TYPES[kind]).inc(count)
+    if rejected:
+        ENGAGEMENT_EVENTS_DROPPED.labels(reason="invalid").inc(rejected)
+    if overwritten:
+        ENGAGEMENT_EVENTS_DROPPED.labels(reason="overflow").inc(overwritten)
+        if not _overflowing:
+            _overflowing = True
+            logger.warning(
+                f"Engagement buffer full ({EVENTS_BUFFER_SIZE} events): overwriting unflushed events "
+                f"until the next flush"
+            )
+
+    ensure_started()
+    return len(accepted), rejected
+
+
+def aggregate(
+    events: List[tuple]
+) -> Tuple[Dict[Tuple[str, Optional[str]], List[int]], Dict[str, datetime]]:
+    """
+    Reduce buffered events to counters and last-active times.
+
+    Returns:
+        Tuple of ({(app_id, notification_id): counts per EVENT_TYPES}, with
+        notification_id None for the app's totals, and {token: last event time})
+    """
+    counters: Dict[Tuple[str, Optional[str]], List[int]] = {}
+    last_active: Dict[str, float] = {}
+    for kind, app_id, notification_id, token, ts in events:
+        keys = [(app_id, None)] if notification_id is None else [(app_id, None), (app_id, notification_id)]
+        for key in keys:
+            counts = counters.get(key)
+            if counts is None:
+                counts = counters[key] = [0] * len(EVENT_TYPES)
+            counts[kind] += 1
+        if ts > last_active.get(token, 0):
+            last_active[token] = ts
+    return counters, {token: datetime.utcfromtimestamp(ts) for token, ts in last_active.items()}
+
+
+def flush() -> Dict[str, int]:
+    """
+    Drain the buffer and write the aggregates to Firestore.
+
+    Returns:
+        Dictionary with events, counters (documents incremented) and tokens
+        (last_active updates) written
+    """
+    global _carry, _overflowing
+    events = _buffer.drain()
+    _overflowing = False
+    counters, last_active = aggregate(events)
+    _merge_carry(counters, last_active)
+    if not counters and not last_active:
+        return {"events": 0, "counters": 0, "tokens": 0}
+
+    total = len(counters)
+    try:
+        _write_counters(counters)
+    except Exception as e:
+        logger.error(f"Failed to write engagement counters, keeping them for the next flush: {str(e)}")
+        _carry = (counters, last_active)
+        return {"events": len(events), "counters": 0, "tokens": 0}
+
+    try:
+        touched = token_manager.record_token_activity(last_active)
+    except Exception as e:
+        logger.error(f"Failed to update last_active, keeping it for the next flush: {str(e)}")
+        _carry = ({}, last_active)
+        touched = 0
+
+    with _lock:
+        _stats["flushed"] += len(events)
+    logger.info(f"Flushed {len(events)} engagement events: {total} counters, {touched} tokens")
+    return {"events": len(events), "counters": total, "tokens": touched}
+
+
+def status() -> Dict[str, int]:
+    """Event counts in this process: accepted, rejected, dropped, flushed and buffered."""
+    with _lock:
+        return dict(_stats, buffered=len(_buffer))
+
+
+def ensure_started() -> None:
+    """Start the flusher thread once per process."""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name="engagement-flush", daemon=True)
+        _thread.start()
+
+
+def stop() -> None:
+    """Stop the flusher thread and write out what is buffered."""
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    try:
+        flush()
+    except Exception as e:
+        logger.error(f"Final engagement flush failed: {str(e)}")
+
+
+def _run() -> None:
+    while not _stop.wait(EVENTS_FLUSH_SECONDS):
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Engagement flush failed: {str(e)}")
+
+
+def _merge_carry(counters: Dict[Tuple[str, Optional[str]], List[int]], last_active: Dict[str, datetime]) -> None:
+    """
+    Add aggregates left by a failed flush, dropping them if they would outgrow the buffer.
+
+    last_active updates are dropped first; counters only once they alone
+    outgrow it.
+    """
+    global _carry
+    carried_counters, carried_active = _carry
+    _carry = ({}, {})
+    if len(carried_counters) + len(carried_active) > EVENTS_BUFFER_SIZE:
+        logger.warning(f"Dropping {len(carried_active)} unwritten last_active updates after repeated failures")
+        carried_active = {}
+    if len(carried_counters) > EVENTS_BUFFER_SIZE:
+        logger.warning(f"Dropping {len(carried_counters)} unwritten engagement counters after repeated failures")
+        carried_counters = {}
+    for key, counts in carried_counters.items():
+        merged = counters.setdefault(key, [0] * len(EVENT_TYPES))
+        for kind, count in enumerate(counts):
+            merged[kind] += count
+    for token, ts in carried_active.items():
+        if token not in last_active or ts > last_active[token]:
+            last_active[token] = ts
+
+
+def _document_id(value: str) -> str:
+    """Document id a counter is stored under for an app_id or notification_id."""
+    return quote(value, safe='')
+
+
+def _write_counters(counters: Dict[Tuple[str, Optional[str]], List[int]]) -> None:
+    """Increment counter documents in batches, removing each batch from counters once committed."""
+    from google.cloud.firestore_v1 import transforms
+
+    db = token_manager.get_firestore_client()
+    collection = db.collection(ENGAGEMENT_COLLECTION)
+    items = list(counters.items())
+    for start in range(0, len(items), token_manager.BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        chunk = items[start:start + token_manager.BATCH_WRITE_LIMIT]
+        for (app_id, notification_id), counts in chunk:
+            ref = collection.document(_document_id(app_id))
+            data = {"app_id": app_id, "updated_at": transforms.SERVER_TIMESTAMP}
+            if notification_id is not None:
+                ref = ref.collection(NOTIFICATIONS_SUBCOLLECTION).document(_document_id(notification_id))
+                data["notification_id"] = notification_id
+            for kind, count in enumerate(counts):
+                if count:
+                    data[EVENT_TYPES[kind]] = transforms.Increment(count)
+            batch.set(ref, data, merge=True)
+        FIRESTORE_BREAKER.call(batch.commit, timeout=token_manager.FIRESTORE_TIMEOUT)
+        for key, _ in chunk:
+            del counters[key]
+
+
+def _reset_in_child() -> None:
+    global _buffer, _lock, _thread, _carry
+    # The flusher thread does not survive fork; events buffered in the parent are its own
+    _buffer = RingBuffer(EVENTS_BUFFER_SIZE)
+    _lock = threading.Lock()
+    _carry = ({}, {})
+    _thread = None
+
+
+os.register_at_fork(after_in_child=_reset_in_child)
@@ -0,0 +1,627 @@
+"""
+Fan-out path shared by the send endpoints and background replays.
+
+Audience resolution (Firestore) and delivery (FCM) are separate steps so
+callers can check budgets or split the audience between them.
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Tuple
+import firebase_service
+import token_manager
+import app_configs
+import outbox
+import ledger
+import segments
+import templates
+import circuit_breaker
+import admission
+import digest
+import shutdown
+from circuit_breaker import CircuitOpenError
+from profiling import phase
+
+logger = logging.getLogger(__name__)
+
+# send_each_for_multicast accepts at most 500 tokens per call (and send_each 500 messages)
+FCM_MULTICAST_LIMIT = 500
+
+# Rejected recipients listed in a templated send's response
+REJECTION_SAMPLE_SIZE = 20
+
+
+def chunk_tokens(tokens: List[str], size: int = FCM_MULTICAST_LIMIT) -> List[List[str]]:
+    """Split a token list into FCM-sized chunks."""
+    return [tokens[i:i + size] for i in range(0, len(tokens), size)]
+
+
+def apply_app_defaults(
+    app_id: str,
+    title: str,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None
+) -> Tuple[str, Optional[str], Optional[str]]:
+    """
+    Apply an app's title prefix and default icon/badge.
+
+    Args:
+        app_id: App identifier
+        title: Notification title
+        icon: Icon override (app default used if None)
+        badge: Badge override (app default used if None)
+
+    Returns:
+        Tuple of (title, icon, badge)
+    """
+    app_config = app_configs.get_app_config(app_id)
+
+    if app_config.get('default_title_prefix') and not title.startswith(app_config['default_title_prefix']):
+        title = f"{app_config['default_title_prefix']} {title}"
+
+    if icon is None:
+        icon = app_config.get('icon')
+    if badge is None:
+        badge = app_config.get('badge')
+
+    return title, icon, badge
+
+
+def deliver(
+    tokens: List[str],
+    title: str,
+    body: str,
+    app_id: Optional[str] = None,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    block: bool = True,
+    project: Optional[str] = None,
+    user_id: Optional[str] = None,
+    send_id: Optional[str] = None,
+    collapse_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Send one notification to a list of tokens in FCM-sized chunks.
+
+    Sends go to app_id's Firebase project. Without an app_id and with more
+    than one project configured, tokens are grouped by the project of the app
+    they are registered for, and each group is sent through its own project.
+
+    If the FCM breaker opens part-way through and the outbox fallback is
+    enabled, the chunks not yet sent are queued instead of being lost. If the
+    worker is shutting down and its drain deadline is near, the chunks not yet
+    sent are checkpointed as a scheduled delivery due immediately.
+
+    Args:
+        tokens: FCM device tokens
+        title: Notification title
+        body: Notification body text
+        app_id: App identifier
+        icon: Icon URL
+        badge: Badge URL
+        data: Custom data payload
+        block: Wait for room under the tokens-in-flight cap. HTTP requests
+            pass False to be rejected instead.
+        project: Firebase project to send through (overrides app_id's)
+        user_id: User the send targeted (recorded in the delivery ledger)
+        send_id: Delivery ledger id of the send (default: a new id). Jobs
+            that deliver in several calls pass their job id.
+        collapse_key: Key under which a later notification replaces this one
+            on the device (see digest)
+
+    Returns:
+        Dictionary with send_id, sent_to, failed and queued counts, errors
+        (failed messages per FCM error code) and, if checkpointed, checkpoint_id
+
+    Raises:
+        CircuitOpenError: If FCM is unavailable and the fallback is fail-fast
+        AdmissionRejected: If block is False and too many tokens are in flight
+    """
+    send_id = send_id or ledger.new_send_id()
+    with admission.TOKENS.reserve(len(tokens), wait=block):
+        if app_id is None and project is None and firebase_service.has_tenant_projects():
+            result = _deliver_by_project(tokens, title, body, icon, badge, data, user_id, send_id, collapse_key)
+        else:
+            result = _deliver_chunks(
+                tokens, title, body, app_id, icon, badge, data, project, user_id, send_id, collapse_key
+            )
+    return {"send_id": send_id, **result}
+
+
+def group_by_project(tokens: List[str]) -> Dict[str, List[str]]:
+    """
+    Split tokens by the Firebase project of the app each is registered for.
+
+    Tokens that are not registered (or have no app) go to the default project.
+    """
+    token_apps = token_manager.get_token_apps(tokens)
+    projects = {}
+    groups = {}
+    for token in tokens:
+        app_id = token_apps.get(token)
+        if app_id not in projects:
+            projects[app_id] = firebase_service.project_for_app(app_id)
+        groups.setdefault(projects[app_id], []).append(token)
+    return groups
+
+
+def _deliver_by_project(
+    tokens: List[str],
+    title: str,
+    body: str,
+    icon: Optional[str],
+    badge: Optional[str],
+    data: Optional[Dict[str, Any]],
+    user_id: Optional[str],
+    send_id: str,
+    collapse_key: Optional[str]
+) -> Dict[str, Any]:
+    result = {"sent_to": 0, "failed": 0, "queued": 0, "errors": {}}
+    for project, group in group_by_project(tokens).items():
+        group_result = _deliver_chunks(
+            group, title, body, None, icon, badge, data, project, user_id, send_id, collapse_key
+        )
+        for counter in ("sent_to", "failed", "queued"):
+            result[counter] += group_result[counter]
+        for code, count in group_result["errors"].items():
+            result["errors"][code] = result["errors"].get(code, 0) + count
+        if "checkpoint_id" in group_result:
+            result.setdefault("checkpoint_id", group_result["checkpoint_id"])
+    return result
+
+
+def _deliver_chunks(
+    tokens: List[str],
+    title: str,
+    body: str,
+    app_id: Optional[str],
+    icon: Optional[str],
+    badge: Optional[str],
+    data: Optional[Dict[str, Any]],
+    project: Optional[str],
+    user_id: Optional[str],
+    send_id: str,
+    collapse_key: Optional[str] = None
+) -> Dict[str, Any]:
+    sent = 0
+    failed = 0
+    queued = 0
+    checkpoint_id = None
+    failures = firebase_service.new_failure_summary()
+    # Replays of the unsent part are recorded under the same send
+    message = {
+        "title": title, "body": body, "app_id": app_id, "icon": icon, "badge": badge, "data": data,
+        "user_id": user_id, "send_id": send_id
+    }
+    if project:
+        # and keep going to the same project
+        message["project"] = project
+    if collapse_key:
+        message["collapse_key"] = collapse_key
+
+    chunks = chunk_tokens(tokens)
+    for index, chunk in enumerate(chunks):
+        if shutdown.should_stop_sending():
+            remaining = [token for rest in chunks[index:] for token in rest]
+            checkpoint_id = _checkpoint("deliver", {"tokens": remaining, **message}, len(remaining))
+            queued = len(remaining)
+            break
+        try:
+            batch_response = firebase_service.send_multicast_notification(
+                tokens=chunk,
+                title=title,
+                body=body,
+                app_id=app_id,
+                icon=icon,
+                badge=badge,
+                data=data,
+                failure_summary=failures,
+                project=project,
+                collapse_key=collapse_key
+            )
+        except CircuitOpenError:
+            if not circuit_breaker.outbox_fallback():
+                raise
+            remaining = [token for rest in chunks[index:] for token in rest]
+            outbox.enqueue("deliver", {"tokens": remaining, **message})
+            queued = len(remaining)
+            break
+        except Exception as e:
+            ledger.record(send_id, chunk, app_id, user_id, error=e)
+            raise
+
+        if batch_response:
+            sent += batch_response.success_count
+            failed += batch_response.failure_count
+            ledger.record(send_id, chunk, app_id, user_id, responses=batch_response.responses)
+
+    logger.info(f"Delivered to {len(tokens)} tokens for app_id: {app_id}: {sent} sent, {failed} failed, {queued} queued")
+    if failures["failed"]:
+        firebase_service.log_failure_summary(failures, app_id)
+
+    result = {
+        "sent_to": sent,
+        "failed": failed,
+        "queued": queued,
+        "errors": failures["by_code"]
+    }
+    if checkpoint_id:
+        result["checkpoint_id"] = checkpoint_id
+    return result
+
+
+def _checkpoint(kind: str, payload: Dict[str, Any], unsent: int) -> str:
+    """
+    Persist the unsent part of a delivery for the scheduler to resume.
+
+    Args:
+        kind: Replay handler that resumes it ("deliver" or "deliver_rendered")
+        payload: The handler's arguments, holding only the unsent messages
+        unsent: Number of unsent messages (for the log)
+
+    Returns:
+        The scheduled job id
+    """
+    # Imported here: scheduler imports this module
+    import scheduler
+
+    job = scheduler.schedule(kind, payload, datetime.now(timezone.utc), spread_seconds=0)
+    logger.warning(
+        f"Shutting down: checkpointed {unsent} unsent messages for app_id: {payload['app_id']} "
+        f"as scheduled job {job['id']}"
+    )
+    return job["id"]
+
+
+def render_template(
+    template: templates.Template,
+    recipients: List[Any],
+    app_id: str
+) -> Tuple[List[List[str]], Dict[str, Any]]:
+    """
+    Render a template for every recipient and resolve recipients to tokens.
+
+    Each recipient is an object with a token or a user_id (all of the user's
+    devices in the app), optional variables and an optional locale. A user's
+    message is rendered once for all of their devices; users are resolved in
+    batched Firestore queries.
+
+    Args:
+        template: Compiled template
+        recipients: Posted recipient objects
+        app_id: App the template belongs to (its title prefix is applied)
+
+    Returns:
+        Tuple of ([token, title, body] per message, summary with recipients,
+        rendered, rejected, no_devices and a sample of rejections)
+    """
+    rejected = []
+
+    def reject(index: int, error: str) -> None:
+        if len(rejected) < REJECTION_SAMPLE_SIZE:
+            rejected.append({"index": index, "error": error})
+
+    rendered = []
+    user_ids = []
+    failed = 0
+    with phase("template_render"):
+        for index, recipient in enumerate(recipients):
+            if not isinstance(recipient, dict):
+                failed += 1
+                reject(index, "Recipient must be an object")
+                continue
+            token, user_id = recipient.get("token"), recipient.get("user_id")
+            variables = recipient.get("variables") or {}
+            locale = recipient.get("locale")
+            if (not token) == (not user_id) or not isinstance(token or user_id, str):
+                failed += 1
+                reject(index, "Recipient needs a token or a user_id")
+                continue
+            if not isinstance(variables, dict) or (locale is not None and not isinstance(locale, str)):
+                failed += 1
+                reject(index, "variables must be an object and locale a string")
+                continue
+            try:
+                title, body = template.render(variables, locale)
+            except templates.MissingVariable as e:
+                failed += 1
+                reject(index, str(e))
+                continue
+            rendered.append((token, user_id, title, body))
+            if user_id:
+                user_ids.append(user_id)
+
+    user_tokens = token_manager.get_tokens_for_users(user_ids, app_id) if user_ids else {}
+
+    prefix = app_configs.get_app_config(app_id).get('default_title_prefix')
+    messages = []
+    no_devices = 0
+    for token, user_id, title, body in rendered:
+        if prefix and not title.startswith(prefix):
+            title = f"{prefix} {title}"
+        if token:
+            messages.append([token, title, body])
+            continue
+        devices = user_tokens.get(user_id)
+        if not devices:
+            no_devices += 1
+            continue
+        messages.extend([device, title, body] for device in devices)
+
+    summary = {
+        "recipients": len(recipients),
+        "rendered": len(rendered),
+        "rejected": failed,
+        "no_devices": no_devices,
+        "rejections": rejected
+    }
+    return messages, summary
+
+
+def send_template(
+    app_id: str,
+    template_id: str,
+    recipients: List[Any],
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    block: bool = True
+) -> Dict[str, Any]:
+    """
+    Send a stored template, personalized per recipient (see render_template).
+
+    Raises:
+        KeyError: If the template does not exist
+    """
+    template = templates.get_template(app_id, template_id)
+    if template is None:
+        raise KeyError(f"Template not found: {template_id}")
+    messages, summary = render_template(template, recipients, app_id)
+    result = deliver_rendered(messages, app_id=app_id, icon=icon, badge=badge, data=data, block=block)
+    return {**summary, **result}
+
+
+def deliver_rendered(
+    messages: List[List[str]],
+    app_id: str,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    block: bool = True,
+    send_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Send personalized messages through the app's Firebase project, 500 per send_each call.
+
+    Like deliver(): the messages not yet sent are queued in the outbox if the
+    FCM breaker opens part-way through, or checkpointed if the worker is
+    shutting down.
+
+    Args:
+        messages: [token, title, body] per message
+        app_id: App identifier
+        icon: Icon URL (app default if None)
+        badge: Badge URL (app default if None)
+        data: Custom data payload shared by every message
+        block: Wait for room under the tokens-in-flight cap
+        send_id: Delivery ledger id of the send (default: a new id)
+
+    Returns:
+        Dictionary with send_id, sent_to, failed and queued counts, errors and,
+        if checkpointed, checkpoint_id
+    """
+    send_id = send_id or ledger.new_send_id()
+    sent = 0
+    failed = 0
+    queued = 0
+    checkpoint_id = None
+    failures = firebase_service.new_failure_summary()
+    # Replays of the unsent part are recorded under the same send
+    message = {"app_id": app_id, "icon": icon, "badge": badge, "data": data, "send_id": send_id}
+
+    with admission.TOKENS.reserve(len(messages), wait=block):
+        chunks = chunk_tokens(messages)
+        for index, chunk in enumerate(chunks):
+            if shutdown.should_stop_sending():
+                remaining = [item for rest in chunks[index:] for item in rest]
+                checkpoint_id = _checkpoint("deliver_rendered", {"messages": remaining, **message}, len(remaining))
+                queued = len(remaining)
+                break
+            tokens = [token for token, _, _ in chunk]
+            try:
+                batch_response = firebase_service.send_each_notification(
+                    [tuple(item) for item in chunk],
+                    app_id=app_id,
+                    icon=icon,
+                    badge=badge,
+                    data=data,
+                    failure_summary=failures
+                )
+            except CircuitOpenError:
+                if not circuit_breaker.outbox_fallback():
+                    raise
+                remaining = [item for rest in chunks[index:] for item in rest]
+                outbox.enqueue("deliver_rendered", {"messages": remaining, **message})
+                queued = len(remaining)
+                break
+            except Exception as e:
+                ledger.record(send_id, tokens, app_id, error=e)
+                raise
+
+            if batch_response:
+                sent += batch_response.success_count
+                failed += batch_response.failure_count
+                ledger.record(send_id, tokens, app_id, responses=batch_response.responses)
+
+    logger.info(
+        f"Delivered {len(messages)} personalized messages for app_id: {app_id}: "
+        f"{sent} sent, {failed} failed, {queued} queued"
+    )
+    if failures["failed"]:
+        firebase_service.log_failure_summary(failures, app_id)
+
+    result = {
+        "send_id": send_id,
+        "sent_to": sent,
+        "failed": failed,
+        "queued": queued,
+        "errors": failures["by_code"]
+    }
+    if checkpoint_id:
+        result["checkpoint_id"] = checkpoint_id
+    return result
+
+
+def resolve(kind: str, payload: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Resolve an audience-level send into its tokens and the message to deliver.
+
+    Args:
+        kind: One of AUDIENCE_KINDS
+        payload: The send's arguments (audience fields, including any segment, plus
+            title, body, icon, badge, data and any collapse_key)
+
+    Returns:
+        Tuple of (tokens, deliver keyword arguments)
+    """
+    message = {
+        "title": payload["title"],
+        "body": payload["body"],
+        "app_id": payload.get("app_id"),
+        "icon": payload.get("icon"),
+        "badge": payload.get("badge"),
+        "data": payload.get("data"),
+        "user_id": payload.get("user_id")
+    }
+    if payload.get("collapse_key"):
+        message["collapse_key"] = payload["collapse_key"]
+
+    if kind == "send_to_app":
+        message["title"], message["icon"], message["badge"] = apply_app_defaults(
+            payload["app_id"], payload["title"], payload.get("icon"), payload.get("badge")
+        )
+        if payload.get("segment"):
+            tokens, _ = segments.find_tokens(
+                payload["app_id"], segments.parse(payload["segment"]), user_id=payload.get("user_id")
+            )
+        else:
+            tokens = token_manager.get_tokens_for_app(app_id=payload["app_id"], user_id=payload.get("user_id"))
+    elif kind == "send_to_user":
+        tokens = token_manager.get_tokens_for_user(user_id=payload["user_id"], app_id=payload.get("app_id"))
+    elif kind == "broadcast":
+        tokens = token_manager.get_all_tokens()
+    else:
+        raise ValueError(f"Unknown audience kind: {kind}")
+
+    return tokens, message
+
+
+def _resolve_and_deliver(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    tokens, message = resolve(kind, payload)
+    if not tokens:
+        return {"sent_to": 0, "failed": 0, "queued": 0}
+    return deliver(tokens, **message)
+
+
+def send_to_app(
+    app_id: str,
+    title: str,
+    body: str,
+    user_id: Optional[str] = None,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    segment: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Resolve the audience of an app (optionally one user or a segment, see segments.parse) and deliver to it."""
+    return _resolve_and_deliver("send_to_app", {
+        "app_id": app_id, "title": title, "body": body, "user_id": user_id,
+        "icon": icon, "badge": badge, "data": data, "segment": segment
+    })
+
+
+def send_to_user(
+    user_id: str,
+    title: str,
+    body: str,
+    app_id: Optional[str] = None,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    collapse_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """Resolve a user's devices and deliver to them."""
+    return _resolve_and_deliver("send_to_user", {
+        "user_id": user_id, "title": title, "body": body, "app_id": app_id,
+        "icon": icon, "badge": badge, "data": data, "collapse_key": collapse_key
+    })
+
+
+def broadcast(
+    title: str,
+    body: str,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Deliver to every registered device."""
+    return _resolve_and_deliver("broadcast", {
+        "title": title, "body": body, "icon": icon, "badge": badge, "data": data
+    })
+
+
+def send_single(
+    token: str,
+    title: str,
+    body: str,
+    app_id: Optional[str] = None,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Send to one device token."""
+    project = None
+    if app_id is None and firebase_service.has_tenant_projects():
+        project = firebase_service.project_for_app(token_manager.get_token_apps([token]).get(token))
+    send_id = ledger.new_send_id()
+    try:
+        message_id = firebase_service.send_push_notification(
+            token=token,
+            title=title,
+            body=body,
+            app_id=app_id,
+            icon=icon,
+            badge=badge,
+            data=data,
+            project=project
+        )
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        # FCM errors are re-raised as ValueError; record the original error's code
+        ledger.record(send_id, [token], app_id, error=e.__context__ or e)
+        raise
+    ledger.record(send_id, [token], app_id, message_id=message_id)
+    return {"send_id": send_id, "message_id": message_id}
+
+
+# Send kinds whose audience is resolved from Firestore at send time
+AUDIENCE_KINDS = ("send_to_app", "send_to_user", "broadcast")
+
+# Outbox and schedule entry kinds and the functions that run them
+REPLAY_HANDLERS = {
+    "deliver": deliver,
+    "deliver_rendered": deliver_rendered,
+    "send_to_app": send_to_app,
+    "send_to_user": send_to_user,
+    "broadcast": broadcast,
+    "send_single": send_single,
+    "send_template": send_template,
+    "flush_digest": digest.flush
+}
+
+
+def drain_outbox(limit: int = 100) -> Dict[str, int]:
+    """Replay queued sends now that dependencies may have recovered."""
+    return outbox.drain(REPLAY_HANDLERS, limit=limit)
@@ -1,15 +1,37 @@
 """
 Firebase Admin SDK initialization and FCM push notification sending.
+
+The SDK (firebase_admin, and through it google-auth, httpx and protobuf) is
+imported on first use by load_sdk() rather than at module import, so the web
+server can bind and answer /api/health before paying for it.
+
+Sends go to the Firebase project named by the app's config (firebase_project),
+or the default project from FIREBASE_ADMIN_CREDENTIALS*. Every project has its
+own firebase_admin.App (and so its own FCM HTTP connection pool), circuit
+breaker and optional send rate, so tenants do not share one quota.
 """
 
 import os
 import json
 import logging
-from typing import Optional, Dict, Any
-import firebase_admin
-from firebase_admin import credentials, messaging
+import time
+import threading
+from typing import Optional, Dict, Any, Callable, List, Tuple, TYPE_CHECKING
 from dotenv import load_dotenv
 import app_configs
+import rate_limit
+from circuit_breaker import FCM_BREAKER, CircuitBreaker, register_breaker
+from profiling import phase
+from metrics import FCM_FAILURES, FCM_MESSAGES, FCM_SEND_SECONDS, FCM_SENDS_IN_FLIGHT, app_label
+
+if TYPE_CHECKING:
+    from firebase_admin import credentials, messaging
+
+# Populated by load_sdk()
+firebase_admin = None
+credentials = None
+messaging = None
+exceptions = None
 
 
 def convert_data_to_strings(data: Optional[Dict[str, Any]]) -> Dict[str, str]:
@@ -35,124 +57,367 @@ logger = logging.getLogger(__name__)
 
 # Initialize Firebase Admin SDK
 _firebase_app = None
+_init_lock = threading.Lock()
+_sdk_lock = threading.Lock()
+
+# Bound every FCM HTTP call so a degraded backend cannot hold a worker indefinitely
+FCM_HTTP_TIMEOUT = float(os.getenv('FCM_HTTP_TIMEOUT', '10'))
+
+# Failed tokens kept as examples in a failure summary
+FAILURE_SAMPLE_SIZE = int(os.getenv('FAILURE_SAMPLE_SIZE', '10'))
+
+
+def load_sdk() -> None:
+    """Import the Firebase Admin SDK modules on first use (thread-safe, idempotent)."""
+    global firebase_admin, credentials, messaging, exceptions
+    
+    if messaging is not None:
+        return
+    
+    with _sdk_lock:
+        if messaging is not None:
+            return
+        
+        import firebase_admin as sdk
+        from firebase_admin import credentials as sdk_credentials, exceptions as sdk_exceptions
+        from firebase_admin import messaging as sdk_messaging
+        
+        firebase_admin = sdk
+        credentials = sdk_credentials
+        exceptions = sdk_exceptions
+        # Rejected tokens and bad payloads are caller errors, not an FCM outage
+        for project in _projects.values():
+            project.breaker.excluded_exceptions = (sdk_messaging.UnregisteredError, sdk_exceptions.InvalidArgumentError)
+        # Assigned last: other threads treat a non-None messaging as "SDK loaded"
+        messaging = sdk_messaging
 
 
 def initialize_firebase():
-    """Initialize Firebase Admin SDK with credentials from environment."""
+    """
+    Initialize Firebase Admin SDK with credentials from environment.
+    
+    Safe to call from any thread and on every operation: initialization runs
+    once under a lock and later calls return the cached app immediately.
+    """
     global _firebase_app
     
     if _firebase_app is not None:
-        logger.info("Firebase Admin SDK already initialized")
         return _firebase_app
     
-    try:
-        # Try to get credentials from path first
-        creds_path = os.getenv('FIREBASE_ADMIN_CREDENTIALS_PATH')
-        creds_json = os.getenv('FIREBASE_ADMIN_CREDENTIALS')
+    load_sdk()
+    
+    with _init_lock:
+        # Another thread may have finished initializing while we waited
+        if _firebase_app is not None:
+            return _firebase_app
         
-        if creds_path:
-            # Resolve relative paths to absolute
-            if not os.path.isabs(creds_path):
-                creds_path = os.path.abspath(creds_path)
+        try:
+            _firebase_app = firebase_admin.initialize_app(_load_credentials(), {'httpTimeout': FCM_HTTP_TIMEOUT})
+            logger.info("Firebase Admin SDK initialized successfully")
+            return _firebase_app
             
-            if os.path.exists(creds_path):
-                logger.info(f"Loading Firebase credentials from file: {creds_path}")
-                cred = credentials.Certificate(creds_path)
-            else:
-                # File not found, but check if we have JSON env var as fallback
-                if creds_json:
-                    logger.warning(f"Firebase credentials file not found at: {creds_path}, using environment variable instead")
-                    cred_dict = json.loads(creds_json)
-                    cred = credentials.Certificate(cred_dict)
-                else:
-                    raise ValueError(
-                        f"Firebase credentials file not found at: {creds_path}. "
-                        "Please upload the file to Railway or set FIREBASE_ADMIN_CREDENTIALS environment variable."
-                    )
-        elif creds_json:
-            logger.info("Loading Firebase credentials from environment variable")
-            cred_dict = json.loads(creds_json)
-            cred = credentials.Certificate(cred_dict)
-        else:
-            raise ValueError(
-                "Firebase credentials not found. Set either FIREBASE_ADMIN_CREDENTIALS_PATH "
-                "or FIREBASE_ADMIN_CREDENTIALS environment variable."
-            )
+        except Exception as e:
+            logger.error(f"Failed to initialize Firebase Admin SDK: {str(e)}")
+            raise
+
+
+def _load_credentials() -> "credentials.Certificate":
+    """Load service account credentials from FIREBASE_ADMIN_CREDENTIALS_PATH or FIREBASE_ADMIN_CREDENTIALS."""
+    # Try to get credentials from path first
+    creds_path = os.getenv('FIREBASE_ADMIN_CREDENTIALS_PATH')
+    creds_json = os.getenv('FIREBASE_ADMIN_CREDENTIALS')
+    
+    if creds_path:
+        # Resolve relative paths to absolute
+        if not os.path.isabs(creds_path):
+            creds_path = os.path.abspath(creds_path)
         
-        _firebase_app = firebase_admin.initialize_app(cred)
-        logger.info("Firebase Admin SDK initialized successfully")
-        return _firebase_app
+        if os.path.exists(creds_path):
+            logger.info(f"Loading Firebase credentials from file: {creds_path}")
+            return credentials.Certificate(creds_path)
         
-    except Exception as e:
-        logger.error(f"Failed to initialize Firebase Admin SDK: {str(e)}")
-        raise
+        # File not found, but check if we have JSON env var as fallback
+        if creds_json:
+            logger.warning(f"Firebase credentials file not found at: {creds_path}, using environment variable instead")
+            return credentials.Certificate(json.loads(creds_json))
+        
+        raise ValueError(
+            f"Firebase credentials file not found at: {creds_path}. "
+            "Please upload the file to Railway or set FIREBASE_ADMIN_CREDENTIALS environment variable."
+        )
+    
+    if creds_json:
+        logger.info("Loading Firebase credentials from environment variable")
+        return credentials.Certificate(json.loads(creds_json))
+    
+    raise ValueError(
+        "Firebase credentials not found. Set either FIREBASE_ADMIN_CREDENTIALS_PATH "
+        "or FIREBASE_ADMIN_CREDENTIALS environment variable."
+    )
 
 
-def send_push_notification(
-    token: str,
-    title: str,
-    body: str,
-    app_id: Optional[str] = None,
-    icon: Optional[str] = None,
-    badge: Optional[str] = None,
-    data: Optional[Dict[str, Any]] = None,
-    sound: str = "default"
-) -> messaging.SendResponse:
+class FirebaseProject:
     """
-    Send a push notification to a single device token.
-    
+    A Firebase project FCM sends can be routed to.
+
     Args:
-        token: FCM device token
-        title: Notification title
-        body: Notification body text
-        app_id: App identifier (used to get default icon/badge if not provided)
-        icon: Custom icon URL (overrides app default)
-        badge: Custom badge URL (overrides app default)
-        data: Custom data payload (key-value pairs)
-        sound: Sound to play (default: "default")
-        
-    Returns:
-        SendResponse object with message_id
-        
+        name: Project name used in app configs (firebase_project), logs and breaker names
+        credentials_spec: {"credentials_path": ...}, {"credentials": {...}} or
+            {"credentials_env": VAR}; None for the default project
+        messages_per_second: Send rate for this project, shared by all workers (None: unlimited)
+        breaker: Circuit breaker guarding this project's FCM calls
+    """
+
+    def __init__(
+        self,
+        name: str,
+        credentials_spec: Optional[Dict[str, Any]],
+        messages_per_second: Optional[float],
+        breaker: CircuitBreaker
+    ):
+        self.name = name
+        self.credentials_spec = credentials_spec
+        self.messages_per_second = messages_per_second
+        self.breaker = breaker
+        self._app = None
+        self._lock = threading.Lock()
+
+    def app(self):
+        """The project's firebase_admin.App, initialized on first use."""
+        if self.credentials_spec is None:
+            return initialize_firebase()
+        if self._app is not None:
+            return self._app
+        load_sdk()
+        with self._lock:
+            if self._app is None:
+                self._app = firebase_admin.initialize_app(
+                    _project_credentials(self.name, self.credentials_spec),
+                    {'httpTimeout': FCM_HTTP_TIMEOUT},
+                    name=self.name
+                )
+                logger.info(f"Firebase project {self.name} initialized")
+        return self._app
+
+    def pace(self, message_count: int) -> None:
+        """Wait until the project's send rate allows message_count more messages."""
+        rate = self.messages_per_second
+        if rate is None:
+            return
+        while True:
+            wait = rate_limit.take(f"fcm:{self.name}", rate, rate, cost=message_count)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def _project_credentials(name: str, spec: Dict[str, Any]) -> "credentials.Certificate":
+    if spec.get("credentials_path"):
+        return credentials.Certificate(os.path.abspath(spec["credentials_path"]))
+    if spec.get("credentials"):
+        return credentials.Certificate(spec["credentials"])
+    creds_json = os.getenv(spec["credentials_env"])
+    if not creds_json:
+        raise ValueError(f"Firebase project {name}: environment variable {spec['credentials_env']} is not set")
+    return credentials.Certificate(json.loads(creds_json))
+
+
+def parse_projects(config: Dict[str, Any]) -> Dict[str, FirebaseProject]:
+    """
+    Build the project pool from a {name: {credentials..., messages_per_second}} mapping.
+
+    The default project (FIREBASE_ADMIN_CREDENTIALS*, rate FCM_MESSAGES_PER_SECOND)
+    is always included.
+
     Raises:
-        ValueError: If token is invalid
-        Exception: If sending fails
+        ValueError: If an entry has no credentials or a non-positive rate
     """
-    # Ensure Firebase is initialized
-    if _firebase_app is None:
-        initialize_firebase()
-    
-    # Get app-specific defaults if app_id provided
-    if app_id:
-        if icon is None:
-            icon = app_configs.get_app_icon(app_id)
-        if badge is None:
-            badge = app_configs.get_app_badge(app_id)
+    rate = os.getenv('FCM_MESSAGES_PER_SECOND')
+    projects = {
+        DEFAULT_PROJECT: FirebaseProject(DEFAULT_PROJECT, None, float(rate) if rate else None, FCM_BREAKER)
+    }
+    for name, entry in config.items():
+        if name == DEFAULT_PROJECT:
+            raise ValueError(f"Firebase project name '{DEFAULT_PROJECT}' is reserved")
+        sources = [key for key in ("credentials_path", "credentials", "credentials_env") if entry.get(key)]
+        if len(sources) != 1:
+            raise ValueError(
+                f"Firebase project {name}: set exactly one of credentials_path, credentials or credentials_env"
+            )
+        rate = entry.get("messages_per_second")
+        if rate is not None and float(rate) <= 0:
+            raise ValueError(f"Firebase project {name}: messages_per_second must be positive")
+        projects[name] = FirebaseProject(
+            name,
+            {sources[0]: entry[sources[0]]},
+            float(rate) if rate is not None else None,
+            register_breaker(f"fcm:{name}", "FCM")
+        )
+    return projects
+
+
+def _load_projects() -> Dict[str, FirebaseProject]:
+    config = {}
+    projects_file = os.getenv('FIREBASE_PROJECTS_FILE', '')
+    if projects_file:
+        with open(projects_file, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    if os.getenv('FIREBASE_PROJECTS'):
+        config.update(json.loads(os.getenv('FIREBASE_PROJECTS')))
+    projects = parse_projects(config)
+    if len(projects) > 1:
+        logger.info(f"Firebase projects: {', '.join(sorted(projects))}")
+    return projects
+
+
+DEFAULT_PROJECT = "default"
+
+_projects = _load_projects()
+
+
+def project_names() -> List[str]:
+    """Names of the configured Firebase projects."""
+    return sorted(_projects)
+
+
+def has_tenant_projects() -> bool:
+    """Whether any project besides the default one is configured."""
+    return len(_projects) > 1
+
+
+def project_for_app(app_id: Optional[str]) -> str:
+    """
+    Name of the Firebase project an app's sends go to.
+
+    Raises:
+        ValueError: If the app's config names a project that is not configured
+    """
+    if not app_id:
+        return DEFAULT_PROJECT
+    name = app_configs.get_app_config(app_id).get("firebase_project") or DEFAULT_PROJECT
+    if name not in _projects:
+        raise ValueError(f"App {app_id} uses unknown Firebase project: {name}")
+    return name
+
+
+def _route(app_id: Optional[str], project: Optional[str]) -> FirebaseProject:
+    name = project or project_for_app(app_id)
+    try:
+        return _projects[name]
+    except KeyError:
+        raise ValueError(f"Unknown Firebase project: {name}")
+
+
+def new_failure_summary() -> Dict[str, Any]:
+    """
+    Empty summary of failed messages.
     
-    # Convert data values to strings (FCM requirement)
-    string_data = convert_data_to_strings(data)
+    Returns:
+        Dictionary with failed (count), by_code (count per FCM error code) and
+        sample (up to FAILURE_SAMPLE_SIZE failed tokens with their errors)
+    """
+    return {"failed": 0, "by_code": {}, "sample": []}
+
+
+def log_failure_summary(summary: Dict[str, Any], app_id: Optional[str] = None) -> None:
+    """Log a failure summary as one structured warning."""
+    logger.warning(
+        f"{summary['failed']} message(s) failed for app_id: {app_id}: {summary['by_code']}",
+        extra={"app_id": app_id, "failures": summary}
+    )
+
+
+def error_code(error: BaseException) -> str:
+    """
+    FCM error code for a failed send, e.g. UNREGISTERED, QUOTA_EXCEEDED or UNAVAILABLE.
     
-    # Build the message
-    message = messaging.Message(
-        token=token,
-        notification=messaging.Notification(
+    FCM-specific errors are raised as subclasses whose generic code is less
+    precise (an unregistered token is NOT_FOUND), so those are mapped first.
+    """
+    load_sdk()
+    fcm_errors = (
+        (messaging.UnregisteredError, 'UNREGISTERED'),
+        (messaging.QuotaExceededError, 'QUOTA_EXCEEDED'),
+        (messaging.SenderIdMismatchError, 'SENDER_ID_MISMATCH'),
+        (messaging.ThirdPartyAuthError, 'THIRD_PARTY_AUTH_ERROR'),
+    )
+    for error_type, code in fcm_errors:
+        if isinstance(error, error_type):
+            return code
+    return getattr(error, 'code', None) or type(error).__name__
+
+
+def _count_failures(app_id: Optional[str], code: str, count: int = 1) -> None:
+    FCM_MESSAGES.labels(app_id=app_label(app_id), result="failure").inc(count)
+    FCM_FAILURES.labels(app_id=app_label(app_id), error_code=code).inc(count)
+
+
+def _call_fcm(
+    operation: str,
+    app_id: Optional[str],
+    send: Callable,
+    message,
+    message_count: int = 1,
+    project: Optional[FirebaseProject] = None
+):
+    """
+    Run an FCM send call through the project's rate limit and breaker,
+    recording its latency, the calls in flight, and a failure for every
+    message if the whole call fails.
+    """
+    project = project or _projects[DEFAULT_PROJECT]
+    project.pace(message_count)
+    in_flight = FCM_SENDS_IN_FLIGHT.labels(operation=operation)
+    with project.breaker.guard():
+        in_flight.inc()
+        try:
+            with phase("fcm_send"), FCM_SEND_SECONDS.labels(operation=operation, app_id=app_label(app_id)).time():
+                if project.credentials_spec is None:
+                    # The default project is firebase_admin's default app
+                    return send(message)
+                return send(message, app=project.app())
+        except Exception as e:
+            _count_failures(app_id, error_code(e), message_count)
+            raise
+        finally:
+            in_flight.dec()
+
+
+def _platform_configs(
+    title: str,
+    body: str,
+    icon: Optional[str],
+    badge: Optional[str],
+    sound: str,
+    collapse_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    The notification and its web push, APNs and Android configs, as message keyword arguments.
+
+    With a collapse_key, a newer notification with the same key replaces an
+    older one on the device (and in FCM's queue while the device is offline)
+    instead of being shown next to it.
+    """
+    return {
+        "notification": messaging.Notification(
             title=title,
             body=body
         ),
-        data=string_data,
-        webpush=messaging.WebpushConfig(
+        "webpush": messaging.WebpushConfig(
             notification=messaging.WebpushNotification(
                 title=title,
                 body=body,
                 icon=icon or "/icon-192x192.png",
                 badge=badge or "/icon-96x96.png",
                 require_interaction=False,
-                vibrate=[200, 100, 200]
+                vibrate=[200, 100, 200],
+                tag=collapse_key
             )
             # Note: fcm_options.link requires HTTPS URL, so we omit it
             # The notification will use the default action (opening the app)
         ),
-        apns=messaging.APNSConfig(
+        "apns": messaging.APNSConfig(
+            headers={"apns-collapse-id": collapse_key} if collapse_key else None,
             payload=messaging.APNSPayload(
                 aps=messaging.Aps(
                     alert=messaging.ApsAlert(
@@ -164,25 +429,85 @@ def send_push_notification(
                 )
             )
         ),
-        android=messaging.AndroidConfig(
+        "android": messaging.AndroidConfig(
+            collapse_key=collapse_key,
             notification=messaging.AndroidNotification(
                 title=title,
                 body=body,
                 icon="ic_notification",
                 sound=sound,
-                channel_id="default"
+                channel_id="default",
+                tag=collapse_key
             )
         )
-    )
+    }
+
+
+def send_push_notification(
+    token: str,
+    title: str,
+    body: str,
+    app_id: Optional[str] = None,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    sound: str = "default",
+    project: Optional[str] = None
+) -> "messaging.SendResponse":
+    """
+    Send a push notification to a single device token.
+    
+    Args:
+        token: FCM device token
+        title: Notification title
+        body: Notification body text
+        app_id: App identifier (used to get default icon/badge if not provided)
+        icon: Custom icon URL (overrides app default)
+        badge: Custom badge URL (overrides app default)
+        data: Custom data payload (key-value pairs)
+        sound: Sound to play (default: "default")
+        project: Firebase project to send through (default: the app's project)
+        
+    Returns:
+        SendResponse object with message_id
+        
+    Raises:
+        ValueError: If token is invalid
+        CircuitOpenError: If FCM is failing and the breaker is open
+        Exception: If sending fails
+    """
+    # Ensure the app's Firebase project is initialized
+    firebase_project = _route(app_id, project)
+    firebase_project.app()
+    load_sdk()
+    
+    # Get app-specific defaults if app_id provided
+    if app_id:
+        if icon is None:
+            icon = app_configs.get_app_icon(app_id)
+        if badge is None:
+            badge = app_configs.get_app_badge(app_id)
+    
+    with phase("message_build"):
+        # Convert data values to strings (FCM requirement)
+        string_data = convert_data_to_strings(data)
+        
+        # Build the message
+        message = messaging.Message(
+            token=token,
+            data=string_data,
+            **_platform_configs(title, body, icon, badge, sound)
+        )
     
     try:
-        response = messaging.send(message)
+        response = _call_fcm("send", app_id, messaging.send, message, project=firebase_project)
+        FCM_MESSAGES.labels(app_id=app_label(app_id), result="success").inc()
         logger.info(f"Successfully sent message to token {token[:20]}...: {response}")
         return response
     except messaging.UnregisteredError:
         logger.warning(f"Token {token[:20]}... is unregistered or invalid")
         raise ValueError("Token is unregistered or invalid")
-    except messaging.InvalidArgumentError as e:
+    except exceptions.InvalidArgumentError as e:
         logger.error(f"Invalid argument: {str(e)}")
         raise ValueError(f"Invalid argument: {str(e)}")
     except Exception as e:
@@ -198,8 +523,11 @@ def send_multicast_notification(
     icon: Optional[str] = None,
     badge: Optional[str] = None,
     data: Optional[Dict[str, Any]] = None,
-    sound: str = "default"
-) -> messaging.BatchResponse:
+    sound: str = "default",
+    failure_summary: Optional[Dict[str, Any]] = None,
+    project: Optional[str] = None,
+    collapse_key: Optional[str] = None
+) -> "messaging.BatchResponse":
     """
     Send push notifications to multiple device tokens.
     
@@ -212,13 +540,22 @@ def send_multicast_notification(
         badge: Custom badge URL (overrides app default)
         data: Custom data payload (key-value pairs)
         sound: Sound to play (default: "default")
+        failure_summary: Summary from new_failure_summary() to add this call's
+            failures to, so a fan-out over many calls logs them once. Without
+            it the call logs its own summary.
+        project: Firebase project to send through (default: the app's project)
+        collapse_key: Key under which newer notifications replace this one on the device
         
     Returns:
         BatchResponse object with success/failure counts
+        
+    Raises:
+        CircuitOpenError: If FCM is failing and the breaker is open
     """
-    # Ensure Firebase is initialized
-    if _firebase_app is None:
-        initialize_firebase()
+    # Ensure the app's Firebase project is initialized
+    firebase_project = _route(app_id, project)
+    firebase_project.app()
+    load_sdk()
     
     if not tokens:
         logger.warning("No tokens provided for multicast notification")
@@ -231,68 +568,125 @@ def send_multicast_notification(
         if badge is None:
             badge = app_configs.get_app_badge(app_id)
     
-    # Convert data values to strings (FCM requirement)
-    string_data = convert_data_to_strings(data)
-    
-    # Build the message
-    message = messaging.MulticastMessage(
-        tokens=tokens,
-        notification=messaging.Notification(
-            title=title,
-            body=body
-        ),
-        data=string_data,
-        webpush=messaging.WebpushConfig(
-            notification=messaging.WebpushNotification(
-                title=title,
-                body=body,
-                icon=icon or "/icon-192x192.png",
-                badge=badge or "/icon-96x96.png",
-                require_interaction=False,
-                vibrate=[200, 100, 200]
-            )
-            # Note: fcm_options.link requires HTTPS URL, so we omit it
-            # The notification will use the default action (opening the app)
-        ),
-        apns=messaging.APNSConfig(
-            payload=messaging.APNSPayload(
-                aps=messaging.Aps(
-                    alert=messaging.ApsAlert(
-                        title=title,
-                        body=body
-                    ),
-                    sound=sound,
-                    badge=1
-                )
-            )
-        ),
-        android=messaging.AndroidConfig(
-            notification=messaging.AndroidNotification(
-                title=title,
-                body=body,
-                icon="ic_notification",
-                sound=sound,
-                channel_id="default"
-            )
+    with phase("message_build"):
+        # Convert data values to strings (FCM requirement)
+        string_data = convert_data_to_strings(data)
+        
+        # Build the message
+        message = messaging.MulticastMessage(
+            tokens=tokens,
+            data=string_data,
+            **_platform_configs(title, body, icon, badge, sound, collapse_key)
         )
-    )
     
     try:
         # Use send_each_for_multicast instead of send_multicast
-        response = messaging.send_each_for_multicast(message)
-        logger.info(
+        response = _call_fcm(
+            "multicast", app_id, messaging.send_each_for_multicast, message, len(tokens), project=firebase_project
+        )
+        FCM_MESSAGES.labels(app_id=app_label(app_id), result="success").inc(response.success_count)
+        logger.debug(
             f"Multicast notification sent: {response.success_count} successful, "
             f"{response.failure_count} failed"
         )
         
-        # Log failed tokens
-        if response.failure_count > 0:
-            for idx, resp in enumerate(response.responses):
-                if not resp.success:
-                    logger.warning(f"Failed to send to token {tokens[idx][:20]}...: {resp.exception}")
-        
+        _summarize_failures(tokens, response, app_id, failure_summary)
         return response
     except Exception as e:
         logger.error(f"Failed to send multicast notification: {str(e)}")
         raise
 
+
+def send_each_notification(
+    messages: List[Tuple[str, str, str]],
+    app_id: Optional[str] = None,
+    icon: Optional[str] = None,
+    badge: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+    sound: str = "default",
+    failure_summary: Optional[Dict[str, Any]] = None,
+    project: Optional[str] = None
+) -> "messaging.BatchResponse":
+    """
+    Send a different notification to each token in one FCM call (send_each).
+    
+    Args:
+        messages: (token, title, body) per message, at most 500
+        app_id: App identifier (used to get default icon/badge if not provided)
+        icon: Custom icon URL (overrides app default)
+        badge: Custom badge URL (overrides app default)
+        data: Custom data payload shared by every message
+        sound: Sound to play (default: "default")
+        failure_summary: Summary from new_failure_summary() to add this call's
+            failures to (see send_multicast_notification)
+        project: Firebase project to send through (default: the app's project)
+        
+    Returns:
+        BatchResponse with one response per message, in order
+        
+    Raises:
+        CircuitOpenError: If FCM is failing and the breaker is open
+    """
+    firebase_project = _route(app_id, project)
+    firebase_project.app()
+    load_sdk()
+    
+    if not messages:
+        logger.warning("No messages provided for send_each")
+        return None
+    
+    if app_id:
+        if icon is None:
+            icon = app_configs.get_app_icon(app_id)
+        if badge is None:
+            badge = app_configs.get_app_badge(app_id)
+    
+    with phase("message_build"):
+        string_data = convert_data_to_strings(data)
+        batch = [
+            messaging.Message(token=token, data=string_data, **_platform_configs(title, body, icon, badge, sound))
+            for token, title, body in messages
+        ]
+    
+    try:
+        response = _call_fcm("send_each", app_id, messaging.send_each, batch, len(batch), project=firebase_project)
+        FCM_MESSAGES.labels(app_id=app_label(app_id), result="success").inc(response.success_count)
+        logger.debug(
+            f"Personalized notifications sent: {response.success_count} successful, "
+            f"{response.failure_count} failed"
+        )
+        _summarize_failures([token for token, _, _ in messages], response, app_id, failure_summary)
+        return response
+    except Exception as e:
+        logger.error(f"Failed to send personalized notifications: {str(e)}")
+        raise
+
+
+def _summarize_failures(
+    tokens: List[str],
+    response: "messaging.BatchResponse",
+    app_id: Optional[str],
+    failure_summary: Optional[Dict[str, Any]]
+) -> None:
+    """Count a batch's failures per error code; one summary per call (or per fan-out), not one log line per token."""
+    if response.failure_count == 0:
+        return
+    summary = failure_summary if failure_summary is not None else new_failure_summary()
+    by_code = {}
+    for token, resp in zip(tokens, response.responses):
+        if not resp.success:
+            code = error_code(resp.exception)
+            by_code[code] = by_code.get(code, 0) + 1
+            if len(summary["sample"]) < FAILURE_SAMPLE_SIZE:
+                summary["sample"].append({
+                    "token": f"{token[:20]}...",
+                    "error_code": code,
+                    "error": str(resp.exception)
+                })
+    for code, count in by_code.items():
+        _count_failures(app_id, code, count)
+        summary["by_code"][code] = summary["by_code"].get(code, 0) + count
+    summary["failed"] += response.failure_count
+    if failure_summary is None:
+        log_failure_summary(summary, app_id)
+
@@ -0,0 +1,137 @@
+"""
+Gunicorn configuration for the notification service.
+
+Almost all request time is spent waiting on FCM and Firestore, so workers are
+threaded (gthread): each process serves several requests concurrently while
+they wait on I/O, instead of one request per sync worker.
+
+Gunicorn loads ./gunicorn.conf.py automatically; every setting can be
+overridden with the environment variables below.
+"""
+
+import os
+import signal
+import shutil
+import tempfile
+
+
+def _cpu_count() -> int:
+    """CPUs this process may run on (respects container CPU affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Server socket
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+backlog = int(os.getenv('GUNICORN_BACKLOG', '2048'))
+
+# Worker processes: 2 x CPUs + 1, capped because each worker holds its own
+# Firebase SDK, gRPC channel and HTTP pools in memory
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv(
+    'WEB_CONCURRENCY',
+    min(_cpu_count() * 2 + 1, int(os.getenv('GUNICORN_MAX_WORKERS', '8')))
+))
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+# Import the app once in the master so workers share those pages copy-on-write.
+# The Firebase SDK is imported lazily, and no Firebase app or gRPC channel is
+# created in the master; each worker initializes its own after fork.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# Timeouts. gthread workers heartbeat from their main loop, so timeout only
+# catches a wedged worker, not a long fan-out. graceful_timeout stays inside
+# the platform's termination grace period.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '25'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# On SIGTERM a worker has SHUTDOWN_DRAIN_SECONDS to finish or checkpoint its
+# fan-outs (see shutdown.py). Leave a margin inside graceful_timeout for the
+# final log flush. Set before the app is imported so shutdown.py reads it.
+os.environ.setdefault('SHUTDOWN_DRAIN_SECONDS', str(max(1, graceful_timeout - 5)))
+
+# Firebase warm-up after fork: "background" lets the worker serve /api/health
+# while the SDK imports and connects (/api/ready gates traffic meanwhile);
+# "sync" finishes it before the worker accepts any request
+WARM_UP_MODE = os.getenv('WARM_UP_MODE', 'background').lower()
+
+# Prometheus multiprocess mode: each worker writes its metric samples to files
+# in this directory and /metrics merges them. Set here, before the app (and
+# prometheus_client) is imported, so every process picks it up.
+METRICS_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'notification-service-metrics')
+)
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+# Logging
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+errorlog = '-'
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+
+
+def on_starting(server):
+    """Start from empty metrics so samples from a previous run are not merged in."""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges (in-flight sends) from the merged metrics."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    """
+    Initialize Firebase, warm the Firestore channel and load app configs in each worker.
+
+    gRPC channels must not be shared across fork(), so this runs after the
+    worker is forked. The heavy SDK imports happen here too, on a background
+    thread by default, so a restarted or newly scaled worker answers health
+    checks immediately and the first real request never pays for them.
+    """
+    import app_configs
+    import token_manager
+
+    if WARM_UP_MODE == 'background':
+        token_manager.start_warm_up(background=True)
+        app_configs.ensure_started(background=True)
+        worker.log.info(f"Worker {worker.pid}: Firebase warm-up started in background")
+        return
+
+    app_configs.ensure_started()
+    if token_manager.warm_up():
+        worker.log.info(f"Worker {worker.pid}: Firebase ready")
+    else:
+        worker.log.warning(f"Worker {worker.pid}: warm-up failed, will retry on first request")
+
+
+def post_worker_init(worker):
+    """
+    Start draining sends when the worker receives SIGTERM.
+
+    Gunicorn's own handler stops the accept loop and waits up to
+    graceful_timeout for in-flight requests; this runs first so those requests
+    checkpoint their unsent chunks before the deadline instead of being killed.
+    """
+    import shutdown
+
+    gunicorn_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        shutdown.begin()
+        if callable(gunicorn_handler):
+            gunicorn_handler(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def worker_exit(server, worker):
+    """Checkpoint background sends and flush buffered logs before the worker exits."""
+    import shutdown
+
+    shutdown.finish()
@@ -0,0 +1,239 @@
+"""
+Background send jobs (staged rollouts, long broadcasts) and their progress.
+
+Job state lives in one JSON file per job under DATA_DIR/jobs so any gunicorn
+worker can answer a status request, not only the one running the job.
+"""
+
+import os
+import json
+import uuid
+import logging
+import threading
+import time
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.getenv('JOBS_DIR', os.path.join(os.getenv('DATA_DIR', 'data'), 'jobs'))
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# Stopped by a worker shutdown before it finished
+INTERRUPTED = "interrupted"
+
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+_lock = threading.Lock()
+
+# Job threads started by this process
+_running: List[threading.Thread] = []
+
+
+def create_job(kind: str, params: Dict[str, Any], **fields) -> Dict[str, Any]:
+    """
+    Create and persist a new job.
+
+    Args:
+        kind: Job type, e.g. "rollout"
+        params: The request parameters the job runs with
+        **fields: Extra initial state
+
+    Returns:
+        The stored job
+    """
+    now = datetime.utcnow().isoformat()
+    job = {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "status": PENDING,
+        "params": params,
+        "created_at": now,
+        "updated_at": now,
+        **fields
+    }
+    _write(job)
+    return job
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Get a job by id, or None if it does not exist."""
+    try:
+        with open(_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_jobs(kind: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    """List jobs, newest first."""
+    if not os.path.isdir(JOBS_DIR):
+        return []
+    found = []
+    for name in os.listdir(JOBS_DIR):
+        if name.endswith('.json'):
+            job = get_job(name[:-len('.json')])
+            if job and (kind is None or job["kind"] == kind):
+                found.append(job)
+    found.sort(key=lambda job: job["created_at"], reverse=True)
+    return found[:limit]
+
+
+def update_job(job_id: str, **fields) -> Dict[str, Any]:
+    """
+    Merge fields into a job's state and persist it.
+
+    The job is re-read under the store lock, so fields written meanwhile by
+    another worker (e.g. cancel_requested) are kept.
+
+    Returns:
+        The updated job
+    """
+    with _lock, _store_lock():
+        job = get_job(job_id)
+        if job is None:
+            raise KeyError(f"Job not found: {job_id}")
+        job.update(fields)
+        job["updated_at"] = datetime.utcnow().isoformat()
+        _write(job)
+        return job
+
+
+def transition(job_id: str, allowed: Callable[[Dict[str, Any]], bool], **fields) -> Optional[Dict[str, Any]]:
+    """
+    Merge fields into a job only if allowed(job) holds, atomically across workers.
+
+    Used to claim a job (e.g. to resume it) so that two workers cannot both run it.
+
+    Returns:
+        The updated job, or None if it does not exist or allowed(job) is false
+    """
+    with _lock, _store_lock():
+        job = get_job(job_id)
+        if job is None or not allowed(job):
+            return None
+        job.update(fields)
+        job["updated_at"] = datetime.utcnow().isoformat()
+        _write(job)
+        return job
+
+
+def append_result(job_id: str, record: Dict[str, Any]) -> None:
+    """Append one record (e.g. a sent chunk's outcome) to a job's result log."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with open(_results_path(job_id), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+def read_results(job_id: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Read a job's result log, oldest first."""
+    try:
+        with open(_results_path(job_id), 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    end = None if limit is None else offset + limit
+    # A torn final line (crash mid-append) is skipped
+    results = []
+    for line in lines[offset:end]:
+        try:
+            results.append(json.loads(line))
+        except ValueError:
+            continue
+    return results
+
+
+def request_cancel(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Ask a running job to stop at its next checkpoint.
+
+    Returns:
+        The job, or None if it does not exist
+    """
+    job = transition(job_id, lambda job: job["status"] not in FINISHED, cancel_requested=True)
+    return job or get_job(job_id)
+
+
+def cancel_requested(job_id: str) -> bool:
+    """Whether a cancel was requested (possibly from another worker)."""
+    job = get_job(job_id)
+    return bool(job and job.get("cancel_requested"))
+
+
+def start(job: Dict[str, Any], target: Callable[[str], None]) -> threading.Thread:
+    """
+    Run target(job_id) on a background thread, recording failure if it raises.
+
+    Returns:
+        The started thread
+    """
+    def run():
+        try:
+            target(job["id"])
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {str(e)}")
+            update_job(job["id"], status=FAILED, error=str(e))
+
+    thread = threading.Thread(target=run, name=f"job-{job['id'][:8]}", daemon=True)
+    thread.start()
+    with _lock:
+        _running[:] = [t for t in _running if t.is_alive()]
+        _running.append(thread)
+    return thread
+
+
+def join_running(timeout: Optional[float] = None) -> int:
+    """
+    Wait for this process's job threads to finish.
+
+    Args:
+        timeout: Total seconds to wait (None waits indefinitely)
+
+    Returns:
+        Number of jobs still running when the wait ended
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _lock:
+        threads = list(_running)
+    for thread in threads:
+        thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+    return sum(1 for thread in threads if thread.is_alive())
+
+
+def _path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{os.path.basename(job_id)}.json")
+
+
+def _results_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{os.path.basename(job_id)}.results.jsonl")
+
+
+@contextmanager
+def _store_lock():
+    """Exclusive lock on the job store shared by all worker processes."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with open(os.path.join(JOBS_DIR, '.lock'), 'w') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        yield
+
+
+def _write(job: Dict[str, Any]) -> None:
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = _path(job["id"])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, default=str)
+    os.replace(tmp_path, path)
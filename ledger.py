@@ -0,0 +1,668 @@
+"""
+Delivery ledger: one record per device per send, kept on local disk.
+
+Every FCM outcome (sent, or failed with its error code) is recorded with the
+send it belonged to, a hash of the device token, the app and user the send
+targeted and the time. GET /api/deliveries queries it.
+
+Senders only append FCM's batch response to an in-memory buffer. A writer
+thread per process turns the buffer into records and appends them in batches
+to that process's active segment, a JSON-lines file. A segment is sealed once
+it holds LEDGER_SEGMENT_RECORDS records or is LEDGER_SEGMENT_SECONDS old: an
+index written next to it holds the segment's time range and, for every block
+of LEDGER_INDEX_BLOCK records, the block's byte range, time range, apps and
+failure count. Queries read only the blocks whose index entry can match.
+
+Compaction runs periodically in whichever worker holds the compaction lock.
+It drops segments older than LEDGER_RETENTION_HOURS, seals segments left
+behind by workers that died, and merges small segments into larger
+time-sorted ones.
+
+The buffer is bounded: when it is full, outcomes are dropped and counted
+rather than slowing down the send.
+"""
+
+import os
+import re
+import json
+import time
+import heapq
+import uuid
+import atexit
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import firebase_service
+from metrics import LEDGER_RECORDS
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LEDGER_DIR = os.getenv('LEDGER_DIR', os.path.join(os.getenv('DATA_DIR', 'data'), 'deliveries'))
+
+LEDGER_ENABLED = os.getenv('LEDGER_ENABLED', 'true').lower() == 'true'
+
+# The writer flushes this often, or sooner once LEDGER_BATCH_SIZE outcomes are buffered
+LEDGER_FLUSH_SECONDS = float(os.getenv('LEDGER_FLUSH_SECONDS', '1'))
+LEDGER_BATCH_SIZE = int(os.getenv('LEDGER_BATCH_SIZE', '5000'))
+
+# Outcomes buffered per process before new ones are dropped
+LEDGER_MAX_PENDING = int(os.getenv('LEDGER_MAX_PENDING', '200000'))
+
+# When the active segment is sealed, and the granularity of its index
+LEDGER_SEGMENT_RECORDS = int(os.getenv('LEDGER_SEGMENT_RECORDS', '100000'))
+LEDGER_SEGMENT_SECONDS = float(os.getenv('LEDGER_SEGMENT_SECONDS', '300'))
+LEDGER_INDEX_BLOCK = int(os.getenv('LEDGER_INDEX_BLOCK', '1000'))
+
+LEDGER_RETENTION_HOURS = float(os.getenv('LEDGER_RETENTION_HOURS', '72'))
+LEDGER_COMPACT_SECONDS = float(os.getenv('LEDGER_COMPACT_SECONDS', '300'))
+
+SENT = "sent"
+FAILED = "failed"
+
+# Order of the values in a stored record (one JSON array per line)
+FIELDS = ("timestamp", "send_id", "message_id", "token_hash", "app_id", "user_id", "status", "error_code")
+_TS, _SEND_ID, _MESSAGE_ID, _TOKEN_HASH, _APP_ID, _USER_ID, _STATUS, _ERROR_CODE = range(len(FIELDS))
+
+# A block lists the apps in it up to this many; beyond that any app may match
+BLOCK_MAX_APPS = 32
+
+# An active segment this much older than LEDGER_SEGMENT_SECONDS belongs to a dead worker
+ORPHAN_GRACE_SECONDS = 60
+
+QUERY_MAX_LIMIT = 1000
+
+_RELATIVE_TIME = re.compile(r'^(\d+(?:\.\d+)?)([smhd])$')
+_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+_lock = threading.Condition()
+_pending: List[tuple] = []
+_pending_count = 0
+_dropped = 0
+_write_lock = threading.Lock()
+_segment = None
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+_index_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+def new_send_id() -> str:
+    """Id grouping the ledger records of one send."""
+    return uuid.uuid4().hex
+
+
+def hash_token(token: str) -> str:
+    """Short, stable hash stored instead of the device token."""
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def record(
+    send_id: str,
+    tokens: List[str],
+    app_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    responses: Optional[list] = None,
+    error: Optional[BaseException] = None,
+    message_id: Optional[str] = None
+) -> None:
+    """
+    Buffer the outcome of one FCM call for the writer thread.
+
+    Only references are kept here; records are built on the writer thread.
+
+    Args:
+        send_id: Send the call belongs to
+        tokens: Tokens the call was for
+        app_id: App the send targeted
+        user_id: User the send targeted
+        responses: FCM SendResponse per token (multicast)
+        error: Error that failed the whole call (every token failed)
+        message_id: FCM message id of a successful single send
+    """
+    global _pending_count, _dropped
+    if not LEDGER_ENABLED or not tokens:
+        return
+    with _lock:
+        if _pending_count + len(tokens) > LEDGER_MAX_PENDING:
+            _dropped += len(tokens)
+            LEDGER_RECORDS.labels(result="dropped").inc(len(tokens))
+            return
+        _pending.append((round(time.time(), 3), send_id, app_id, user_id, tokens, responses, error, message_id))
+        _pending_count += len(tokens)
+        if _pending_count >= LEDGER_BATCH_SIZE:
+            _lock.notify_all()
+    ensure_started()
+
+
+def status() -> Dict[str, int]:
+    """Buffered and dropped outcome counts in this process."""
+    return {"pending": _pending_count, "dropped": _dropped}
+
+
+def ensure_started() -> None:
+    """Start the writer thread once per process."""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name="ledger-writer", daemon=True)
+        _thread.start()
+
+
+def stop() -> None:
+    """Stop the writer thread, write out everything buffered and seal the active segment."""
+    _stop.set()
+    with _lock:
+        _lock.notify_all()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    flush(seal=True)
+
+
+def flush(seal: bool = False) -> int:
+    """
+    Write buffered outcomes to the active segment now.
+
+    Args:
+        seal: Also seal the active segment
+
+    Returns:
+        Number of records written
+    """
+    global _pending, _pending_count, _segment
+    with _lock:
+        batch, _pending, _pending_count = _pending, [], 0
+    with _write_lock:
+        records = sorted(_expand(batch), key=lambda r: r[_TS])
+        written = 0
+        while written < len(records):
+            if _segment is None:
+                _segment = _ActiveSegment()
+            room = LEDGER_SEGMENT_RECORDS - _segment.index.records
+            _segment.append(records[written:written + room])
+            written += min(room, len(records) - written)
+            if _segment.index.records >= LEDGER_SEGMENT_RECORDS:
+                _segment.seal()
+                _segment = None
+        if _segment is not None and (seal or _segment.age() >= LEDGER_SEGMENT_SECONDS):
+            _segment.seal()
+            _segment = None
+    if written:
+        LEDGER_RECORDS.labels(result="written").inc(written)
+    return written
+
+
+def parse_time(value: str, now: Optional[float] = None) -> float:
+    """
+    Parse a query bound into epoch seconds.
+
+    Args:
+        value: ISO 8601 datetime (UTC unless it has an offset), or a
+            duration ago such as "90s", "15m", "1h" or "7d"
+        now: Epoch seconds relative durations count back from
+
+    Returns:
+        Epoch seconds
+
+    Raises:
+        ValueError: If the value is neither
+    """
+    value = value.strip()
+    match = _RELATIVE_TIME.match(value)
+    if match:
+        now = time.time() if now is None else now
+        return now - float(match.group(1)) * _UNIT_SECONDS[match.group(2)]
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"Invalid time (expected ISO 8601 or a duration like 1h): {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def query(
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    app_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    error_code: Optional[str] = None,
+    send_id: Optional[str] = None,
+    token: Optional[str] = None,
+    limit: int = 100
+) -> Dict[str, Any]:
+    """
+    Find delivery records, newest first.
+
+    Outcomes still buffered in a worker (up to LEDGER_FLUSH_SECONDS old) are
+    not visible yet.
+
+    Args:
+        since: Earliest time (epoch seconds, inclusive)
+        until: Latest time (epoch seconds, exclusive)
+        app_id: App the send targeted
+        user_id: User the send targeted
+        status: SENT or FAILED
+        error_code: FCM error code, e.g. UNREGISTERED (implies FAILED)
+        send_id: Send the records belong to
+        token: Device token (matched by its hash)
+        limit: Maximum records returned (counts cover every match)
+
+    Returns:
+        Dictionary with deliveries, matched (total matches), summary (sent,
+        failed and failures per error code over every match) and scanned
+        (segments, blocks and records read)
+    """
+    criteria = {}
+    if app_id is not None:
+        criteria[_APP_ID] = app_id
+    if user_id is not None:
+        criteria[_USER_ID] = user_id
+    if status is not None:
+        criteria[_STATUS] = status
+    if error_code is not None:
+        criteria[_ERROR_CODE] = error_code
+        criteria[_STATUS] = FAILED
+    if send_id is not None:
+        criteria[_SEND_ID] = send_id
+    if token is not None:
+        criteria[_TOKEN_HASH] = hash_token(token)
+    since = float('-inf') if since is None else since
+    until = float('inf') if until is None else until
+
+    newest: List[tuple] = []
+    summary = {SENT: 0, FAILED: 0, "errors": {}}
+    scanned = {"segments": 0, "blocks": 0, "records": 0}
+    for name, path, index in _segments():
+        if index is not None and (index["max_ts"] < since or index["min_ts"] >= until):
+            continue
+        scanned["segments"] += 1
+        for rec in _read_segment(path, index, since, until, criteria, scanned):
+            if not since <= rec[_TS] < until or any(rec[field] != value for field, value in criteria.items()):
+                continue
+            summary[rec[_STATUS]] += 1
+            if rec[_ERROR_CODE]:
+                summary["errors"][rec[_ERROR_CODE]] = summary["errors"].get(rec[_ERROR_CODE], 0) + 1
+            entry = (rec[_TS], scanned["records"], rec)
+            if len(newest) < limit:
+                heapq.heappush(newest, entry)
+            elif limit:
+                heapq.heappushpop(newest, entry)
+
+    deliveries = []
+    for _, _, rec in sorted(newest, reverse=True):
+        delivery = dict(zip(FIELDS, rec))
+        delivery["timestamp"] = datetime.fromtimestamp(rec[_TS], timezone.utc).isoformat()
+        deliveries.append(delivery)
+    return {
+        "deliveries": deliveries,
+        "matched": summary[SENT] + summary[FAILED],
+        "summary": summary,
+        "scanned": scanned
+    }
+
+
+def compact(now: Optional[float] = None) -> Dict[str, int]:
+    """
+    Expire, seal and merge segments. Only one worker compacts at a time; the
+    others return immediately.
+
+    Args:
+        now: Epoch seconds to treat as the current time
+
+    Returns:
+        Dictionary with expired, sealed and merged segment counts
+    """
+    result = {"expired": 0, "sealed": 0, "merged": 0}
+    if not os.path.isdir(LEDGER_DIR):
+        return result
+    lock_file = _try_lock()
+    if lock_file is False:
+        return result
+    try:
+        now = time.time() if now is None else now
+        active = _segment.name if _segment is not None else None
+        orphaned_before = now - LEDGER_SEGMENT_SECONDS - ORPHAN_GRACE_SECONDS
+        for name, path, index in _segments():
+            if path.endswith('.log') and name != active and _name_time(name) < orphaned_before:
+                sealed = os.path.join(LEDGER_DIR, f"{name}.seg")
+                os.replace(path, sealed)
+                _write_index(name, _index_file(sealed, truncate=True))
+                result["sealed"] += 1
+            elif path.endswith('.seg') and index is None:
+                _write_index(name, _index_file(path))
+                result["sealed"] += 1
+
+        small = []
+        cutoff = now - LEDGER_RETENTION_HOURS * 3600
+        for name, path, index in _segments():
+            if index is None:
+                continue
+            if index["max_ts"] < cutoff:
+                _remove(name)
+                result["expired"] += 1
+            elif index["records"] < LEDGER_SEGMENT_RECORDS // 2:
+                small.append((name, index["records"]))
+        result["merged"] = _merge(small)
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+    if any(result.values()):
+        logger.info(f"Compacted delivery ledger: {result}")
+    return result
+
+
+class _IndexBuilder:
+    """Block index of a segment, built as records are appended in file order."""
+
+    def __init__(self):
+        self.blocks: List[Dict[str, Any]] = []
+        self.records = 0
+        self.size = 0
+
+    def add(self, rec: list, length: int) -> None:
+        ts = rec[_TS]
+        if not self.blocks or self.blocks[-1]["records"] >= LEDGER_INDEX_BLOCK:
+            self.blocks.append({
+                "offset": self.size, "length": 0, "records": 0,
+                "min_ts": ts, "max_ts": ts, "apps": [], "failed": 0
+            })
+        block = self.blocks[-1]
+        block["length"] += length
+        block["records"] += 1
+        block["min_ts"] = min(block["min_ts"], ts)
+        block["max_ts"] = max(block["max_ts"], ts)
+        if block["apps"] is not None and rec[_APP_ID] not in block["apps"]:
+            block["apps"] = block["apps"] + [rec[_APP_ID]] if len(block["apps"]) < BLOCK_MAX_APPS else None
+        if rec[_STATUS] == FAILED:
+            block["failed"] += 1
+        self.records += 1
+        self.size += length
+
+    def build(self, replaces: Optional[List[str]] = None) -> Dict[str, Any]:
+        return {
+            "records": self.records,
+            "min_ts": min((block["min_ts"] for block in self.blocks), default=0),
+            "max_ts": max((block["max_ts"] for block in self.blocks), default=0),
+            "blocks": self.blocks,
+            "replaces": replaces or []
+        }
+
+
+class _ActiveSegment:
+    """This process's segment being appended to."""
+
+    def __init__(self):
+        os.makedirs(LEDGER_DIR, exist_ok=True)
+        self.name = f"{time.time_ns():020d}-{os.getpid()}"
+        self.path = os.path.join(LEDGER_DIR, f"{self.name}.log")
+        self.opened = time.monotonic()
+        self.index = _IndexBuilder()
+        self.file = open(self.path, 'ab')
+
+    def age(self) -> float:
+        return time.monotonic() - self.opened
+
+    def append(self, records: List[list]) -> None:
+        lines = []
+        for rec in records:
+            line = _encode(rec)
+            self.index.add(rec, len(line))
+            lines.append(line)
+        # One write per batch: a concurrent reader sees whole lines, or a
+        # partial last line it skips
+        self.file.write(b''.join(lines))
+        self.file.flush()
+
+    def seal(self) -> None:
+        self.file.close()
+        sealed = os.path.join(LEDGER_DIR, f"{self.name}.seg")
+        os.replace(self.path, sealed)
+        _write_index(self.name, self.index.build())
+
+
+def _run() -> None:
+    next_compact = 0.0
+    while not _stop.is_set():
+        with _lock:
+            if _pending_count < LEDGER_BATCH_SIZE:
+                _lock.wait(LEDGER_FLUSH_SECONDS)
+        if _stop.is_set():
+            break
+        try:
+            flush()
+            if time.monotonic() >= next_compact:
+                next_compact = time.monotonic() + LEDGER_COMPACT_SECONDS
+                compact()
+        except Exception as e:
+            logger.error(f"Delivery ledger writer failed: {str(e)}")
+
+
+def _expand(batch: List[tuple]) -> Iterator[list]:
+    """Turn buffered FCM call outcomes into records."""
+    for ts, send_id, app_id, user_id, tokens, responses, error, message_id in batch:
+        if error is not None:
+            code = firebase_service.error_code(error)
+            outcomes = ((None, FAILED, code) for _ in tokens)
+        elif responses is not None:
+            outcomes = (
+                (r.message_id, SENT, None) if r.success else (None, FAILED, firebase_service.error_code(r.exception))
+                for r in responses
+            )
+        else:
+            outcomes = ((message_id, SENT, None) for _ in tokens)
+        for token, (msg_id, outcome, code) in zip(tokens, outcomes):
+            yield [ts, send_id, msg_id, hash_token(token), app_id, user_id, outcome, code]
+
+
+def _encode(rec: list) -> bytes:
+    return (json.dumps(rec, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _name_time(name: str) -> float:
+    return int(name.split('-', 1)[0]) / 1e9
+
+
+def _segments() -> List[Tuple[str, str, Optional[Dict[str, Any]]]]:
+    """
+    Readable segments as (name, path, index or None), oldest first.
+
+    Sealed segments without an index (mid-seal) and active ones are read in
+    full. Segments replaced by a merged one that is already in place are left
+    out so no record is counted twice.
+    """
+    if not os.path.isdir(LEDGER_DIR):
+        return []
+    names = os.listdir(LEDGER_DIR)
+    present = set(names)
+    segments = []
+    replaced = set()
+    for file_name in sorted(names):
+        name, ext = os.path.splitext(file_name)
+        if ext not in ('.seg', '.log'):
+            continue
+        index = _load_index(name) if ext == '.seg' and f"{name}.idx" in present else None
+        if index is not None:
+            replaced.update(index["replaces"])
+        segments.append((name, os.path.join(LEDGER_DIR, file_name), index))
+    return [segment for segment in segments if segment[0] not in replaced]
+
+
+def _load_index(name: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(LEDGER_DIR, f"{name}.idx")
+    try:
+        mtime = os.path.getmtime(path)
+        cached = _index_cache.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    _index_cache[name] = (mtime, index)
+    return index
+
+
+def _block_can_match(block: Dict[str, Any], since: float, until: float, criteria: Dict[int, Any]) -> bool:
+    if block["max_ts"] < since or block["min_ts"] >= until:
+        return False
+    if _APP_ID in criteria and block["apps"] is not None and criteria[_APP_ID] not in block["apps"]:
+        return False
+    if criteria.get(_STATUS) == FAILED and not block["failed"]:
+        return False
+    if criteria.get(_STATUS) == SENT and block["failed"] == block["records"]:
+        return False
+    return True
+
+
+def _read_segment(
+    path: str,
+    index: Optional[Dict[str, Any]],
+    since: float,
+    until: float,
+    criteria: Dict[int, Any],
+    scanned: Dict[str, int]
+) -> Iterator[list]:
+    """Records of a segment in the blocks that can match (every record without an index)."""
+    try:
+        with open(path, 'rb') as f:
+            if index is None:
+                scanned["blocks"] += 1
+                yield from _parse(f.read(), scanned)
+                return
+            for block in index["blocks"]:
+                if _block_can_match(block, since, until, criteria):
+                    scanned["blocks"] += 1
+                    f.seek(block["offset"])
+                    yield from _parse(f.read(block["length"]), scanned)
+    except FileNotFoundError:
+        # Merged or expired by compaction while the query ran
+        return
+
+
+def _parse(data: bytes, scanned: Dict[str, int]) -> Iterator[list]:
+    for line in data.splitlines():
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            # The last line of an active segment may still be being written
+            continue
+        scanned["records"] += 1
+        yield rec
+
+
+def _index_file(path: str, truncate: bool = False) -> Dict[str, Any]:
+    """
+    Index a sealed segment from its contents.
+
+    Args:
+        truncate: Cut off a torn final line (when sealing a dead worker's segment)
+    """
+    builder = _IndexBuilder()
+    size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # A torn final line from a worker that died mid-write
+                break
+            builder.add(rec, len(line))
+            size += len(line)
+    if truncate and size < os.path.getsize(path):
+        os.truncate(path, size)
+        logger.warning(f"Truncated a torn record at the end of delivery ledger segment {os.path.basename(path)}")
+    return builder.build()
+
+
+def _write_index(name: str, index: Dict[str, Any]) -> None:
+    path = os.path.join(LEDGER_DIR, f"{name}.idx")
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _merge(small: List[Tuple[str, int]]) -> int:
+    """Merge runs of small sealed segments into segments of up to LEDGER_SEGMENT_RECORDS records."""
+    groups, group, total = [], [], 0
+    for name, records in small:
+        if group and total + records > LEDGER_SEGMENT_RECORDS:
+            groups.append(group)
+            group, total = [], 0
+        group.append(name)
+        total += records
+    groups.append(group)
+
+    merged = 0
+    for group in groups:
+        if len(group) < 2:
+            continue
+        records = []
+        for name in group:
+            with open(os.path.join(LEDGER_DIR, f"{name}.seg"), 'rb') as f:
+                # Segments sealed before torn tails were truncated may still end in one
+                records.extend(_parse(f.read(), {"records": 0}))
+        records.sort(key=lambda rec: rec[_TS])
+
+        name = f"{group[0].split('-', 1)[0]}-m{uuid.uuid4().hex[:8]}"
+        path = os.path.join(LEDGER_DIR, f"{name}.seg")
+        builder = _IndexBuilder()
+        with open(f"{path}.tmp", 'wb') as f:
+            for rec in records:
+                line = _encode(rec)
+                builder.add(rec, len(line))
+                f.write(line)
+        # The index goes first: readers skip the inputs only once the merged
+        # segment they were replaced by is in place
+        _write_index(name, builder.build(replaces=group))
+        os.replace(f"{path}.tmp", path)
+        for old in group:
+            _remove(old)
+        merged += len(group)
+    return merged
+
+
+def _remove(name: str) -> None:
+    for ext in ('.idx', '.seg'):
+        try:
+            os.remove(os.path.join(LEDGER_DIR, f"{name}{ext}"))
+        except FileNotFoundError:
+            pass
+    _index_cache.pop(name, None)
+
+
+def _try_lock():
+    """Take the compaction lock: the open lock file, None without flock, or False if another worker has it."""
+    if fcntl is None:
+        return None
+    handle = open(os.path.join(LEDGER_DIR, '.compact.lock'), 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    return handle
+
+
+def _reset_in_child() -> None:
+    global _lock, _write_lock, _pending, _pending_count, _dropped, _segment, _thread
+    # The writer thread does not survive fork, and the parent's segment is not ours to append to
+    _lock = threading.Condition()
+    _write_lock = threading.Lock()
+    _pending, _pending_count, _dropped = [], 0, 0
+    _segment = None
+    _thread = None
+
+
+os.register_at_fork(after_in_child=_reset_in_child)
+atexit.register(stop)
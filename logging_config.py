@@ -0,0 +1,151 @@
+"""
+Non-blocking, structured logging for the service.
+
+Request threads only put records on an in-memory queue (QueueHandler); a
+single background thread (QueueListener) formats them as JSON lines and
+writes them to stderr. A slow or blocked log sink therefore cannot stall a
+send. If the queue fills up, records are dropped and counted rather than
+blocking the caller.
+
+Extra fields passed with logger.info(..., extra={...}) become top-level keys
+in the JSON output.
+"""
+
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# "json" for one JSON object per line, "text" for the classic human-readable format
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Records buffered between request threads and the writer thread
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking or erroring."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread. Only resolve what refers to
+        # the caller's objects (message arguments, traceback) before queueing.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+_lock = threading.Lock()
+
+
+def _build_output_handler() -> logging.Handler:
+    output = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return output
+
+
+def configure_logging() -> None:
+    """
+    Route all logging through the queue and start the writer thread.
+
+    Safe to call more than once; only the first call configures anything.
+    """
+    global _handler, _listener
+
+    with _lock:
+        if _handler is not None:
+            return
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _handler = DroppingQueueHandler(log_queue)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_handler)
+        root.setLevel(LOG_LEVEL)
+
+        _listener = QueueListener(log_queue, _build_output_handler(), respect_handler_level=True)
+        _listener.start()
+        atexit.register(flush_logging)
+        # The writer thread does not survive fork (gunicorn workers): start a new one in the child
+        os.register_at_fork(after_in_child=_restart_in_child)
+
+
+def flush_logging() -> None:
+    """Write out every queued record and stop the writer thread."""
+    global _listener
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def dropped_count() -> int:
+    """Records dropped because the log queue was full."""
+    return _handler.dropped if _handler is not None else 0
+
+
+def _restart_in_child() -> None:
+    global _listener, _lock
+
+    # Locks and the queue may have been held by another thread at fork time
+    _lock = threading.Lock()
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _handler.queue = log_queue
+    _handler.dropped = 0
+    _listener = QueueListener(log_queue, _build_output_handler(), respect_handler_level=True)
+    _listener.start()
@@ -0,0 +1,236 @@
+"""
+Prometheus metrics for the notification service.
+
+Histograms, counters and gauges for the hot paths (HTTP routes, Firestore
+token queries, FCM sends) are defined here and updated by the modules that
+own those paths. GET /metrics renders them in the Prometheus text format.
+
+Under gunicorn every worker is a separate process with its own counters. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it before the app is
+imported) each worker writes its samples to files in that directory and
+render() merges them, so one scrape reports the whole instance.
+"""
+
+import os
+from typing import Optional, Tuple
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+# App ids labelled as themselves besides the configured apps (comma-separated)
+METRICS_APP_IDS = frozenset(app_id.strip() for app_id in os.getenv('METRICS_APP_IDS', '').split(',') if app_id.strip())
+
+# Request latencies range from a few ms (health, registration) to tens of
+# seconds (large fan-outs), so the buckets span both
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'HTTP request latency by route',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+
+FIRESTORE_QUERY_SECONDS = Histogram(
+    'firestore_query_duration_seconds',
+    'Time to run and stream a Firestore token query',
+    ['operation', 'app_id'],
+    buckets=LATENCY_BUCKETS
+)
+
+TOKENS_FETCHED = Counter(
+    'tokens_fetched_total',
+    'Device tokens read from Firestore',
+    ['operation', 'app_id']
+)
+
+SEGMENT_DOCUMENTS_READ = Counter(
+    'segment_documents_read_total',
+    'Token documents segment queries were estimated to read and actually read, by index used',
+    ['index', 'kind']
+)
+
+USER_INDEX_LOOKUPS = Counter(
+    'user_token_index_lookups_total',
+    'User token lookups answered by the user\'s index document (hit) or sent to a query (missing, unindexed)',
+    ['result']
+)
+
+TOKEN_QUERIES_COALESCED = Counter(
+    'token_queries_coalesced_total',
+    'Token queries answered by another caller\'s in-flight query'
+)
+
+FCM_SEND_SECONDS = Histogram(
+    'fcm_send_duration_seconds',
+    'Time for one FCM send call (single message or one multicast batch)',
+    ['operation', 'app_id'],
+    buckets=LATENCY_BUCKETS
+)
+
+FCM_MESSAGES = Counter(
+    'fcm_messages_total',
+    'Messages handed to FCM, by outcome',
+    ['app_id', 'result']
+)
+
+FCM_FAILURES = Counter(
+    'fcm_failures_total',
+    'Failed messages by FCM error code',
+    ['app_id', 'error_code']
+)
+
+FCM_SENDS_IN_FLIGHT = Gauge(
+    'fcm_sends_in_flight',
+    'FCM send calls currently in progress',
+    ['operation'],
+    multiprocess_mode='livesum'
+)
+
+BREAKER_STATE = Gauge(
+    'circuit_breaker_state',
+    'Circuit breaker state (0 closed, 1 half-open, 2 open)',
+    ['dependency'],
+    multiprocess_mode='livemax'
+)
+
+BREAKER_REJECTED = Counter(
+    'circuit_breaker_rejected_total',
+    'Calls rejected by an open circuit breaker',
+    ['dependency']
+)
+
+ADMISSION_ACTIVE = Gauge(
+    'admission_active',
+    'Requests running under an admission budget',
+    ['budget'],
+    multiprocess_mode='livesum'
+)
+
+ADMISSION_QUEUED = Gauge(
+    'admission_queued',
+    'Requests waiting for an admission budget slot',
+    ['budget'],
+    multiprocess_mode='livesum'
+)
+
+ADMISSION_REJECTED = Counter(
+    'admission_rejected_total',
+    'Requests rejected with 429 because their budget was full',
+    ['budget']
+)
+
+TOKENS_IN_FLIGHT = Gauge(
+    'tokens_in_flight',
+    'Device tokens currently being delivered',
+    multiprocess_mode='livesum'
+)
+
+API_KEY_REQUESTS = Counter(
+    'api_key_requests_total',
+    'Authenticated requests per API key',
+    ['key']
+)
+
+API_KEY_TOKENS = Counter(
+    'api_key_tokens_total',
+    'Device tokens sent to per API key (fan-out sends)',
+    ['key']
+)
+
+API_KEY_RATE_LIMITED = Counter(
+    'api_key_rate_limited_total',
+    'Requests rejected because an API key was over a limit',
+    ['key', 'limit']
+)
+
+LEDGER_RECORDS = Counter(
+    'delivery_ledger_records_total',
+    'Delivery outcomes written to the delivery ledger, or dropped because its buffer was full',
+    ['result']
+)
+
+ENGAGEMENT_EVENTS = Counter(
+    'engagement_events_total',
+    'Engagement events accepted by POST /api/events',
+    ['type']
+)
+
+ENGAGEMENT_EVENTS_DROPPED = Counter(
+    'engagement_events_dropped_total',
+    'Engagement events rejected as invalid or overwritten in a full buffer before being flushed',
+    ['reason']
+)
+
+DIGEST_NOTIFICATIONS = Counter(
+    'digest_notifications_total',
+    'Notifications sent with a digest group: sent at once, held for a digest, or bypassed when the digest store failed',
+    ['app_id', 'outcome']
+)
+
+DIGEST_SENDS = Counter(
+    'digest_sends_total',
+    'Digest windows closed with held notifications, each sent as one notification',
+    ['app_id']
+)
+
+DIGEST_SENDS_SAVED = Counter(
+    'digest_sends_saved_total',
+    'Sends avoided by merging held notifications into one digest',
+    ['app_id']
+)
+
+# Backlogs live on disk and are shared by all workers, so whichever worker
+# answers the scrape reports the current value
+OUTBOX_PENDING = Gauge(
+    'outbox_pending',
+    'Sends queued in the outbox for replay',
+    multiprocess_mode='mostrecent'
+)
+
+SCHEDULED_PENDING = Gauge(
+    'scheduled_pending',
+    'Scheduled sends waiting for their send time',
+    multiprocess_mode='mostrecent'
+)
+
+DIGEST_WINDOWS_OPEN = Gauge(
+    'digest_windows_open',
+    'Digest windows holding notifications that have not been sent yet',
+    multiprocess_mode='mostrecent'
+)
+
+
+def app_label(app_id: Optional[str]) -> str:
+    """
+    Label value for an optional app_id.
+
+    Only configured apps and METRICS_APP_IDS get series of their own; any
+    other id is labelled "other", so callers cannot create unbounded series
+    (which stay on disk in multiprocess mode) by sending to made-up app ids.
+    """
+    if not app_id:
+        return "none"
+    if app_id in METRICS_APP_IDS:
+        return app_id
+    # Imported here: app_configs imports modules that import this one
+    import app_configs
+    return app_id if app_configs.is_known(app_id) else "other"
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    Returns:
+        (body, content type)
+    """
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
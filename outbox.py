@@ -0,0 +1,119 @@
+"""
+Local outbox for sends that could not be delivered because a dependency was down.
+
+Each entry is one JSON file, so every gunicorn worker can enqueue safely and a
+drain claims entries with an atomic rename before replaying them.
+"""
+
+import os
+import json
+import uuid
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+from circuit_breaker import CircuitOpenError, fail_fast
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', os.path.join(os.getenv('DATA_DIR', 'data'), 'outbox'))
+
+
+def enqueue(kind: str, payload: Dict[str, Any]) -> str:
+    """
+    Persist a send for later replay.
+
+    Args:
+        kind: Replay handler name (e.g. "send_to_app", "deliver")
+        payload: Keyword arguments for the handler (must be JSON serializable)
+
+    Returns:
+        Outbox entry id
+    """
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    entry_id = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+    entry = {
+        "id": entry_id,
+        "kind": kind,
+        "payload": payload,
+        "created_at": datetime.utcnow().isoformat(),
+        "attempts": 0
+    }
+    _write(os.path.join(OUTBOX_DIR, f"{entry_id}.json"), entry)
+    logger.info(f"Queued {kind} to outbox: {entry_id}")
+    return entry_id
+
+
+def pending_count() -> int:
+    """Number of entries waiting in the outbox."""
+    if not os.path.isdir(OUTBOX_DIR):
+        return 0
+    return sum(1 for name in os.listdir(OUTBOX_DIR) if name.endswith('.json'))
+
+
+def drain(handlers: Dict[str, Callable[..., Any]], limit: int = 100) -> Dict[str, int]:
+    """
+    Replay queued entries, oldest first.
+
+    Entries whose handler raises are put back for the next drain. Handlers run
+    with the outbox fallback off, so a breaker that is still open fails the
+    replay (and stops the drain) instead of queueing its sends as a new entry.
+
+    Args:
+        handlers: Mapping of entry kind to a callable taking the payload as kwargs
+        limit: Maximum number of entries to replay in this call
+
+    Returns:
+        Dictionary with replayed, failed and remaining counts
+    """
+    replayed = 0
+    failed = 0
+
+    for path in _oldest_entries(limit):
+        claimed = f"{path}.claimed"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            # Another worker claimed it first
+            continue
+
+        with open(claimed, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+
+        handler = handlers.get(entry["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"No outbox handler for kind: {entry['kind']}")
+            with fail_fast():
+                handler(**entry["payload"])
+            os.remove(claimed)
+            replayed += 1
+        except Exception as e:
+            logger.warning(f"Outbox replay failed for {entry['id']}: {str(e)}")
+            entry["attempts"] += 1
+            entry["last_error"] = str(e)
+            _write(path, entry)
+            os.remove(claimed)
+            failed += 1
+            if isinstance(e, CircuitOpenError):
+                # Dependency is still down, no point trying the rest now
+                break
+
+    return {
+        "replayed": replayed,
+        "failed": failed,
+        "remaining": pending_count()
+    }
+
+
+def _oldest_entries(limit: int) -> List[str]:
+    if not os.path.isdir(OUTBOX_DIR):
+        return []
+    names = sorted(name for name in os.listdir(OUTBOX_DIR) if name.endswith('.json'))
+    return [os.path.join(OUTBOX_DIR, name) for name in names[:limit]]
+
+
+def _write(path: str, entry: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, default=str)
+    os.replace(tmp_path, path)
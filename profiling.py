@@ -0,0 +1,188 @@
+"""
+Per-request phase timings (Server-Timing header) and on-demand profiling.
+
+Hot-path code wraps its steps in phase("token_query") and similar blocks.
+While a request is being handled the durations are summed per phase (a
+fan-out runs one FCM call per 500 tokens) and app.py reports them in the
+Server-Timing response header, e.g.
+
+    Server-Timing: app_config;dur=0.1, token_query;dur=48.2, message_build;dur=1.9, fcm_send;dur=131.0, total;dur=184.4
+
+Outside a request (scheduler and rollout threads) phase() does nothing.
+
+A request can also be recorded with cProfile, on demand by an admin
+(?profile=1) or for a random sample of requests (PROFILE_SAMPLE_RATE). Dumps
+are kept in a bounded on-disk ring buffer under DATA_DIR/profiles: once
+PROFILE_MAX_FILES are stored, the oldest are deleted.
+"""
+
+import io
+import os
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.getenv('DATA_DIR', 'data'), 'profiles'))
+
+# Fraction of requests profiled without being asked (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+
+# Profiles kept on disk before the oldest are overwritten
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('request_timings', default=None)
+
+
+def start_timings() -> Token:
+    """Begin collecting phase timings for the current request."""
+    return _timings.set({})
+
+
+def finish_timings(token: Token) -> Dict[str, float]:
+    """
+    Stop collecting phase timings for the current request.
+
+    Returns:
+        Milliseconds spent per phase
+    """
+    timings = _timings.get() or {}
+    _timings.reset(token)
+    return timings
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Add the duration of the block to the current request's timing for name."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def server_timing_header(timings: Dict[str, float], total_ms: float) -> str:
+    """Format phase timings (ms) as a Server-Timing header value."""
+    entries = [f"{name};dur={duration:.1f}" for name, duration in timings.items()]
+    entries.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(entries)
+
+
+def should_sample() -> bool:
+    """Whether to profile this request under PROFILE_SAMPLE_RATE."""
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_profile() -> cProfile.Profile:
+    """Start profiling the current thread."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def save_profile(profiler: cProfile.Profile, **info) -> str:
+    """
+    Stop a profiler and store its stats in the ring buffer.
+
+    Args:
+        profiler: Profiler returned by start_profile()
+        **info: Request details stored alongside (method, route, status, duration_ms, timings)
+
+    Returns:
+        The profile id
+    """
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    # Ids sort by creation time, which is the ring buffer's eviction order
+    profile_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    stats_path = _path(profile_id, '.prof')
+    profiler.dump_stats(f"{stats_path}.tmp")
+    os.replace(f"{stats_path}.tmp", stats_path)
+
+    meta = {"id": profile_id, "created_at": datetime.utcnow().isoformat(), **info}
+    with open(f"{_path(profile_id, '.json')}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(meta, f, default=str)
+    os.replace(f"{_path(profile_id, '.json')}.tmp", _path(profile_id, '.json'))
+
+    _prune()
+    logger.info(f"Saved profile {profile_id} for {info.get('method')} {info.get('route')}")
+    return profile_id
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Stored profiles' request details, newest first."""
+    profiles = []
+    for profile_id in _profile_ids():
+        try:
+            with open(_path(profile_id, '.json'), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            # Evicted by another worker while listing
+            continue
+    profiles.reverse()
+    return profiles
+
+
+def get_profile_path(profile_id: str) -> Optional[str]:
+    """Path of a stored profile's pstats dump, or None if it does not exist."""
+    path = _path(profile_id, '.prof')
+    return path if os.path.exists(path) else None
+
+
+def profile_summary(profile_id: str, sort: str = 'cumulative', limit: int = 40) -> Optional[str]:
+    """
+    Render a stored profile as pstats text.
+
+    Args:
+        profile_id: Profile id
+        sort: pstats sort key, e.g. "cumulative" or "tottime"
+        limit: Number of functions to print
+
+    Returns:
+        The report, or None if the profile does not exist
+
+    Raises:
+        KeyError: If sort is not a valid pstats sort key
+    """
+    path = get_profile_path(profile_id)
+    if path is None:
+        return None
+    stream = io.StringIO()
+    pstats.Stats(path, stream=stream).sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def _path(profile_id: str, suffix: str) -> str:
+    return os.path.join(PROFILE_DIR, f"{os.path.basename(profile_id)}{suffix}")
+
+
+def _profile_ids() -> List[str]:
+    """Stored profile ids, oldest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(name[:-len('.prof')] for name in os.listdir(PROFILE_DIR) if name.endswith('.prof'))
+
+
+def _prune() -> None:
+    """Delete the oldest profiles beyond PROFILE_MAX_FILES."""
+    ids = _profile_ids()
+    for profile_id in ids[:max(0, len(ids) - PROFILE_MAX_FILES)]:
+        for suffix in ('.prof', '.json'):
+            try:
+                os.remove(_path(profile_id, suffix))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,106 @@
+"""
+Token-bucket rate limiting.
+
+A bucket holds up to `capacity` units and refills at `rate` units per second.
+A request takes `cost` units (1 per request, or the audience size for a
+fan-out) and is allowed if the bucket has them. A request costing more than
+the whole bucket is allowed when the bucket is full and leaves it in debt, so
+a large fan-out delays the caller's next ones instead of never running.
+
+Buckets live in the shared SQLite store by default, so all gunicorn workers
+enforce one limit per key. RATE_LIMIT_BACKEND=memory keeps them per process.
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+import shared_store
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'sqlite').lower()
+
+shared_store.register_schema("rate_limit", [
+    """CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+        bucket TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )"""
+])
+
+_memory_buckets: Dict[str, Tuple[float, float]] = {}
+_memory_lock = threading.Lock()
+
+
+def take(bucket: str, rate: float, capacity: float, cost: float = 1.0, now: Optional[float] = None) -> float:
+    """
+    Try to take cost units from a bucket.
+
+    Args:
+        bucket: Bucket name, e.g. "requests:billing"
+        rate: Refill rate in units per second
+        capacity: Maximum units the bucket holds (the allowed burst)
+        cost: Units this request needs
+        now: Current time (for tests)
+
+    Returns:
+        0 if allowed, otherwise seconds until the request would be allowed
+    """
+    now = time.time() if now is None else now
+    if RATE_LIMIT_BACKEND == 'memory':
+        with _memory_lock:
+            tokens, updated_at = _memory_buckets.get(bucket, (capacity, now))
+            tokens, wait = _take(tokens, updated_at, rate, capacity, cost, now)
+            _memory_buckets[bucket] = (tokens, now)
+        return wait
+
+    try:
+        with shared_store.transaction() as db:
+            row = db.execute(
+                "SELECT tokens, updated_at FROM rate_limit_buckets WHERE bucket = ?", (bucket,)
+            ).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            tokens, wait = _take(tokens, updated_at, rate, capacity, cost, now)
+            db.execute(
+                "INSERT INTO rate_limit_buckets (bucket, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(bucket) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (bucket, tokens, now)
+            )
+        return wait
+    except sqlite3.Error as e:
+        # A limiter problem must not take sends down with it
+        logger.warning(f"Rate limit store unavailable, allowing request: {str(e)}")
+        return 0.0
+
+
+def reset(bucket: Optional[str] = None) -> None:
+    """Forget one bucket's state, or every bucket's."""
+    with _memory_lock:
+        if bucket is None:
+            _memory_buckets.clear()
+        else:
+            _memory_buckets.pop(bucket, None)
+    if RATE_LIMIT_BACKEND != 'memory':
+        with shared_store.transaction() as db:
+            if bucket is None:
+                db.execute("DELETE FROM rate_limit_buckets")
+            else:
+                db.execute("DELETE FROM rate_limit_buckets WHERE bucket = ?", (bucket,))
+
+
+def _take(
+    tokens: float,
+    updated_at: float,
+    rate: float,
+    capacity: float,
+    cost: float,
+    now: float
+) -> Tuple[float, float]:
+    """Refill and take from a bucket. Returns (tokens left, seconds to wait or 0)."""
+    tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= cost or tokens >= capacity:
+        return tokens - cost, 0.0
+    return tokens, (min(cost, capacity) - tokens) / rate
@@ -0,0 +1,119 @@
+"""
+Backfill or repair the per-user token index (user_tokens).
+
+Rebuilds the index document of every user found in device_tokens or
+user_tokens, each in its own transaction, so it is safe to run while the
+service is registering tokens. Run it once after deploying the index, and
+again whenever lookups and queries disagree.
+
+Usage:
+    python rebuild_user_index.py                     # every user
+    python rebuild_user_index.py --user user123      # only these users (repeatable)
+    python rebuild_user_index.py --workers 16
+"""
+
+import argparse
+import itertools
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+from urllib.parse import unquote
+from dotenv import load_dotenv
+import token_manager
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Documents read per page while listing users
+PAGE_SIZE = 1000
+
+
+def iter_user_ids() -> Iterator[str]:
+    """Every user with a token or an index document, each once."""
+    db = token_manager.get_firestore_client()
+    seen = set()
+    tokens = db.collection(token_manager.COLLECTION_NAME).select(["user_id"])
+    for doc in _paged(tokens):
+        user_id = (doc.to_dict() or {}).get("user_id")
+        if user_id and user_id not in seen:
+            seen.add(user_id)
+            yield user_id
+    # Users whose tokens are all gone still have an index document to check
+    for doc in _paged(db.collection(token_manager.USER_INDEX_COLLECTION).select(["user_id"])):
+        user_id = (doc.to_dict() or {}).get("user_id") or unquote(doc.id)
+        if user_id not in seen:
+            seen.add(user_id)
+            yield user_id
+
+
+def _paged(query) -> Iterator:
+    last = None
+    while True:
+        page = query.order_by("__name__").limit(PAGE_SIZE)
+        if last is not None:
+            page = page.start_after(last)
+        docs = list(page.stream(timeout=token_manager.FIRESTORE_TIMEOUT))
+        yield from docs
+        if len(docs) < PAGE_SIZE:
+            return
+        last = docs[-1]
+
+
+def rebuild(user_ids: Optional[List[str]] = None, workers: int = 8) -> int:
+    """
+    Rebuild index documents, a page of users at a time.
+
+    Args:
+        user_ids: Users to rebuild (default: every user)
+        workers: Users rebuilt concurrently
+
+    Returns:
+        Number of users whose rebuild failed
+    """
+    started = time.monotonic()
+    users = tokens = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in _batches(iter(user_ids or iter_user_ids()), PAGE_SIZE):
+            for count in executor.map(_rebuild_user, batch):
+                if count is None:
+                    failed += 1
+                else:
+                    users += 1
+                    tokens += count
+            logger.info(f"Rebuilt {users} users ({tokens} tokens), {failed} failed")
+
+    logger.info(f"Done in {time.monotonic() - started:.1f}s: {users} users ({tokens} tokens), {failed} failed")
+    return failed
+
+
+def _rebuild_user(user_id: str) -> Optional[int]:
+    try:
+        return token_manager.rebuild_user_index(user_id)
+    except Exception as e:
+        logger.error(f"Failed to rebuild index for user_id: {user_id}: {str(e)}")
+        return None
+
+
+def _batches(items: Iterator[str], size: int) -> Iterator[List[str]]:
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--user", action="append", dest="users", help="Rebuild only this user (repeatable)")
+    parser.add_argument("--workers", type=int, default=8, help="Users rebuilt concurrently")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    return 1 if rebuild(args.users, args.workers) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+Staged percentage rollout for large broadcasts.
+
+Instead of notifying every device at once, a rollout sends in waves (e.g. 1%,
+10%, 50%, 100% of the audience) with a pause and/or a target send rate, so the
+traffic that opened notifications drive back to our origin ramps up gradually.
+
+Each token is assigned to a bucket by hashing it with the job id. A wave covers
+a contiguous bucket range, so waves never overlap and re-running a wave (after
+a restart) selects exactly the same tokens.
+
+A worker shutdown stops a rollout between FCM batches: the job and the wave it
+was in are marked "interrupted", with the batches already sent per wave in
+chunks_sent. Each wave is sent in token order and checkpoints the last token
+of every batch it sent as its cursor, writing the batch as in_flight first
+(as broadcasts do). resume() continues an interrupted rollout: it skips
+completed waves and the tokens up to the cursor. A batch that was in flight
+when the rollout stopped may or may not have reached FCM; it is skipped and
+counted as unknown, so no device is notified twice.
+
+Like broadcasts, waves are sent with the outbox fallback off: an open breaker
+interrupts the rollout at the wave's cursor instead of moving the rest of the
+audience into the outbox. While a wave is sending or throttling, the job is
+touched every broadcasts.HEARTBEAT_SECONDS, so a slow rollout is never taken
+for abandoned and resumed a second time.
+"""
+
+import time
+import bisect
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+import api_keys
+import broadcasts
+import circuit_breaker
+import fanout
+import jobs
+import shutdown
+import token_manager
+from circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Buckets per 100%, i.e. wave percentages resolve to 0.01% steps
+BUCKETS = 10000
+
+DEFAULT_WAVES = [1, 10, 50, 100]
+
+# Granularity of pauses, so a cancel is noticed without waiting out the pause
+CANCEL_CHECK_SECONDS = 5.0
+
+
+def validate_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validate and normalize a rollout plan from a request body.
+
+    Args:
+        plan: {"waves": [1, 10, 50, 100], "pause_seconds": 60, "rate_per_second": 1000}
+
+    Returns:
+        Normalized plan
+
+    Raises:
+        ValueError: If the plan is invalid
+    """
+    if not isinstance(plan, dict):
+        plan = {}
+    waves = plan.get("waves", DEFAULT_WAVES)
+    if not isinstance(waves, list) or not waves:
+        raise ValueError("rollout.waves must be a non-empty list of percentages")
+    try:
+        waves = [float(w) for w in waves]
+        pause_seconds = float(plan.get("pause_seconds", 0))
+        rate = plan.get("rate_per_second")
+        rate = float(rate) if rate is not None else None
+    except (TypeError, ValueError):
+        raise ValueError("rollout values must be numbers")
+
+    previous = 0.0
+    for wave in waves:
+        if wave <= previous or wave > 100:
+            raise ValueError("rollout.waves must be strictly increasing percentages in (0, 100]")
+        previous = wave
+    if pause_seconds < 0:
+        raise ValueError("rollout.pause_seconds must not be negative")
+    if rate is not None and rate <= 0:
+        raise ValueError("rollout.rate_per_second must be positive")
+
+    return {
+        "waves": waves,
+        "pause_seconds": pause_seconds,
+        "rate_per_second": rate
+    }
+
+
+def bucket(token: str, salt: str) -> int:
+    """Deterministic bucket in [0, BUCKETS) for a token within a rollout."""
+    digest = hashlib.blake2b(f"{salt}:{token}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % BUCKETS
+
+
+def partition(tokens: List[str], waves: List[float], salt: str) -> List[List[str]]:
+    """
+    Split tokens into disjoint waves by bucket range.
+
+    Wave i receives the buckets between waves[i-1]% and waves[i]%, so the
+    cumulative audience after wave i is waves[i]% of the tokens.
+    """
+    bounds = [round(w * BUCKETS / 100) for w in waves]
+    result = [[] for _ in waves]
+    for token in tokens:
+        b = bucket(token, salt)
+        for index, bound in enumerate(bounds):
+            if b < bound:
+                result[index].append(token)
+                break
+    return result
+
+
+def start_rollout(message: Dict[str, Any], plan: Dict[str, Any], api_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Create a rollout job for a broadcast and start it in the background.
+
+    Args:
+        message: deliver() arguments other than tokens (title, body, icon, badge, data)
+        plan: Validated rollout plan
+        api_key: Name of the key that started it; every batch is charged against its tokens-per-minute limit
+
+    Returns:
+        The created job
+    """
+    job = jobs.create_job("rollout", {"message": message, "plan": plan, "api_key": api_key}, waves=[
+        {
+            "percent": wave, "status": jobs.PENDING, "tokens": 0, "sent": 0, "failed": 0, "unknown": 0,
+            "chunks_sent": 0, "cursor": None, "in_flight": None
+        }
+        for wave in plan["waves"]
+    ], sent=0, failed=0, unknown=0, total_tokens=None, current_wave=None)
+    jobs.start(job, run_rollout)
+    logger.info(f"Started broadcast rollout {job['id']}: waves={plan['waves']}")
+    return job
+
+
+def resumable(job: Dict[str, Any]) -> bool:
+    """Whether a rollout job can be resumed now."""
+    if job["kind"] != "rollout":
+        return False
+    if job["status"] in (jobs.INTERRUPTED, jobs.FAILED):
+        return True
+    if job["status"] in (jobs.PENDING, jobs.RUNNING):
+        # A pause between waves does not touch the job, so it only counts from the next wave's start
+        last_seen = max(job["updated_at"], job.get("next_wave_at") or "")
+        return datetime.utcnow() - datetime.fromisoformat(last_seen) > timedelta(seconds=broadcasts.STALE_SECONDS)
+    return False
+
+
+def resume(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Continue a rollout from its last checkpoint in the background.
+
+    Returns:
+        The job, or None if it is not resumable (finished, running, or not a rollout)
+    """
+    job = jobs.transition(job_id, resumable, status=jobs.RUNNING, error=None, resumed_at=datetime.utcnow().isoformat())
+    if job is None:
+        return None
+    jobs.start(job, run_rollout)
+    logger.info(f"Resumed rollout {job_id} at wave {job.get('current_wave')}")
+    return job
+
+
+def run_rollout(job_id: str) -> None:
+    """Run a rollout job's remaining waves to completion (blocking)."""
+    job = jobs.get_job(job_id)
+    message = job["params"]["message"]
+    plan = job["params"]["plan"]
+    key = api_keys.get_key(job["params"].get("api_key"))
+
+    tokens = token_manager.get_all_tokens()
+    waves = [sorted(wave_tokens) for wave_tokens in partition(tokens, plan["waves"], salt=job_id)]
+    state = job["waves"]
+    for wave_state, wave_tokens in zip(state, waves):
+        wave_state["tokens"] = len(wave_tokens)
+    jobs.update_job(job_id, status=jobs.RUNNING, total_tokens=len(tokens), waves=state)
+
+    sent = job.get("sent", 0)
+    failed = job.get("failed", 0)
+    unknown = job.get("unknown", 0)
+    error = None
+    for index, wave_tokens in enumerate(waves):
+        wave = state[index]
+        if wave["status"] == jobs.COMPLETED:
+            continue
+        # A resumed wave that had started goes on at once; a new one waits out its pause
+        if index > 0 and plan["pause_seconds"] and wave["status"] == jobs.PENDING:
+            _pause(job_id, plan["pause_seconds"])
+        # A shutting-down worker does not start another wave
+        if jobs.cancel_requested(job_id) or shutdown.draining():
+            break
+
+        cursor = wave.get("cursor")
+        if wave.get("in_flight"):
+            in_flight = wave["in_flight"]
+            logger.warning(
+                f"Rollout {job_id} wave {index + 1}: a batch of {in_flight['tokens']} tokens may have been "
+                f"sent before the job stopped; skipping it so no device is notified twice"
+            )
+            cursor = in_flight["last_token"]
+            wave["unknown"] = wave.get("unknown", 0) + in_flight["tokens"]
+            unknown += in_flight["tokens"]
+            wave["cursor"], wave["in_flight"] = cursor, None
+        if cursor is not None:
+            wave_tokens = wave_tokens[bisect.bisect_right(wave_tokens, cursor):]
+
+        wave["status"] = jobs.RUNNING
+        wave.setdefault("started_at", datetime.utcnow().isoformat())
+        jobs.update_job(job_id, current_wave=index, waves=state, unknown=unknown)
+
+        with circuit_breaker.fail_fast(), broadcasts.heartbeat(job_id):
+            for chunk in fanout.chunk_tokens(wave_tokens):
+                if jobs.cancel_requested(job_id):
+                    wave["status"] = jobs.CANCELLED
+                    break
+                if shutdown.should_stop_sending() or not broadcasts.charge(job_id, key, len(chunk)):
+                    wave["status"] = jobs.INTERRUPTED
+                    break
+                started = time.monotonic()
+                wave["in_flight"] = {"last_token": chunk[-1], "tokens": len(chunk)}
+                jobs.update_job(job_id, waves=state)
+                try:
+                    result = fanout.deliver(chunk, send_id=job_id, **message)
+                except CircuitOpenError as e:
+                    # The breaker refused the call, so nothing in this batch was sent
+                    wave["in_flight"] = None
+                    wave["status"] = jobs.INTERRUPTED
+                    error = str(e)
+                    break
+                wave["sent"] += result["sent_to"]
+                wave["failed"] += result["failed"]
+                sent += result["sent_to"]
+                failed += result["failed"]
+                wave["chunks_sent"] = wave.get("chunks_sent", 0) + 1
+                wave["cursor"], wave["in_flight"] = chunk[-1], None
+                jobs.update_job(job_id, sent=sent, failed=failed, waves=state)
+                _throttle(len(chunk), plan.get("rate_per_second"), started)
+            else:
+                wave["status"] = jobs.COMPLETED
+
+        wave["finished_at"] = datetime.utcnow().isoformat()
+        jobs.update_job(job_id, waves=state)
+        logger.info(
+            f"Rollout {job_id} wave {index + 1}/{len(waves)} ({plan['waves'][index]}%): "
+            f"{wave['sent']} sent, {wave['failed']} failed"
+        )
+        if error is not None:
+            break
+
+    if jobs.cancel_requested(job_id):
+        status = jobs.CANCELLED
+    elif any(wave["status"] != jobs.COMPLETED for wave in state):
+        status = jobs.INTERRUPTED
+    else:
+        status = jobs.COMPLETED
+    jobs.update_job(job_id, status=status, current_wave=None, error=error)
+    logger.info(f"Rollout {job_id} {status}: {sent} sent, {failed} failed, {unknown} unknown")
+
+
+def _pause(job_id: str, seconds: float) -> None:
+    """Wait between waves, returning early if the job is cancelled or the worker shuts down."""
+    jobs.update_job(job_id, next_wave_at=(datetime.utcnow() + timedelta(seconds=seconds)).isoformat())
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline and not jobs.cancel_requested(job_id) and not shutdown.draining():
+        time.sleep(max(0.0, min(CANCEL_CHECK_SECONDS, deadline - time.monotonic())))
+    jobs.update_job(job_id, next_wave_at=None)
+
+
+def _throttle(sent: int, rate_per_second: Optional[float], started: float) -> None:
+    """Sleep so that sending `sent` messages took at least sent / rate seconds."""
+    if not rate_per_second:
+        return
+    remaining = sent / rate_per_second - (time.monotonic() - started)
+    if remaining > 0:
+        time.sleep(remaining)
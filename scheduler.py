@@ -0,0 +1,469 @@
+"""
+Scheduled notification delivery.
+
+Jobs are persisted as one JSON file each under DATA_DIR/schedule and kept in an
+in-memory min-heap ordered by due time. A single timer thread sleeps until the
+earliest job is due and fires it into the fan-out path. With several gunicorn
+workers only the worker holding the schedule lock runs the timer; it rescans
+the directory periodically to pick up jobs created by the others.
+
+Large cohorts are not sent on the minute: when a job's audience is bigger than
+SCHEDULE_STAGGER_THRESHOLD tokens it is split into FCM-sized chunks that are
+persisted as child jobs spread evenly across the job's spread window. Each
+child's id is the parent's id and the chunk index, and the parent records how
+many children it has written, so a parent re-run after a crash does not write
+(and send) a chunk twice.
+
+A job scheduled with an API key charges the key's tokens-per-minute quota
+for its audience when it fires; over the quota it is retried once the key
+has room.
+"""
+
+import os
+import re
+import json
+import heapq
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import api_keys
+import fanout
+import shutdown
+from circuit_breaker import CircuitOpenError
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_DIR = os.getenv('SCHEDULE_DIR', os.path.join(os.getenv('DATA_DIR', 'data'), 'schedule'))
+
+# How often the timer rescans the store for jobs added by other workers
+SCHEDULE_POLL_SECONDS = float(os.getenv('SCHEDULE_POLL_SECONDS', '5'))
+
+# Default window over which a large cohort is spread, and the size that triggers it
+SCHEDULE_SPREAD_SECONDS = float(os.getenv('SCHEDULE_SPREAD_SECONDS', '60'))
+SCHEDULE_STAGGER_THRESHOLD = int(os.getenv('SCHEDULE_STAGGER_THRESHOLD', '1000'))
+
+SCHEDULE_MAX_ATTEMPTS = int(os.getenv('SCHEDULE_MAX_ATTEMPTS', '5'))
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '4'))
+
+# send_at values slightly in the past (clock skew, slow clients) still fire
+PAST_GRACE_SECONDS = 60
+
+_TIME_OF_DAY = re.compile(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?$')
+
+_heap: List[tuple] = []
+_known = set()
+_lock = threading.Condition()
+_thread: Optional[threading.Thread] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_stop = threading.Event()
+_lock_file = None
+
+
+def parse_send_at(send_at: str, tz_name: Optional[str] = None) -> datetime:
+    """
+    Parse a send_at value into an aware UTC datetime.
+
+    Accepts an ISO 8601 datetime, or a time of day ("09:00") meaning its next
+    occurrence. Values without a UTC offset are read in tz_name (default UTC).
+
+    Args:
+        send_at: ISO 8601 datetime or HH:MM[:SS]
+        tz_name: IANA timezone name, e.g. "Asia/Kuala_Lumpur"
+
+    Returns:
+        Due time in UTC
+
+    Raises:
+        ValueError: If the value or timezone is invalid, or the time has passed
+    """
+    try:
+        tz = ZoneInfo(tz_name) if tz_name else timezone.utc
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {tz_name}")
+
+    now = datetime.now(tz)
+    match = _TIME_OF_DAY.match(send_at.strip())
+    if match:
+        hour, minute, second = (int(part or 0) for part in match.groups())
+        if hour > 23 or minute > 59 or second > 59:
+            raise ValueError(f"Invalid send_at time: {send_at}")
+        due = now.replace(hour=hour, minute=minute, second=second, microsecond=0)
+        if due <= now:
+            due += timedelta(days=1)
+    else:
+        try:
+            due = datetime.fromisoformat(send_at.strip().replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"Invalid send_at (expected ISO 8601 or HH:MM): {send_at}")
+        if due.tzinfo is None:
+            due = due.replace(tzinfo=tz)
+
+    due = due.astimezone(timezone.utc)
+    if due < datetime.now(timezone.utc) - timedelta(seconds=PAST_GRACE_SECONDS):
+        raise ValueError("send_at is in the past")
+    return due
+
+
+def schedule(
+    kind: str,
+    payload: Dict[str, Any],
+    due_at: datetime,
+    spread_seconds: Optional[float] = None,
+    parent_id: Optional[str] = None,
+    api_key: Optional[str] = None,
+    job_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Persist a send to run at due_at.
+
+    Args:
+        kind: Fan-out handler name (see fanout.REPLAY_HANDLERS)
+        payload: Handler keyword arguments
+        due_at: Aware datetime the send is due
+        spread_seconds: Window to stagger a large audience over (default SCHEDULE_SPREAD_SECONDS)
+        parent_id: Job this one was split from
+        api_key: Name of the key that scheduled it, charged for the audience when it fires
+        job_id: Id to store the job under (default a random one)
+
+    Returns:
+        The stored job
+    """
+    if kind not in fanout.REPLAY_HANDLERS:
+        raise ValueError(f"Unknown send kind: {kind}")
+
+    job = {
+        "id": job_id or uuid.uuid4().hex,
+        "kind": kind,
+        "payload": payload,
+        "due_at": due_at.astimezone(timezone.utc).isoformat(),
+        "due_ts": due_at.timestamp(),
+        "spread_seconds": SCHEDULE_SPREAD_SECONDS if spread_seconds is None else float(spread_seconds),
+        "status": "scheduled",
+        "attempts": 0,
+        "created_at": datetime.utcnow().isoformat()
+    }
+    if parent_id:
+        job["parent_id"] = parent_id
+    if api_key:
+        job["api_key"] = api_key
+
+    _save(job)
+    _push(job)
+    logger.info(f"Scheduled {kind} job {job['id']} for {job['due_at']}")
+    return job
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Get a pending or failed job by id."""
+    for suffix in ('.json', '.failed'):
+        path = os.path.join(SCHEDULE_DIR, f"{job_id}{suffix}")
+        if os.path.exists(path):
+            return _load(path)
+    return None
+
+
+def list_jobs(limit: int = 100) -> List[Dict[str, Any]]:
+    """List pending jobs, soonest first."""
+    jobs = [_load(path) for path in _job_paths()]
+    jobs = [job for job in jobs if job]
+    jobs.sort(key=lambda job: job["due_ts"])
+    return jobs[:limit]
+
+
+def cancel(job_id: str) -> bool:
+    """
+    Cancel a pending job.
+
+    Returns:
+        True if the job was pending and is now cancelled
+    """
+    try:
+        os.remove(_path(job_id))
+    except FileNotFoundError:
+        return False
+    # The heap entry is skipped when it comes due because its file is gone
+    logger.info(f"Cancelled scheduled job {job_id}")
+    return True
+
+
+def pending_count() -> int:
+    """Number of jobs waiting to fire."""
+    return len(_job_paths())
+
+
+def run_due(now: Optional[float] = None) -> int:
+    """
+    Fire every job that is due.
+
+    Jobs run on the scheduler's thread pool when the engine is running, and
+    inline otherwise.
+
+    Args:
+        now: Epoch seconds to treat as the current time
+
+    Returns:
+        Number of jobs fired
+    """
+    now = datetime.now(timezone.utc).timestamp() if now is None else now
+    due = []
+    with _lock:
+        while _heap and _heap[0][0] <= now:
+            _, job_id = heapq.heappop(_heap)
+            _known.discard(job_id)
+            due.append(job_id)
+
+    fired = 0
+    for job_id in due:
+        path = _path(job_id)
+        claimed = f"{path}.firing"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            # Cancelled, or already fired
+            continue
+        job = _load(claimed)
+        if not job:
+            continue
+        fired += 1
+        if _executor:
+            _executor.submit(_fire, job, claimed)
+        else:
+            _fire(job, claimed)
+    return fired
+
+
+def reload(recover_claimed: bool = False) -> int:
+    """
+    Load jobs from disk into the heap.
+
+    Args:
+        recover_claimed: Also re-queue jobs left mid-fire by a process that
+            died. Only safe when no other process can be firing jobs.
+
+    Returns:
+        Number of newly loaded jobs
+    """
+    os.makedirs(SCHEDULE_DIR, exist_ok=True)
+    loaded = 0
+    if recover_claimed:
+        for name in os.listdir(SCHEDULE_DIR):
+            if name.endswith('.json.firing'):
+                # The job is re-run rather than lost
+                path = os.path.join(SCHEDULE_DIR, name)
+                os.replace(path, path[:-len('.firing')])
+    for path in _job_paths():
+        job = _load(path)
+        if job and job["id"] not in _known:
+            _push(job)
+            loaded += 1
+    return loaded
+
+
+def enabled() -> bool:
+    """Whether scheduled jobs run in this deployment (SCHEDULER_ENABLED)."""
+    return os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+
+
+def ensure_started() -> None:
+    """Start the timer thread once per process (no-op when SCHEDULER_ENABLED=false)."""
+    global _thread, _executor
+    if not enabled() or shutdown.draining():
+        return
+    if _thread is not None and _thread.is_alive():
+        return
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop.clear()
+        _executor = ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS, thread_name_prefix="scheduler")
+        _thread = threading.Thread(target=_run, name="scheduler-timer", daemon=True)
+        _thread.start()
+
+
+def stop() -> None:
+    """Stop the timer thread and wait for running fires to finish."""
+    global _executor
+    _stop.set()
+    with _lock:
+        _lock.notify_all()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def _run() -> None:
+    next_reload = 0.0
+    recovered = False
+    # A shutting-down worker fires nothing new; other workers or the next
+    # deploy pick up the schedule
+    while not _stop.is_set() and not shutdown.draining():
+        if not _acquire_leadership():
+            _stop.wait(SCHEDULE_POLL_SECONDS)
+            continue
+
+        now = datetime.now(timezone.utc).timestamp()
+        if now >= next_reload:
+            try:
+                # The first load after taking the lock picks up jobs a dead leader was firing
+                reload(recover_claimed=not recovered)
+                recovered = True
+            except Exception as e:
+                logger.error(f"Failed to reload schedule: {str(e)}")
+            next_reload = now + SCHEDULE_POLL_SECONDS
+
+        with _lock:
+            next_due = _heap[0][0] if _heap else float('inf')
+            timeout = max(0.0, min(next_due, next_reload) - now)
+            if timeout > 0:
+                _lock.wait(timeout)
+
+        if shutdown.draining():
+            break
+        try:
+            run_due()
+        except Exception as e:
+            logger.error(f"Scheduler tick failed: {str(e)}")
+
+
+def _fire(job: Dict[str, Any], claimed_path: str) -> None:
+    try:
+        if job["kind"] in fanout.AUDIENCE_KINDS:
+            result = _fire_audience(job, claimed_path)
+        else:
+            result = fanout.REPLAY_HANDLERS[job["kind"]](**job["payload"])
+        os.remove(claimed_path)
+        logger.info(f"Fired scheduled job {job['id']}: {result}")
+    except (CircuitOpenError, api_keys.RateLimited) as e:
+        # Dependency is down or the key is over its quota; try again once it may have room
+        _retry(job, claimed_path, e.retry_after, str(e), count_attempt=False)
+    except Exception as e:
+        logger.error(f"Scheduled job {job['id']} failed: {str(e)}")
+        _retry(job, claimed_path, min(300, 2 ** job["attempts"] * 5), str(e))
+
+
+def _fire_audience(job: Dict[str, Any], claimed_path: str) -> Dict[str, Any]:
+    tokens, message = fanout.resolve(job["kind"], job["payload"])
+    if not tokens:
+        return {"sent_to": 0, "failed": 0, "queued": 0}
+    written = job.get("chunks_scheduled", 0)
+    if not written:
+        # Staggered chunks are charged here once, with the whole audience
+        api_keys.charge_tokens(api_keys.get_key(job.get("api_key")), len(tokens))
+    # Every chunk of a staggered send is recorded under the scheduled job
+    message["send_id"] = job["id"]
+
+    chunks = fanout.chunk_tokens(tokens)
+    spread = job.get("spread_seconds") or 0
+    if spread <= 0 or len(tokens) <= SCHEDULE_STAGGER_THRESHOLD or len(chunks) < 2:
+        return fanout.deliver(tokens, **message)
+
+    # Persist every chunk as its own job before any is sent, so a restart
+    # mid-spread resumes the remaining chunks instead of the whole cohort.
+    # A re-run parent skips the chunks it recorded, and a child written just
+    # before the crash is found under its id
+    step = spread / len(chunks)
+    start = max(job["due_ts"], datetime.now(timezone.utc).timestamp())
+    for index, chunk in enumerate(chunks[written:], written):
+        child_id = f"{job['id']}-{index}"
+        if not _exists(child_id):
+            due = datetime.fromtimestamp(start + index * step, tz=timezone.utc)
+            schedule("deliver", {"tokens": chunk, **message}, due, spread_seconds=0, parent_id=job["id"], job_id=child_id)
+        job["chunks_scheduled"] = index + 1
+        _write(claimed_path, job)
+
+    with _lock:
+        _lock.notify_all()
+    return {"staggered_chunks": len(chunks), "spread_seconds": spread}
+
+
+def _retry(job: Dict[str, Any], claimed_path: str, delay: float, error: str, count_attempt: bool = True) -> None:
+    if count_attempt:
+        job["attempts"] += 1
+    job["last_error"] = error
+
+    if job["attempts"] >= SCHEDULE_MAX_ATTEMPTS:
+        job["status"] = "failed"
+        _write(os.path.join(SCHEDULE_DIR, f"{job['id']}.failed"), job)
+        os.remove(claimed_path)
+        logger.error(f"Scheduled job {job['id']} gave up after {job['attempts']} attempts")
+        return
+
+    due = datetime.now(timezone.utc) + timedelta(seconds=max(1.0, delay))
+    job["due_at"] = due.isoformat()
+    job["due_ts"] = due.timestamp()
+    _save(job)
+    os.remove(claimed_path)
+    _push(job)
+
+
+def _push(job: Dict[str, Any]) -> None:
+    with _lock:
+        if job["id"] in _known:
+            return
+        _known.add(job["id"])
+        heapq.heappush(_heap, (job["due_ts"], job["id"]))
+        if _heap[0][1] == job["id"]:
+            # New earliest job: wake the timer so it does not oversleep
+            _lock.notify_all()
+
+
+def _acquire_leadership() -> bool:
+    global _lock_file
+    if _lock_file is not None or fcntl is None:
+        return True
+    os.makedirs(SCHEDULE_DIR, exist_ok=True)
+    handle = open(os.path.join(SCHEDULE_DIR, '.lock'), 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _lock_file = handle
+    logger.info(f"Scheduler timer running in process {os.getpid()}")
+    return True
+
+
+def _path(job_id: str) -> str:
+    return os.path.join(SCHEDULE_DIR, f"{job_id}.json")
+
+
+def _exists(job_id: str) -> bool:
+    path = _path(job_id)
+    return any(os.path.exists(p) for p in (path, f"{path}.firing", os.path.join(SCHEDULE_DIR, f"{job_id}.failed")))
+
+
+def _job_paths() -> List[str]:
+    if not os.path.isdir(SCHEDULE_DIR):
+        return []
+    return [os.path.join(SCHEDULE_DIR, name) for name in os.listdir(SCHEDULE_DIR) if name.endswith('.json')]
+
+
+def _save(job: Dict[str, Any]) -> None:
+    os.makedirs(SCHEDULE_DIR, exist_ok=True)
+    _write(_path(job["id"]), job)
+
+
+def _load(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path: str, job: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, default=str)
+    os.replace(tmp_path, path)
@@ -0,0 +1,363 @@
+"""
+Audience segments for send-to-app: filters on device_type, platform and
+last_active.
+
+A segment is posted with the send as an object with any of:
+
+    {
+        "device_type": "android",                # or a list of values
+        "platform": ["chrome", "firefox"],
+        "last_active": {"since": "7d", "until": "2026-10-01T00:00:00Z"}
+    }
+
+since and until are ISO 8601 datetimes or durations ago (see
+ledger.parse_time). They are resolved when the send runs, so "7d" on a
+scheduled send means the seven days before it goes out.
+
+Every segment query is scoped to the app's tokens. The planner picks one
+access path that Firestore serves from an index and applies the other
+filters in memory to the documents it reads:
+
+- app_id: every token of the app
+- device_type or platform: app_id == X and the field in the wanted values
+  (merged single-field indexes)
+- last_active: app_id == X and last_active in the range, which needs the
+  composite index (app_id ASC, last_active ASC)
+
+Paths are costed from per-app statistics: a count() of the app's tokens and
+a sample of its first SEGMENT_SAMPLE_SIZE documents. Documents are keyed by
+FCM token, which is random, so the first documents in id order are a
+uniform sample. Statistics are cached per process for SEGMENT_STATS_SECONDS.
+With a user_id the query is app_id == X and user_id == U, and the whole
+segment is applied in memory to that user's few devices.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import admission
+import ledger
+import token_manager
+from circuit_breaker import FIRESTORE_BREAKER
+from profiling import phase
+from metrics import FIRESTORE_QUERY_SECONDS, TOKENS_FETCHED, SEGMENT_DOCUMENTS_READ, app_label
+
+logger = logging.getLogger(__name__)
+
+# Fields a segment can list values for
+VALUE_FIELDS = ("device_type", "platform")
+
+# Segment fields Firestore has indexes for (with app_id); others are only filtered in memory
+SEGMENT_INDEXES = tuple(
+    field.strip() for field in os.getenv('SEGMENT_INDEXES', 'device_type,platform,last_active').split(',')
+    if field.strip()
+)
+
+# Documents sampled per app to estimate how selective each filter is
+SEGMENT_SAMPLE_SIZE = max(1, int(os.getenv('SEGMENT_SAMPLE_SIZE', '1000')))
+SEGMENT_STATS_SECONDS = float(os.getenv('SEGMENT_STATS_SECONDS', '600'))
+
+# Index entries a count() aggregation reads per billed document read
+COUNT_ENTRIES_PER_READ = 1000
+
+_READ_FIELDS = ["token", "device_type", "platform", "last_active"]
+
+
+class Filter:
+    """One segment filter: a field's allowed values, or a last_active range in epoch seconds."""
+
+    __slots__ = ("field", "values", "since", "until")
+
+    def __init__(
+        self,
+        field: str,
+        values: Optional[List[str]] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None
+    ):
+        self.field = field
+        self.values = values
+        self.since = since
+        self.until = until
+
+    def matches(self, data: Dict[str, Any]) -> bool:
+        """Whether a token document passes this filter (a missing field never does)."""
+        value = data.get(self.field)
+        if self.values is not None:
+            return value in self.values
+        if not isinstance(value, datetime):
+            return False
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        ts = value.timestamp()
+        return (self.since is None or ts >= self.since) and (self.until is None or ts < self.until)
+
+    def conditions(self) -> List[Tuple[str, str, Any]]:
+        """The filter as Firestore where() conditions."""
+        if self.values is not None:
+            return [(self.field, "in", self.values)]
+        conditions = []
+        # Stored timestamps are naive UTC (see token_manager.save_token)
+        if self.since is not None:
+            conditions.append((self.field, ">=", datetime.utcfromtimestamp(self.since)))
+        if self.until is not None:
+            conditions.append((self.field, "<", datetime.utcfromtimestamp(self.until)))
+        return conditions
+
+
+class _AppStats:
+    """A sample of an app's token documents and its token count."""
+
+    __slots__ = ("total", "sample", "taken_at")
+
+    def __init__(self, total: int, sample: List[Dict[str, Any]], taken_at: float):
+        self.total = total
+        self.sample = sample
+        self.taken_at = taken_at
+
+
+_stats: Dict[str, _AppStats] = {}
+_stats_lock = threading.Lock()
+
+
+def parse(spec: Any, now: Optional[float] = None) -> List[Filter]:
+    """
+    Parse a posted segment.
+
+    Args:
+        spec: Segment object (see the module docstring)
+        now: Epoch seconds relative last_active bounds count back from
+
+    Returns:
+        List of filters, one per field
+
+    Raises:
+        ValueError: If the segment is malformed or empty
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("segment must be an object")
+    unknown = set(spec) - set(VALUE_FIELDS) - {"last_active"}
+    if unknown:
+        raise ValueError(f"Unknown segment fields: {', '.join(sorted(unknown))}")
+
+    filters = []
+    for field in VALUE_FIELDS:
+        if field not in spec:
+            continue
+        values = spec[field]
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not values or not all(isinstance(v, str) and v for v in values):
+            raise ValueError(f"segment.{field} must be a string or a non-empty list of strings")
+        if len(values) > token_manager.IN_QUERY_LIMIT:
+            raise ValueError(f"segment.{field} can list at most {token_manager.IN_QUERY_LIMIT} values")
+        filters.append(Filter(field, values=sorted(set(values))))
+
+    if "last_active" in spec:
+        bounds = spec["last_active"]
+        if not isinstance(bounds, dict) or not bounds or set(bounds) - {"since", "until"}:
+            raise ValueError("segment.last_active must be an object with since and/or until")
+        parsed = {}
+        for name, value in bounds.items():
+            if not isinstance(value, str):
+                raise ValueError(f"segment.last_active.{name} must be a string")
+            parsed[name] = ledger.parse_time(value, now=now)
+        if "since" in parsed and "until" in parsed and parsed["since"] >= parsed["until"]:
+            raise ValueError("segment.last_active.since must be before until")
+        filters.append(Filter("last_active", since=parsed.get("since"), until=parsed.get("until")))
+
+    if not filters:
+        raise ValueError(f"segment must filter on at least one of: {', '.join(VALUE_FIELDS + ('last_active',))}")
+    return filters
+
+
+def plan(app_id: str, filters: List[Filter], user_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Choose how to read a segment's tokens.
+
+    Args:
+        app_id: App the segment belongs to
+        filters: Parsed segment (see parse)
+        user_id: Optional user the send is limited to
+
+    Returns:
+        Dictionary with index (the access path), pushed (the filter Firestore
+        applies, or None), candidates ({path: estimated reads}),
+        estimated_reads, estimated_matches and statistics; the estimates are
+        None when there are no statistics (sends to one user)
+    """
+    if user_id:
+        return {
+            "index": "user_id", "pushed": None, "candidates": {},
+            "estimated_reads": None, "estimated_matches": None, "statistics": None
+        }
+
+    stats, reads = _statistics(app_id)
+    sample = stats.sample
+
+    def estimate(passing: int) -> int:
+        return round(stats.total * passing / len(sample)) if sample else 0
+
+    candidates = {"app_id": stats.total}
+    pushable = {"app_id": None}
+    for segment_filter in filters:
+        if segment_filter.field in SEGMENT_INDEXES:
+            candidates[segment_filter.field] = estimate(sum(1 for doc in sample if segment_filter.matches(doc)))
+            pushable[segment_filter.field] = segment_filter
+
+    # Fewest estimated reads; on a tie, the path listed first (app_id needs no extra index)
+    order = list(candidates)
+    index = min(order, key=lambda path: (candidates[path], order.index(path)))
+    return {
+        "index": index,
+        "pushed": pushable[index],
+        "candidates": candidates,
+        "estimated_reads": candidates[index],
+        "estimated_matches": estimate(sum(1 for doc in sample if all(f.matches(doc) for f in filters))),
+        "statistics": {
+            "documents": stats.total,
+            "sampled": len(sample),
+            "age_seconds": round(time.time() - stats.taken_at, 1),
+            "reads": reads
+        }
+    }
+
+
+def find_tokens(
+    app_id: str,
+    filters: List[Filter],
+    user_id: Optional[str] = None,
+    limit: Optional[int] = None
+) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Get the tokens of an app (optionally one user) that match a segment.
+
+    Args:
+        app_id: App identifier
+        filters: Parsed segment (see parse)
+        user_id: Optional user identifier to filter by
+        limit: Stop reading and reject once more than this many tokens match
+            (see admission.TokenBudget.room)
+
+    Returns:
+        Tuple of (unique tokens, plan report). The report has the plan's
+        index, candidates, estimates and statistics, the conditions run by
+        Firestore and in memory, actual_reads and matched.
+
+    Raises:
+        AdmissionRejected: If more than limit tokens match
+    """
+    try:
+        with phase("token_query"):
+            chosen = plan(app_id, filters, user_id)
+            pushed = chosen.pop("pushed")
+
+            db = token_manager.get_firestore_client()
+            conditions = [("app_id", "==", app_id)]
+            if user_id:
+                conditions.append(("user_id", "==", user_id))
+            if pushed is not None:
+                conditions.extend(pushed.conditions())
+            in_memory = [f for f in filters if f is not pushed]
+
+            query = db.collection(token_manager.COLLECTION_NAME)
+            for field, op, value in conditions:
+                query = query.where(field, op, value)
+
+            labels = {"operation": "tokens_for_segment", "app_id": app_label(app_id)}
+            reads = 0
+            tokens = set()
+            with FIRESTORE_QUERY_SECONDS.labels(**labels).time():
+                with FIRESTORE_BREAKER.guard():
+                    for doc in query.select(_READ_FIELDS).stream(timeout=token_manager.FIRESTORE_TIMEOUT):
+                        reads += 1
+                        data = doc.to_dict()
+                        if all(f.matches(data) for f in in_memory):
+                            tokens.add(data["token"])
+                            if limit is not None and len(tokens) > limit:
+                                break
+            TOKENS_FETCHED.labels(**labels).inc(reads)
+            if limit is not None and len(tokens) > limit:
+                raise admission.TOKENS.reject()
+
+        if chosen["index"] == "app_id" and not user_id:
+            # The whole app was read: its token count is now exact
+            _update_total(app_id, reads)
+
+        SEGMENT_DOCUMENTS_READ.labels(index=chosen["index"], kind="actual").inc(reads)
+        if chosen["estimated_reads"] is not None:
+            SEGMENT_DOCUMENTS_READ.labels(index=chosen["index"], kind="estimated").inc(chosen["estimated_reads"])
+
+        report = dict(
+            chosen,
+            firestore_filters=[_describe(*condition) for condition in conditions],
+            memory_filters=[_describe(*condition) for f in in_memory for condition in f.conditions()],
+            actual_reads=reads,
+            matched=len(tokens)
+        )
+        logger.info(
+            f"Segment query for app_id: {app_id} used index {report['index']}: "
+            f"estimated {report['estimated_reads']} reads, read {reads}, matched {len(tokens)}"
+        )
+        return list(tokens), report
+
+    except Exception as e:
+        logger.error(f"Failed to get tokens for segment: {str(e)}")
+        raise
+
+
+def _statistics(app_id: str) -> Tuple[_AppStats, int]:
+    """
+    The app's cached statistics, sampled again once stale.
+
+    Returns:
+        Tuple of (statistics, documents read to refresh them, 0 if cached)
+    """
+    with _stats_lock:
+        stats = _stats.get(app_id)
+    if stats is not None and time.time() - stats.taken_at < SEGMENT_STATS_SECONDS:
+        return stats, 0
+
+    db = token_manager.get_firestore_client()
+    query = db.collection(token_manager.COLLECTION_NAME).where("app_id", "==", app_id)
+    with FIRESTORE_BREAKER.guard():
+        sample = [
+            doc.to_dict()
+            for doc in query.select(_READ_FIELDS).limit(SEGMENT_SAMPLE_SIZE).stream(
+                timeout=token_manager.FIRESTORE_TIMEOUT
+            )
+        ]
+        reads = len(sample)
+        if len(sample) < SEGMENT_SAMPLE_SIZE:
+            total = len(sample)
+        else:
+            total = query.count().get(timeout=token_manager.FIRESTORE_TIMEOUT)[0][0].value
+            reads += max(1, -(-total // COUNT_ENTRIES_PER_READ))
+
+    stats = _AppStats(total, sample, time.time())
+    with _stats_lock:
+        _stats[app_id] = stats
+    logger.info(f"Sampled {len(sample)} of {total} tokens for app_id: {app_id} segment statistics")
+    return stats, reads
+
+
+def _update_total(app_id: str, total: int) -> None:
+    with _stats_lock:
+        stats = _stats.get(app_id)
+        if stats is not None:
+            stats.total = total
+
+
+def _describe(field: str, op: str, value: Any) -> str:
+    if isinstance(value, datetime):
+        value = value.replace(tzinfo=timezone.utc).isoformat().replace('+00:00', 'Z')
+    return f"{field} {op} {value}"
+
+
+def clear_statistics() -> None:
+    """Forget cached statistics so the next segment query samples again."""
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,80 @@
+"""
+Small SQLite database shared by every worker process on the instance.
+
+Used for hot state that must be consistent across gunicorn workers, such as
+rate limit counters, where a file per entry would be too slow. The database
+runs in WAL mode with synchronous=NORMAL, so a write transaction costs
+microseconds rather than an fsync.
+
+Each thread gets its own connection (sqlite3 connections must not be shared
+across threads or fork), created on first use.
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+SHARED_DB_PATH = os.getenv('SHARED_DB_PATH', os.path.join(os.getenv('DATA_DIR', 'data'), 'shared.sqlite3'))
+
+# How long a writer waits for another process's transaction before failing
+SHARED_DB_BUSY_TIMEOUT = float(os.getenv('SHARED_DB_BUSY_TIMEOUT', '5'))
+
+_local = threading.local()
+_schemas: Dict[str, Iterable[str]] = {}
+_schemas_lock = threading.Lock()
+
+
+def register_schema(name: str, statements: Iterable[str]) -> None:
+    """
+    Register CREATE ... IF NOT EXISTS statements to run on every new connection.
+
+    Args:
+        name: Owner of the tables, e.g. "rate_limit"
+        statements: Idempotent DDL statements
+    """
+    with _schemas_lock:
+        _schemas[name] = list(statements)
+
+
+def connect() -> sqlite3.Connection:
+    """This thread's connection to the shared database, opened on first use."""
+    key = (os.getpid(), SHARED_DB_PATH)
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+    entry = _local.connections.get(key)
+    if entry is None:
+        os.makedirs(os.path.dirname(os.path.abspath(SHARED_DB_PATH)), exist_ok=True)
+        connection = sqlite3.connect(SHARED_DB_PATH, timeout=SHARED_DB_BUSY_TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        entry = _local.connections[key] = (connection, set())
+
+    connection, applied = entry
+    if len(applied) < len(_schemas):
+        with _schemas_lock:
+            pending = {name: statements for name, statements in _schemas.items() if name not in applied}
+        for name, statements in pending.items():
+            for statement in statements:
+                connection.execute(statement)
+            applied.add(name)
+    return connection
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """
+    Run a block in a write transaction (BEGIN IMMEDIATE).
+
+    Taking the write lock up front means a read-modify-write inside the block
+    cannot race with another process.
+    """
+    connection = connect()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
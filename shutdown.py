@@ -0,0 +1,113 @@
+"""
+Graceful worker shutdown.
+
+When the platform stops a deployment, gunicorn sends SIGTERM to every worker
+and kills them graceful_timeout seconds later. On SIGTERM a worker:
+
+1. Stops admitting sends. New send requests get 503 with Retry-After and
+   /api/ready reports 503, so callers retry against another instance.
+2. Lets in-flight fan-outs keep sending FCM batches while the drain deadline
+   (SHUTDOWN_DRAIN_SECONDS) allows. A batch already handed to FCM is never
+   cut off.
+3. Checkpoints what has not been sent when the deadline nears. The remaining
+   tokens of a fan-out become a scheduled delivery due immediately (resumed
+   by whichever worker next leads the scheduler), and staged rollouts stop
+   between batches as "interrupted".
+4. On exit, stops the scheduler, waits for background jobs up to the
+   deadline and flushes the delivery ledger, engagement events and the log
+   queue.
+
+SHUTDOWN_DRAIN_SECONDS must be shorter than gunicorn's graceful_timeout,
+which must be shorter than the platform's termination grace period.
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Time from SIGTERM until every fan-out has finished or checkpointed
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '20'))
+
+# Stop starting new FCM batches this long before the deadline; one batch can
+# take up to FCM_HTTP_TIMEOUT
+SHUTDOWN_BATCH_RESERVE_SECONDS = float(
+    os.getenv('SHUTDOWN_BATCH_RESERVE_SECONDS', os.getenv('FCM_HTTP_TIMEOUT', '10'))
+)
+
+# Retry-After sent to requests refused while draining
+SHUTDOWN_RETRY_AFTER = 5
+
+_draining = threading.Event()
+_deadline = float('inf')
+
+
+def begin(drain_seconds: float = None) -> None:
+    """
+    Start draining. Safe to call from a signal handler: it only sets state.
+
+    Args:
+        drain_seconds: Time until in-flight work must be finished or checkpointed
+            (default SHUTDOWN_DRAIN_SECONDS)
+    """
+    global _deadline
+    if _draining.is_set():
+        return
+    _deadline = time.monotonic() + (SHUTDOWN_DRAIN_SECONDS if drain_seconds is None else drain_seconds)
+    _draining.set()
+
+
+def draining() -> bool:
+    """Whether this worker is shutting down."""
+    return _draining.is_set()
+
+
+def remaining() -> float:
+    """Seconds left until the drain deadline (infinite when not draining)."""
+    if not _draining.is_set():
+        return float('inf')
+    return max(0.0, _deadline - time.monotonic())
+
+
+def wait(timeout: float) -> bool:
+    """
+    Sleep up to timeout seconds, waking early if the worker starts shutting down.
+
+    Returns:
+        True if the worker is shutting down
+    """
+    return _draining.wait(timeout)
+
+
+def should_stop_sending() -> bool:
+    """Whether a sender should checkpoint instead of starting another FCM batch."""
+    return _draining.is_set() and remaining() <= SHUTDOWN_BATCH_RESERVE_SECONDS
+
+
+def finish() -> None:
+    """
+    Complete the shutdown once the worker stops serving requests.
+
+    Stops the scheduler (its running fires checkpoint like any fan-out),
+    waits for background jobs until the drain deadline and flushes the
+    delivery ledger, engagement events and logs.
+    """
+    # Imported here: these modules import fanout, which depends on this one
+    import jobs
+    import ledger
+    import engagement
+    import scheduler
+    import logging_config
+
+    begin()
+    logger.info(f"Shutting down: {remaining():.1f}s left to drain background sends")
+    scheduler.stop()
+    unfinished = jobs.join_running(timeout=remaining())
+    if unfinished:
+        logger.warning(f"Shutdown deadline reached with {unfinished} background job(s) still running")
+    ledger.stop()
+    engagement.stop()
+    logger.info("Shutdown complete")
+    logging_config.flush_logging()
@@ -0,0 +1,337 @@
+"""
+Named notification templates, stored per app, with locale variants.
+
+A template has a title and body with placeholders, and optional locale
+variants that override either of them:
+
+    {
+        "title": "{{symbol}} is up {{change}}%",
+        "body": "Hi {{first_name|there}}, your alert at {{price}} fired",
+        "locales": {"fr": {"body": "Bonjour {{first_name|}}, votre alerte à {{price}} s'est déclenchée"}}
+    }
+
+{{name}} is replaced by the recipient's variable, and {{name|text}} falls
+back to text when the variable is missing. A missing variable with no
+fallback fails that recipient's render.
+
+Templates are stored in Firestore at
+notification_templates/{app_id}/templates/{template_id}. Each is compiled
+once into a Template: every text becomes a str.format_map() pattern, so
+rendering a message is one C-level format call per text. Compiled templates
+are cached per process and read again after TEMPLATE_CACHE_SECONDS, so an
+edit made through another worker or instance is picked up within that time.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote
+import token_manager
+from circuit_breaker import FIRESTORE_BREAKER
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_COLLECTION = "notification_templates"
+TEMPLATES_SUBCOLLECTION = "templates"
+
+# Compiled templates kept per process, and how long one is served before it is read again
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '1024'))
+TEMPLATE_CACHE_SECONDS = float(os.getenv('TEMPLATE_CACHE_SECONDS', '60'))
+
+# Recipients accepted in one templated send
+TEMPLATE_MAX_RECIPIENTS = int(os.getenv('TEMPLATE_MAX_RECIPIENTS', '100000'))
+
+TEXT_FIELDS = ("title", "body")
+
+# Longest title or body pattern accepted
+MAX_TEXT_LENGTH = 4096
+
+# Requested locale spellings remembered per template ("fr_FR", "fr-fr", ...)
+RESOLVED_LOCALES_LIMIT = 256
+
+_PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?:\|([^{}]*))?\}\}")
+_TEMPLATE_ID = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+
+class MissingVariable(KeyError):
+    """A placeholder without a fallback had no value in the recipient's variables."""
+
+    def __str__(self) -> str:
+        return f"Missing template variable: {self.args[0]}"
+
+
+class Text:
+    """One compiled title or body."""
+
+    __slots__ = ("source", "pattern", "names", "defaults")
+
+    def __init__(self, source: str):
+        self.source = source
+        literals = []
+        placeholders = []
+        names = []
+        defaults = {}
+        position = 0
+        for match in _PLACEHOLDER.finditer(source):
+            literals.append(source[position:match.start()])
+            name, fallback = match.group(1), match.group(2)
+            placeholders.append("{" + name + "}")
+            names.append(name)
+            if fallback is not None:
+                defaults[name] = fallback.strip()
+            position = match.end()
+        literals.append(source[position:])
+        if any("{{" in literal or "}}" in literal for literal in literals):
+            # Leftover double braces are an unclosed or malformed placeholder
+            raise ValueError(f"Malformed placeholder in template text: {source}")
+
+        parts = [_escape(literals[0])]
+        for placeholder, literal in zip(placeholders, literals[1:]):
+            parts += [placeholder, _escape(literal)]
+        self.pattern = "".join(parts)
+        self.names = tuple(dict.fromkeys(names))
+        self.defaults = defaults
+
+    def render(self, variables: Dict[str, Any]) -> str:
+        """
+        Fill in the placeholders.
+
+        Raises:
+            MissingVariable: If a placeholder without a fallback has no value
+        """
+        if not self.names:
+            return self.source
+        try:
+            return self.pattern.format_map(variables)
+        except KeyError as e:
+            if not self.defaults:
+                raise MissingVariable(e.args[0])
+        # Only recipients missing a variable pay for merging in the fallbacks
+        try:
+            return self.pattern.format_map({**self.defaults, **variables})
+        except KeyError as e:
+            raise MissingVariable(e.args[0])
+
+
+class Template:
+    """A compiled template: title and body per locale."""
+
+    __slots__ = ("app_id", "template_id", "variants", "_resolved")
+
+    def __init__(self, app_id: str, template_id: str, stored: Dict[str, Any]):
+        self.app_id = app_id
+        self.template_id = template_id
+        default = (Text(stored["title"]), Text(stored["body"]))
+        self.variants: Dict[Optional[str], Tuple[Text, Text]] = {None: default}
+        for locale, texts in (stored.get("locales") or {}).items():
+            self.variants[normalize_locale(locale)] = (
+                Text(texts["title"]) if "title" in texts else default[0],
+                Text(texts["body"]) if "body" in texts else default[1]
+            )
+        self._resolved: Dict[Optional[str], Tuple[Text, Text]] = {None: default}
+
+    @property
+    def variables(self) -> List[str]:
+        """Every placeholder name used by any variant."""
+        names = {}
+        for title, body in self.variants.values():
+            names.update(dict.fromkeys(title.names + body.names))
+        return list(names)
+
+    def variant(self, locale: Optional[str]) -> Tuple[Text, Text]:
+        """
+        The title and body for a locale: an exact match ("pt-br"), then the
+        language ("pt"), then the default texts.
+        """
+        texts = self._resolved.get(locale)
+        if texts is None:
+            normalized = normalize_locale(locale)
+            texts = self.variants.get(normalized) or self.variants.get(normalized.split("-")[0]) or self.variants[None]
+            # Locales come from requests; only remember a bounded number of spellings
+            if len(self._resolved) < RESOLVED_LOCALES_LIMIT:
+                self._resolved[locale] = texts
+        return texts
+
+    def render(self, variables: Dict[str, Any], locale: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Render the title and body for one recipient.
+
+        Returns:
+            Tuple of (title, body)
+
+        Raises:
+            MissingVariable: If a required variable is missing
+        """
+        title, body = self.variant(locale)
+        return title.render(variables), body.render(variables)
+
+
+_cache: "OrderedDict[Tuple[str, str], Tuple[Template, float]]" = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "loads": 0}
+
+
+def normalize_locale(locale: str) -> str:
+    """Lower-case a locale and use hyphens ("pt_BR" -> "pt-br")."""
+    return locale.strip().replace("_", "-").lower()
+
+
+def validate(template_id: str, spec: Any) -> Dict[str, Any]:
+    """
+    Validate a template from a request body and compile it to check its placeholders.
+
+    Returns:
+        The template with only known fields
+
+    Raises:
+        ValueError: If the id or any text is invalid
+    """
+    if not _TEMPLATE_ID.match(template_id):
+        raise ValueError("template_id must be 1-128 letters, digits, '.', '_' or '-'")
+    if not isinstance(spec, dict):
+        raise ValueError("Template must be a JSON object")
+    unknown = set(spec) - set(TEXT_FIELDS) - {"locales"}
+    if unknown:
+        raise ValueError(f"Unknown template fields: {', '.join(sorted(unknown))}")
+
+    stored = {}
+    for field in TEXT_FIELDS:
+        stored[field] = _validate_text(spec.get(field), field)
+
+    locales = spec.get("locales") or {}
+    if not isinstance(locales, dict):
+        raise ValueError("locales must be an object of {locale: {title, body}}")
+    stored["locales"] = {}
+    for locale, texts in locales.items():
+        if not isinstance(texts, dict) or not texts or set(texts) - set(TEXT_FIELDS):
+            raise ValueError(f"locales.{locale} must be an object with title and/or body")
+        stored["locales"][normalize_locale(locale)] = {
+            field: _validate_text(value, f"locales.{locale}.{field}") for field, value in texts.items()
+        }
+
+    # Compiling reports malformed placeholders now rather than at send time
+    Template("", template_id, stored)
+    return stored
+
+
+def put_template(app_id: str, template_id: str, stored: Dict[str, Any]) -> bool:
+    """
+    Create or replace a template.
+
+    Args:
+        app_id: App identifier
+        template_id: Template identifier
+        stored: Validated template (see validate)
+
+    Returns:
+        True if the template was created, False if it replaced one
+    """
+    from google.cloud.firestore_v1 import transforms
+
+    ref = _ref(app_id, template_id)
+    with FIRESTORE_BREAKER.guard():
+        created = not ref.get(timeout=token_manager.FIRESTORE_TIMEOUT).exists
+        ref.set(
+            {"app_id": app_id, "template_id": template_id, **stored, "updated_at": transforms.SERVER_TIMESTAMP},
+            timeout=token_manager.FIRESTORE_TIMEOUT
+        )
+    _forget(app_id, template_id)
+    logger.info(f"Stored template {template_id} for app_id: {app_id}")
+    return created
+
+
+def get_template_doc(app_id: str, template_id: str) -> Optional[Dict[str, Any]]:
+    """A template as stored, or None if it does not exist."""
+    with FIRESTORE_BREAKER.guard():
+        doc = _ref(app_id, template_id).get(timeout=token_manager.FIRESTORE_TIMEOUT)
+    return doc.to_dict() if doc.exists else None
+
+
+def list_templates(app_id: str) -> List[Dict[str, Any]]:
+    """An app's stored templates, by template id."""
+    collection = (
+        token_manager.get_firestore_client().collection(TEMPLATES_COLLECTION)
+        .document(quote(app_id, safe='')).collection(TEMPLATES_SUBCOLLECTION)
+    )
+    with FIRESTORE_BREAKER.guard():
+        return [doc.to_dict() for doc in collection.stream(timeout=token_manager.FIRESTORE_TIMEOUT)]
+
+
+def delete_template(app_id: str, template_id: str) -> bool:
+    """
+    Delete a template.
+
+    Returns:
+        True if it existed
+    """
+    ref = _ref(app_id, template_id)
+    with FIRESTORE_BREAKER.guard():
+        if not ref.get(timeout=token_manager.FIRESTORE_TIMEOUT).exists:
+            return False
+        ref.delete(timeout=token_manager.FIRESTORE_TIMEOUT)
+    _forget(app_id, template_id)
+    logger.info(f"Deleted template {template_id} for app_id: {app_id}")
+    return True
+
+
+def get_template(app_id: str, template_id: str) -> Optional[Template]:
+    """
+    A compiled template, from the process cache while it is fresh.
+
+    Returns:
+        The template, or None if it does not exist
+    """
+    key = (app_id, template_id)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] < TEMPLATE_CACHE_SECONDS:
+            _cache.move_to_end(key)
+            _stats["hits"] += 1
+            return cached[0]
+
+    stored = get_template_doc(app_id, template_id)
+    if stored is None:
+        _forget(app_id, template_id)
+        return None
+    template = Template(app_id, template_id, stored)
+    with _cache_lock:
+        _stats["loads"] += 1
+        _cache[key] = (template, time.monotonic())
+        _cache.move_to_end(key)
+        while len(_cache) > TEMPLATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return template
+
+
+def status() -> Dict[str, int]:
+    """Compiled templates cached in this process, and cache hits and loads."""
+    with _cache_lock:
+        return dict(_stats, cached=len(_cache))
+
+
+def _forget(app_id: str, template_id: str) -> None:
+    with _cache_lock:
+        _cache.pop((app_id, template_id), None)
+
+
+def _ref(app_id: str, template_id: str):
+    return (
+        token_manager.get_firestore_client().collection(TEMPLATES_COLLECTION)
+        .document(quote(app_id, safe='')).collection(TEMPLATES_SUBCOLLECTION).document(template_id)
+    )
+
+
+def _validate_text(value: Any, field: str) -> str:
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"{field} is required and must be a string")
+    if len(value) > MAX_TEXT_LENGTH:
+        raise ValueError(f"{field} is longer than {MAX_TEXT_LENGTH} characters")
+    return value
+
+
+def _escape(literal: str) -> str:
+    return literal.replace("{", "{{").replace("}", "}}")
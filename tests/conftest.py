@@ -0,0 +1,9 @@
+"""
+Shared test setup: keep local state (outbox, schedules, jobs) out of the repo.
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='notification-service-test-'))
+os.environ.setdefault('SCHEDULER_ENABLED', 'false')
@@ -0,0 +1,171 @@
+"""
+Tests for admission control (concurrency budgets and the tokens-in-flight cap).
+"""
+
+import unittest
+import json
+import os
+import sys
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+import api_keys
+from admission import AdmissionRejected, ConcurrencyBudget, TokenBudget
+from app import app
+from benchmarks import fakes
+
+
+class ConcurrencyBudgetTestCase(unittest.TestCase):
+    """Test cases for ConcurrencyBudget."""
+
+    def test_rejects_when_full_and_queue_full(self):
+        """Test a full budget with no queue room rejects immediately."""
+        budget = ConcurrencyBudget('test', limit=1, max_queue=0, queue_timeout=1.0)
+        budget.acquire()
+        with self.assertRaises(AdmissionRejected):
+            budget.acquire()
+        budget.release()
+        budget.acquire()
+        self.assertEqual(budget.snapshot()['rejected'], 1)
+
+    def test_queued_request_admitted_when_slot_frees(self):
+        """Test a waiting request gets the slot released by another."""
+        budget = ConcurrencyBudget('test', limit=1, max_queue=1, queue_timeout=5.0)
+        budget.acquire()
+        threading.Timer(0.1, budget.release).start()
+        started = time.monotonic()
+        budget.acquire()
+        self.assertLess(time.monotonic() - started, 5.0)
+        self.assertEqual(budget.snapshot()['queued'], 0)
+
+    def test_queued_request_times_out(self):
+        """Test a waiting request is rejected after queue_timeout."""
+        budget = ConcurrencyBudget('test', limit=1, max_queue=1, queue_timeout=0.05)
+        budget.acquire()
+        with self.assertRaises(AdmissionRejected):
+            budget.acquire()
+
+
+class TokenBudgetTestCase(unittest.TestCase):
+    """Test cases for TokenBudget."""
+
+    def test_rejects_over_cap(self):
+        """Test a reservation that would exceed the cap is rejected."""
+        budget = TokenBudget(100)
+        with budget.reserve(60):
+            with self.assertRaises(AdmissionRejected):
+                with budget.reserve(50):
+                    pass
+            with budget.reserve(40):
+                self.assertEqual(budget.snapshot()['in_flight'], 100)
+        self.assertEqual(budget.snapshot()['in_flight'], 0)
+
+    def test_oversized_delivery_admitted_alone(self):
+        """Test an audience larger than the cap still runs when nothing else is in flight."""
+        budget = TokenBudget(100)
+        with budget.reserve(1000):
+            self.assertEqual(budget.snapshot()['in_flight'], 1000)
+
+    def test_wait_blocks_until_room(self):
+        """Test background senders wait for room instead of being rejected."""
+        budget = TokenBudget(100)
+        holder = budget.reserve(100)
+        holder.__enter__()
+        threading.Timer(0.1, holder.__exit__, (None, None, None)).start()
+        with budget.reserve(50, wait=True, timeout=5.0):
+            self.assertEqual(budget.snapshot()['in_flight'], 50)
+
+
+class AdmissionAPITestCase(unittest.TestCase):
+    """Test cases for admission control on the endpoints."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+
+    def send_to_app(self):
+        return self.app.post(
+            '/api/send-to-app',
+            data=json.dumps({'app_id': 'test-app', 'title': 'Title', 'body': 'Body'}),
+            content_type='application/json'
+        )
+
+    @patch('token_manager.save_token')
+    def test_full_bulk_budget_returns_429_but_registration_works(self, mock_save_token):
+        """Test bulk sends are rejected when their budget is full without affecting registrations."""
+        mock_save_token.return_value = {'token': 'test_token', 'app_id': 'test-app'}
+        full = ConcurrencyBudget(admission.BULK, limit=0, max_queue=0, queue_timeout=0)
+        with patch.dict(admission.BUDGETS, {admission.BULK: full}):
+            response = self.send_to_app()
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response.headers)
+            self.assertFalse(response.get_json()['success'])
+
+            response = self.app.post(
+                '/api/register-token',
+                data=json.dumps({'token': 'test_token', 'app_id': 'test-app'}),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+
+    @patch('firebase_service.send_multicast_notification')
+    @patch('token_manager.get_tokens_for_app')
+    def test_slot_released_after_request(self, mock_get_tokens, mock_send):
+        """Test a completed request returns its slot."""
+        mock_get_tokens.return_value = ['token1']
+        mock_send.return_value = MagicMock(success_count=1, failure_count=0, responses=[])
+        budget = ConcurrencyBudget(admission.BULK, limit=1, max_queue=0, queue_timeout=0)
+        with patch.dict(admission.BUDGETS, {admission.BULK: budget}):
+            self.assertEqual(self.send_to_app().status_code, 200)
+            self.assertEqual(self.send_to_app().status_code, 200)
+            self.assertEqual(budget.snapshot()['active'], 0)
+
+    @patch('firebase_service.send_multicast_notification')
+    @patch('token_manager.get_tokens_for_app')
+    def test_tokens_in_flight_cap_returns_429(self, mock_get_tokens, mock_send):
+        """Test a fan-out is rejected when too many tokens are already being delivered."""
+        mock_get_tokens.return_value = ['token1', 'token2']
+        tokens = TokenBudget(10)
+        with patch.object(admission, 'TOKENS', tokens), tokens.reserve(9):
+            response = self.send_to_app()
+        self.assertEqual(response.status_code, 429)
+        mock_send.assert_not_called()
+
+    @patch('token_manager.get_tokens_for_app')
+    def test_unauthenticated_request_takes_no_slot(self, mock_get_tokens):
+        """Test a request with a bad API key is refused before it can use up the budget."""
+        budget = ConcurrencyBudget(admission.BULK, limit=1, max_queue=0, queue_timeout=0)
+        keys = api_keys.parse_keys({'billing': {'key': 'billing-key'}})
+        with patch.dict(admission.BUDGETS, {admission.BULK: budget}), patch.object(api_keys, '_keys', keys):
+            with patch.object(budget, 'acquire', wraps=budget.acquire) as acquire:
+                response = self.app.post(
+                    '/api/send-to-app',
+                    data=json.dumps({'app_id': 'test-app', 'title': 'Title', 'body': 'Body'}),
+                    content_type='application/json',
+                    headers={'X-API-Key': 'wrong-key'}
+                )
+        self.assertEqual(response.status_code, 401)
+        acquire.assert_not_called()
+        mock_get_tokens.assert_not_called()
+
+    def test_audience_over_cap_rejected_while_reading(self):
+        """Test an audience that cannot fit under the cap is rejected without being read in full."""
+        db = fakes.FakeFirestore()
+        fakes.seed_tokens(db, 100, ['test-app'])
+        self.addCleanup(fakes.install(db, fakes.FakeFCM()))
+        tokens = TokenBudget(20)
+        with patch.object(admission, 'TOKENS', tokens):
+            with tokens.reserve(10):
+                response = self.send_to_app()
+        self.assertEqual(response.status_code, 429)
+        # Coalesced reads stop at the whole cap rather than the caller's room
+        self.assertLessEqual(db.documents_read, 21)
+        self.assertEqual(tokens.snapshot()['rejected'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+Tests for named API keys and per-key rate limits.
+"""
+
+import unittest
+import json
+import os
+import sys
+import tempfile
+import threading
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_keys
+import jobs
+import rate_limit
+import rollout
+import scheduler
+import shared_store
+from app import app
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """Test cases for the token-bucket limiter."""
+
+    def setUp(self):
+        patcher = patch.object(shared_store, 'SHARED_DB_PATH', os.path.join(tempfile.mkdtemp(), 'shared.sqlite3'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bucket_refills_over_time(self):
+        """Test a bucket allows its burst, then one request per refill interval."""
+        self.assertEqual(rate_limit.take('requests:a', rate=1, capacity=2, now=100.0), 0)
+        self.assertEqual(rate_limit.take('requests:a', rate=1, capacity=2, now=100.0), 0)
+        self.assertAlmostEqual(rate_limit.take('requests:a', rate=1, capacity=2, now=100.0), 1.0)
+        self.assertEqual(rate_limit.take('requests:a', rate=1, capacity=2, now=101.0), 0)
+
+    def test_oversized_cost_runs_when_full_and_leaves_debt(self):
+        """Test a fan-out larger than the bucket runs once and delays the next."""
+        self.assertEqual(rate_limit.take('tokens:a', rate=10, capacity=100, cost=250, now=0.0), 0)
+        self.assertGreater(rate_limit.take('tokens:a', rate=10, capacity=100, cost=1, now=1.0), 0)
+
+    def test_buckets_shared_between_connections(self):
+        """Test a bucket drained on one connection is seen as drained on another."""
+        rate_limit.take('requests:shared', rate=1, capacity=1, now=50.0)
+        waits = []
+        thread = threading.Thread(
+            target=lambda: waits.append(rate_limit.take('requests:shared', rate=1, capacity=1, now=50.0))
+        )
+        thread.start()
+        thread.join()
+        self.assertGreater(waits[0], 0)
+
+    @patch.object(rate_limit, 'RATE_LIMIT_BACKEND', 'memory')
+    def test_memory_backend(self):
+        """Test the per-process backend enforces the same limits."""
+        rate_limit.reset()
+        self.assertEqual(rate_limit.take('requests:m', rate=1, capacity=1, now=10.0), 0)
+        self.assertGreater(rate_limit.take('requests:m', rate=1, capacity=1, now=10.0), 0)
+
+
+class ParseKeysTestCase(unittest.TestCase):
+    """Test cases for API key configuration."""
+
+    def test_parse_keys(self):
+        """Test keys can be plain strings or objects with limits."""
+        keys = api_keys.parse_keys({
+            'internal': 'secret-1',
+            'billing': {'key': 'secret-2', 'requests_per_second': 5, 'tokens_per_minute': 1000}
+        })
+        with patch.object(api_keys, '_keys', keys):
+            self.assertEqual(api_keys.authenticate('secret-1')['name'], 'internal')
+            self.assertIsNone(api_keys.authenticate('secret-1')['requests_per_second'])
+            self.assertEqual(api_keys.authenticate('secret-2')['tokens_per_minute'], 1000)
+            self.assertIsNone(api_keys.authenticate('unknown'))
+            self.assertIsNone(api_keys.authenticate(None))
+
+    def test_invalid_keys_rejected(self):
+        """Test entries without a key or with non-positive limits are configuration errors."""
+        with self.assertRaises(ValueError):
+            api_keys.parse_keys({'broken': {'requests_per_second': 5}})
+        with self.assertRaises(ValueError):
+            api_keys.parse_keys({'broken': {'key': 'x', 'tokens_per_minute': 0}})
+
+
+class ApiKeyEndpointTestCase(unittest.TestCase):
+    """Test cases for per-key limits on the endpoints."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        keys = api_keys.parse_keys({
+            'noisy': {'key': 'noisy-key', 'requests_per_second': 1, 'tokens_per_minute': 3},
+            'quiet': {'key': 'quiet-key'}
+        })
+        for patcher in (
+            patch.object(api_keys, '_keys', keys),
+            patch.object(shared_store, 'SHARED_DB_PATH', os.path.join(tempfile.mkdtemp(), 'shared.sqlite3'))
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_jobs(self, key):
+        return self.app.get('/api/jobs', headers={'X-API-Key': key})
+
+    def send_to_app(self, key):
+        return self.app.post(
+            '/api/send-to-app',
+            data=json.dumps({'app_id': 'test-app', 'title': 'Title', 'body': 'Body'}),
+            content_type='application/json',
+            headers={'X-API-Key': key}
+        )
+
+    def test_unknown_key_rejected(self):
+        """Test a key that is not configured gets 401."""
+        self.assertEqual(self.get_jobs('wrong-key').status_code, 401)
+
+    def test_request_rate_is_per_key(self):
+        """Test one key going over its request rate does not affect another."""
+        self.assertEqual(self.get_jobs('noisy-key').status_code, 200)
+        response = self.get_jobs('noisy-key')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertIn('noisy', response.get_json()['error'])
+        self.assertEqual(self.get_jobs('quiet-key').status_code, 200)
+
+    @patch.object(api_keys, 'RATE_LIMIT_BURST_SECONDS', 10)
+    @patch('firebase_service.send_multicast_notification')
+    @patch('token_manager.get_tokens_for_app')
+    def test_tokens_per_minute_limits_fanout(self, mock_get_tokens, mock_send):
+        """Test fan-outs are charged their audience size against the key's tokens per minute."""
+        mock_get_tokens.return_value = ['token1', 'token2']
+        mock_send.return_value = MagicMock(success_count=2, failure_count=0, responses=[])
+
+        self.assertEqual(self.send_to_app('noisy-key').status_code, 200)
+        response = self.send_to_app('noisy-key')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(mock_send.call_count, 1)
+
+    @patch.object(api_keys, 'RATE_LIMIT_BURST_SECONDS', 10)
+    @patch('firebase_service.send_multicast_notification')
+    @patch('token_manager.get_tokens_for_app')
+    def test_scheduled_send_is_charged_when_it_fires(self, mock_get_tokens, mock_send):
+        """Test send_at does not bypass the key's tokens per minute: an over-quota job waits instead of sending."""
+        mock_get_tokens.return_value = ['token1', 'token2']
+        mock_send.return_value = MagicMock(success_count=2, failure_count=0, responses=[])
+        for name, value in (('SCHEDULE_DIR', tempfile.mkdtemp()), ('_heap', []), ('_known', set())):
+            patcher = patch.object(scheduler, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for _ in range(2):
+            response = self.app.post(
+                '/api/send-to-app',
+                data=json.dumps({'app_id': 'test-app', 'title': 'T', 'body': 'B', 'send_at': '2099-01-01T00:00:00Z'}),
+                content_type='application/json',
+                headers={'X-API-Key': 'noisy-key'}
+            )
+            self.assertEqual(response.status_code, 202)
+        self.assertEqual({job['api_key'] for job in scheduler.list_jobs()}, {'noisy'})
+
+        scheduler.run_due(now=4102444800 + 1)
+        self.assertEqual(mock_send.call_count, 1)
+        retried = scheduler.list_jobs()
+        self.assertEqual(len(retried), 1)
+        self.assertIn('tokens_per_minute', retried[0]['last_error'])
+        self.assertEqual(retried[0]['attempts'], 0)
+
+    @patch('rollout.jobs.start')
+    @patch('token_manager.get_all_tokens')
+    def test_rollout_batches_are_charged_to_the_key(self, mock_get_tokens, mock_start):
+        """Test a rollout records the key that started it and charges each batch against it."""
+        mock_get_tokens.return_value = ['token1', 'token2']
+        jobs_dir = tempfile.mkdtemp()
+        patcher = patch.object(jobs, 'JOBS_DIR', jobs_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        response = self.app.post(
+            '/api/broadcast',
+            data=json.dumps({'title': 'T', 'body': 'B', 'rollout': {'waves': [100]}}),
+            content_type='application/json',
+            headers={'X-API-Key': 'noisy-key'}
+        )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        with patch('broadcasts.charge', return_value=False) as mock_charge:
+            rollout.run_rollout(job_id)
+        self.assertEqual(mock_charge.call_args[0][1:], (api_keys.get_key('noisy'), 2))
+        self.assertEqual(jobs.get_job(job_id)['status'], jobs.INTERRUPTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
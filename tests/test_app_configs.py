@@ -0,0 +1,210 @@
+"""
+Tests for the app config registry: snapshot cache, change watching and /api/apps.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+import app_configs
+import circuit_breaker
+from app import app
+from benchmarks import fakes
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class AppConfigRegistryTestCase(unittest.TestCase):
+    """Test cases for config lookups and reloads."""
+
+    def setUp(self):
+        """Give each test an empty file store and no loaded snapshot."""
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'app_configs.json')
+        for name, value in (
+            ('_source', app_configs.FileSource(self.path)),
+            ('_snapshot', None),
+            ('_loaded_at', 0.0),
+            ('APP_CONFIG_WATCH_SECONDS', 0.02)
+        ):
+            patcher = patch.object(app_configs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+
+    def test_builtin_configs_until_something_is_stored(self):
+        """Test the built-in apps are served, with defaults resolved, while the store is empty."""
+        config = app_configs.get_app_config('weather-app')
+        self.assertEqual(config['icon'], '/weather-icon-192x192.png')
+        self.assertTrue(app_configs.is_configured('news-app'))
+
+    def test_unknown_app_defaults_are_shared_and_read_only(self):
+        """Test lookups for an unconfigured app return one precomputed mapping."""
+        config = app_configs.get_app_config('brand-new-app')
+        self.assertIs(config, app_configs.get_app_config('brand-new-app'))
+        self.assertEqual(config['name'], 'App: brand-new-app')
+        self.assertEqual(config['badge'], '/icon-96x96.png')
+        with self.assertRaises(TypeError):
+            config['icon'] = '/other.png'
+
+    def test_put_resolves_defaults_and_keeps_builtins(self):
+        """Test a stored app is served immediately with missing fields defaulted."""
+        app_configs.put_app_config('shop-app', {'name': 'Shop', 'icon': '/shop.png'})
+
+        config = app_configs.get_app_config('shop-app')
+        self.assertEqual((config['icon'], config['badge']), ('/shop.png', '/icon-96x96.png'))
+        self.assertIn('trading-app', app_configs.list_app_configs())
+        self.assertTrue(app_configs.delete_app_config('shop-app'))
+        self.assertFalse(app_configs.delete_app_config('shop-app'))
+        self.assertFalse(app_configs.is_configured('shop-app'))
+
+    def test_file_change_by_another_process_is_picked_up(self):
+        """Test the file watch replaces the snapshot when the file changes."""
+        app_configs.get_app_config('weather-app')
+        app_configs._source.watch(app_configs._install)
+
+        app_configs.FileSource(self.path).put('shop-app', {'name': 'Shop'})
+
+        self.assertTrue(wait_for(lambda: app_configs.is_configured('shop-app')))
+
+    def test_stale_snapshot_served_while_refreshing(self):
+        """Test an expired snapshot is still served and refreshed in the background."""
+        app_configs.get_app_config('weather-app')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'shop-app': {'name': 'Shop'}}, f)
+
+        with patch.object(app_configs, 'APP_CONFIG_TTL_SECONDS', 0):
+            self.assertTrue(app_configs.is_configured('weather-app'))
+            self.assertTrue(wait_for(lambda: app_configs.is_configured('shop-app')))
+
+    def test_firestore_listener_replaces_snapshot(self):
+        """Test a Firestore snapshot callback installs the collection's configs."""
+        collection = MagicMock()
+        source = app_configs.FirestoreSource('app_configs')
+        with patch.object(source, '_ref', return_value=collection):
+            source.watch(app_configs._install)
+        on_snapshot = collection.on_snapshot.call_args[0][0]
+
+        doc = MagicMock(id='shop-app')
+        doc.to_dict.return_value = {'name': 'Shop', 'color': '#123456'}
+        on_snapshot([doc], [], None)
+
+        self.assertEqual(app_configs.get_app_config('shop-app')['color'], '#123456')
+        self.assertFalse(app_configs.is_configured('weather-app'))
+
+    def test_first_firestore_lookup_does_not_wait_for_the_load(self):
+        """Test lookups serve the built-in configs while the worker's Firestore load is still running."""
+        release = threading.Event()
+        source = app_configs.FirestoreSource('app_configs')
+
+        def load():
+            release.wait(5)
+            return {'shop-app': {'name': 'Shop'}}
+        with patch.object(app_configs, '_source', source), patch.object(app_configs, '_watch_pid', None), \
+                patch.object(source, 'load', side_effect=load), patch.object(source, 'watch'):
+            started = time.monotonic()
+            self.assertEqual(app_configs.get_app_config('weather-app')['icon'], '/weather-icon-192x192.png')
+            self.assertFalse(app_configs.is_configured('shop-app'))
+            self.assertLess(time.monotonic() - started, 1)
+
+            release.set()
+            self.assertTrue(wait_for(lambda: app_configs.is_configured('shop-app')))
+
+    def test_firestore_first_write_keeps_builtins_and_deletes_stick(self):
+        """Test the first Firestore write seeds the built-ins, and deleting every app leaves none."""
+        db = fakes.FakeFirestore()
+        self.addCleanup(fakes.install(db, fakes.FakeFCM()))
+        source = app_configs.FirestoreSource('app_configs')
+        self.assertIsNone(source.load())
+
+        source.put('shop-app', {'name': 'Shop'})
+        self.assertEqual(sorted(source.load()), ['news-app', 'shop-app', 'trading-app', 'weather-app'])
+
+        self.assertTrue(source.delete('weather-app'))
+        self.assertFalse(source.delete('weather-app'))
+        for app_id in ('news-app', 'shop-app', 'trading-app'):
+            self.assertTrue(source.delete(app_id))
+        self.assertEqual(source.load(), {})
+
+    def test_firestore_writes_go_through_the_breaker(self):
+        """Test config writes are refused while the Firestore breaker is open."""
+        breaker = CircuitBreaker("firestore", window_size=1, minimum_calls=1, open_seconds=60)
+        with self.assertRaises(RuntimeError), breaker.guard():
+            raise RuntimeError("unavailable")
+        collection = MagicMock()
+        source = app_configs.FirestoreSource('app_configs')
+        with patch.object(circuit_breaker, 'FIRESTORE_BREAKER', breaker), \
+                patch.object(source, '_ref', return_value=collection):
+            with self.assertRaises(CircuitOpenError):
+                source.put('shop-app', {'name': 'Shop'})
+            with self.assertRaises(CircuitOpenError):
+                source.delete('shop-app')
+        collection.document.assert_not_called()
+
+
+class AppConfigEndpointTestCase(unittest.TestCase):
+    """Test cases for the /api/apps endpoints."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        self.data_dir = tempfile.mkdtemp()
+        for target, name, value in (
+            (app_configs, '_source', app_configs.FileSource(os.path.join(self.data_dir, 'app_configs.json'))),
+            (app_configs, '_snapshot', None),
+            (app_module, 'ADMIN_API_KEY', 'admin-secret')
+        ):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+
+    def put(self, app_id, body, admin_key='admin-secret'):
+        return self.app.put(
+            f'/api/apps/{app_id}',
+            data=json.dumps(body),
+            content_type='application/json',
+            headers={'X-Admin-Key': admin_key}
+        )
+
+    def test_crud(self):
+        """Test apps can be created, read, replaced and deleted."""
+        self.assertEqual(self.app.get('/api/apps/shop-app').status_code, 404)
+        self.assertEqual(self.put('shop-app', {'name': 'Shop'}).status_code, 201)
+        self.assertEqual(self.put('shop-app', {'name': 'Shop', 'icon': '/shop.png'}).status_code, 200)
+
+        response = self.app.get('/api/apps/shop-app')
+        self.assertEqual(response.get_json()['config']['icon'], '/shop.png')
+        self.assertIn('shop-app', self.app.get('/api/apps').get_json()['apps'])
+
+        response = self.app.delete('/api/apps/shop-app', headers={'X-Admin-Key': 'admin-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.get('/api/apps/shop-app').status_code, 404)
+
+    def test_writes_require_admin_key_and_valid_fields(self):
+        """Test writes are admin-only and unknown or non-string fields are rejected."""
+        self.assertEqual(self.put('shop-app', {'name': 'Shop'}, admin_key='wrong').status_code, 401)
+        self.assertEqual(self.put('shop-app', {'nmae': 'Shop'}).status_code, 400)
+        self.assertEqual(self.put('shop-app', {'name': 5}).status_code, 400)
+        self.assertEqual(self.put(app_configs.SEEDED_DOCUMENT, {'name': 'Shop'}).status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Tests for the offline benchmark harness (fakes, case runner and comparison).
+"""
+
+import unittest
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import token_manager
+from benchmarks import compare, fakes, loadtest, run
+
+
+class FakeStoreTestCase(unittest.TestCase):
+    """Test cases for the in-memory token store."""
+
+    def test_token_queries_run_against_fake(self):
+        """Test the token_manager queries used by the send paths work on the fake store."""
+        db = fakes.FakeFirestore()
+        fakes.seed_tokens(db, 1200, ['app-a', 'app-b'], users=10)
+        token_manager.set_firestore_client(db)
+        self.addCleanup(token_manager.set_firestore_client, None)
+
+        self.assertEqual(len(token_manager.get_tokens_for_app('app-a')), 600)
+        self.assertEqual(len(token_manager.get_tokens_for_app('app-a', user_id='user-0')), 120)
+        self.assertEqual(len(token_manager.get_all_tokens()), 1200)
+        page = token_manager.get_token_page(after='bench-token-00000499', limit=500)
+        self.assertEqual(page[0][0], 'bench-token-00000500')
+        self.assertEqual(len(token_manager.get_token_page(after=page[-1][0], limit=500)), 200)
+
+
+class BenchmarkRunTestCase(unittest.TestCase):
+    """Test cases for running and comparing cases."""
+
+    def test_case_reports_throughput_latency_and_memory(self):
+        """Test a small send-to-app case delivers every token through the fake FCM."""
+        args = argparse.Namespace(fcm_latency_ms=0, fcm_error_rate=0.1, store_latency_ms=0, seed=1)
+
+        result = run.run_case('send_to_app', 1200, 2, args)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['fcm_calls'], 6)
+        self.assertGreater(result['tokens_per_second'], 0)
+        self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99'])
+        self.assertGreaterEqual(result['rss_bytes']['peak'], result['rss_bytes']['seeded'])
+
+    def test_compare_flags_regressions_beyond_threshold(self):
+        """Test lower throughput or higher p99 past the threshold counts as a regression."""
+        def result(tokens_per_second, p99):
+            return {('broadcast', 1000): {
+                'tokens_per_second': tokens_per_second,
+                'latency_ms': {'p99': p99},
+                'rss_bytes': {'peak': 2**20}
+            }}
+
+        _, regressions = compare.compare(result(1000, 10), result(950, 10.5), 0.10)
+        self.assertEqual(regressions, [])
+        _, regressions = compare.compare(result(1000, 10), result(800, 12), 0.10)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(run.percentile([3, 1, 2, 4], 50), 2)
+
+
+
+class LoadTestTestCase(unittest.TestCase):
+    """Test cases for the load test's request mix and saturation report."""
+
+    def test_mix_is_interleaved_in_exact_proportions(self):
+        """Test weights are normalized and each endpoint gets its share of every run of picks."""
+        mix = loadtest.parse_mix('send-to-app=1,register-token=3')
+        pick = loadtest.interleave(mix)
+
+        picks = [pick() for _ in range(8)]
+        self.assertEqual(picks.count('register-token'), 6)
+        self.assertNotEqual(picks[:4].count('send-to-app'), 0)
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('send-everywhere=1')
+
+    def test_saturation_is_first_step_over_slo_or_error_budget(self):
+        """Test an endpoint saturates at the first step that breaks the latency SLO or error budget."""
+        def step(rps, p99, error_rate):
+            return {'target_rps': rps, 'endpoints': {'send-to-app': {
+                'target_rps': rps, 'achieved_rps': rps, 'error_rate': error_rate, 'latency_ms': {'p99': p99}
+            }}}
+
+        report = loadtest.saturation(
+            [step(10, 200, 0.0), step(50, 400, 0.0), step(100, 450, 0.2), step(200, 5000, 0.5)],
+            slo_ms=1000, max_error_rate=0.01
+        )
+
+        self.assertEqual(report['send-to-app']['sustained_rps'], 50)
+        self.assertEqual(report['send-to-app']['saturated_at_rps'], 100)
+        self.assertIn('error rate', report['send-to-app']['reason'])
+
+
+if __name__ == '__main__':
+    unittest.main()
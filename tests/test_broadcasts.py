@@ -0,0 +1,194 @@
+"""
+Tests for resumable, cursor-checkpointed broadcasts.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import broadcasts
+import circuit_breaker
+import jobs
+import shutdown
+from app import app
+from circuit_breaker import CircuitOpenError
+
+TOKENS = [f"token{i:05d}" for i in range(1200)]
+MESSAGE = {"title": "Title", "body": "Body", "icon": None, "badge": None, "data": {}}
+
+
+def token_page(after=None, limit=500):
+    """Page over TOKENS in document id order (the token is the document id)."""
+    start = 0 if after is None else TOKENS.index(after) + 1
+    return [(token, token) for token in TOKENS[start:start + limit]]
+
+
+class BroadcastJobTestCase(unittest.TestCase):
+    """Test cases for broadcast jobs and resuming them."""
+
+    def setUp(self):
+        """Isolate the job store and record every token handed to FCM."""
+        self.app = app.test_client()
+        self.app.testing = True
+        self.jobs_dir = tempfile.mkdtemp()
+        self.sent = []
+        self.fail_on_call = None
+        for patcher in (
+            patch.object(jobs, 'JOBS_DIR', self.jobs_dir),
+            patch.object(shutdown, '_draining', threading.Event()),
+            patch('token_manager.get_token_page', side_effect=token_page),
+            patch('firebase_service.send_multicast_notification', side_effect=self.send)
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.jobs_dir, True)
+
+    def send(self, tokens, **kwargs):
+        self.sent.extend(tokens)
+        if self.fail_on_call is not None and self.fail_on_call(len(self.sent) // 500):
+            raise RuntimeError("connection reset")
+        return MagicMock(success_count=len(tokens), failure_count=0, responses=[])
+
+    def create_job(self):
+        return jobs.create_job(
+            "broadcast", {"message": MESSAGE, "api_key": None},
+            cursor=None, in_flight=None, chunks=0, errors={},
+            **{counter: 0 for counter in broadcasts.COUNTERS}
+        )
+
+    def resume(self, job_id):
+        self.assertIsNotNone(broadcasts.resume(job_id))
+        self.assertEqual(jobs.join_running(timeout=5), 0)
+        return jobs.get_job(job_id)
+
+    def test_runs_every_page_once(self):
+        """Test a broadcast pages through the collection and logs each chunk."""
+        job = self.create_job()
+        broadcasts.run_broadcast(job['id'])
+
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.COMPLETED)
+        self.assertEqual(self.sent, TOKENS)
+        self.assertEqual((job['sent'], job['processed'], job['chunks']), (1200, 1200, 3))
+        self.assertEqual(job['cursor'], TOKENS[-1])
+        self.assertIsNone(job['in_flight'])
+        self.assertEqual([c['tokens'] for c in jobs.read_results(job['id'])], [500, 500, 200])
+
+    def test_resume_skips_chunk_with_unknown_outcome(self):
+        """Test a chunk that failed mid-send is not retried, so no token is attempted twice."""
+        self.fail_on_call = lambda calls: calls == 2
+        job = self.create_job()
+        jobs.start(job, broadcasts.run_broadcast)
+        jobs.join_running(timeout=5)
+
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.FAILED)
+        self.assertEqual(job['in_flight']['index'], 1)
+
+        self.fail_on_call = None
+        job = self.resume(job['id'])
+
+        self.assertEqual(job['status'], jobs.COMPLETED)
+        self.assertEqual(self.sent, TOKENS)
+        self.assertEqual((job['sent'], job['unknown'], job['processed']), (700, 500, 1200))
+        self.assertEqual([c['outcome'] for c in jobs.read_results(job['id'])], ['sent', 'unknown', 'sent'])
+
+    def test_resume_uses_logged_result_of_in_flight_chunk(self):
+        """Test a chunk logged before the job state was updated counts as sent on resume."""
+        job = self.create_job()
+        in_flight = {"index": 0, "after": None, "last_doc_id": TOKENS[499], "tokens": 500}
+        jobs.append_result(job['id'], {
+            **in_flight, "outcome": "sent", "sent": 498, "failed": 2, "queued": 0, "errors": {"UNREGISTERED": 2}
+        })
+        jobs.update_job(job['id'], status=jobs.FAILED, in_flight=in_flight)
+
+        job = self.resume(job['id'])
+
+        self.assertEqual(self.sent, TOKENS[500:])
+        self.assertEqual((job['sent'], job['failed'], job['unknown']), (498 + 700, 2, 0))
+        self.assertEqual(job['errors'], {"UNREGISTERED": 2})
+
+    def test_shutdown_interrupts_and_resume_continues(self):
+        """Test a draining worker stops at a page boundary and a resume picks up at the cursor."""
+        def drain_after_first_chunk(calls):
+            shutdown.begin(drain_seconds=0)
+            return False
+        self.fail_on_call = drain_after_first_chunk
+        job = self.create_job()
+        broadcasts.run_broadcast(job['id'])
+
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.INTERRUPTED)
+        self.assertEqual(job['cursor'], TOKENS[499])
+
+        self.fail_on_call = None
+        with patch.object(shutdown, '_draining', threading.Event()):
+            job = self.resume(job['id'])
+        self.assertEqual(job['status'], jobs.COMPLETED)
+        self.assertEqual(self.sent, TOKENS)
+
+    @patch.object(circuit_breaker, 'FALLBACK', 'outbox')
+    def test_open_breaker_interrupts_at_cursor_instead_of_queueing(self):
+        """Test an open FCM breaker stops the job at its cursor even with the outbox fallback on."""
+        job = self.create_job()
+        with patch('firebase_service.send_multicast_notification',
+                   side_effect=[MagicMock(success_count=500, failure_count=0, responses=[]),
+                                CircuitOpenError("fcm", 5)]), \
+                patch('outbox.enqueue') as mock_enqueue:
+            broadcasts.run_broadcast(job['id'])
+
+        job = jobs.get_job(job['id'])
+        mock_enqueue.assert_not_called()
+        self.assertEqual((job['status'], job['cursor'], job['chunks'], job['queued']), (jobs.INTERRUPTED, TOKENS[499], 1, 0))
+        self.assertIsNone(job['in_flight'])
+
+        job = self.resume(job['id'])
+        self.assertEqual(job['status'], jobs.COMPLETED)
+        self.assertEqual(self.sent, TOKENS[500:])
+
+    def test_slow_page_keeps_the_job_fresh(self):
+        """Test a page waiting longer than the heartbeat interval keeps touching the job."""
+        job = self.create_job()
+        release = threading.Event()
+        waiting = lambda tokens, **kwargs: (release.wait(0.2), self.send(tokens))[1]
+        with patch.object(broadcasts, 'HEARTBEAT_SECONDS', 0.02), \
+                patch('firebase_service.send_multicast_notification', side_effect=waiting):
+            jobs.start(job, broadcasts.run_broadcast)
+            seen = set()
+            deadline = time.monotonic() + 5
+            while len(seen) < 3 and time.monotonic() < deadline:
+                seen.add(jobs.get_job(job['id']).get('heartbeat_at'))
+            self.assertEqual(len(seen), 3)
+            self.assertFalse(broadcasts.resumable(jobs.get_job(job['id'])))
+            release.set()
+            self.assertEqual(jobs.join_running(timeout=5), 0)
+        self.assertEqual(jobs.get_job(job['id'])['status'], jobs.COMPLETED)
+
+    def test_broadcast_endpoint_starts_job_and_resume_rejects_finished(self):
+        """Test resumable broadcasts return 202 and only unfinished jobs can be resumed."""
+        response = self.app.post(
+            '/api/broadcast',
+            data=json.dumps({'title': 'Title', 'body': 'Body', 'resumable': True}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        jobs.join_running(timeout=5)
+
+        self.assertEqual(jobs.get_job(job_id)['status'], jobs.COMPLETED)
+        self.assertEqual(self.app.post(f'/api/jobs/{job_id}/resume').status_code, 409)
+        self.assertEqual(self.app.post('/api/jobs/missing/resume').status_code, 404)
+        chunks = self.app.get(f'/api/jobs/{job_id}/chunks?offset=1&limit=5').get_json()['chunks']
+        self.assertEqual([c['index'] for c in chunks], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Tests for circuit breakers and the fail-fast / outbox fallbacks.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch, MagicMock
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import circuit_breaker
+import outbox
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from app import app
+
+
+def failing():
+    raise RuntimeError("boom")
+
+
+def rejected_token():
+    raise ValueError("bad token")
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """Test cases for the breaker state machine."""
+    
+    def test_opens_after_failure_rate_exceeded(self):
+        """Test breaker opens once the failure rate crosses the threshold."""
+        breaker = CircuitBreaker("test", window_size=4, minimum_calls=4, open_seconds=60)
+        for _ in range(4):
+            with self.assertRaises(RuntimeError):
+                breaker.call(failing)
+        
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            breaker.call(lambda: "ok")
+        self.assertGreater(ctx.exception.retry_after, 0)
+    
+    def test_slow_calls_count_as_failures(self):
+        """Test calls over the latency threshold open the breaker."""
+        breaker = CircuitBreaker("test", slow_call_seconds=0.0, window_size=2, minimum_calls=2)
+        breaker.call(lambda: "ok")
+        breaker.call(lambda: "ok")
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+    
+    def test_half_open_probe_closes_breaker(self):
+        """Test successful probes close the breaker after the cool-down."""
+        breaker = CircuitBreaker("test", window_size=1, minimum_calls=1, open_seconds=0, half_open_max_calls=1)
+        with self.assertRaises(RuntimeError):
+            breaker.call(failing)
+        
+        self.assertEqual(breaker.state, circuit_breaker.HALF_OPEN)
+        self.assertEqual(breaker.call(lambda: "ok"), "ok")
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+    
+    def test_excluded_exceptions_do_not_trip(self):
+        """Test caller errors are not counted against the dependency."""
+        breaker = CircuitBreaker("test", window_size=2, minimum_calls=2, excluded_exceptions=(ValueError,))
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                breaker.call(rejected_token)
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+
+
+class BreakerFallbackTestCase(unittest.TestCase):
+    """Test cases for how the API responds when a breaker is open."""
+    
+    def setUp(self):
+        """Set up test client and an isolated outbox."""
+        self.app = app.test_client()
+        self.app.testing = True
+        self.outbox_dir = tempfile.mkdtemp()
+        patcher = patch.object(outbox, 'OUTBOX_DIR', self.outbox_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.outbox_dir, True)
+    
+    def send_to_app(self):
+        return self.app.post(
+            '/api/send-to-app',
+            data=json.dumps({
+                'app_id': 'test-app',
+                'title': 'Test Title',
+                'body': 'Test Body'
+            }),
+            content_type='application/json'
+        )
+    
+    @patch('token_manager.get_tokens_for_app')
+    def test_fail_fast_returns_503_with_retry_after(self, mock_get_tokens):
+        """Test an open breaker yields 503 and Retry-After."""
+        mock_get_tokens.side_effect = CircuitOpenError("firestore", 12.3)
+        
+        response = self.send_to_app()
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '13')
+        self.assertFalse(json.loads(response.data)['success'])
+    
+    @patch.object(circuit_breaker, 'FALLBACK', 'outbox')
+    @patch('token_manager.get_tokens_for_app')
+    @patch('firebase_service.send_multicast_notification')
+    def test_outbox_fallback_queues_and_drains(self, mock_send_multicast, mock_get_tokens):
+        """Test a send is queued while Firestore is down and replayed on drain."""
+        mock_get_tokens.side_effect = CircuitOpenError("firestore", 5)
+        
+        response = self.send_to_app()
+        
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(json.loads(response.data)['queued'])
+        self.assertEqual(outbox.pending_count(), 1)
+        
+        mock_get_tokens.side_effect = None
+        mock_get_tokens.return_value = ['token1', 'token2']
+        mock_response = MagicMock()
+        mock_response.success_count = 2
+        mock_response.failure_count = 0
+        mock_send_multicast.return_value = mock_response
+        
+        response = self.app.post('/api/outbox/drain')
+        
+        data = json.loads(response.data)
+        self.assertEqual(data['replayed'], 1)
+        self.assertEqual(data['remaining'], 0)
+        mock_send_multicast.assert_called_once()
+    
+    @patch.object(circuit_breaker, 'FALLBACK', 'outbox')
+    @patch('firebase_service.send_multicast_notification')
+    def test_replay_while_still_open_keeps_the_entry(self, mock_send_multicast):
+        """Test a deliver replayed while FCM is still down stays queued with its attempts, and the drain stops."""
+        mock_send_multicast.side_effect = CircuitOpenError("fcm", 5)
+        for i in range(2):
+            outbox.enqueue('deliver', {'tokens': [f'token{i}'], 'title': 'T', 'body': 'B'})
+        first = sorted(os.listdir(self.outbox_dir))[0]
+        
+        data = json.loads(self.app.post('/api/outbox/drain').data)
+        
+        self.assertEqual((data['replayed'], data['failed'], data['remaining']), (0, 1, 2))
+        self.assertEqual(mock_send_multicast.call_count, 1)
+        self.assertEqual(sorted(os.listdir(self.outbox_dir))[0], first)
+        with open(os.path.join(self.outbox_dir, first)) as f:
+            self.assertEqual(json.load(f)['attempts'], 1)
+    
+    def test_health_reports_breakers(self):
+        """Test health output includes breaker state."""
+        response = self.app.get('/api/health')
+        data = json.loads(response.data)
+        self.assertIn('fcm', data['dependencies'])
+        self.assertIn('firestore', data['dependencies'])
+        self.assertIn('pending', data['outbox'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+"""
+Tests for per-user notification digests.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client import REGISTRY
+import digest
+import firebase_service
+import scheduler
+import token_manager
+from benchmarks import fakes
+from app import app
+
+
+class DigestParseTestCase(unittest.TestCase):
+    """Test cases for validating a send's digest option."""
+
+    def test_parse(self):
+        """Test a group name or an object is accepted, and malformed options rejected."""
+        self.assertEqual(digest.parse('price-alerts'), ('price-alerts', digest.DIGEST_WINDOW_SECONDS))
+        self.assertEqual(digest.parse({'group': 'AAPL:price', 'window_seconds': 5}), ('AAPL:price', 5.0))
+        for spec in (
+            '', 'price alerts', 'x' * 65, ['price'], {'window_seconds': 5}, {'group': 'g', 'window': 5},
+            {'group': 'g', 'window_seconds': 0}, {'group': 'g', 'window_seconds': '5'},
+            {'group': 'g', 'window_seconds': digest.DIGEST_MAX_WINDOW_SECONDS + 1}
+        ):
+            with self.assertRaises(ValueError, msg=spec):
+                digest.parse(spec)
+
+
+class DigestTestCase(unittest.TestCase):
+    """Test cases for coalescing a user's notifications into digests."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        self.schedule_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.schedule_dir, True)
+        # Digests need the scheduler; its jobs are run here with run_due rather than the timer thread
+        for name, value in (
+            ('SCHEDULE_DIR', self.schedule_dir), ('_heap', []), ('_known', set()),
+            ('enabled', lambda: True), ('ensure_started', lambda: None)
+        ):
+            patcher = patch.object(scheduler, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        digest.reset()
+        self.addCleanup(digest.reset)
+
+        self.addCleanup(fakes.install(fakes.FakeFirestore(), fakes.FakeFCM()))
+        for token, user_id in (('alice-phone', 'alice'), ('alice-laptop', 'alice'), ('bob-phone', 'bob')):
+            token_manager.save_token(token, 'trading-app', user_id)
+
+        self.sent = []
+        send_each_for_multicast = firebase_service.messaging.send_each_for_multicast
+
+        def capture(message, **kwargs):
+            self.sent.append(message)
+            return send_each_for_multicast(message, **kwargs)
+        patcher = patch.object(firebase_service.messaging, 'send_each_for_multicast', capture)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, title, user_id='alice', group='price-alerts'):
+        response = self.app.post('/api/send-to-user', data=json.dumps({
+            'user_id': user_id, 'app_id': 'trading-app', 'title': title, 'body': f'{title} body',
+            'data': {'symbol': title}, 'digest': {'group': group, 'window_seconds': 10}
+        }), content_type='application/json')
+        return response.status_code, response.get_json()
+
+    def saved(self):
+        return REGISTRY.get_sample_value('digest_sends_saved_total', {'app_id': 'trading-app'}) or 0
+
+    def test_burst_is_sent_once_as_a_digest(self):
+        """Test the first notification goes out at once and the rest of the burst as one digest replacing it."""
+        saved = self.saved()
+        status, body = self.post('AAPL up 3%')
+        self.assertEqual((status, body['sent_to'], body['digest']['status']), (200, 2, 'send'))
+        for count, title in enumerate(('TSLA down 2%', 'AAPL up 4%', 'MSFT up 1%'), start=2):
+            status, body = self.post(title)
+            self.assertEqual((status, body['digest']['status'], body['digest']['count']), (202, 'held', count))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(scheduler.pending_count(), 1)
+
+        self.assertEqual(scheduler.run_due(time.time() + 11), 1)
+
+        self.assertEqual(len(self.sent), 2)
+        message = self.sent[1]
+        self.assertEqual(sorted(message.tokens), ['alice-laptop', 'alice-phone'])
+        self.assertEqual(message.notification.title, '4 new notifications')
+        self.assertEqual(message.notification.body, 'MSFT up 1%\nAAPL up 4%\nTSLA down 2%\nAAPL up 3%')
+        self.assertEqual(message.data, {'symbol': 'MSFT up 1%', 'digest_count': '4'})
+        for sent in self.sent:
+            self.assertEqual(sent.android.collapse_key, 'price-alerts')
+            self.assertEqual(sent.android.notification.tag, 'price-alerts')
+            self.assertEqual(sent.apns.headers, {'apns-collapse-id': 'price-alerts'})
+            self.assertEqual(sent.webpush.notification.tag, 'price-alerts')
+        self.assertEqual(self.saved() - saved, 2)
+
+        # The window is closed, so the next notification opens a new one
+        self.assertEqual(self.post('AAPL up 5%')[1]['digest']['status'], 'send')
+
+    def test_windows_are_per_user_and_group(self):
+        """Test other users and groups get their own windows, and a window that held nothing just expires."""
+        now = time.time()
+        self.assertEqual(digest.add('alice', 'trading-app', 'price', 10, 'T', 'B', now=now)['status'], 'send')
+        self.assertEqual(digest.add('alice', 'trading-app', 'news', 10, 'T', 'B', now=now)['status'], 'send')
+        self.assertEqual(digest.add('bob', 'trading-app', 'price', 10, 'T', 'B', now=now)['status'], 'send')
+        self.assertEqual(digest.add('alice', None, 'price', 10, 'T', 'B', now=now)['status'], 'send')
+        self.assertEqual(digest.add('alice', 'trading-app', 'price', 10, 'T', 'B', now=now + 5)['status'], 'held')
+        self.assertEqual(digest.add('bob', 'trading-app', 'price', 10, 'T', 'B', now=now + 11)['status'], 'send')
+        self.assertEqual(digest.open_windows(), 1)
+        self.assertEqual(scheduler.pending_count(), 1)
+
+    def test_hold_first_and_long_bursts(self):
+        """Test a lone held notification is sent as itself, and a digest lists only the latest titles."""
+        with patch.object(digest, 'DIGEST_SEND_FIRST', False), patch.object(digest, 'DIGEST_TITLES', 2):
+            self.assertEqual(self.post('Only one', user_id='bob')[0], 202)
+            for i in range(4):
+                self.post(f'Alert {i}')
+            self.assertEqual(self.sent, [])
+            scheduler.run_due(time.time() + 11)
+
+        bodies = sorted((m.notification.title, m.notification.body) for m in self.sent)
+        self.assertEqual(bodies, [('4 new notifications', 'Alert 3\nAlert 2\n+2 more'), ('Only one', 'Only one body')])
+
+    def test_failed_digest_is_retried(self):
+        """Test a digest whose send fails is kept as a send of its own."""
+        self.post('A')
+        self.post('B')
+        with patch('fanout.send_to_user', side_effect=RuntimeError('FCM down')):
+            scheduler.run_due(time.time() + 11)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(digest.open_windows(), 0)
+        self.assertEqual(scheduler.list_jobs()[0]['kind'], 'send_to_user')
+
+        scheduler.run_due(time.time() + 1)
+        self.assertEqual(self.sent[1].notification.title, '2 new notifications')
+
+    def test_window_with_lost_flush_job_is_reopened(self):
+        """Test a holding window whose flush job never ran is reopened under a new job with what it held."""
+        now = time.time()
+        first = digest.add('alice', 'trading-app', 'price-alerts', 10, 'A', 'A body', now=now)
+        with patch.object(scheduler, 'schedule'):
+            self.assertEqual(digest.add('alice', 'trading-app', 'price-alerts', 10, 'B', 'B body', now=now + 1)['status'], 'held')
+        self.assertEqual(scheduler.pending_count(), 0)
+
+        later = now + 10 + digest.DIGEST_FLUSH_GRACE_SECONDS
+        window = digest.add('alice', 'trading-app', 'price-alerts', 10, 'C', 'C body', now=later)
+        self.assertEqual((window['status'], window['count']), ('held', 3))
+        self.assertNotEqual(window['window_id'], first['window_id'])
+        self.assertEqual(scheduler.pending_count(), 1)
+
+        scheduler.run_due(later + 11)
+        self.assertEqual(self.sent[-1].notification.title, '3 new notifications')
+        self.assertEqual(digest.open_windows(), 0)
+
+    def test_failed_flush_schedule_sends_without_digest(self):
+        """Test a notification is sent normally when its flush job cannot be written."""
+        self.post('A')
+        with patch.object(scheduler, 'schedule', side_effect=OSError('disk full')):
+            status, body = self.post('B')
+        self.assertEqual((status, body['digest']['status']), (200, 'send'))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(digest.open_windows(), 0)
+
+    def test_digest_rejected_without_scheduler(self):
+        """Test a digest is refused when no scheduler would ever flush it."""
+        with patch.object(scheduler, 'enabled', return_value=False):
+            status, body = self.post('A')
+        self.assertEqual(status, 400)
+        self.assertIn('scheduler', body['error'])
+        self.assertEqual(self.sent, [])
+
+    def test_invalid_digest(self):
+        """Test a malformed digest or one combined with send_at is rejected."""
+        response = self.app.post('/api/send-to-user', data=json.dumps({
+            'user_id': 'alice', 'title': 'T', 'body': 'B', 'digest': {'group': 'a b'}
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/api/send-to-user', data=json.dumps({
+            'user_id': 'alice', 'title': 'T', 'body': 'B', 'digest': 'g', 'send_at': '09:00'
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+End-to-end tests: HTTP requests through the real token queries against the
+in-memory Firestore fake, with FCM replaced by the local fake transport.
+"""
+
+import unittest
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import token_manager
+from benchmarks import fakes
+from app import app
+
+
+class EndToEndTestCase(unittest.TestCase):
+    """Test cases for registering tokens and sending to them."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        self.db = fakes.FakeFirestore()
+        self.fcm = fakes.FakeFCM()
+        self.addCleanup(fakes.install(self.db, self.fcm))
+
+    def post(self, path, body):
+        response = self.app.post(path, data=json.dumps(body), content_type='application/json')
+        return response.status_code, response.get_json()
+
+    def register(self, token, app_id, user_id=None):
+        status, _ = self.post('/api/register-token', {'token': token, 'app_id': app_id, 'user_id': user_id})
+        self.assertEqual(status, 200)
+
+    def test_reregistering_updates_the_token_in_place(self):
+        """Test a token registered again keeps its creation time and takes the new app and user."""
+        self.register('token-1', 'weather-app', 'alice')
+        created_at = token_manager.get_token_info('token-1')['created_at']
+
+        self.register('token-1', 'news-app', 'bob')
+
+        info = token_manager.get_token_info('token-1')
+        self.assertEqual((info['app_id'], info['user_id']), ('news-app', 'bob'))
+        self.assertEqual(info['created_at'], created_at)
+        self.assertEqual(token_manager.get_tokens_for_app('weather-app'), [])
+
+    def test_send_to_app_reaches_only_that_apps_devices(self):
+        """Test send-to-app resolves its audience by app and optional user, with app defaults applied."""
+        self.register('w-alice-phone', 'weather-app', 'alice')
+        self.register('w-alice-laptop', 'weather-app', 'alice')
+        self.register('w-bob', 'weather-app', 'bob')
+        self.register('n-alice', 'news-app', 'alice')
+
+        status, body = self.post('/api/send-to-app', {'app_id': 'weather-app', 'title': 'Rain', 'body': 'Soon'})
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(body['tokens']), ['w-alice-laptop', 'w-alice-phone', 'w-bob'])
+        self.assertEqual(body['sent_to'], 3)
+
+        status, body = self.post(
+            '/api/send-to-app', {'app_id': 'weather-app', 'user_id': 'alice', 'title': 'Rain', 'body': 'Soon'}
+        )
+        self.assertEqual(sorted(body['tokens']), ['w-alice-laptop', 'w-alice-phone'])
+        self.assertEqual(self.fcm.messages, 5)
+
+    def test_send_to_user_and_broadcast_count_fcm_failures(self):
+        """Test per-user and broadcast sends reach every device and report rejected tokens."""
+        for i in range(1200):
+            self.register(f'token-{i:04d}', 'weather-app' if i % 2 else 'news-app', f'user-{i % 3}')
+        self.fcm.error_rate = 0.5
+
+        status, body = self.post('/api/send-to-user', {'user_id': 'user-0', 'title': 'Hi', 'body': 'There'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['sent_to'] + body['failed'], 400)
+
+        status, body = self.post('/api/broadcast', {'title': 'All', 'body': 'Hands'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['sent_to'] + body['failed'], 1200)
+        self.assertGreater(body['failed'], 0)
+        self.assertEqual(body['errors'], {'UNREGISTERED': body['failed']})
+        self.assertEqual(self.fcm.calls, 1 + 3)
+
+    def test_deleted_token_is_no_longer_sent_to(self):
+        """Test deleting a token removes it from every audience."""
+        self.register('token-1', 'weather-app')
+        self.register('token-2', 'weather-app')
+
+        self.assertTrue(token_manager.delete_token('token-1'))
+        self.assertFalse(token_manager.delete_token('token-1'))
+
+        status, body = self.post('/api/send-to-app', {'app_id': 'weather-app', 'title': 'T', 'body': 'B'})
+        self.assertEqual(body['tokens'], ['token-2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests for engagement event ingestion and aggregated flushing.
+"""
+
+import unittest
+import json
+import os
+import sys
+from datetime import datetime
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engagement
+import token_manager
+from benchmarks import fakes
+from app import app
+
+
+def event(kind, token, app_id='weather-app', notification_id=None):
+    posted = {'type': kind, 'token': token, 'app_id': app_id}
+    if notification_id:
+        posted['notification_id'] = notification_id
+    return posted
+
+
+class RingBufferTestCase(unittest.TestCase):
+    """Test cases for the fixed-size event buffer."""
+
+    def test_overwrites_oldest_when_full(self):
+        """Test a full buffer keeps the newest items, oldest first, and is empty after a drain."""
+        buffer = engagement.RingBuffer(3)
+        self.assertEqual(buffer.extend([1, 2]), 0)
+        self.assertEqual(buffer.extend([3, 4, 5]), 2)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.drain(), [3, 4, 5])
+        self.assertEqual(buffer.drain(), [])
+        buffer.extend([6])
+        self.assertEqual(buffer.drain(), [6])
+
+
+class EngagementTestCase(unittest.TestCase):
+    """Test cases for ingesting events and writing their aggregates to Firestore."""
+
+    def setUp(self):
+        for name, value in [('_buffer', engagement.RingBuffer(100)), ('_carry', ({}, {})),
+                            ('ensure_started', lambda: None)]:
+            patcher = patch.object(engagement, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = app.test_client()
+        self.app.testing = True
+        self.db = fakes.FakeFirestore()
+        fakes.seed_tokens(self.db, 3, ['weather-app'])
+        self.addCleanup(fakes.install(self.db, fakes.FakeFCM()))
+        self.tokens = [f"bench-token-{i:08d}" for i in range(3)]
+
+    def post(self, events):
+        response = self.app.post('/api/events', data=json.dumps({'events': events}), content_type='application/json')
+        return response.status_code, response.get_json()
+
+    def engagement_doc(self, *path):
+        return self.db.document('/'.join((engagement.ENGAGEMENT_COLLECTION,) + path)).get().to_dict()
+
+    def test_counters_accumulate_across_flushes(self):
+        """Test events are counted per app and per notification, and increments add up over flushes."""
+        status, body = self.post([
+            event('open', self.tokens[0], notification_id='n1'),
+            event('click', self.tokens[0], notification_id='n1'),
+            event('open', self.tokens[1], notification_id='n2'),
+            event('dismiss', self.tokens[2]),
+            {'type': 'swipe', 'token': self.tokens[0], 'app_id': 'weather-app'},
+            {'type': 'open', 'app_id': 'weather-app'}
+        ])
+        self.assertEqual(status, 202)
+        self.assertEqual((body['accepted'], body['rejected']), (4, 2))
+        self.assertEqual(engagement.flush(), {'events': 4, 'counters': 3, 'tokens': 3})
+
+        self.post([event('open', self.tokens[1], notification_id='n1')])
+        engagement.flush()
+
+        totals = self.engagement_doc('weather-app')
+        self.assertEqual((totals['open'], totals['click'], totals['dismiss']), (3, 1, 1))
+        n1 = self.engagement_doc('weather-app', engagement.NOTIFICATIONS_SUBCOLLECTION, 'n1')
+        self.assertEqual((n1['notification_id'], n1['open'], n1['click']), ('n1', 2, 1))
+        self.assertNotIn('dismiss', n1)
+
+    def test_last_active_only_for_registered_tokens(self):
+        """Test last_active moves forward for known tokens and unknown tokens are not created."""
+        before = token_manager.get_token_info(self.tokens[0]).get('last_active')
+        self.post([event('open', self.tokens[0]), event('open', 'deleted-token')])
+
+        self.assertEqual(engagement.flush()['tokens'], 1)
+
+        self.assertNotEqual(token_manager.get_token_info(self.tokens[0])['last_active'], before)
+        self.assertIsNone(token_manager.get_token_info('deleted-token'))
+
+    def test_tokens_that_are_not_document_ids(self):
+        """Test events for tokens Firestore cannot store are rejected, and never block last_active updates."""
+        status, body = self.post([event('open', 'a/b'), event('open', '__name__'), event('open', self.tokens[0])])
+        self.assertEqual((status, body['accepted'], body['rejected']), (202, 1, 2))
+
+        now = datetime.utcnow()
+        self.assertEqual(token_manager.record_token_activity({'a/b': now, '..': now, self.tokens[1]: now}), 1)
+        self.assertEqual(token_manager.get_token_info(self.tokens[1])['last_active'], now)
+
+    def test_ids_that_are_not_document_ids(self):
+        """Test events whose app or notification id cannot be a counter document id are rejected."""
+        status, body = self.post([
+            event('open', self.tokens[0], app_id='..'),
+            event('open', self.tokens[0], app_id='__x__'),
+            event('open', self.tokens[0], notification_id='n' * 1501),
+            event('open', self.tokens[0], app_id='a/b', notification_id='n1')
+        ])
+        self.assertEqual((status, body['accepted'], body['rejected']), (202, 1, 3))
+        engagement.flush()
+        n1 = self.engagement_doc('a%2Fb', engagement.NOTIFICATIONS_SUBCOLLECTION, 'n1')
+        self.assertEqual((n1['notification_id'], n1['open']), ('n1', 1))
+
+    def test_failed_write_is_kept_for_next_flush(self):
+        """Test counters that could not be written are added to the next flush rather than lost."""
+        self.post([event('open', self.tokens[0]), event('open', self.tokens[1])])
+        with patch.object(self.db, 'batch', side_effect=RuntimeError('unavailable')):
+            self.assertEqual(engagement.flush()['counters'], 0)
+
+        self.post([event('click', self.tokens[0])])
+        engagement.flush()
+
+        totals = self.engagement_doc('weather-app')
+        self.assertEqual((totals['open'], totals['click']), (2, 1))
+
+    def test_carried_counters_are_capped(self):
+        """Test unwritten counters are dropped once they outgrow the buffer rather than carried forever."""
+        self.post([event('open', self.tokens[0], notification_id=f'n{i}') for i in range(3)])
+        with patch.object(engagement, 'EVENTS_BUFFER_SIZE', 3), \
+                patch.object(self.db, 'batch', side_effect=RuntimeError('unavailable')):
+            engagement.flush()
+            self.assertEqual(len(engagement._carry[0]), 4)
+            engagement.flush()
+            self.assertEqual(engagement._carry, ({}, {}))
+
+    def test_rejects_malformed_requests(self):
+        """Test a missing, empty or oversized events list is rejected."""
+        for body in ({}, {'events': []}, {'events': 'open'}):
+            status, _ = self.post(body.get('events'))
+            self.assertEqual(status, 400)
+        with patch.object(engagement, 'EVENTS_MAX_BATCH', 1):
+            status, _ = self.post([event('open', 'a'), event('open', 'b')])
+        self.assertEqual(status, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""
+Tests for the in-memory Firestore fake's semantics.
+"""
+
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transactional, transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+from benchmarks.fake_firestore import DESCENDING, MAX_BATCH_WRITES, FakeFirestore
+
+
+def ids(query):
+    return [doc.id for doc in query.stream()]
+
+
+class FakeFirestoreDocumentTestCase(unittest.TestCase):
+    """Test cases for document reads and writes."""
+
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.docs = self.db.collection('docs')
+
+    def test_write_semantics(self):
+        """Test set replaces, merge merges, update needs the document and create refuses to overwrite."""
+        ref = self.docs.document('a')
+        with self.assertRaises(exceptions.NotFound):
+            ref.update({'n': 1})
+
+        ref.set({'n': 1, 'nested': {'x': 1, 'y': 2}})
+        ref.set({'nested': {'y': 3}, 'extra': True}, merge=True)
+        self.assertEqual(ref.get().to_dict(), {'n': 1, 'nested': {'x': 1, 'y': 3}, 'extra': True})
+
+        ref.update({'nested.x': transforms.Increment(4), 'extra': transforms.DELETE_FIELD})
+        self.assertEqual(ref.get().to_dict(), {'n': 1, 'nested': {'x': 5, 'y': 3}})
+
+        ref.set({'m': 1})
+        self.assertEqual(ref.get().to_dict(), {'m': 1})
+        with self.assertRaises(exceptions.AlreadyExists):
+            ref.create({'m': 2})
+        ref.delete()
+        ref.delete()
+        self.assertFalse(ref.get().exists)
+        self.assertIsNone(ref.get().to_dict())
+
+    def test_reads_and_writes_are_copies(self):
+        """Test mutating written or read data does not change the stored document."""
+        data = {'tags': ['a']}
+        ref = self.docs.document('a')
+        ref.set(data)
+        data['tags'].append('b')
+        snapshot = ref.get()
+        snapshot.to_dict()['tags'].append('c')
+        self.assertEqual(ref.get().to_dict(), {'tags': ['a']})
+
+    def test_server_timestamp_and_select(self):
+        """Test SERVER_TIMESTAMP is resolved and field paths limit what is read."""
+        _, ref = self.docs.add({'at': transforms.SERVER_TIMESTAMP, 'a': 1, 'b': 2})
+        self.assertEqual(len(ref.id), 20)
+        snapshot = ref.get(field_paths=['a'])
+        self.assertEqual(snapshot.to_dict(), {'a': 1})
+        self.assertIsNotNone(ref.get().get('at').tzinfo)
+        self.assertEqual(ids(self.docs.select(['b'])), [ref.id])
+
+    def test_batch_is_atomic(self):
+        """Test a batch with a failing write applies none of its writes, and size is capped."""
+        self.docs.document('a').set({'n': 1})
+        batch = self.db.batch()
+        batch.set(self.docs.document('b'), {'n': 2})
+        batch.delete(self.docs.document('a'))
+        batch.update(self.docs.document('missing'), {'n': 3})
+        with self.assertRaises(exceptions.NotFound):
+            batch.commit()
+        self.assertEqual(ids(self.docs), ['a'])
+
+        batch = self.db.batch()
+        for i in range(MAX_BATCH_WRITES + 1):
+            batch.set(self.docs.document(f'd{i}'), {})
+        with self.assertRaises(exceptions.InvalidArgument):
+            batch.commit()
+
+    def test_transaction_retries_on_conflict(self):
+        """Test a transaction reruns when a document it read changes, and reads must come before writes."""
+        ref = self.docs.document('counter')
+        ref.set({'n': 0})
+        seen = []
+
+        @transactional
+        def increment(transaction):
+            seen.append(ref.get(transaction=transaction).to_dict()['n'])
+            if len(seen) == 1:
+                # Another client writes between this transaction's read and its commit
+                ref.update({'n': 10})
+            transaction.update(ref, {'n': seen[-1] + 1})
+
+        increment(self.db.transaction())
+        self.assertEqual(seen, [0, 10])
+        self.assertEqual(ref.get().to_dict(), {'n': 11})
+
+        @transactional
+        def read_after_write(transaction):
+            transaction.set(self.docs.document('other'), {})
+            ref.get(transaction=transaction)
+
+        with self.assertRaises(exceptions.InvalidArgument):
+            read_after_write(self.db.transaction())
+        self.assertFalse(self.docs.document('other').get().exists)
+
+    def test_subcollections_and_get_all(self):
+        """Test subcollections are separate and get_all returns missing documents as not existing."""
+        user = self.db.collection('users').document('u1')
+        user.collection('tokens').document('t1').set({'app_id': 'a'})
+        self.assertEqual(ids(self.db.collection('users/u1/tokens')), ['t1'])
+        self.assertEqual(ids(self.db.collection('users')), [])
+
+        snapshots = list(self.db.get_all([self.db.document('users/u1/tokens/t1'), user]))
+        self.assertEqual([s.exists for s in snapshots], [True, False])
+
+
+class FakeFirestoreQueryTestCase(unittest.TestCase):
+    """Test cases for filters, ordering and cursors."""
+
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.docs = self.db.collection('docs')
+        for i, (group, score) in enumerate([('a', 3), ('b', 1), ('a', 2), ('b', 5), ('a', 4)]):
+            self.docs.document(f'd{i}').set({'group': group, 'score': score, 'tags': [group, f't{i}']})
+        self.docs.document('no-score').set({'group': 'a', 'tags': []})
+        self.docs.document('text-score').set({'group': 'b', 'score': '9'})
+
+    def test_filters(self):
+        """Test equality, range, in and array filters, and that missing or mistyped fields never match."""
+        self.assertEqual(ids(self.docs.where('group', '==', 'a')), ['d0', 'd2', 'd4', 'no-score'])
+        self.assertEqual(ids(self.docs.where(filter=FieldFilter('score', '>', 2))), ['d0', 'd4', 'd3'])
+        self.assertEqual(ids(self.docs.where('score', 'in', [1, 5])), ['d1', 'd3'])
+        self.assertEqual(ids(self.docs.where('score', '!=', 3)), ['d1', 'd2', 'd4', 'd3', 'text-score'])
+        self.assertEqual(ids(self.docs.where('tags', 'array_contains', 't2')), ['d2'])
+        self.assertEqual(ids(self.docs.where('tags', 'array_contains_any', ['t1', 't3'])), ['d1', 'd3'])
+        self.assertEqual(ids(self.docs.where('group', '==', 'a').where('score', '<=', 3)), ['d2', 'd0'])
+
+    def test_ordering_limit_offset(self):
+        """Test ordering skips documents without the field and ties break by document id."""
+        self.assertEqual(ids(self.docs.order_by('score').limit(3)), ['d1', 'd2', 'd0'])
+        self.assertEqual(ids(self.docs.order_by('score', direction=DESCENDING).limit(2)), ['text-score', 'd3'])
+        self.assertEqual(ids(self.docs.order_by('group').order_by('score').offset(1).limit(2)), ['d0', 'd4'])
+        with self.assertRaises(exceptions.InvalidArgument):
+            ids(self.docs.where('score', '>', 1).order_by('group'))
+
+    def test_cursors(self):
+        """Test field-value and snapshot cursors page through an ordered query."""
+        query = self.docs.where('group', '==', 'a').order_by('score')
+        first = query.limit(2).get()
+        self.assertEqual([doc.id for doc in first], ['d2', 'd0'])
+        self.assertEqual(ids(query.start_after(first[-1])), ['d4'])
+        self.assertEqual(ids(query.start_at({'score': 3}).end_at({'score': 4})), ['d0', 'd4'])
+        by_id = self.docs.order_by('__name__')
+        self.assertEqual(ids(by_id.start_after({'__name__': 'd3'}).limit(2)), ['d4', 'no-score'])
+        self.assertEqual(ids(by_id.end_before({'__name__': 'd2'})), ['d0', 'd1'])
+
+    def test_count_and_billed_reads(self):
+        """Test count() matches the query and reads are billed per document, or per 1000 for counts."""
+        before = self.db.documents_read
+        self.assertEqual(self.docs.where('group', '==', 'a').count(alias='n').get()[0][0].value, 4)
+        self.assertEqual(self.docs.where('score', '>', 2).count().get()[0][0].value, 3)
+        self.assertEqual(self.db.documents_read - before, 2)
+
+        ids(self.docs.where('group', '==', 'b'))
+        self.docs.document('missing').get()
+        self.assertEqual(self.db.documents_read - before, 2 + 3 + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Tests for routing FCM sends to per-app Firebase projects.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+import app_configs
+import fanout
+import firebase_service
+from app import app
+
+PROJECTS = {
+    "tenant-a": {"credentials_env": "TENANT_A_CREDENTIALS", "messages_per_second": 100},
+    "tenant-b": {"credentials_path": "/secrets/tenant-b.json"}
+}
+
+
+def batch(message, app=None):
+    return MagicMock(success_count=len(message.tokens), failure_count=0, responses=[])
+
+
+class FirebaseProjectTestCase(unittest.TestCase):
+    """Test cases for the project pool and send routing."""
+
+    def setUp(self):
+        """Configure two tenant projects and an app store with one app per project."""
+        firebase_service.load_sdk()
+        self.data_dir = tempfile.mkdtemp()
+        self.projects = firebase_service.parse_projects(PROJECTS)
+        self.apps = {name: object() for name in self.projects}
+        for target, name, value in (
+            (firebase_service, '_projects', self.projects),
+            (firebase_service, '_firebase_app', self.apps['default']),
+            (app_configs, '_source', app_configs.FileSource(os.path.join(self.data_dir, 'app_configs.json'))),
+            (app_configs, '_snapshot', None)
+        ):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in PROJECTS:
+            patcher = patch.object(self.projects[name], 'app', return_value=self.apps[name])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+        app_configs.put_app_config('shop-app', {'name': 'Shop', 'firebase_project': 'tenant-a'})
+        app_configs.put_app_config('blog-app', {'name': 'Blog', 'firebase_project': 'tenant-b'})
+
+    def test_rejects_invalid_project_config(self):
+        """Test every project needs exactly one credentials source and the default name is reserved."""
+        for config in (
+            {"default": {"credentials_path": "/a.json"}},
+            {"tenant": {}},
+            {"tenant": {"credentials_path": "/a.json", "credentials_env": "A"}},
+            {"tenant": {"credentials_path": "/a.json", "messages_per_second": 0}}
+        ):
+            with self.assertRaises(ValueError):
+                firebase_service.parse_projects(config)
+
+    def test_routes_send_to_the_app_project(self):
+        """Test an app's sends use its project's App and breaker; other apps use the default."""
+        with patch.object(firebase_service.messaging, 'send_each_for_multicast', side_effect=batch) as mock_send, \
+                patch('rate_limit.take', return_value=0.0):
+            firebase_service.send_multicast_notification(['t1'], 'Title', 'Body', app_id='shop-app')
+            firebase_service.send_multicast_notification(['t2'], 'Title', 'Body', app_id='weather-app')
+
+        self.assertIs(mock_send.call_args_list[0].kwargs['app'], self.apps['tenant-a'])
+        self.assertNotIn('app', mock_send.call_args_list[1].kwargs)
+        self.assertEqual(self.projects['tenant-a'].breaker.name, 'fcm:tenant-a')
+
+    @patch('time.sleep')
+    @patch('rate_limit.take')
+    def test_paces_sends_to_project_rate(self, mock_take, mock_sleep):
+        """Test a project's messages_per_second is charged per message and waited out."""
+        mock_take.side_effect = [0.25, 0.0]
+        with patch.object(firebase_service.messaging, 'send_each_for_multicast', side_effect=batch):
+            firebase_service.send_multicast_notification(['t1', 't2', 't3'], 'Title', 'Body', app_id='shop-app')
+
+        mock_take.assert_called_with('fcm:tenant-a', 100.0, 100.0, cost=3)
+        mock_sleep.assert_called_once_with(0.25)
+
+    @patch('token_manager.get_token_apps')
+    @patch('firebase_service.send_multicast_notification')
+    def test_appless_delivery_is_split_by_project(self, mock_send, mock_token_apps):
+        """Test tokens without an app_id are grouped by the project of their registered app."""
+        mock_token_apps.return_value = {'a1': 'shop-app', 'b1': 'blog-app', 'a2': 'shop-app', 'w1': 'weather-app'}
+        mock_send.side_effect = lambda tokens, **kwargs: MagicMock(
+            success_count=len(tokens), failure_count=0, responses=[]
+        )
+
+        result = fanout.deliver(['a1', 'b1', 'a2', 'w1', 'gone'], 'Title', 'Body')
+
+        sends = {call.kwargs['project']: call.kwargs['tokens'] for call in mock_send.call_args_list}
+        self.assertEqual(sends, {'tenant-a': ['a1', 'a2'], 'tenant-b': ['b1'], 'default': ['w1', 'gone']})
+        self.assertEqual(result['sent_to'], 5)
+
+    def test_app_config_must_name_a_configured_project(self):
+        """Test PUT /api/apps rejects an unknown firebase_project."""
+        client = app.test_client()
+        with patch.object(app_module, 'ADMIN_API_KEY', 'admin-secret'):
+            response = client.put(
+                '/api/apps/new-app',
+                data=json.dumps({'name': 'New', 'firebase_project': 'tenant-z'}),
+                content_type='application/json',
+                headers={'X-Admin-Key': 'admin-secret'}
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('tenant-z', response.get_json()['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
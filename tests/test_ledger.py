@@ -0,0 +1,193 @@
+"""
+Tests for the delivery ledger: recording, indexed queries and compaction.
+"""
+
+import unittest
+import json
+import os
+import sys
+import time
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_admin import messaging
+import ledger
+from benchmarks import fakes
+from app import app
+
+
+def sent(message_id='projects/p/messages/1'):
+    return SimpleNamespace(success=True, message_id=message_id, exception=None)
+
+
+def unregistered():
+    return SimpleNamespace(success=False, message_id=None, exception=messaging.UnregisteredError('gone'))
+
+
+def use_temp_ledger(test):
+    """Point the ledger at a fresh directory with small blocks, writing only on explicit flushes."""
+    # Earlier tests' sends started the writer thread; stop it and seal its segment
+    ledger.stop()
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    for name, value in [
+        ('LEDGER_DIR', directory), ('LEDGER_INDEX_BLOCK', 10), ('LEDGER_SEGMENT_RECORDS', 100),
+        ('ensure_started', lambda: None)
+    ]:
+        patcher = patch.object(ledger, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    test.addCleanup(ledger.flush, seal=True)
+
+
+class LedgerTestCase(unittest.TestCase):
+    """Test cases for the ledger store."""
+
+    def setUp(self):
+        use_temp_ledger(self)
+
+    def test_records_outcomes_per_token(self):
+        """Test multicast responses, whole-call errors and single sends become one record per token."""
+        ledger.record('s1', ['t1', 't2'], 'weather-app', 'alice', responses=[sent(), unregistered()])
+        ledger.record('s2', ['t3', 't4'], 'weather-app', error=messaging.QuotaExceededError('slow down'))
+        ledger.record('s3', ['t5'], 'news-app', message_id='projects/p/messages/5')
+        self.assertEqual(ledger.status()['pending'], 5)
+        self.assertEqual(ledger.flush(), 5)
+
+        result = ledger.query(app_id='weather-app', status=ledger.FAILED)
+        self.assertEqual(result['matched'], 3)
+        self.assertEqual(result['summary']['errors'], {'UNREGISTERED': 1, 'QUOTA_EXCEEDED': 2})
+
+        delivery = ledger.query(token='t1')['deliveries'][0]
+        self.assertEqual(delivery['token_hash'], ledger.hash_token('t1'))
+        self.assertEqual(
+            (delivery['send_id'], delivery['user_id'], delivery['status'], delivery['error_code']),
+            ('s1', 'alice', ledger.SENT, None)
+        )
+        self.assertNotIn('t1', json.dumps(ledger.query()))
+        self.assertEqual(ledger.query(send_id='s3')['deliveries'][0]['message_id'], 'projects/p/messages/5')
+
+    def test_drops_outcomes_when_the_buffer_is_full(self):
+        """Test a full buffer drops new outcomes instead of growing."""
+        with patch.object(ledger, 'LEDGER_MAX_PENDING', 3):
+            ledger.record('s1', ['t1', 't2'], responses=[sent(), sent()])
+            ledger.record('s2', ['t3', 't4'], responses=[sent(), sent()])
+        self.assertEqual(ledger.status()['pending'], 2)
+        self.assertEqual(ledger.flush(), 2)
+
+    def test_index_limits_what_a_query_reads(self):
+        """Test sealed segments and blocks outside the query's time range, app or status are not read."""
+        ledger.record('old', [f'o{i}' for i in range(30)], 'weather-app', responses=[sent()] * 30)
+        ledger.flush(seal=True)
+        time.sleep(0.01)
+        since = time.time()
+        time.sleep(0.01)
+        ledger.record('new', [f'w{i}' for i in range(30)], 'weather-app', responses=[sent()] * 30)
+        ledger.record('new', [f'n{i}' for i in range(20)], 'news-app', responses=[unregistered()] * 20)
+        ledger.flush(seal=True)
+
+        result = ledger.query(since=since, app_id='news-app', status=ledger.FAILED, limit=5)
+        self.assertEqual(result['matched'], 20)
+        self.assertEqual(len(result['deliveries']), 5)
+        self.assertEqual(result['scanned'], {'segments': 1, 'blocks': 2, 'records': 20})
+
+        result = ledger.query(since=since, status=ledger.FAILED)
+        self.assertEqual(result['scanned']['blocks'], 2)
+        self.assertEqual(ledger.query()['matched'], 80)
+
+    def test_compaction_seals_merges_and_expires(self):
+        """Test orphaned segments are sealed, small ones merged without losing records, and old ones dropped."""
+        for i in range(4):
+            ledger.record(f's{i}', [f't{i}-{n}' for n in range(10)], 'weather-app', responses=[sent()] * 10)
+            ledger.flush(seal=i < 3)
+        # The last segment is still active, as if its worker had died
+        orphan = ledger._segment
+        ledger._segment = None
+        orphan.file.close()
+
+        later = time.time() + ledger.LEDGER_SEGMENT_SECONDS + ledger.ORPHAN_GRACE_SECONDS + 1
+        self.assertEqual(ledger.compact(now=later), {'expired': 0, 'sealed': 1, 'merged': 4})
+        self.assertEqual(len([n for n in os.listdir(ledger.LEDGER_DIR) if n.endswith('.seg')]), 1)
+        result = ledger.query()
+        self.assertEqual(result['matched'], 40)
+        self.assertEqual(result['scanned']['records'], 40)
+
+        expired = time.time() + ledger.LEDGER_RETENTION_HOURS * 3600 + 1
+        self.assertEqual(ledger.compact(now=expired)['expired'], 1)
+        self.assertEqual(ledger.query()['matched'], 0)
+
+    def test_compaction_survives_torn_orphans(self):
+        """Test orphaned segments ending in a torn record are sealed without it and still merge."""
+        for i in range(3):
+            ledger.record(f's{i}', [f't{i}-{n}' for n in range(10)], 'weather-app', responses=[sent()] * 10)
+            ledger.flush()
+            orphan = ledger._segment
+            ledger._segment = None
+            orphan.file.close()
+            if i < 2:
+                with open(orphan.path, 'ab') as f:
+                    f.write(b'[1700000000.0,"s-torn","t')
+        # A segment sealed with its torn tail kept, as compaction used to
+        with open(orphan.path, 'ab') as f:
+            f.write(b'[1700000000.0,')
+        os.replace(orphan.path, orphan.path[:-len('.log')] + '.seg')
+
+        later = time.time() + ledger.LEDGER_SEGMENT_SECONDS + ledger.ORPHAN_GRACE_SECONDS + 1
+        self.assertEqual(ledger.compact(now=later), {'expired': 0, 'sealed': 3, 'merged': 3})
+        result = ledger.query()
+        self.assertEqual((result['matched'], result['scanned']['records']), (30, 30))
+        self.assertEqual(ledger.compact(now=later), {'expired': 0, 'sealed': 0, 'merged': 0})
+
+    def test_parse_time(self):
+        """Test bounds can be ISO 8601 datetimes or durations ago."""
+        self.assertEqual(ledger.parse_time('1h', now=10000), 6400)
+        self.assertEqual(ledger.parse_time('2026-01-01T00:00:00Z'), ledger.parse_time('2026-01-01T00:00:00'))
+        with self.assertRaises(ValueError):
+            ledger.parse_time('yesterday')
+
+
+class DeliveriesAPITestCase(unittest.TestCase):
+    """Test cases for recording sends and querying them over HTTP."""
+
+    def setUp(self):
+        use_temp_ledger(self)
+        self.app = app.test_client()
+        self.app.testing = True
+        self.db = fakes.FakeFirestore()
+        fakes.seed_tokens(self.db, 40, ['weather-app', 'news-app'], users=4)
+        self.addCleanup(fakes.install(self.db, fakes.FakeFCM(error_rate=0.5)))
+
+    def test_failures_for_an_app(self):
+        """Test a send's failures are found by app, status and send id."""
+        response = self.app.post(
+            '/api/send-to-app', data=json.dumps({'app_id': 'weather-app', 'title': 'T', 'body': 'B'}),
+            content_type='application/json'
+        )
+        send = response.get_json()
+        self.app.post('/api/broadcast', data=json.dumps({'title': 'T', 'body': 'B'}), content_type='application/json')
+        ledger.flush()
+
+        response = self.app.get('/api/deliveries?app_id=weather-app&status=failed&since=1h')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['matched'], send['failed'])
+        self.assertEqual(data['summary']['errors'], {'UNREGISTERED': send['failed']})
+        self.assertTrue(all(d['send_id'] == send['send_id'] for d in data['deliveries']))
+
+        data = self.app.get(f"/api/deliveries?send_id={send['send_id']}").get_json()
+        self.assertEqual(data['summary']['sent'], send['sent_to'])
+        self.assertEqual(self.app.get('/api/deliveries').get_json()['matched'], 60)
+
+    def test_invalid_query(self):
+        """Test invalid bounds, status or limit are rejected."""
+        for query in ('since=yesterday', 'status=bounced', 'limit=5000'):
+            response = self.app.get(f'/api/deliveries?{query}')
+            self.assertEqual(response.status_code, 400, query)
+
+
+if __name__ == '__main__':
+    unittest.main()
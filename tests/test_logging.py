@@ -0,0 +1,104 @@
+"""
+Tests for aggregated send failure summaries and the queued JSON logging pipeline.
+"""
+
+import unittest
+import json
+import logging
+import os
+import queue
+import sys
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fanout
+import firebase_service
+import logging_config
+
+
+def batch_response(tokens, failing_error):
+    """A BatchResponse-like mock in which every token failed with failing_error."""
+    return MagicMock(
+        success_count=0,
+        failure_count=len(tokens),
+        responses=[MagicMock(success=False, exception=failing_error) for _ in tokens]
+    )
+
+
+class FailureSummaryTestCase(unittest.TestCase):
+    """Test cases for per-request failure summaries."""
+
+    def setUp(self):
+        firebase_service.load_sdk()
+        patcher = patch('firebase_service._firebase_app', object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.unregistered = firebase_service.messaging.UnregisteredError('Requested entity was not found.')
+
+    @patch.object(firebase_service, 'FAILURE_SAMPLE_SIZE', 2)
+    def test_multicast_logs_one_summary(self):
+        """Test failed tokens produce one warning with counts and a capped sample."""
+        tokens = [f'stale-token-{i}' for i in range(50)]
+        with patch.object(firebase_service.messaging, 'send_each_for_multicast',
+                          return_value=batch_response(tokens, self.unregistered)):
+            with self.assertLogs('firebase_service', 'WARNING') as logs:
+                firebase_service.send_multicast_notification(tokens, 'Title', 'Body', app_id='test-app')
+
+        self.assertEqual(len(logs.records), 1)
+        summary = logs.records[0].failures
+        self.assertEqual(summary['failed'], 50)
+        self.assertEqual(summary['by_code'], {'UNREGISTERED': 50})
+        self.assertEqual(len(summary['sample']), 2)
+        self.assertTrue(summary['sample'][0]['token'].endswith('...'))
+
+    def test_fanout_aggregates_across_chunks(self):
+        """Test a multi-chunk delivery reports all failures once, in its result and its log."""
+        tokens = [f'stale-token-{i}' for i in range(700)]
+        with patch.object(firebase_service.messaging, 'send_each_for_multicast',
+                          side_effect=lambda message: batch_response(message.tokens, self.unregistered)):
+            with self.assertLogs(level='WARNING') as logs:
+                result = fanout.deliver(tokens, 'Title', 'Body', app_id='test-app')
+
+        self.assertEqual(result['failed'], 700)
+        self.assertEqual(result['errors'], {'UNREGISTERED': 700})
+        summaries = [record for record in logs.records if hasattr(record, 'failures')]
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0].failures['failed'], 700)
+
+
+class LoggingPipelineTestCase(unittest.TestCase):
+    """Test cases for the JSON formatter and the non-blocking queue handler."""
+
+    def test_json_formatter_includes_extra_fields(self):
+        """Test records are single JSON lines with extra fields at the top level."""
+        record = logging.LogRecord('fanout', logging.WARNING, __file__, 1, 'failed %d', (3,), None)
+        record.failures = {'by_code': {'UNREGISTERED': 3}}
+        entry = json.loads(logging_config.JsonFormatter().format(record))
+        self.assertEqual(entry['message'], 'failed 3')
+        self.assertEqual(entry['level'], 'WARNING')
+        self.assertEqual(entry['failures'], {'by_code': {'UNREGISTERED': 3}})
+
+    def test_queue_handler_drops_instead_of_blocking(self):
+        """Test a full log queue drops records rather than blocking the caller."""
+        handler = logging_config.DroppingQueueHandler(queue.Queue(maxsize=1))
+        record = logging.LogRecord('fanout', logging.INFO, __file__, 1, 'hello', (), None)
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_queued_record_keeps_traceback(self):
+        """Test exceptions are rendered before queueing so the writer thread can output them."""
+        handler = logging_config.DroppingQueueHandler(queue.Queue())
+        try:
+            raise RuntimeError('boom')
+        except RuntimeError:
+            record = logging.LogRecord('app', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info())
+        handler.handle(record)
+        entry = json.loads(logging_config.JsonFormatter().format(handler.queue.get_nowait()))
+        self.assertIn('RuntimeError: boom', entry['exception'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Tests for the Prometheus /metrics endpoint and hot-path instrumentation.
+"""
+
+import unittest
+import os
+import sys
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client import REGISTRY
+import api_keys
+import firebase_service
+import metrics
+from app import app
+
+
+def sample(name, **labels):
+    """Current value of a metric sample in the default registry (0 if absent)."""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+    """Test cases for the /metrics endpoint."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+
+    def test_exposes_route_latency_histogram(self):
+        """Test requests are timed under their route pattern."""
+        before = sample('http_request_duration_seconds_count', method='GET', route='/api/jobs/<job_id>', status='404')
+        self.app.get('/api/jobs/does-not-exist')
+
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_bucket', text)
+        self.assertIn('circuit_breaker_state{dependency="fcm"}', text)
+        self.assertIn('outbox_pending', text)
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', method='GET', route='/api/jobs/<job_id>', status='404'),
+            before + 1
+        )
+
+    @patch.object(api_keys, '_keys', api_keys.parse_keys({'default': 'secret'}))
+    def test_requires_api_key_when_configured(self):
+        """Test /metrics is protected like the other operational endpoints."""
+        self.assertEqual(self.app.get('/metrics').status_code, 401)
+        response = self.app.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+
+class SendMetricsTestCase(unittest.TestCase):
+    """Test cases for FCM send instrumentation."""
+
+    def setUp(self):
+        firebase_service.load_sdk()
+        for patcher in (
+            patch('firebase_service._firebase_app', object()),
+            patch.object(metrics, 'METRICS_APP_IDS', frozenset({'metrics-app'}))
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('firebase_service.messaging.send_each_for_multicast')
+    def test_multicast_counts_successes_and_failures_by_code(self, mock_send):
+        """Test per-message outcomes are counted, failures under their FCM error code."""
+        messaging = firebase_service.messaging
+        unregistered = messaging.UnregisteredError('gone')
+        mock_send.return_value = MagicMock(
+            success_count=2,
+            failure_count=1,
+            responses=[
+                MagicMock(success=True),
+                MagicMock(success=False, exception=unregistered),
+                MagicMock(success=True)
+            ]
+        )
+        before = {
+            'success': sample('fcm_messages_total', app_id='metrics-app', result='success'),
+            'failure': sample('fcm_messages_total', app_id='metrics-app', result='failure'),
+            'unregistered': sample('fcm_failures_total', app_id='metrics-app', error_code='UNREGISTERED'),
+            'calls': sample('fcm_send_duration_seconds_count', operation='multicast', app_id='metrics-app')
+        }
+
+        firebase_service.send_multicast_notification(['t1', 't2', 't3'], 'Title', 'Body', app_id='metrics-app')
+
+        self.assertEqual(sample('fcm_messages_total', app_id='metrics-app', result='success'), before['success'] + 2)
+        self.assertEqual(sample('fcm_messages_total', app_id='metrics-app', result='failure'), before['failure'] + 1)
+        self.assertEqual(
+            sample('fcm_failures_total', app_id='metrics-app', error_code='UNREGISTERED'),
+            before['unregistered'] + 1
+        )
+        self.assertEqual(
+            sample('fcm_send_duration_seconds_count', operation='multicast', app_id='metrics-app'),
+            before['calls'] + 1
+        )
+        self.assertEqual(sample('fcm_sends_in_flight', operation='multicast'), 0)
+
+    @patch('firebase_service.messaging.send_each_for_multicast')
+    def test_failed_call_counts_every_message(self, mock_send):
+        """Test a multicast call that raises counts all of its messages as failed."""
+        mock_send.side_effect = RuntimeError("connection reset")
+        before = sample('fcm_failures_total', app_id='metrics-app', error_code='RuntimeError')
+
+        with self.assertRaises(RuntimeError):
+            firebase_service.send_multicast_notification(['t1', 't2'], 'Title', 'Body', app_id='metrics-app')
+
+        self.assertEqual(sample('fcm_failures_total', app_id='metrics-app', error_code='RuntimeError'), before + 2)
+        self.assertEqual(sample('fcm_sends_in_flight', operation='multicast'), 0)
+
+    def test_app_label_for_missing_app_id(self):
+        """Test sends without an app_id are labeled "none"."""
+        self.assertEqual(metrics.app_label(None), 'none')
+        self.assertEqual(metrics.app_label('metrics-app'), 'metrics-app')
+
+    def test_app_label_for_unknown_app_id(self):
+        """Test only configured or allow-listed apps get a label of their own."""
+        self.assertEqual(metrics.app_label('trading-app'), 'trading-app')
+        self.assertEqual(metrics.app_label('made-up-app-12345'), 'other')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Tests for Server-Timing phase timings and on-demand request profiling.
+"""
+
+import unittest
+import json
+import os
+import sys
+import tempfile
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import firebase_service
+import profiling
+from app import app
+
+
+def parse_server_timing(header):
+    """Map of phase name to duration (ms) from a Server-Timing header."""
+    timings = {}
+    for entry in header.split(','):
+        name, duration = entry.strip().split(';dur=')
+        timings[name] = float(duration)
+    return timings
+
+
+class ServerTimingTestCase(unittest.TestCase):
+    """Test cases for the Server-Timing header."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+
+    def test_every_response_has_total(self):
+        """Test a request without instrumented phases still reports its total."""
+        response = self.app.get('/api/health')
+        timings = parse_server_timing(response.headers['Server-Timing'])
+        self.assertIn('total', timings)
+
+    @patch('firebase_service._firebase_app', object())
+    @patch('token_manager.get_firestore_client')
+    @patch('token_manager._stream_tokens')
+    def test_send_to_app_reports_each_phase(self, mock_stream, mock_client):
+        """Test send-to-app breaks its time down into config, query, build and send."""
+        firebase_service.load_sdk()
+        mock_stream.return_value = ['token1', 'token2']
+        with patch.object(firebase_service.messaging, 'send_each_for_multicast') as mock_send:
+            mock_send.return_value = MagicMock(success_count=2, failure_count=0, responses=[])
+            response = self.app.post(
+                '/api/send-to-app',
+                data=json.dumps({'app_id': 'weather-app', 'title': 'Rain', 'body': 'Bring an umbrella'}),
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        timings = parse_server_timing(response.headers['Server-Timing'])
+        for name in ('app_config', 'token_query', 'message_build', 'fcm_send', 'total'):
+            self.assertIn(name, timings)
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+    def test_phase_outside_request_is_noop(self):
+        """Test phase() does nothing when no request is collecting timings."""
+        with profiling.phase('token_query'):
+            pass
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """Test cases for captured profiles and the admin endpoints."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        for patcher in (
+            patch.object(profiling, 'PROFILE_DIR', tempfile.mkdtemp()),
+            patch('app.ADMIN_API_KEY', 'admin-secret')
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.admin = {'X-Admin-Key': 'admin-secret'}
+
+    def test_profile_requires_admin_key(self):
+        """Test ?profile=1 is ignored without the admin key."""
+        response = self.app.get('/api/health?profile=1')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_capture_list_and_download(self):
+        """Test an admin can profile a request and fetch the dump."""
+        response = self.app.get('/api/health?profile=1', headers=self.admin)
+        profile_id = response.headers['X-Profile-Id']
+
+        listed = self.app.get('/api/admin/profiles', headers=self.admin).get_json()
+        self.assertEqual(listed['profiles'][0]['id'], profile_id)
+        self.assertEqual(listed['profiles'][0]['route'], '/api/health')
+
+        dump = self.app.get(f'/api/admin/profiles/{profile_id}', headers=self.admin)
+        self.assertEqual(dump.status_code, 200)
+        self.assertGreater(len(dump.data), 0)
+
+        report = self.app.get(f'/api/admin/profiles/{profile_id}?format=text&sort=tottime', headers=self.admin)
+        self.assertIn('function calls', report.get_data(as_text=True))
+
+    def test_admin_endpoints_reject_wrong_key(self):
+        """Test the admin endpoints need the admin key, not just any header."""
+        response = self.app.get('/api/admin/profiles', headers={'X-Admin-Key': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+
+    @patch('app.ADMIN_API_KEY', '')
+    def test_admin_endpoints_disabled_without_key(self):
+        """Test the admin endpoints are off when ADMIN_API_KEY is not configured."""
+        self.assertEqual(self.app.get('/api/admin/profiles').status_code, 403)
+
+    def test_ring_buffer_keeps_newest(self):
+        """Test only PROFILE_MAX_FILES profiles are kept, evicting the oldest."""
+        with patch.object(profiling, 'PROFILE_MAX_FILES', 2):
+            ids = [
+                self.app.get('/api/health?profile=1', headers=self.admin).headers['X-Profile-Id']
+                for _ in range(3)
+            ]
+        kept = [profile['id'] for profile in profiling.list_profiles()]
+        self.assertEqual(kept, [ids[2], ids[1]])
+        self.assertIsNone(profiling.get_profile_path(ids[0]))
+
+    @patch.object(profiling, 'PROFILE_SAMPLE_RATE', 1.0)
+    def test_sampling_profiles_without_admin(self):
+        """Test PROFILE_SAMPLE_RATE profiles requests nobody asked to profile."""
+        response = self.app.get('/api/health')
+        self.assertIn('X-Profile-Id', response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
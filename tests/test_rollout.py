@@ -0,0 +1,229 @@
+"""
+Tests for staged broadcast rollouts.
+"""
+
+import unittest
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch, MagicMock
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import broadcasts
+import circuit_breaker
+import jobs
+import rollout
+from app import app
+from circuit_breaker import CircuitOpenError
+
+
+class RolloutTestCase(unittest.TestCase):
+    """Test cases for wave partitioning and rollout jobs."""
+    
+    def setUp(self):
+        """Set up test client and an isolated job store."""
+        self.app = app.test_client()
+        self.app.testing = True
+        self.jobs_dir = tempfile.mkdtemp()
+        patcher = patch.object(jobs, 'JOBS_DIR', self.jobs_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.jobs_dir, True)
+    
+    def test_partition_is_disjoint_deterministic_and_proportional(self):
+        """Test waves never overlap, cover every token, and are repeatable."""
+        tokens = [f'token{i}' for i in range(20000)]
+        waves = rollout.partition(tokens, [1, 10, 50, 100], salt='job1')
+        
+        flattened = [token for wave in waves for token in wave]
+        self.assertEqual(len(flattened), len(tokens))
+        self.assertEqual(set(flattened), set(tokens))
+        self.assertEqual(waves, rollout.partition(tokens, [1, 10, 50, 100], salt='job1'))
+        # Cumulative 1% / 10% / 50% of 20k, within sampling noise
+        self.assertAlmostEqual(len(waves[0]), 200, delta=60)
+        self.assertAlmostEqual(len(waves[0]) + len(waves[1]), 2000, delta=200)
+    
+    def test_validate_plan(self):
+        """Test invalid wave plans are rejected."""
+        self.assertEqual(rollout.validate_plan({})['waves'], [1, 10, 50, 100])
+        for plan in ({'waves': [10, 5]}, {'waves': [50, 150]}, {'waves': []}, {'pause_seconds': -1}):
+            with self.assertRaises(ValueError):
+                rollout.validate_plan(plan)
+    
+    @patch('token_manager.get_all_tokens')
+    @patch('firebase_service.send_multicast_notification')
+    def test_run_rollout_sends_every_wave(self, mock_send_multicast, mock_get_tokens):
+        """Test a rollout job reaches every token once and records progress."""
+        tokens = [f'token{i}' for i in range(1500)]
+        mock_get_tokens.return_value = tokens
+        
+        def send(tokens, **kwargs):
+            response = MagicMock()
+            response.success_count = len(tokens)
+            response.failure_count = 0
+            return response
+        mock_send_multicast.side_effect = send
+        
+        job = jobs.create_job('rollout', {
+            'message': {'title': 'T', 'body': 'B'},
+            'plan': rollout.validate_plan({'waves': [10, 100]})
+        }, waves=[{'percent': p, 'status': jobs.PENDING, 'tokens': 0, 'sent': 0, 'failed': 0} for p in (10, 100)])
+        rollout.run_rollout(job['id'])
+        
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.COMPLETED)
+        self.assertEqual(job['sent'], 1500)
+        self.assertEqual([w['status'] for w in job['waves']], [jobs.COMPLETED, jobs.COMPLETED])
+        sent_tokens = [t for c in mock_send_multicast.call_args_list for t in c.kwargs['tokens']]
+        self.assertEqual(sorted(sent_tokens), sorted(tokens))
+    
+    @patch('token_manager.get_all_tokens')
+    @patch('firebase_service.send_multicast_notification')
+    def test_interrupted_rollout_resumes_at_its_cursor(self, mock_send_multicast, mock_get_tokens):
+        """Test a resume skips finished waves, sent batches and a batch in flight, and sends the rest."""
+        tokens = [f'token{i:05d}' for i in range(3000)]
+        mock_get_tokens.return_value = tokens
+        
+        def send(tokens, **kwargs):
+            response = MagicMock()
+            response.success_count = len(tokens)
+            response.failure_count = 0
+            return response
+        mock_send_multicast.side_effect = send
+        
+        with patch('rollout.jobs.start'):
+            job = rollout.start_rollout({'title': 'T', 'body': 'B'}, rollout.validate_plan({'waves': [10, 100]}))
+        # Stop during the second wave, after its first batch
+        with patch.object(rollout, 'shutdown') as mock_shutdown:
+            mock_shutdown.draining.return_value = False
+            mock_shutdown.should_stop_sending.side_effect = [False, False, True]
+            rollout.run_rollout(job['id'])
+        
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.INTERRUPTED)
+        self.assertEqual([w['status'] for w in job['waves']], [jobs.COMPLETED, jobs.INTERRUPTED])
+        first_wave, second_wave = rollout.partition(tokens, [10, 100], salt=job['id'])
+        self.assertEqual(job['waves'][1]['cursor'], sorted(second_wave)[499])
+        
+        # A crash while the next batch was being sent leaves it in flight
+        job['waves'][1]['in_flight'] = {'last_token': sorted(second_wave)[999], 'tokens': 500}
+        jobs.update_job(job['id'], waves=job['waves'])
+        finished = jobs.create_job('rollout', {}, status=jobs.COMPLETED)
+        self.assertEqual(self.app.post(f"/api/jobs/{finished['id']}/resume").status_code, 409)
+        response = self.app.post(f"/api/jobs/{job['id']}/resume")
+        self.assertEqual(response.status_code, 202)
+        jobs.join_running(5)
+        
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.COMPLETED)
+        self.assertEqual((job['sent'], job['unknown']), (len(tokens) - 500, 500))
+        sent_tokens = [t for c in mock_send_multicast.call_args_list for t in c.kwargs['tokens']]
+        self.assertEqual(len(sent_tokens), len(set(sent_tokens)))
+        self.assertEqual(set(sent_tokens), set(tokens) - set(sorted(second_wave)[500:1000]))
+        self.assertTrue(set(first_wave) <= set(sent_tokens))
+    
+    @patch.object(circuit_breaker, 'FALLBACK', 'outbox')
+    @patch('token_manager.get_all_tokens')
+    def test_open_breaker_interrupts_wave_at_its_cursor(self, mock_get_tokens):
+        """Test an open FCM breaker stops the rollout at the wave's cursor instead of queueing the rest."""
+        tokens = [f'token{i:05d}' for i in range(1500)]
+        mock_get_tokens.return_value = tokens
+        with patch('rollout.jobs.start'):
+            job = rollout.start_rollout({'title': 'T', 'body': 'B'}, rollout.validate_plan({'waves': [100]}))
+        with patch('firebase_service.send_multicast_notification',
+                   side_effect=[MagicMock(success_count=500, failure_count=0, responses=[]),
+                                CircuitOpenError("fcm", 5)]), \
+                patch('outbox.enqueue') as mock_enqueue:
+            rollout.run_rollout(job['id'])
+
+        job = jobs.get_job(job['id'])
+        mock_enqueue.assert_not_called()
+        wave = job['waves'][0]
+        self.assertEqual((job['status'], wave['status'], job['sent']), (jobs.INTERRUPTED, jobs.INTERRUPTED, 500))
+        self.assertEqual(wave['cursor'], sorted(tokens)[499])
+        self.assertIsNone(wave['in_flight'])
+        self.assertIn('fcm', job['error'])
+
+        sent = []
+        def send(tokens, **kwargs):
+            sent.extend(tokens)
+            return MagicMock(success_count=len(tokens), failure_count=0, responses=[])
+        with patch('firebase_service.send_multicast_notification', side_effect=send):
+            self.assertIsNotNone(rollout.resume(job['id']))
+            jobs.join_running(5)
+        job = jobs.get_job(job['id'])
+        self.assertEqual((job['status'], job['sent'], job['unknown']), (jobs.COMPLETED, 1500, 0))
+        self.assertEqual(sent, sorted(tokens)[500:])
+
+    @patch('token_manager.get_all_tokens')
+    def test_throttled_rollout_keeps_the_job_fresh(self, mock_get_tokens):
+        """Test a rollout sleeping out its send rate keeps touching the job, so it is not resumed twice."""
+        mock_get_tokens.return_value = [f'token{i}' for i in range(10)]
+        with patch('rollout.jobs.start'):
+            job = rollout.start_rollout(
+                {'title': 'T', 'body': 'B'}, rollout.validate_plan({'waves': [100], 'rate_per_second': 50})
+            )
+        with patch.object(broadcasts, 'HEARTBEAT_SECONDS', 0.02), \
+                patch('firebase_service.send_multicast_notification',
+                      return_value=MagicMock(success_count=10, failure_count=0, responses=[])):
+            jobs.start(jobs.get_job(job['id']), rollout.run_rollout)
+            seen = set()
+            deadline = time.monotonic() + 5
+            while len(seen) < 3 and time.monotonic() < deadline:
+                seen.add(jobs.get_job(job['id']).get('heartbeat_at'))
+            self.assertEqual(len(seen), 3)
+            self.assertEqual(jobs.join_running(timeout=5), 0)
+        self.assertEqual(jobs.get_job(job['id'])['status'], jobs.COMPLETED)
+
+    def test_cancel_survives_progress_from_another_worker(self):
+        """Test a cancel is not overwritten by another process writing the job's progress."""
+        job = jobs.create_job('rollout', {}, status=jobs.RUNNING)
+        
+        def write_progress():
+            # A slow disk: each write lands well after the job was read
+            write = jobs._write
+            jobs._write = lambda job: (time.sleep(0.02), write(job))
+            for i in range(1, 21):
+                jobs.update_job(job['id'], chunks_sent=i)
+        worker = multiprocessing.get_context('fork').Process(target=write_progress)
+        worker.start()
+        time.sleep(0.05)
+        jobs.request_cancel(job['id'])
+        # Once requested, the cancel must never be lost
+        while worker.is_alive():
+            self.assertTrue(jobs.cancel_requested(job['id']))
+        worker.join()
+        
+        self.assertTrue(jobs.cancel_requested(job['id']))
+        self.assertEqual(jobs.get_job(job['id'])['chunks_sent'], 20)
+    
+    @patch('rollout.jobs.start')
+    def test_broadcast_rollout_returns_job(self, mock_start):
+        """Test /api/broadcast with rollout returns 202 and a status endpoint."""
+        response = self.app.post(
+            '/api/broadcast',
+            data=json.dumps({
+                'title': 'Broadcast Title',
+                'body': 'Broadcast Body',
+                'rollout': {'waves': [1, 10, 100], 'pause_seconds': 60}
+            }),
+            content_type='application/json'
+        )
+        
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        mock_start.assert_called_once()
+        
+        response = self.app.get(data['status_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([w['percent'] for w in json.loads(response.data)['job']['waves']], [1, 10, 100])
+
+
+if __name__ == '__main__':
+    unittest.main()
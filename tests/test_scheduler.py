@@ -0,0 +1,200 @@
+"""
+Tests for scheduled notification delivery.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler
+from app import app
+
+
+def batch_response(count):
+    response = MagicMock()
+    response.success_count = count
+    response.failure_count = 0
+    return response
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """Test cases for the schedule store and timer engine."""
+    
+    def setUp(self):
+        """Give each test an empty schedule store and heap."""
+        self.schedule_dir = tempfile.mkdtemp()
+        for name, value in (('SCHEDULE_DIR', self.schedule_dir), ('_heap', []), ('_known', set())):
+            patcher = patch.object(scheduler, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.schedule_dir, True)
+    
+    def test_parse_time_of_day_in_timezone(self):
+        """Test "09:00" resolves to the next 09:00 in the given timezone."""
+        due = scheduler.parse_send_at("09:00", "Asia/Kuala_Lumpur")
+        local = due.astimezone(scheduler.ZoneInfo("Asia/Kuala_Lumpur"))
+        self.assertEqual((local.hour, local.minute), (9, 0))
+        self.assertGreater(due, datetime.now(timezone.utc))
+    
+    def test_parse_rejects_past_and_bad_values(self):
+        """Test invalid send_at values raise ValueError."""
+        with self.assertRaises(ValueError):
+            scheduler.parse_send_at("2001-01-01T00:00:00Z")
+        with self.assertRaises(ValueError):
+            scheduler.parse_send_at("tomorrow")
+        with self.assertRaises(ValueError):
+            scheduler.parse_send_at("09:00", "Mars/Olympus_Mons")
+    
+    @patch('token_manager.get_tokens_for_user')
+    @patch('firebase_service.send_multicast_notification')
+    def test_due_jobs_fire_in_order(self, mock_send_multicast, mock_get_tokens):
+        """Test only due jobs fire, and they leave the store once sent."""
+        mock_get_tokens.return_value = ['token1']
+        mock_send_multicast.return_value = batch_response(1)
+        now = datetime.now(timezone.utc)
+        payload = {'user_id': 'user123', 'title': 'T', 'body': 'B'}
+        
+        later = scheduler.schedule('send_to_user', payload, now + timedelta(hours=1))
+        scheduler.schedule('send_to_user', payload, now)
+        
+        self.assertEqual(scheduler.run_due(), 1)
+        self.assertEqual(scheduler.pending_count(), 1)
+        self.assertIsNotNone(scheduler.get_job(later['id']))
+        mock_send_multicast.assert_called_once()
+    
+    def test_reload_restores_heap_from_disk(self):
+        """Test jobs persisted by another process are loaded at startup."""
+        scheduler.schedule('broadcast', {'title': 'T', 'body': 'B'}, datetime.now(timezone.utc) + timedelta(minutes=5))
+        scheduler._heap.clear()
+        scheduler._known.clear()
+        
+        self.assertEqual(scheduler.reload(), 1)
+        self.assertEqual(len(scheduler._heap), 1)
+    
+    @patch.object(scheduler, 'SCHEDULE_STAGGER_THRESHOLD', 100)
+    @patch('token_manager.get_all_tokens')
+    @patch('firebase_service.send_multicast_notification')
+    def test_large_cohort_is_staggered(self, mock_send_multicast, mock_get_tokens):
+        """Test a large audience is split into chunk jobs across the spread window."""
+        mock_get_tokens.return_value = [f'token{i}' for i in range(1200)]
+        mock_send_multicast.side_effect = lambda tokens, **kwargs: batch_response(len(tokens))
+        now = datetime.now(timezone.utc)
+        
+        scheduler.schedule('broadcast', {'title': 'T', 'body': 'B'}, now, spread_seconds=60)
+        scheduler.run_due(now.timestamp())
+        
+        # Three 500-token chunks at +0s, +20s and +40s; the first is due immediately
+        self.assertEqual(scheduler.pending_count(), 3)
+        dues = sorted(job['due_ts'] for job in scheduler.list_jobs())
+        self.assertAlmostEqual(dues[2] - dues[0], 40, delta=1)
+        
+        scheduler.run_due(now.timestamp() + 60)
+        self.assertEqual(scheduler.pending_count(), 0)
+        self.assertEqual(sum(len(c.kwargs['tokens']) for c in mock_send_multicast.call_args_list), 1200)
+
+    
+    @patch.object(scheduler, 'SCHEDULE_STAGGER_THRESHOLD', 100)
+    @patch('token_manager.get_all_tokens')
+    @patch('firebase_service.send_multicast_notification')
+    def test_staggered_parent_rerun_does_not_duplicate_chunks(self, mock_send_multicast, mock_get_tokens):
+        """Test a parent re-run after dying mid-split writes only the chunks it had not written."""
+        mock_get_tokens.return_value = [f'token{i}' for i in range(1200)]
+        mock_send_multicast.side_effect = lambda tokens, **kwargs: batch_response(len(tokens))
+        now = datetime.now(timezone.utc)
+        parent = scheduler.schedule('broadcast', {'title': 'T', 'body': 'B'}, now, spread_seconds=60)
+        
+        class Crash(BaseException):
+            pass
+        
+        real_schedule = scheduler.schedule
+        
+        def schedule_then_crash(*args, **kwargs):
+            job = real_schedule(*args, **kwargs)
+            if job['id'].endswith('-1'):
+                # Dies after writing the second child, before recording it on the parent
+                raise Crash()
+            return job
+        
+        with patch.object(scheduler, 'schedule', side_effect=schedule_then_crash):
+            with self.assertRaises(Crash):
+                scheduler.run_due(now.timestamp())
+        
+        # A new process recovers the claimed parent and runs it again
+        scheduler._heap.clear()
+        scheduler._known.clear()
+        scheduler.reload(recover_claimed=True)
+        scheduler.run_due(now.timestamp())
+        
+        self.assertEqual(
+            sorted(job['id'] for job in scheduler.list_jobs()), [f"{parent['id']}-{i}" for i in range(3)]
+        )
+        scheduler.run_due(now.timestamp() + 60)
+        self.assertEqual(scheduler.pending_count(), 0)
+        self.assertEqual(sum(len(c.kwargs['tokens']) for c in mock_send_multicast.call_args_list), 1200)
+
+
+class ScheduledSendAPITestCase(unittest.TestCase):
+    """Test cases for send_at on the send endpoints."""
+    
+    def setUp(self):
+        """Set up test client and an isolated schedule store."""
+        self.app = app.test_client()
+        self.app.testing = True
+        self.schedule_dir = tempfile.mkdtemp()
+        for name, value in (('SCHEDULE_DIR', self.schedule_dir), ('_heap', []), ('_known', set())):
+            patcher = patch.object(scheduler, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.schedule_dir, True)
+    
+    @patch('token_manager.get_tokens_for_app')
+    def test_send_at_schedules_and_can_be_cancelled(self, mock_get_tokens):
+        """Test send_at returns 202 with a job id and nothing is sent yet."""
+        response = self.app.post(
+            '/api/send-to-app',
+            data=json.dumps({
+                'app_id': 'test-app',
+                'title': 'Test Title',
+                'body': 'Test Body',
+                'send_at': '09:00',
+                'timezone': 'Europe/London'
+            }),
+            content_type='application/json'
+        )
+        
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.data)['job_id']
+        mock_get_tokens.assert_not_called()
+        
+        response = self.app.get(f'/api/scheduled/{job_id}')
+        self.assertEqual(json.loads(response.data)['job']['kind'], 'send_to_app')
+        
+        response = self.app.delete(f'/api/scheduled/{job_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.get(f'/api/scheduled/{job_id}').status_code, 404)
+    
+    def test_invalid_send_at(self):
+        """Test an unparseable send_at is a 400."""
+        response = self.app.post(
+            '/api/broadcast',
+            data=json.dumps({
+                'title': 'Broadcast Title',
+                'body': 'Broadcast Body',
+                'send_at': 'soon'
+            }),
+            content_type='application/json'
+        )
+        
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
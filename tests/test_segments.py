@@ -0,0 +1,164 @@
+"""
+Tests for audience segments: parsing, query planning and segmented sends.
+"""
+
+import unittest
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import segments
+import token_manager
+from benchmarks import fakes
+from app import app
+
+DEVICES = [('android', 'chrome')] * 6 + [('ios', 'safari')] * 3 + [('web', 'firefox')]
+
+
+def seed_devices(db, count, app_id='trading-app', seed=0):
+    """Register count tokens with a mix of devices, active at some point in the last 30 days."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    docs = {}
+    for i in range(count):
+        token = f"token-{rng.getrandbits(64):016x}"
+        device_type, platform = rng.choice(DEVICES)
+        docs[token] = {
+            "token": token, "app_id": app_id, "user_id": f"user-{i % 50}", "device_type": device_type,
+            "platform": platform, "last_active": now - timedelta(days=rng.uniform(0, 30))
+        }
+    db.load(token_manager.COLLECTION_NAME, docs)
+    return docs
+
+
+def matching(docs, filters, user_id=None):
+    return sorted(
+        token for token, data in docs.items()
+        if all(f.matches(data) for f in filters) and (user_id is None or data["user_id"] == user_id)
+    )
+
+
+class SegmentParseTestCase(unittest.TestCase):
+    """Test cases for validating posted segments."""
+
+    def test_parse(self):
+        """Test values and relative bounds are parsed, and malformed segments rejected."""
+        filters = segments.parse({'device_type': 'android', 'last_active': {'since': '7d'}}, now=1000000)
+        self.assertEqual([f.field for f in filters], ['device_type', 'last_active'])
+        self.assertEqual(filters[0].values, ['android'])
+        self.assertEqual(filters[1].since, 1000000 - 7 * 86400)
+
+        for spec in (
+            'android', {}, {'os': 'android'}, {'device_type': []}, {'platform': [1]},
+            {'device_type': [f'd{i}' for i in range(31)]}, {'last_active': '7d'},
+            {'last_active': {'since': 'last week'}}, {'last_active': {'since': '1d', 'until': '7d'}}
+        ):
+            with self.assertRaises(ValueError, msg=spec):
+                segments.parse(spec)
+
+
+class SegmentPlannerTestCase(unittest.TestCase):
+    """Test cases for choosing an index and reading a segment's tokens."""
+
+    def setUp(self):
+        self.db = fakes.FakeFirestore()
+        self.docs = seed_devices(self.db, 3000)
+        seed_devices(self.db, 500, app_id='news-app', seed=1)
+        self.addCleanup(fakes.install(self.db, fakes.FakeFCM()))
+        segments.clear_statistics()
+        self.addCleanup(segments.clear_statistics)
+
+    def find(self, spec, user_id=None):
+        filters = segments.parse(spec)
+        before = self.db.documents_read
+        tokens, report = segments.find_tokens('trading-app', filters, user_id=user_id)
+        self.assertEqual(sorted(tokens), matching(self.docs, filters, user_id))
+        return report, self.db.documents_read - before
+
+    def test_picks_the_most_selective_index(self):
+        """Test the planner reads through the narrowest index and its estimates track the actual reads."""
+        report, billed = self.find({'device_type': 'android', 'last_active': {'since': '3d'}})
+
+        self.assertEqual(report['index'], 'last_active')
+        self.assertEqual(set(report['candidates']), {'app_id', 'device_type', 'last_active'})
+        self.assertEqual(report['candidates']['app_id'], 3000)
+        self.assertLess(report['candidates']['last_active'], report['candidates']['device_type'])
+        self.assertEqual(report['memory_filters'], ['device_type in [\'android\']'])
+        self.assertAlmostEqual(report['estimated_reads'], report['actual_reads'], delta=100)
+        self.assertAlmostEqual(report['estimated_matches'], report['matched'], delta=60)
+        # Sampling 1000 documents and counting 3000 index entries, then the query itself
+        self.assertEqual(report['statistics']['reads'], 1000 + 3)
+        self.assertEqual(billed, report['statistics']['reads'] + report['actual_reads'])
+
+        report, billed = self.find({'device_type': ['web'], 'platform': ['firefox', 'safari']})
+        self.assertEqual(report['index'], 'device_type')
+        self.assertEqual(report['statistics']['reads'], 0)
+        self.assertEqual(billed, report['actual_reads'])
+
+    def test_unindexed_and_unselective_filters_run_in_memory(self):
+        """Test filters without an index, or as broad as the app, read the app's tokens and filter in memory."""
+        with patch.object(segments, 'SEGMENT_INDEXES', ('device_type',)):
+            report, _ = self.find({'platform': 'chrome', 'last_active': {'until': '1d'}})
+        self.assertEqual((report['index'], report['actual_reads']), ('app_id', 3000))
+        self.assertEqual(len(report['memory_filters']), 2)
+
+        report, _ = self.find({'last_active': {'since': '60d'}})
+        self.assertEqual(report['index'], 'app_id')
+
+    def test_one_users_devices_are_filtered_in_memory(self):
+        """Test a send limited to a user reads that user's devices without sampling the app."""
+        report, billed = self.find({'device_type': 'ios'}, user_id='user-7')
+        self.assertEqual(report['index'], 'user_id')
+        self.assertIsNone(report['estimated_reads'])
+        self.assertEqual(billed, report['actual_reads'])
+        self.assertEqual(report['actual_reads'], 60)
+
+
+class SegmentSendTestCase(unittest.TestCase):
+    """Test cases for segmented sends over HTTP."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        self.db = fakes.FakeFirestore()
+        self.docs = seed_devices(self.db, 400)
+        self.fcm = fakes.FakeFCM()
+        self.addCleanup(fakes.install(self.db, self.fcm))
+        segments.clear_statistics()
+        self.addCleanup(segments.clear_statistics)
+
+    def post(self, body):
+        response = self.app.post('/api/send-to-app', data=json.dumps(body), content_type='application/json')
+        return response.status_code, response.get_json()
+
+    def test_send_to_segment(self):
+        """Test only the segment's devices are sent to and the plan is reported."""
+        segment = {'device_type': 'android', 'last_active': {'since': '7d'}}
+        status, body = self.post({'app_id': 'trading-app', 'title': 'T', 'body': 'B', 'segment': segment})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(body['tokens']), matching(self.docs, segments.parse(segment)))
+        self.assertEqual(self.fcm.messages, len(body['tokens']))
+        self.assertEqual(body['segment']['index'], 'last_active')
+        self.assertEqual(body['segment']['matched'], body['sent_to'])
+
+        status, body = self.post(
+            {'app_id': 'trading-app', 'title': 'T', 'body': 'B', 'segment': {'device_type': 'tv'}}
+        )
+        self.assertEqual((status, body['sent_to'], body['segment']['actual_reads']), (200, 0, 0))
+
+    def test_invalid_segment(self):
+        """Test a malformed segment is rejected before anything is read."""
+        status, body = self.post({'app_id': 'trading-app', 'title': 'T', 'body': 'B', 'segment': {'os': 'ios'}})
+        self.assertEqual(status, 400)
+        self.assertIn('os', body['error'])
+        self.assertEqual(self.db.documents_read, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
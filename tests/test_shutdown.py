@@ -0,0 +1,138 @@
+"""
+Tests for graceful shutdown: refusing new sends and checkpointing unsent chunks.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fanout
+import jobs
+import rollout
+import scheduler
+import shutdown
+from app import app
+
+
+def batch(tokens):
+    return MagicMock(success_count=len(tokens), failure_count=0, responses=[])
+
+
+class ShutdownTestCase(unittest.TestCase):
+    """Test cases for draining a worker."""
+
+    def setUp(self):
+        """Give each test a fresh drain state and isolated schedule and job stores."""
+        self.app = app.test_client()
+        self.app.testing = True
+        self.data_dir = tempfile.mkdtemp()
+        for target, name, value in (
+            (shutdown, '_draining', threading.Event()),
+            (scheduler, 'SCHEDULE_DIR', os.path.join(self.data_dir, 'schedule')),
+            (scheduler, '_heap', []),
+            (scheduler, '_known', set()),
+            (jobs, 'JOBS_DIR', os.path.join(self.data_dir, 'jobs'))
+        ):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+
+    @patch('firebase_service.send_multicast_notification')
+    def test_keeps_sending_while_deadline_allows(self, mock_send):
+        """Test a fan-out far from the drain deadline sends every chunk."""
+        mock_send.side_effect = lambda tokens, **kwargs: batch(tokens)
+        shutdown.begin(drain_seconds=60)
+
+        result = fanout.deliver([f"token{i}" for i in range(1200)], 'Title', 'Body', app_id='test-app')
+
+        self.assertEqual(result['sent_to'], 1200)
+        self.assertEqual(result['queued'], 0)
+        self.assertEqual(scheduler.list_jobs(), [])
+
+    @patch('firebase_service.send_multicast_notification')
+    def test_checkpoints_unsent_chunks_near_deadline(self, mock_send):
+        """Test chunks not started before the deadline become a scheduled delivery."""
+        def send(tokens, **kwargs):
+            # SIGTERM arrives while the first chunk is with FCM
+            shutdown.begin(drain_seconds=0)
+            return batch(tokens)
+        mock_send.side_effect = send
+        tokens = [f"token{i}" for i in range(1200)]
+
+        result = fanout.deliver(tokens, 'Title', 'Body', app_id='test-app', data={'k': 'v'})
+
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(result['sent_to'], 500)
+        self.assertEqual(result['queued'], 700)
+        checkpoint = scheduler.get_job(result['checkpoint_id'])
+        self.assertEqual(checkpoint['kind'], 'deliver')
+        self.assertEqual(checkpoint['payload']['tokens'], tokens[500:])
+        self.assertEqual(checkpoint['payload']['data'], {'k': 'v'})
+        self.assertEqual(checkpoint['spread_seconds'], 0)
+
+    def test_refuses_new_sends_while_draining(self):
+        """Test send endpoints get 503 with Retry-After and readiness fails."""
+        shutdown.begin()
+
+        response = self.app.post(
+            '/api/send-to-app',
+            data=json.dumps({'app_id': 'test-app', 'title': 'Title', 'body': 'Body'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], str(shutdown.SHUTDOWN_RETRY_AFTER))
+        self.assertEqual(self.app.get('/api/ready').status_code, 503)
+        self.assertTrue(self.app.get('/api/health').get_json()['shutting_down'])
+
+    @patch('firebase_service.send_multicast_notification')
+    @patch('token_manager.get_all_tokens')
+    def test_rollout_interrupted_between_batches(self, mock_get_tokens, mock_send):
+        """Test a rollout stops without starting the next wave and records where it stopped."""
+        mock_get_tokens.return_value = [f"token{i}" for i in range(2000)]
+        job = jobs.create_job("rollout", {
+            "message": {"title": "Title", "body": "Body"},
+            "plan": rollout.validate_plan({"waves": [10, 100]})
+        }, waves=[
+            {"percent": wave, "status": jobs.PENDING, "tokens": 0, "sent": 0, "failed": 0, "chunks_sent": 0}
+            for wave in (10, 100)
+        ], sent=0, failed=0)
+
+        def stop_after_first_wave(tokens, **kwargs):
+            shutdown.begin(drain_seconds=0)
+            return batch(tokens)
+        mock_send.side_effect = stop_after_first_wave
+
+        rollout.run_rollout(job['id'])
+
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.INTERRUPTED)
+        self.assertEqual(job['waves'][0]['chunks_sent'], 1)
+        self.assertEqual(job['waves'][1]['status'], jobs.PENDING)
+        self.assertEqual(mock_send.call_count, 1)
+
+    @patch('logging_config.flush_logging')
+    @patch('scheduler.stop')
+    def test_finish_waits_for_jobs_and_flushes_logs(self, mock_stop, mock_flush):
+        """Test the exit step stops the scheduler, waits for job threads and flushes logs."""
+        release = threading.Event()
+        job = jobs.create_job("test", {})
+        jobs.start(job, lambda job_id: release.wait(5))
+        threading.Timer(0.05, release.set).start()
+
+        shutdown.finish()
+
+        mock_stop.assert_called_once()
+        mock_flush.assert_called_once()
+        self.assertEqual(jobs.join_running(timeout=0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Startup-time benchmark: import cost and time to the first health response.
+
+Each measurement runs in a fresh interpreter so nothing imported by other
+tests skews it. Budgets can be tuned per machine with
+STARTUP_IMPORT_BUDGET_SECONDS and STARTUP_HEALTH_BUDGET_SECONDS.
+"""
+
+import unittest
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['firebase_admin', 'google.cloud.firestore', 'grpc', 'google.protobuf']
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/api/health')
+healthy = time.perf_counter()
+loaded_after_health = [m for m in %(heavy)r if m in sys.modules]
+import token_manager
+token_manager.preimport_sdk()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "first_health_seconds": healthy - start,
+    "health_status": response.status_code,
+    "loaded_after_health": loaded_after_health,
+    "loaded_after_preimport": [m for m in %(heavy)r if m in sys.modules]
+}))
+""" % {"heavy": HEAVY_MODULES}
+
+
+def measure_startup():
+    env = dict(os.environ, SCHEDULER_ENABLED='false')
+    output = subprocess.run(
+        [sys.executable, '-c', MEASURE],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class StartupBenchmarkTestCase(unittest.TestCase):
+    """Track cold-start cost of the web app."""
+    
+    @classmethod
+    def setUpClass(cls):
+        """Measure once in a fresh interpreter."""
+        cls.result = measure_startup()
+        print(
+            f"\nstartup: import {cls.result['import_seconds'] * 1000:.0f} ms, "
+            f"first /api/health {cls.result['first_health_seconds'] * 1000:.0f} ms"
+        )
+    
+    def test_heavy_sdk_not_imported_before_first_use(self):
+        """Test answering /api/health does not import the Firebase/gRPC stack."""
+        self.assertEqual(self.result['health_status'], 200)
+        self.assertEqual(self.result['loaded_after_health'], [])
+    
+    def test_preimport_loads_sdk(self):
+        """Test the warm-up pre-import brings in the SDK modules."""
+        self.assertEqual(sorted(self.result['loaded_after_preimport']), sorted(HEAVY_MODULES))
+    
+    def test_startup_within_budget(self):
+        """Test import and first health response stay within budget."""
+        import_budget = float(os.getenv('STARTUP_IMPORT_BUDGET_SECONDS', '1.0'))
+        health_budget = float(os.getenv('STARTUP_HEALTH_BUDGET_SECONDS', '1.5'))
+        self.assertLess(self.result['import_seconds'], import_budget)
+        self.assertLess(self.result['first_health_seconds'], health_budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+Tests for notification templates: compilation, locale variants and templated sends.
+"""
+
+import unittest
+import json
+import os
+import sys
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+import firebase_service
+import templates
+import token_manager
+from benchmarks import fakes
+from app import app
+
+PRICE_ALERT = {
+    'title': '{{symbol}} is up {{ change }}%',
+    'body': 'Hi {{first_name|there}}, your alert at {price} fired: {{price}}',
+    'locales': {
+        'fr': {'body': 'Bonjour {{first_name|}}, alerte à {{price}}'},
+        'pt-BR': {'title': '{{symbol}} subiu {{change}}%'}
+    }
+}
+
+
+class TemplateTestCase(unittest.TestCase):
+    """Test cases for compiling and rendering templates."""
+
+    def setUp(self):
+        self.template = templates.Template('trading-app', 'price-alert', templates.validate('price-alert', PRICE_ALERT))
+
+    def test_render(self):
+        """Test placeholders, fallbacks and literal braces, and that a missing variable fails."""
+        self.assertEqual(
+            self.template.render({'symbol': 'AAPL', 'change': 3.5, 'price': '$190'}),
+            ('AAPL is up 3.5%', 'Hi there, your alert at {price} fired: $190')
+        )
+        self.assertEqual(
+            self.template.render({'symbol': 'AAPL', 'change': 1, 'price': '$1', 'first_name': 'Ann'})[1],
+            'Hi Ann, your alert at {price} fired: $1'
+        )
+        with self.assertRaises(templates.MissingVariable) as raised:
+            self.template.render({'symbol': 'AAPL', 'price': '$190'})
+        self.assertEqual(str(raised.exception), 'Missing template variable: change')
+        self.assertEqual(self.template.variables, ['symbol', 'change', 'first_name', 'price'])
+
+    def test_locale_variants(self):
+        """Test a locale falls back to its language, and unknown locales and missing texts to the default."""
+        variables = {'symbol': 'AAPL', 'change': 2, 'price': '€5'}
+        self.assertEqual(self.template.render(variables, 'fr_FR'), ('AAPL is up 2%', 'Bonjour , alerte à €5'))
+        self.assertEqual(self.template.render(variables, 'pt-br')[0], 'AAPL subiu 2%')
+        self.assertEqual(self.template.render(variables, 'pt')[0], 'AAPL is up 2%')
+        self.assertEqual(self.template.render(variables, 'de'), self.template.render(variables))
+
+    def test_validate(self):
+        """Test malformed placeholders, missing texts and bad ids are rejected when stored."""
+        for template_id, spec in (
+            ('a', {'title': 'Hi {{name', 'body': 'b'}),
+            ('a', {'title': 'Hi {{ first name }}', 'body': 'b'}),
+            ('a', {'title': 't'}),
+            ('a', {'title': 't', 'body': 'b', 'locales': {'fr': {'subtitle': 's'}}}),
+            ('a/b', {'title': 't', 'body': 'b'})
+        ):
+            with self.assertRaises(ValueError, msg=spec):
+                templates.validate(template_id, spec)
+
+
+class TemplateSendTestCase(unittest.TestCase):
+    """Test cases for storing templates and sending them over HTTP."""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        self.db = fakes.FakeFirestore()
+        self.addCleanup(fakes.install(self.db, fakes.FakeFCM()))
+        patcher = patch.object(app_module, 'ADMIN_API_KEY', 'admin-secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for i, user_id in enumerate(['alice', 'alice', 'bob']):
+            token_manager.save_token(f'device-{i}', 'weather-app', user_id)
+        token_manager.save_token('device-other-app', 'news-app', 'bob')
+
+        self.sent = []
+        send_each = firebase_service.messaging.send_each
+
+        def capture(messages, **kwargs):
+            self.sent.extend(messages)
+            return send_each(messages, **kwargs)
+        patcher = patch.object(firebase_service.messaging, 'send_each', capture)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def put(self, template_id, spec):
+        return self.app.put(
+            f'/api/apps/weather-app/templates/{template_id}', data=json.dumps(spec),
+            content_type='application/json', headers={'X-Admin-Key': 'admin-secret'}
+        )
+
+    def send(self, recipients, template_id='rain'):
+        response = self.app.post('/api/send-template', data=json.dumps({
+            'app_id': 'weather-app', 'template_id': template_id, 'recipients': recipients, 'data': {'kind': 'rain'}
+        }), content_type='application/json')
+        return response.status_code, response.get_json()
+
+    def rendered(self):
+        return sorted((m.token, m.notification.title, m.notification.body) for m in self.sent)
+
+    def test_store_and_send(self):
+        """Test each recipient gets their own rendering, users on every device, with the app's title prefix."""
+        self.assertEqual(self.put('rain', {'title': 'Rain in {{city}}', 'body': '{{name|Hi}}, take an umbrella'}).status_code, 201)
+        self.assertEqual(self.app.get('/api/apps/weather-app/templates/rain').get_json()['variables'], ['city', 'name'])
+
+        status, body = self.send([
+            {'user_id': 'alice', 'variables': {'city': 'Oslo', 'name': 'Alice'}},
+            {'token': 'device-2', 'variables': {'city': 'Bergen'}},
+            {'user_id': 'carol', 'variables': {'city': 'Paris'}},
+            {'token': 'device-x', 'variables': {}},
+            {'variables': {'city': 'Rome'}}
+        ])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            (body['recipients'], body['rendered'], body['rejected'], body['no_devices'], body['messages']),
+            (5, 3, 2, 1, 3)
+        )
+        self.assertEqual([r['index'] for r in body['rejections']], [3, 4])
+        self.assertEqual(body['sent_to'], 3)
+        self.assertEqual(self.rendered(), [
+            ('device-0', '🌤️ Rain in Oslo', 'Alice, take an umbrella'),
+            ('device-1', '🌤️ Rain in Oslo', 'Alice, take an umbrella'),
+            ('device-2', '🌤️ Rain in Bergen', 'Hi, take an umbrella')
+        ])
+        self.assertEqual(self.sent[0].data, {'kind': 'rain'})
+
+    def test_replaced_template_is_used_and_ndjson_is_accepted(self):
+        """Test replacing a template takes effect at once, and recipients can be streamed as NDJSON."""
+        self.put('rain', {'title': 'Rain', 'body': 'Old'})
+        self.send([{'token': 'device-0'}])
+        self.assertEqual(self.put('rain', {'title': 'Rain', 'body': 'New {{n}}'}).status_code, 200)
+
+        lines = [{'app_id': 'weather-app', 'template_id': 'rain'}, {'token': 'device-0', 'variables': {'n': 1}}]
+        response = self.app.post(
+            '/api/send-template', data='\n'.join(json.dumps(line) for line in lines),
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m.notification.body for m in self.sent], ['Old', 'New 1'])
+
+    def test_errors(self):
+        """Test unknown templates, empty recipients, invalid templates and non-admin writes are refused."""
+        self.assertEqual(self.send([{'token': 'device-0'}], template_id='missing')[0], 404)
+        self.put('rain', {'title': 'Rain', 'body': 'B'})
+        self.assertEqual(self.send([])[0], 400)
+        self.assertEqual(self.put('rain', {'title': 'Rain {{', 'body': 'B'}).status_code, 400)
+        response = self.app.put(
+            '/api/apps/weather-app/templates/rain', data=json.dumps({'title': 'T', 'body': 'B'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.app.delete(
+            '/api/apps/weather-app/templates/rain', headers={'X-Admin-Key': 'admin-secret'}
+        ).status_code, 200)
+        self.assertEqual(self.send([{'token': 'device-0'}])[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"""
+Tests for token_manager query coalescing, client lifecycle and the per-user token index.
+"""
+
+import unittest
+import os
+import threading
+import time
+from unittest.mock import patch, MagicMock
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+import firebase_service
+import token_manager
+from benchmarks import fakes
+from app import app
+
+
+class CoalescingTestCase(unittest.TestCase):
+    """Test cases for singleflight audience queries."""
+    
+    def setUp(self):
+        """Reset coalescing counters."""
+        patcher = patch.dict(token_manager._coalescing_stats, {"queries": 0, "coalesced": 0, "documents_saved": 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    @patch('token_manager.get_firestore_client')
+    @patch('token_manager._stream_tokens')
+    def test_concurrent_callers_share_one_query(self, mock_stream, mock_client):
+        """Test concurrent identical audience queries hit Firestore once."""
+        release = threading.Event()
+        
+        def slow_stream(query, *args, **kwargs):
+            release.wait(5)
+            return ['token1', 'token2']
+        mock_stream.side_effect = slow_stream
+        
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(token_manager.get_tokens_for_app('test-app')))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        # Let every caller join the in-flight query before it completes
+        deadline = time.monotonic() + 5
+        while token_manager.get_coalescing_stats()["coalesced"] < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(mock_stream.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(sorted(r) == ['token1', 'token2'] for r in results))
+        stats = token_manager.get_coalescing_stats()
+        self.assertEqual(stats["queries"], 1)
+        self.assertEqual(stats["coalesced"], 4)
+        self.assertEqual(stats["documents_saved"], 8)
+        self.assertEqual(stats["in_flight"], 0)
+    
+    @patch('token_manager.get_firestore_client')
+    @patch('token_manager._stream_tokens')
+    def test_different_audiences_are_not_coalesced(self, mock_stream, mock_client):
+        """Test different (app_id, user_id) keys run their own queries."""
+        mock_stream.return_value = ['token1']
+        token_manager.get_tokens_for_app('test-app')
+        token_manager.get_tokens_for_app('test-app', user_id='user123')
+        token_manager.get_tokens_for_user('user123', app_id='test-app')
+        self.assertEqual(mock_stream.call_count, 3)
+    
+    @patch('token_manager.get_firestore_client')
+    @patch('token_manager._stream_tokens')
+    def test_callers_with_different_limits_share_one_query(self, mock_stream, mock_client):
+        """Test each caller's limit is applied to one shared query."""
+        release = threading.Event()
+        
+        def slow_stream(query, *args, **kwargs):
+            release.wait(5)
+            return ['token1', 'token2', 'token3']
+        mock_stream.side_effect = slow_stream
+        
+        results = {}
+        
+        def call(limit):
+            try:
+                results[limit] = token_manager.get_tokens_for_app('test-app', limit=limit)
+            except admission.AdmissionRejected as e:
+                results[limit] = e
+        
+        threads = [threading.Thread(target=call, args=(limit,)) for limit in (2, 3, 10)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while token_manager.get_coalescing_stats()["coalesced"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(mock_stream.call_count, 1)
+        self.assertEqual(mock_stream.call_args.kwargs["limit"], admission.TOKENS.limit)
+        self.assertIsInstance(results[2], admission.AdmissionRejected)
+        self.assertEqual(sorted(results[3]), ['token1', 'token2', 'token3'])
+        self.assertEqual(sorted(results[10]), ['token1', 'token2', 'token3'])
+    
+    def test_unlimited_caller_requeries_when_shared_result_was_cut_short(self):
+        """Test a caller with no limit does not take a result truncated at the leader's limit."""
+        release = threading.Event()
+        
+        def limited():
+            release.wait(5)
+            return ['token1', 'token2', 'token3']
+        
+        leader = threading.Thread(target=token_manager._coalesce, args=(("app", "x", None), limited, 2))
+        leader.start()
+        deadline = time.monotonic() + 5
+        while token_manager.get_coalescing_stats()["in_flight"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        
+        full = ['token%d' % i for i in range(10)]
+        follower = []
+        thread = threading.Thread(target=lambda: follower.append(token_manager._coalesce(("app", "x", None), lambda: full)))
+        thread.start()
+        while token_manager.get_coalescing_stats()["coalesced"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        leader.join()
+        thread.join()
+        
+        self.assertEqual(follower, [full])
+    
+    def test_errors_propagate_to_waiters(self):
+        """Test a failed query raises in the caller and clears the in-flight slot."""
+        def failing():
+            raise RuntimeError("firestore down")
+        
+        with self.assertRaises(RuntimeError):
+            token_manager._coalesce(("app", "x", None), failing)
+        self.assertEqual(token_manager.get_coalescing_stats()["in_flight"], 0)
+
+
+
+class ClientLifecycleTestCase(unittest.TestCase):
+    """Test cases for one-time Firebase init, client caching and readiness."""
+    
+    def setUp(self):
+        """Start each test with no initialized app or client."""
+        patcher = patch.object(firebase_service, '_firebase_app', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(token_manager.set_firestore_client, None)
+        token_manager.set_firestore_client(None)
+    
+    @patch('firebase_service._load_credentials')
+    @patch('firebase_admin.initialize_app')
+    def test_concurrent_init_runs_once(self, mock_initialize_app, mock_load_credentials):
+        """Test racing threads initialize the Firebase app exactly once."""
+        def slow_init(*args, **kwargs):
+            time.sleep(0.05)
+            return MagicMock()
+        mock_initialize_app.side_effect = slow_init
+        
+        threads = [threading.Thread(target=firebase_service.initialize_firebase) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(mock_initialize_app.call_count, 1)
+    
+    @patch('token_manager.initialize_firebase')
+    @patch('firebase_admin.firestore.client')
+    def test_client_is_cached(self, mock_client, mock_initialize):
+        """Test the Firestore client is created once and reused."""
+        first = token_manager.get_firestore_client()
+        second = token_manager.get_firestore_client()
+        self.assertIs(first, second)
+        mock_client.assert_called_once()
+    
+    def test_readiness_follows_warm_up(self):
+        """Test /api/ready is 503 until warm-up succeeds, then 200."""
+        client = app.test_client()
+        db = MagicMock()
+        db.collection.return_value.limit.return_value.get.side_effect = RuntimeError("unavailable")
+        token_manager.set_firestore_client(db)
+        
+        self.assertEqual(client.get('/api/ready').status_code, 503)
+        
+        db.collection.return_value.limit.return_value.get.side_effect = None
+        self.assertEqual(client.get('/api/ready').status_code, 200)
+        self.assertTrue(token_manager.is_ready())
+
+
+class UserIndexTestCase(unittest.TestCase):
+    """Test cases for the per-user token index documents."""
+    
+    def setUp(self):
+        self.db = fakes.FakeFirestore()
+        self.addCleanup(fakes.install(self.db, fakes.FakeFCM()))
+    
+    def index(self, user_id):
+        doc = self.db.collection(token_manager.USER_INDEX_COLLECTION).document(user_id).get()
+        return doc.to_dict()['apps'] if doc.exists else None
+    
+    def lookup(self, user_id, app_id=None):
+        """Look a user up through the index, checking it costs one read and agrees with a query."""
+        before = self.db.documents_read
+        tokens = token_manager.get_tokens_for_user(user_id, app_id=app_id)
+        self.assertEqual(self.db.documents_read - before, 1)
+        self.assertEqual(sorted(tokens), sorted(token_manager.query_user_tokens(user_id, app_id)))
+        return sorted(tokens)
+    
+    def test_save_and_delete_keep_the_index(self):
+        """Test registrations, moves between users and apps, and deletes are reflected in the index."""
+        token_manager.save_token('phone', 'trading-app', 'alice')
+        token_manager.save_token('laptop', 'trading-app', 'alice')
+        token_manager.save_token('tablet', 'news-app', 'alice')
+        self.assertEqual(self.index('alice'), {'trading-app': ['phone', 'laptop'], 'news-app': ['tablet']})
+        self.assertEqual(self.lookup('alice'), ['laptop', 'phone', 'tablet'])
+        self.assertEqual(self.lookup('alice', 'news-app'), ['tablet'])
+        
+        # Re-registering without a user keeps the token's user; a new user or app moves it
+        token_manager.save_token('phone', 'trading-app')
+        token_manager.save_token('laptop', 'trading-app', 'bob')
+        token_manager.save_token('tablet', 'trading-app', 'alice')
+        self.assertEqual(self.index('alice'), {'trading-app': ['phone', 'tablet']})
+        self.assertEqual(self.index('bob'), {'trading-app': ['laptop']})
+        
+        self.assertTrue(token_manager.delete_token('phone'))
+        self.assertTrue(token_manager.delete_token('tablet'))
+        self.assertFalse(token_manager.delete_token('phone'))
+        self.assertEqual(self.index('alice'), {})
+        self.assertEqual(self.lookup('alice'), [])
+    
+    def test_missing_index_falls_back_and_is_built(self):
+        """Test users from before the index are queried, and get an index on their next registration."""
+        self.db.load(token_manager.COLLECTION_NAME, {
+            'old-phone': {'token': 'old-phone', 'app_id': 'trading-app', 'user_id': 'carol'},
+            'old-laptop': {'token': 'old-laptop', 'app_id': 'trading-app', 'user_id': 'carol'}
+        })
+        self.assertEqual(sorted(token_manager.get_tokens_for_user('carol')), ['old-laptop', 'old-phone'])
+        
+        token_manager.delete_token('old-laptop')
+        self.assertIsNone(self.index('carol'))
+        token_manager.save_token('new-phone', 'trading-app', 'carol')
+        self.assertEqual(self.index('carol'), {'trading-app': ['old-phone', 'new-phone']})
+        self.assertEqual(self.lookup('carol'), ['new-phone', 'old-phone'])
+    
+    def test_large_users_are_unindexed_until_rebuilt(self):
+        """Test a user over the limit is looked up by query, and a rebuild indexes them again."""
+        with patch.object(token_manager, 'USER_INDEX_MAX_TOKENS', 2):
+            for i in range(3):
+                token_manager.save_token(f'device-{i}', 'trading-app', 'dave')
+            self.assertIsNone(token_manager.lookup_user_index('dave'))
+            self.assertEqual(len(token_manager.get_tokens_for_user('dave')), 3)
+            
+            token_manager.delete_token('device-0')
+            self.assertIsNone(token_manager.lookup_user_index('dave'))
+            self.assertEqual(token_manager.rebuild_user_index('dave'), 2)
+            self.assertEqual(self.lookup('dave'), ['device-1', 'device-2'])
+    
+    def test_concurrent_registrations_are_not_lost(self):
+        """Test racing registrations for one user all end up in their index."""
+        self.db.latency = 0.001
+        # Each conflict means another registration committed, so five fit in the five transaction attempts
+        threads = [
+            threading.Thread(target=token_manager.save_token, args=(f'device-{i}', 'trading-app', 'erin'))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(self.index('erin')['trading-app']), [f'device-{i}' for i in range(5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
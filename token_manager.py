@@ -1,24 +1,257 @@
 """
 Token CRUD operations in Firestore for managing FCM device tokens.
+
+The Firestore client library (gRPC, protobuf) is imported when the client is
+first created, not at module import.
+
+Besides device_tokens, each user has an index document in user_tokens
+listing their tokens by app, so a user lookup is one document read instead
+of a query. save_token and delete_token update it in the same transaction as
+the token. A user whose index document is missing (not yet backfilled, see
+rebuild_user_index.py) or who has too many tokens to list is looked up with a
+query instead.
 """
 
+import os
 import logging
-from typing import Optional, List, Dict, Any
+import threading
+from typing import Optional, List, Dict, Any, Callable, Hashable, Tuple
 from datetime import datetime
-import firebase_admin
-from firebase_admin import firestore
-from firebase_service import initialize_firebase
+from urllib.parse import quote
+import admission
+from firebase_service import initialize_firebase, load_sdk
+from circuit_breaker import FIRESTORE_BREAKER
+from profiling import phase
+from metrics import (
+    FIRESTORE_QUERY_SECONDS, TOKENS_FETCHED, TOKEN_QUERIES_COALESCED, USER_INDEX_LOOKUPS, app_label
+)
 
 logger = logging.getLogger(__name__)
 
 # Firestore collection name
 COLLECTION_NAME = "device_tokens"
 
+# Firestore accepts at most 500 writes per batch
+BATCH_WRITE_LIMIT = 500
+
+# Values Firestore accepts in one "in" filter
+IN_QUERY_LIMIT = 30
+
+# Per-user index documents: {user_id, apps: {app_id: [token, ...]}, token_count, updated_at},
+# or {user_id, unindexed: true, token_count, updated_at}
+USER_INDEX_COLLECTION = "user_tokens"
+
+# Answer user lookups from the index documents (false: always query device_tokens)
+USER_TOKEN_INDEX = os.getenv('USER_TOKEN_INDEX', 'true').lower() == 'true'
+
+# Users with more tokens are marked unindexed and looked up with a query,
+# which keeps index documents far below Firestore's 1 MiB limit
+USER_INDEX_MAX_TOKENS = int(os.getenv('USER_INDEX_MAX_TOKENS', '1000'))
+
+# Longest document id Firestore accepts, in UTF-8 bytes
+MAX_DOCUMENT_ID_BYTES = 1500
+
+# Per-RPC deadline for Firestore reads and writes, in seconds
+FIRESTORE_TIMEOUT = float(os.getenv('FIRESTORE_TIMEOUT', '10'))
+
+# Share one in-flight Firestore query between concurrent callers asking for the same audience
+TOKEN_QUERY_COALESCING = os.getenv('TOKEN_QUERY_COALESCING', 'true').lower() == 'true'
+
+
+class _InFlightQuery:
+    """A query being run by one caller that others with the same key wait on."""
+    
+    __slots__ = ('done', 'result', 'error', 'read_limit')
+    
+    def __init__(self, read_limit: Optional[int] = None):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.read_limit = read_limit
+
+
+_inflight: Dict[Hashable, _InFlightQuery] = {}
+_inflight_lock = threading.Lock()
+_coalescing_stats = {"queries": 0, "coalesced": 0, "documents_saved": 0}
+
+
+_db = None
+_db_lock = threading.Lock()
+_ready = threading.Event()
+
 
 def get_firestore_client():
-    """Get Firestore client instance."""
-    initialize_firebase()
-    return firestore.client()
+    """
+    Get the process-wide Firestore client, creating it on first use.
+    
+    The client (and its gRPC channel) is created once per process under a
+    lock and reused by every request thread.
+    """
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                initialize_firebase()
+                from firebase_admin import firestore
+                _db = firestore.client()
+    return _db
+
+
+def set_firestore_client(client) -> None:
+    """Replace the cached Firestore client (e.g. with a fake in tests and benchmarks)."""
+    global _db
+    with _db_lock:
+        _db = client
+    if client is None:
+        _ready.clear()
+
+
+def preimport_sdk() -> None:
+    """Import the Firebase Admin and Firestore client libraries without initializing anything."""
+    load_sdk()
+    from firebase_admin import firestore  # noqa: F401
+
+
+def warm_up() -> bool:
+    """
+    Import the SDK, initialize Firebase and open the Firestore channel ahead of traffic.
+    
+    Issues one cheap read so credential token fetch, DNS and the gRPC/TLS
+    handshake happen now rather than in the first real request. Called from
+    the gunicorn post_fork hook in each worker.
+    
+    Returns:
+        True if the service is ready to serve sends
+    """
+    try:
+        preimport_sdk()
+        db = get_firestore_client()
+        with FIRESTORE_BREAKER.guard():
+            db.collection(COLLECTION_NAME).limit(1).get(timeout=FIRESTORE_TIMEOUT)
+        _ready.set()
+        logger.info("Firestore client warmed up")
+        return True
+    except Exception as e:
+        logger.error(f"Firestore warm-up failed: {str(e)}")
+        return False
+
+
+def start_warm_up(background: bool = True):
+    """
+    Run warm_up(), by default on a daemon thread so the caller is not blocked.
+    
+    In the background the worker can answer /api/health immediately while the
+    SDK imports and connects; /api/ready reports 503 until it is done.
+    
+    Returns:
+        The warm-up thread, or warm_up()'s result when run in the foreground
+    """
+    if not background:
+        return warm_up()
+    thread = threading.Thread(target=warm_up, name="firebase-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_ready() -> bool:
+    """Whether warm-up has completed in this process."""
+    return _ready.is_set()
+
+
+def _stream_tokens(
+    query,
+    operation: str,
+    app_id: Optional[str] = None,
+    track_latency: bool = True,
+    limit: Optional[int] = None
+) -> List[str]:
+    """
+    Run a token query through the Firestore breaker and collect the token values.
+    
+    Args:
+        query: Firestore query or collection reference
+        operation: Metrics label naming the caller, e.g. "tokens_for_app"
+        app_id: App the query is scoped to, if any (metrics label)
+        track_latency: Count slow queries against the breaker
+        limit: Stop reading after limit + 1 tokens, enough to tell the
+            audience is over the limit
+    """
+    if limit is not None:
+        query = query.limit(limit + 1)
+    labels = {"operation": operation, "app_id": app_label(app_id)}
+    with FIRESTORE_QUERY_SECONDS.labels(**labels).time():
+        with FIRESTORE_BREAKER.guard(track_latency=track_latency):
+            tokens = [doc.to_dict()["token"] for doc in query.stream(timeout=FIRESTORE_TIMEOUT)]
+    TOKENS_FETCHED.labels(**labels).inc(len(tokens))
+    return tokens
+
+
+def _check_limit(tokens: List[str], limit: Optional[int]) -> None:
+    """Reject an audience read with a limit that turned out to be over it."""
+    if limit is not None and len(tokens) > limit:
+        raise admission.TOKENS.reject()
+
+
+def _coalesce(key: Hashable, query_fn: Callable[[], List[str]], read_limit: Optional[int] = None) -> List[str]:
+    """
+    Run query_fn once for all concurrent callers with the same key.
+    
+    The first caller runs the query; callers arriving while it is in flight
+    wait for it and receive a copy of its result (or its exception). Nothing
+    is cached once the query completes.
+    
+    read_limit is the limit query_fn stops reading at (see _stream_tokens).
+    A caller that needs more than the running query reads gets its result
+    only if it was not cut short, and otherwise runs its own query.
+    """
+    if not TOKEN_QUERY_COALESCING:
+        return query_fn()
+    
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _InFlightQuery(read_limit)
+            _inflight[key] = call
+            _coalescing_stats["queries"] += 1
+        else:
+            _coalescing_stats["coalesced"] += 1
+            TOKEN_QUERIES_COALESCED.inc()
+    
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        cut_short = call.read_limit is not None and len(call.result) > call.read_limit
+        if cut_short and (read_limit is None or read_limit > call.read_limit):
+            return query_fn()
+        with _inflight_lock:
+            _coalescing_stats["documents_saved"] += len(call.result)
+        return list(call.result)
+    
+    try:
+        call.result = query_fn()
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        call.done.set()
+
+
+def get_coalescing_stats() -> Dict[str, int]:
+    """
+    Counters for query coalescing.
+    
+    Returns:
+        Dictionary with queries (Firestore queries run), coalesced (callers that
+        shared another caller's query instead of running their own) and
+        documents_saved (document reads those callers avoided)
+    """
+    with _inflight_lock:
+        return dict(_coalescing_stats, in_flight=len(_inflight))
 
 
 def save_token(
@@ -59,20 +292,16 @@ def save_token(
         if platform:
             token_data["platform"] = platform
         
-        # Check if token already exists
         doc_ref = db.collection(COLLECTION_NAME).document(token)
-        doc = doc_ref.get()
         
-        if doc.exists:
-            # Update existing token
-            token_data["created_at"] = doc.to_dict().get("created_at", now)
-            doc_ref.update(token_data)
-            logger.info(f"Updated token for app_id: {app_id}, user_id: {user_id}")
-        else:
-            # Create new token
-            token_data["created_at"] = now
-            doc_ref.set(token_data)
+        # The token and its users' index documents are written together
+        with FIRESTORE_BREAKER.guard():
+            created = _transactional(_save_in_transaction)(db.transaction(), db, doc_ref, token_data, now)
+        
+        if created:
             logger.info(f"Registered new token for app_id: {app_id}, user_id: {user_id}")
+        else:
+            logger.info(f"Updated token for app_id: {app_id}, user_id: {user_id}")
         
         return token_data
         
@@ -83,7 +312,8 @@ def save_token(
 
 def get_tokens_for_app(
     app_id: str,
-    user_id: Optional[str] = None
+    user_id: Optional[str] = None,
+    limit: Optional[int] = None
 ) -> List[str]:
     """
     Get all device tokens registered for a specific app.
@@ -91,9 +321,14 @@ def get_tokens_for_app(
     Args:
         app_id: App identifier
         user_id: Optional user identifier to filter by
+        limit: Stop reading and reject once the app has more than this many
+            tokens (see admission.TokenBudget.room)
         
     Returns:
         List of unique FCM device tokens (duplicates removed)
+        
+    Raises:
+        AdmissionRejected: If the app has more than limit tokens
     """
     try:
         db = get_firestore_client()
@@ -102,8 +337,17 @@ def get_tokens_for_app(
         if user_id:
             query = query.where("user_id", "==", user_id)
         
-        docs = query.stream()
-        tokens = [doc.to_dict()["token"] for doc in docs]
+        # Concurrent callers share one query whatever their limits, so a limited
+        # one reads up to the whole tokens-in-flight cap and its own limit is
+        # applied to the shared result
+        read_limit = None if limit is None else max(limit, admission.TOKENS.limit)
+        with phase("token_query"):
+            tokens = _coalesce(
+                ("app", app_id, user_id),
+                lambda: _stream_tokens(query, "tokens_for_app", app_id, limit=read_limit),
+                read_limit=read_limit
+            )
+        _check_limit(tokens, limit)
         
         # Remove duplicates (in case same token was registered multiple times)
         unique_tokens = list(set(tokens))
@@ -137,14 +381,8 @@ def get_tokens_for_user(
         List of unique FCM device tokens (duplicates removed)
     """
     try:
-        db = get_firestore_client()
-        query = db.collection(COLLECTION_NAME).where("user_id", "==", user_id)
-        
-        if app_id:
-            query = query.where("app_id", "==", app_id)
-        
-        docs = query.stream()
-        tokens = [doc.to_dict()["token"] for doc in docs]
+        with phase("token_query"):
+            tokens = _coalesce(("user", user_id, app_id), lambda: _user_tokens(user_id, app_id))
         
         # Remove duplicates
         unique_tokens = list(set(tokens))
@@ -163,17 +401,115 @@ def get_tokens_for_user(
         raise
 
 
-def get_all_tokens() -> List[str]:
+def _user_tokens(user_id: str, app_id: Optional[str]) -> List[str]:
+    """A user's tokens from their index document, or from a query if the document cannot answer."""
+    if USER_TOKEN_INDEX:
+        tokens = lookup_user_index(user_id, app_id)
+        if tokens is not None:
+            return tokens
+    return query_user_tokens(user_id, app_id)
+
+
+def query_user_tokens(user_id: str, app_id: Optional[str] = None) -> List[str]:
+    """A user's tokens from a device_tokens query (one read per token, at least one)."""
+    query = get_firestore_client().collection(COLLECTION_NAME).where("user_id", "==", user_id)
+    if app_id:
+        query = query.where("app_id", "==", app_id)
+    return _stream_tokens(query, "tokens_for_user", app_id)
+
+
+def lookup_user_index(user_id: str, app_id: Optional[str] = None) -> Optional[List[str]]:
+    """
+    A user's tokens from their index document (one read).
+    
+    Args:
+        user_id: User identifier
+        app_id: Optional app identifier to filter by
+        
+    Returns:
+        The tokens, or None if the user has no index document or is marked unindexed
+    """
+    labels = {"operation": "user_index", "app_id": app_label(app_id)}
+    ref = _user_index_ref(get_firestore_client(), user_id)
+    with FIRESTORE_QUERY_SECONDS.labels(**labels).time():
+        with FIRESTORE_BREAKER.guard():
+            doc = ref.get(timeout=FIRESTORE_TIMEOUT)
+    
+    index = doc.to_dict() if doc.exists else None
+    if index is None or index.get("unindexed"):
+        USER_INDEX_LOOKUPS.labels(result="missing" if index is None else "unindexed").inc()
+        return None
+    
+    apps = index.get("apps") or {}
+    if app_id:
+        tokens = list(apps.get(app_id, []))
+    else:
+        tokens = [token for app_tokens in apps.values() for token in app_tokens]
+    USER_INDEX_LOOKUPS.labels(result="hit").inc()
+    TOKENS_FETCHED.labels(**labels).inc(len(tokens))
+    return tokens
+
+
+def get_tokens_for_users(user_ids: List[str], app_id: str) -> Dict[str, List[str]]:
+    """
+    Get the device tokens of many users of one app, IN_QUERY_LIMIT users per query.
+
+    Args:
+        user_ids: User identifiers
+        app_id: App identifier
+
+    Returns:
+        Dictionary of user_id -> unique tokens, for users with any
+    """
+    try:
+        db = get_firestore_client()
+        collection = db.collection(COLLECTION_NAME)
+        unique_ids = list(dict.fromkeys(user_ids))
+        labels = {"operation": "tokens_for_users", "app_id": app_label(app_id)}
+        found: Dict[str, set] = {}
+        read = 0
+        with phase("token_query"), FIRESTORE_QUERY_SECONDS.labels(**labels).time():
+            with FIRESTORE_BREAKER.guard():
+                for start in range(0, len(unique_ids), IN_QUERY_LIMIT):
+                    query = (
+                        collection.where("app_id", "==", app_id)
+                        .where("user_id", "in", unique_ids[start:start + IN_QUERY_LIMIT])
+                        .select(["token", "user_id"])
+                    )
+                    for doc in query.stream(timeout=FIRESTORE_TIMEOUT):
+                        data = doc.to_dict()
+                        found.setdefault(data["user_id"], set()).add(data["token"])
+                        read += 1
+        TOKENS_FETCHED.labels(**labels).inc(read)
+        logger.info(f"Found {read} tokens for {len(found)} of {len(unique_ids)} users of app_id: {app_id}")
+        return {user_id: list(tokens) for user_id, tokens in found.items()}
+
+    except Exception as e:
+        logger.error(f"Failed to get tokens for users: {str(e)}")
+        raise
+
+
+def get_all_tokens(limit: Optional[int] = None) -> List[str]:
     """
     Get all registered device tokens (for broadcast).
     
+    Args:
+        limit: Stop reading and reject once there are more than this many
+            tokens (see admission.TokenBudget.room)
+    
     Returns:
         List of all FCM device tokens
+        
+    Raises:
+        AdmissionRejected: If there are more than limit tokens
     """
     try:
         db = get_firestore_client()
-        docs = db.collection(COLLECTION_NAME).stream()
-        tokens = [doc.to_dict()["token"] for doc in docs]
+        # A full scan legitimately takes longer as the collection grows, so only
+        # failures (not duration) count against the breaker here
+        with phase("token_query"):
+            tokens = _stream_tokens(db.collection(COLLECTION_NAME), "all_tokens", track_latency=False, limit=limit)
+        _check_limit(tokens, limit)
         
         logger.info(f"Found {len(tokens)} total tokens")
         return tokens
@@ -183,6 +519,59 @@ def get_all_tokens() -> List[str]:
         raise
 
 
+def get_token_page(after: Optional[str] = None, limit: int = 500) -> List[Tuple[str, str]]:
+    """
+    Get one page of all registered tokens in document id order.
+    
+    Paging by document id gives a stable cursor: a broadcast can stop after
+    any page and continue later from the last document id it processed.
+    
+    Args:
+        after: Document id to continue after (None starts from the beginning)
+        limit: Maximum tokens in the page
+        
+    Returns:
+        List of (document id, token) pairs, empty once the collection is exhausted
+    """
+    db = get_firestore_client()
+    query = db.collection(COLLECTION_NAME).order_by("__name__").limit(limit)
+    if after is not None:
+        query = query.start_after({"__name__": after})
+    
+    labels = {"operation": "token_page", "app_id": app_label(None)}
+    with phase("token_query"):
+        with FIRESTORE_QUERY_SECONDS.labels(**labels).time():
+            with FIRESTORE_BREAKER.guard():
+                page = [(doc.id, doc.to_dict()["token"]) for doc in query.stream(timeout=FIRESTORE_TIMEOUT)]
+    TOKENS_FETCHED.labels(**labels).inc(len(page))
+    return page
+
+
+def get_token_apps(tokens: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Look up the app each token is registered for.
+
+    Args:
+        tokens: FCM device tokens (document ids)
+
+    Returns:
+        Dictionary of token -> app_id for the tokens that are registered
+    """
+    if not tokens:
+        return {}
+
+    db = get_firestore_client()
+    collection = db.collection(COLLECTION_NAME)
+    refs = [collection.document(token) for token in tokens]
+
+    labels = {"operation": "token_apps", "app_id": app_label(None)}
+    with phase("token_query"):
+        with FIRESTORE_QUERY_SECONDS.labels(**labels).time():
+            with FIRESTORE_BREAKER.guard():
+                docs = db.get_all(refs, field_paths=["app_id"], timeout=FIRESTORE_TIMEOUT)
+                return {doc.id: doc.to_dict().get("app_id") for doc in docs if doc.exists}
+
+
 def delete_token(token: str) -> bool:
     """
     Delete a device token from Firestore.
@@ -196,10 +585,11 @@ def delete_token(token: str) -> bool:
     try:
         db = get_firestore_client()
         doc_ref = db.collection(COLLECTION_NAME).document(token)
-        doc = doc_ref.get()
         
-        if doc.exists:
-            doc_ref.delete()
+        with FIRESTORE_BREAKER.guard():
+            deleted = _transactional(_delete_in_transaction)(db.transaction(), db, doc_ref)
+        
+        if deleted:
             logger.info(f"Deleted token: {token[:20]}...")
             return True
         else:
@@ -224,7 +614,7 @@ def get_token_info(token: str) -> Optional[Dict[str, Any]]:
     try:
         db = get_firestore_client()
         doc_ref = db.collection(COLLECTION_NAME).document(token)
-        doc = doc_ref.get()
+        doc = FIRESTORE_BREAKER.call(doc_ref.get, timeout=FIRESTORE_TIMEOUT)
         
         if doc.exists:
             return doc.to_dict()
@@ -246,8 +636,230 @@ def update_token_activity(token: str) -> None:
     try:
         db = get_firestore_client()
         doc_ref = db.collection(COLLECTION_NAME).document(token)
-        doc_ref.update({"last_active": datetime.utcnow()})
+        FIRESTORE_BREAKER.call(doc_ref.update, {"last_active": datetime.utcnow()}, timeout=FIRESTORE_TIMEOUT)
         
     except Exception as e:
         logger.warning(f"Failed to update token activity: {str(e)}")
 
+
+
+def valid_document_id(value: str) -> bool:
+    """Whether value can be used as a Firestore document id (tokens are stored under their own value)."""
+    return (
+        bool(value) and "/" not in value and value not in (".", "..")
+        and not (value.startswith("__") and value.endswith("__"))
+        and len(value.encode("utf-8")) <= MAX_DOCUMENT_ID_BYTES
+    )
+
+
+def record_token_activity(last_active: Dict[str, datetime]) -> int:
+    """
+    Set last_active on many tokens with batched writes.
+    
+    Writes are sent without reading first. A batch that fails because one of
+    its tokens has been deleted is retried with only the tokens that still
+    exist, so unregistered tokens are never recreated. Tokens that cannot be
+    document ids are skipped: they cannot be registered, and one of them must
+    not fail the whole batch.
+    
+    Args:
+        last_active: Token -> time it was last active (naive UTC)
+        
+    Returns:
+        Number of tokens updated
+    """
+    from google.api_core import exceptions
+    
+    db = get_firestore_client()
+    collection = db.collection(COLLECTION_NAME)
+    tokens = [token for token in last_active if valid_document_id(token)]
+    if len(tokens) < len(last_active):
+        logger.warning(f"Skipped last_active for {len(last_active) - len(tokens)} token(s) that are not valid document ids")
+    updated = 0
+    
+    for start in range(0, len(tokens), BATCH_WRITE_LIMIT):
+        chunk = tokens[start:start + BATCH_WRITE_LIMIT]
+        refs = [collection.document(token) for token in chunk]
+        with FIRESTORE_BREAKER.guard():
+            batch = db.batch()
+            for token, ref in zip(chunk, refs):
+                batch.update(ref, {"last_active": last_active[token]})
+            try:
+                batch.commit(timeout=FIRESTORE_TIMEOUT)
+                updated += len(chunk)
+                continue
+            except exceptions.NotFound:
+                pass
+        
+        with FIRESTORE_BREAKER.guard():
+            docs = db.get_all(refs, field_paths=["app_id"], timeout=FIRESTORE_TIMEOUT)
+            existing = [doc.id for doc in docs if doc.exists]
+            if existing:
+                batch = db.batch()
+                for token in existing:
+                    batch.update(collection.document(token), {"last_active": last_active[token]})
+                batch.commit(timeout=FIRESTORE_TIMEOUT)
+        updated += len(existing)
+    
+    return updated
+
+
+def rebuild_user_index(user_id: str) -> int:
+    """
+    Rebuild a user's index document from their token documents, in a transaction.
+    
+    Used to backfill the index and to repair it; see rebuild_user_index.py.
+    
+    Args:
+        user_id: User identifier
+        
+    Returns:
+        Number of tokens the user has
+    """
+    db = get_firestore_client()
+    
+    def rebuild(transaction) -> int:
+        ref = _user_index_ref(db, user_id)
+        # Read so that a save or delete for this user committed meanwhile aborts and retries the rebuild
+        ref.get(transaction=transaction, timeout=FIRESTORE_TIMEOUT)
+        apps = _query_user_apps(transaction, db, user_id)
+        transaction.set(ref, _index_document(user_id, apps))
+        return sum(len(tokens) for tokens in apps.values())
+    
+    with FIRESTORE_BREAKER.guard(track_latency=False):
+        return _transactional(rebuild)(db.transaction())
+
+
+def _transactional(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """fn wrapped to run (and be retried on contention) in a Firestore transaction."""
+    from google.cloud.firestore_v1 import transactional
+    return transactional(fn)
+
+
+def _save_in_transaction(transaction, db, doc_ref, token_data: Dict[str, Any], now: datetime) -> bool:
+    """
+    Write a token and move it between index documents if its user or app changed.
+    
+    Returns:
+        True if the token is new
+    """
+    doc = doc_ref.get(transaction=transaction, timeout=FIRESTORE_TIMEOUT)
+    previous = doc.to_dict() if doc.exists else None
+    token = doc_ref.id
+    old_user, old_app = (previous.get("user_id"), previous.get("app_id")) if previous else (None, None)
+    # update() keeps a user_id the new registration does not repeat
+    new_user, new_app = token_data.get("user_id") or old_user, token_data["app_id"]
+    
+    # Every read comes before the first write
+    indexes = {}
+    if new_user:
+        indexes[new_user] = _load_user_index(transaction, db, new_user, build=True)
+    if old_user and old_user not in indexes:
+        indexes[old_user] = _load_user_index(transaction, db, old_user, build=False)
+    changed = {user for user, (apps, built) in indexes.items() if built}
+    
+    old_apps = indexes.get(old_user, (None, False))[0]
+    if old_apps is not None and (old_user, old_app) != (new_user, new_app):
+        if _index_remove(old_apps, old_app, token):
+            changed.add(old_user)
+    new_apps = indexes.get(new_user, (None, False))[0]
+    if new_apps is not None and _index_add(new_apps, new_app, token):
+        changed.add(new_user)
+    
+    if previous:
+        token_data["created_at"] = previous.get("created_at", now)
+        transaction.update(doc_ref, token_data)
+    else:
+        token_data["created_at"] = now
+        transaction.set(doc_ref, token_data)
+    for user in changed:
+        transaction.set(_user_index_ref(db, user), _index_document(user, indexes[user][0]))
+    return previous is None
+
+
+def _delete_in_transaction(transaction, db, doc_ref) -> bool:
+    """
+    Delete a token and remove it from its user's index document.
+    
+    Returns:
+        True if the token existed
+    """
+    doc = doc_ref.get(transaction=transaction, timeout=FIRESTORE_TIMEOUT)
+    if not doc.exists:
+        return False
+    data = doc.to_dict()
+    user_id = data.get("user_id")
+    apps = None
+    if user_id:
+        # A missing index is not built here: the lookup falls back to a query until it is
+        apps, _ = _load_user_index(transaction, db, user_id, build=False)
+    
+    transaction.delete(doc_ref)
+    if apps is not None and _index_remove(apps, data.get("app_id"), doc_ref.id):
+        transaction.set(_user_index_ref(db, user_id), _index_document(user_id, apps))
+    return True
+
+
+def _load_user_index(transaction, db, user_id: str, build: bool) -> Tuple[Optional[Dict[str, List[str]]], bool]:
+    """
+    Read a user's index document in a transaction.
+    
+    Args:
+        build: Build a missing document from a query of the user's tokens
+        
+    Returns:
+        (tokens by app, or None if the document cannot be edited, whether it was built)
+    """
+    doc = _user_index_ref(db, user_id).get(transaction=transaction, timeout=FIRESTORE_TIMEOUT)
+    if doc.exists:
+        index = doc.to_dict()
+        return (None if index.get("unindexed") else index.get("apps") or {}), False
+    if not build:
+        return None, False
+    return _query_user_apps(transaction, db, user_id), True
+
+
+def _query_user_apps(transaction, db, user_id: str) -> Dict[str, List[str]]:
+    """A user's tokens by app, from a device_tokens query run in a transaction."""
+    query = db.collection(COLLECTION_NAME).where("user_id", "==", user_id).select(["token", "app_id"])
+    apps: Dict[str, List[str]] = {}
+    for doc in query.stream(transaction=transaction, timeout=FIRESTORE_TIMEOUT):
+        data = doc.to_dict()
+        _index_add(apps, data.get("app_id"), data["token"])
+    return apps
+
+
+def _index_document(user_id: str, apps: Dict[str, List[str]]) -> Dict[str, Any]:
+    from google.cloud.firestore_v1 import transforms
+    
+    token_count = sum(len(tokens) for tokens in apps.values())
+    index = {"user_id": user_id, "token_count": token_count, "updated_at": transforms.SERVER_TIMESTAMP}
+    if token_count > USER_INDEX_MAX_TOKENS or "" in apps:
+        # Too many tokens to list, or legacy tokens without an app_id (not a valid
+        # map key): looked up by query until a rebuild can list them
+        index["unindexed"] = True
+    else:
+        index["apps"] = apps
+    return index
+
+
+def _index_add(apps: Dict[str, List[str]], app_id: Optional[str], token: str) -> bool:
+    tokens = apps.setdefault(app_id or "", [])
+    if token in tokens:
+        return False
+    tokens.append(token)
+    return True
+
+
+def _index_remove(apps: Dict[str, List[str]], app_id: Optional[str], token: str) -> bool:
+    tokens = apps.get(app_id or "")
+    if not tokens or token not in tokens:
+        return False
+    tokens.remove(token)
+    if not tokens:
+        del apps[app_id or ""]
+    return True
+
+
+def _user_index_ref(db, user_id: str):
+    return db.collection(USER_INDEX_COLLECTION).document(quote(user_id, safe=''))